@@ -0,0 +1,133 @@
+"""
+Client for the randomness beacon of the API server.
+
+Every response carries the records and producer states that link the returned block hashes
+to a block the client trusts (i.e. the on-chain tip or a block it observed on chain),
+and the client verifies them (in one batch for ranges) before handing them out.
+"""
+
+from typing import Callable, List, Optional, Tuple
+
+import fire
+import numpy as np
+import requests
+
+from steak_protocol.utils.beacon import (
+    BeaconVerificationError,
+    TrustedBlock,
+    block_hash,
+    record_from_json,
+    verify_records,
+)
+from steak_protocol.utils.history import BLOCK_DTYPE
+
+# slot number, block number and block hash of a beacon value
+BeaconValue = Tuple[int, int, bytes]
+
+
+def verified_values(
+    response: dict, trusted_block: TrustedBlock, from_slot: int, to_slot: int
+) -> List[BeaconValue]:
+    """
+    Verify a beacon response against the trusted block and return its values.
+    The values have to cover the slot range: the first one is valid at from_slot
+    and the record after the last one (if it is not the anchor) starts after to_slot.
+    """
+    records = np.array(
+        [record_from_json(r) for r in response["records"]], dtype=BLOCK_DTYPE
+    )
+    producer_states = [bytes.fromhex(p) for p in response["producer_states"]]
+    verify_records(records, producer_states, trusted_block)
+    num_values = response["num_values"]
+    if not 1 <= num_values <= len(records):
+        raise BeaconVerificationError(
+            trusted_block.block_number, "no values in the response"
+        )
+    first = records[0]
+    if int(first["slot_number"]) > from_slot:
+        raise BeaconVerificationError(
+            int(first["block_number"]), f"value not valid at slot {from_slot}"
+        )
+    if num_values < len(records) and int(records[num_values]["slot_number"]) <= to_slot:
+        raise BeaconVerificationError(
+            int(records[num_values]["block_number"]),
+            f"values do not cover slot {to_slot}",
+        )
+    return [
+        (int(r["slot_number"]), int(r["block_number"]), block_hash(r))
+        for r in records[:num_values]
+    ]
+
+
+class BeaconClient:
+    def __init__(
+        self,
+        trusted_block: TrustedBlock,
+        url: str = "http://127.0.0.1:8000",
+        get: Optional[Callable[[str, dict], dict]] = None,
+    ):
+        """
+        All values are verified backward from the trusted block, so only values up to it can be queried
+        """
+        self.trusted_block = trusted_block
+        self.url = url.rstrip("/")
+        self._get = get if get is not None else self._http_get
+
+    def _http_get(self, path: str, params: dict) -> dict:
+        response = requests.get(self.url + path, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def value_at(self, slot: int) -> BeaconValue:
+        """
+        The verified block hash valid at the given slot
+        """
+        (value,) = verified_values(
+            self._get(
+                f"/beacon/slot/{slot}",
+                {"anchor_block": self.trusted_block.block_number},
+            ),
+            self.trusted_block,
+            slot,
+            slot,
+        )
+        return value
+
+    def values_between(self, from_slot: int, to_slot: int) -> List[BeaconValue]:
+        """
+        All verified block hashes valid in the slot range
+        """
+        return verified_values(
+            self._get(
+                "/beacon/range",
+                {
+                    "from_slot": from_slot,
+                    "to_slot": to_slot,
+                    "anchor_block": self.trusted_block.block_number,
+                },
+            ),
+            self.trusted_block,
+            from_slot,
+            to_slot,
+        )
+
+
+def main(
+    slot: int,
+    # the trusted block, i.e. the current on-chain tip of the stake chain
+    anchor_block_number: int,
+    anchor_block_hash: str,
+    anchor_producer_state_hash: str,
+    url: str = "http://127.0.0.1:8000",
+):
+    trusted_block = TrustedBlock(
+        anchor_block_number,
+        bytes.fromhex(anchor_block_hash),
+        bytes.fromhex(anchor_producer_state_hash),
+    )
+    slot_number, block_number, value = BeaconClient(trusted_block, url).value_at(slot)
+    print(f"Block {block_number} (slot {slot_number}): {value.hex()}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,280 @@
+"""
+Follows the chain and keeps the state index up to date.
+
+On every new chain tip the follower queries the stake chain, stake holder and request utxos once,
+decodes them and replaces the snapshot in the index. New blocks are also added to the block history.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional
+
+import fire
+import pycardano
+from opshin.builder import apply_parameters
+from opshin.ledger.api_v2 import SomeOutputDatum
+from opshin.prelude import Token
+from opshin.std.builtins import sha2_256
+from pycardano import DeserializeException, UTxO, script_hash
+
+from steak_protocol.api.index import (
+    Holder,
+    Pool,
+    Request,
+    Tip,
+    current_tip,
+    open_state_index,
+)
+from steak_protocol.offchain.util import (
+    STAKE_CHAIN_AUTH_NFT,
+    VERSION_1,
+    ContractVersion,
+    amount_of_token_in_value,
+    find_stakechain_params,
+    token_from_string,
+)
+from steak_protocol.onchain.stakepool.stakepool import PoolState
+from steak_protocol.onchain.stakepool.stakepool_request import (
+    AddStakeRequest,
+    RemoveStakeRequest,
+)
+from steak_protocol.onchain.types import StakeChainV2State, StakeHolderState
+from steak_protocol.utils import context
+from steak_protocol.utils.backends import address_pattern
+from steak_protocol.utils.block_index import (
+    StakeChainState,
+    add_state,
+    chain_key,
+    db,
+    stakechain_state_from_cbor,
+)
+from steak_protocol.utils.clock import Clock, system_clock
+from steak_protocol.utils.contracts import get_contract
+from steak_protocol.utils.from_script_context import from_address
+from steak_protocol.utils.history import History, sync_from_index
+
+
+@dataclass
+class Deployment:
+    """
+    Addresses and tokens of the followed protocol instance
+    """
+
+    stakechain_address: pycardano.Address
+    stakeholder_address: pycardano.Address
+    request_address: pycardano.Address
+    stakechain_auth_nft: Token
+    stakeholder_auth_nft: Token
+    stakepool_policy_id: bytes
+
+    @classmethod
+    def from_contracts(
+        cls,
+        stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+        stakechain_version: ContractVersion = VERSION_1,
+    ) -> "Deployment":
+        _, _, stakechain_address = get_contract("stakechain_" + stakechain_version)
+        _, _, stakeholder_address = get_contract("stakeholder")
+        _, stakepool_policy_id, _ = get_contract("stakepool")
+        _, _, request_address = get_contract("stakepool_request")
+        stakechain_auth_nft = token_from_string(stakechain_auth_nft)
+        stakeholder_auth_nft_script, _, _ = get_contract("stakeholder_auth_nft")
+        stakeholder_auth_nft = Token(
+            script_hash(
+                apply_parameters(stakeholder_auth_nft_script, stakechain_auth_nft)
+            ).payload,
+            stakechain_auth_nft.token_name,
+        )
+        return cls(
+            stakechain_address,
+            stakeholder_address,
+            request_address,
+            stakechain_auth_nft,
+            stakeholder_auth_nft,
+            stakepool_policy_id.payload,
+        )
+
+
+def find_stakechain_utxo(
+    utxos: List[UTxO], deployment: Deployment
+) -> Optional[tuple[UTxO, StakeChainState]]:
+    for u in utxos:
+        if (
+            amount_of_token_in_value(deployment.stakechain_auth_nft, u.output.amount)
+            == 0
+        ):
+            continue
+        try:
+            return u, stakechain_state_from_cbor(u.output.datum.cbor)
+        except (DeserializeException, AttributeError):
+            continue
+    return None
+
+
+def pool_rows(
+    utxos: List[UTxO], deployment: Deployment, stake_coin: Token
+) -> List[dict]:
+    rows = []
+    for u in utxos:
+        if (
+            amount_of_token_in_value(deployment.stakeholder_auth_nft, u.output.amount)
+            == 0
+        ):
+            continue
+        try:
+            stakeholder_state = StakeHolderState.from_cbor(u.output.datum.cbor)
+            if not isinstance(stakeholder_state.aux, SomeOutputDatum):
+                continue
+            pool_state = PoolState.from_cbor(stakeholder_state.aux.datum.to_cbor())
+        except (DeserializeException, AttributeError):
+            continue
+        fraction = pool_state.params.guaranteed_reward_fraction
+        rows.append(
+            dict(
+                stakechain_id=stakeholder_state.params.stakechain_id,
+                transaction_id=u.input.transaction_id.payload,
+                output_index=u.input.index,
+                state=u.output.datum.cbor,
+                lp_token_policy_id=deployment.stakepool_policy_id,
+                lp_token_name=sha2_256(pool_state.params.initial_utxo.to_cbor()),
+                lp_supply=pool_state.all_lp_tokens,
+                stake=amount_of_token_in_value(stake_coin, u.output.amount),
+                guaranteed_reward_numerator=fraction.numerator,
+                guaranteed_reward_denominator=fraction.denominator,
+            )
+        )
+    return rows
+
+
+def request_rows(utxos: List[UTxO], stake_coin: Token) -> List[dict]:
+    rows = []
+    for u in utxos:
+        try:
+            request = AddStakeRequest.from_cbor(u.output.datum.cbor)
+            kind, amount = "add", amount_of_token_in_value(stake_coin, u.output.amount)
+        except (DeserializeException, AttributeError):
+            try:
+                request = RemoveStakeRequest.from_cbor(u.output.datum.cbor)
+            except (DeserializeException, AttributeError):
+                continue
+            kind = "remove"
+            amount = amount_of_token_in_value(request.req_token, u.output.amount)
+        rows.append(
+            dict(
+                transaction_id=u.input.transaction_id.payload,
+                output_index=u.input.index,
+                kind=kind,
+                lp_token_policy_id=request.req_token.policy_id,
+                lp_token_name=request.req_token.token_name,
+                amount=amount,
+                min_amount=request.req_min_amount,
+                beneficiary=str(from_address(request.beneficiary)),
+            )
+        )
+    return rows
+
+
+def follow_once(
+    context: pycardano.ChainContext, deployment: Deployment, force: bool = False
+) -> bool:
+    """
+    Replace the snapshot if the chain moved since the last call (or if forced).
+    Returns whether the snapshot was replaced.
+    """
+    chain_slot = context.last_block_slot
+    tip = current_tip()
+    if tip is not None and tip.chain_slot == chain_slot and not force:
+        return False
+
+    stakechain_utxos = context.utxos(deployment.stakechain_address)
+    found = find_stakechain_utxo(stakechain_utxos, deployment)
+    assert found is not None, "No stake chain state found"
+    stakechain_utxo, stakechain_state = found
+    if isinstance(stakechain_state, StakeChainV2State):
+        # V2 states only carry the hash of the params stored next to them
+        _, params = find_stakechain_params(
+            stakechain_utxos, stakechain_state.params_hash
+        )
+    else:
+        params = stakechain_state.params
+    stake_coin = params.stake_coin
+    pools = pool_rows(
+        context.utxos(deployment.stakeholder_address), deployment, stake_coin
+    )
+    if getattr(context, "supports_address_patterns", False):
+        request_utxos = context.utxos_by_pattern(
+            address_pattern(deployment.request_address.payment_part)
+        )
+    else:
+        request_utxos = context.utxos(deployment.request_address)
+    requests = request_rows(request_utxos, stake_coin)
+
+    holder_state = stakechain_state.holder_state
+    with db.atomic():
+        add_state(
+            stakechain_state,
+            stakechain_utxo.input.transaction_id.payload,
+            stakechain_utxo.input.index,
+            chain_key(deployment.stakechain_auth_nft),
+        )
+        for table in (Holder, Pool, Request):
+            table.delete().execute()
+        Holder.insert_many(
+            [
+                dict(position=i, stakechain_id=holder_id, weight=weight)
+                for i, (holder_id, weight) in enumerate(
+                    zip(
+                        holder_state.stake_holder_ids,
+                        holder_state.stake_holder_weights,
+                    )
+                )
+            ]
+        ).execute()
+        if pools:
+            Pool.insert_many(pools).execute()
+        if requests:
+            Request.insert_many(requests).execute()
+        Tip.insert(
+            id=0,
+            chain_slot=chain_slot,
+            transaction_id=stakechain_utxo.input.transaction_id.payload,
+            output_index=stakechain_utxo.input.index,
+            state=stakechain_utxo.output.datum.cbor,
+            block_number=stakechain_state.chain_state.block_number,
+            block_hash=stakechain_state.chain_state.block_hash,
+            slot_number=stakechain_state.chain_state.slot_number,
+            reserve=amount_of_token_in_value(stake_coin, stakechain_utxo.output.amount),
+        ).on_conflict_replace().execute()
+    return True
+
+
+def main(
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+    stakechain_version: ContractVersion = VERSION_1,
+    index_path: Optional[str] = None,
+    history_path: Optional[str] = None,
+    poll_interval: float = 10,
+    clock: Clock = system_clock,
+):
+    """
+    Keep the state index at the given path (default: index/stakechain.db) up to date
+    and append new blocks to the history directory if given
+    """
+    open_state_index(index_path)
+    history = History(history_path) if history_path is not None else None
+    deployment = Deployment.from_contracts(stakechain_auth_nft, stakechain_version)
+    while True:
+        try:
+            if follow_once(context, deployment):
+                tip = current_tip()
+                print(f"Block {tip.block_number} at chain slot {tip.chain_slot}")
+                if history is not None:
+                    sync_from_index(history)
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            print(e)
+        clock.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,90 @@
+"""
+The current protocol state as seen by the chain follower.
+
+The follower stores a snapshot of the latest chain tip (stake chain state, holder list, pools
+and open requests) next to the block history of `block_index`. The API server only reads from here,
+so clients never decode states themselves.
+"""
+
+from pathlib import Path
+from typing import Optional, Union
+
+import peewee
+
+from steak_protocol.utils.block_index import BaseModel, db, open_index
+
+
+class Tip(BaseModel):
+    # there is only ever one tip, the latest snapshot
+    id = peewee.IntegerField(primary_key=True, default=0)
+    # cardano slot at which the snapshot was taken
+    chain_slot = peewee.IntegerField()
+    transaction_id = peewee.BlobField()
+    output_index = peewee.IntegerField()
+    state = peewee.BlobField()
+    block_number = peewee.IntegerField()
+    block_hash = peewee.BlobField()
+    slot_number = peewee.IntegerField()
+    # amount of stake coins that remain to be distributed as rewards
+    reserve = peewee.IntegerField()
+
+    def key(self) -> str:
+        """
+        Identifies the snapshot, changes whenever the follower observed a new chain tip
+        """
+        return (
+            f"{self.chain_slot}:{bytes(self.transaction_id).hex()}#{self.output_index}"
+        )
+
+
+class Holder(BaseModel):
+    # position in the holder list of the stake chain
+    position = peewee.IntegerField(primary_key=True)
+    stakechain_id = peewee.BlobField(index=True)
+    weight = peewee.IntegerField()
+
+
+class Pool(BaseModel):
+    stakechain_id = peewee.BlobField(primary_key=True)
+    transaction_id = peewee.BlobField()
+    output_index = peewee.IntegerField()
+    state = peewee.BlobField()
+    lp_token_policy_id = peewee.BlobField()
+    lp_token_name = peewee.BlobField(index=True)
+    lp_supply = peewee.IntegerField()
+    # amount of stake coins held by the pool
+    stake = peewee.IntegerField()
+    guaranteed_reward_numerator = peewee.IntegerField()
+    guaranteed_reward_denominator = peewee.IntegerField()
+
+
+class Request(BaseModel):
+    transaction_id = peewee.BlobField()
+    output_index = peewee.IntegerField()
+    # "add" or "remove"
+    kind = peewee.CharField()
+    lp_token_policy_id = peewee.BlobField()
+    lp_token_name = peewee.BlobField(index=True)
+    # stake coins to add or lp tokens to remove
+    amount = peewee.IntegerField()
+    min_amount = peewee.IntegerField()
+    beneficiary = peewee.CharField()
+
+    class Meta:
+        primary_key = peewee.CompositeKey("transaction_id", "output_index")
+
+
+SNAPSHOT_TABLES = [Tip, Holder, Pool, Request]
+
+
+def open_state_index(path: Union[str, Path, None] = None) -> peewee.SqliteDatabase:
+    """
+    Open (and create if necessary) the block index together with the snapshot tables
+    """
+    open_index(path)
+    db.create_tables(SNAPSHOT_TABLES)
+    return db
+
+
+def current_tip() -> Optional[Tip]:
+    return Tip.get_or_none(Tip.id == 0)
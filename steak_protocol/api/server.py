@@ -0,0 +1,288 @@
+"""
+Read-only HTTP API over the state index.
+
+The index is kept up to date by `steak_protocol.api.follower`. Responses are cached per chain tip:
+the cache key contains the tip of the snapshot, so all requests between two tips are answered from memory.
+"""
+
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple
+
+import fire
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.decorator import cache
+
+from steak_protocol.api.index import (
+    Holder,
+    Pool,
+    Request,
+    Tip,
+    current_tip,
+    open_state_index,
+)
+from steak_protocol.utils.beacon import record_to_json
+from steak_protocol.utils.block_index import Block, block_by_number, latest_block
+from steak_protocol.utils.history import History
+
+# cached responses of old tips expire after this many seconds
+CACHE_EXPIRE = 600
+# maximum number of beacon records returned at once
+MAX_BEACON_RANGE = 1000
+# maximum number of beacon records linking the values to the anchor block
+MAX_BEACON_PROOF = 10_000
+
+
+def tip_key_builder(func, namespace: str = "", *, request=None, **kwargs) -> str:
+    tip = current_tip()
+    tip_key = tip.key() if tip is not None else "none"
+    url = f"{request.url.path}?{request.query_params}" if request is not None else ""
+    return f"{namespace}:{tip_key}:{func.__name__}:{url}"
+
+
+def tip_json(tip: Tip) -> dict:
+    return {
+        "chain_slot": tip.chain_slot,
+        "transaction_id": bytes(tip.transaction_id).hex(),
+        "output_index": tip.output_index,
+        "block_number": tip.block_number,
+        "block_hash": bytes(tip.block_hash).hex(),
+        "slot_number": tip.slot_number,
+        "reserve": tip.reserve,
+        "state": bytes(tip.state).hex(),
+    }
+
+
+def block_json(block: Block) -> dict:
+    return {
+        "block_number": block.block_number,
+        "block_hash": bytes(block.block_hash).hex(),
+        "slot_number": block.slot_number,
+        "producer_state_hash": bytes(block.producer_state_hash).hex(),
+        "producer_message_hash": (
+            bytes(block.producer_message_hash).hex()
+            if block.producer_message_hash is not None
+            else None
+        ),
+        "transaction_id": bytes(block.transaction_id).hex(),
+        "output_index": block.output_index,
+    }
+
+
+def pool_json(pool: Pool) -> dict:
+    return {
+        "stakechain_id": bytes(pool.stakechain_id).hex(),
+        "transaction_id": bytes(pool.transaction_id).hex(),
+        "output_index": pool.output_index,
+        "lp_token": f"{bytes(pool.lp_token_policy_id).hex()}.{bytes(pool.lp_token_name).hex()}",
+        "lp_supply": pool.lp_supply,
+        "stake": pool.stake,
+        "guaranteed_reward_fraction": [
+            pool.guaranteed_reward_numerator,
+            pool.guaranteed_reward_denominator,
+        ],
+        "state": bytes(pool.state).hex(),
+    }
+
+
+def request_json(request: Request) -> dict:
+    return {
+        "transaction_id": bytes(request.transaction_id).hex(),
+        "output_index": request.output_index,
+        "kind": request.kind,
+        "lp_token": f"{bytes(request.lp_token_policy_id).hex()}.{bytes(request.lp_token_name).hex()}",
+        "amount": request.amount,
+        "min_amount": request.min_amount,
+        "beneficiary": request.beneficiary,
+    }
+
+
+def _tip() -> Tip:
+    tip = current_tip()
+    if tip is None:
+        raise HTTPException(503, "The index has not been synced yet")
+    return tip
+
+
+def _from_hex(value: str, name: str) -> bytes:
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        raise HTTPException(400, f"{name} must be hex encoded")
+
+
+def _parse_token(token: str) -> Tuple[bytes, bytes]:
+    parts = token.split(".")
+    if len(parts) != 2:
+        raise HTTPException(400, "Token must be of the form <policy_id>.<token_name>")
+    return _from_hex(parts[0], "Policy id"), _from_hex(parts[1], "Token name")
+
+
+def beacon_json(records, num_values: int) -> dict:
+    """
+    The records together with the producer states that prove them.
+    The first num_values records are the requested values, the remaining records
+    link them to the anchor block requested by the client (the last record).
+    """
+    block_numbers = [int(r["block_number"]) for r in records]
+    producer_states = {
+        block.block_number: bytes(block.producer_state).hex()
+        for block in Block.select(Block.block_number, Block.producer_state).where(
+            Block.block_number.in_(block_numbers)
+        )
+    }
+    missing = [n for n in block_numbers if n not in producer_states]
+    if missing:
+        raise HTTPException(
+            503, f"The index has not been synced up to block {missing[0]} yet"
+        )
+    return {
+        "records": [record_to_json(r) for r in records],
+        "producer_states": [producer_states[n] for n in block_numbers],
+        "num_values": num_values,
+    }
+
+
+def create_app(
+    index_path: Optional[str] = None, history_path: Optional[str] = None
+) -> FastAPI:
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        open_state_index(index_path)
+        FastAPICache.init(
+            InMemoryBackend(),
+            prefix="steak",
+            expire=CACHE_EXPIRE,
+            key_builder=tip_key_builder,
+        )
+        yield
+
+    app = FastAPI(title="Steak Protocol", lifespan=lifespan)
+
+    @app.get("/tip")
+    @cache()
+    def get_tip():
+        return tip_json(_tip())
+
+    @app.get("/blocks/latest")
+    @cache()
+    def get_latest_block():
+        block = latest_block()
+        if block is None:
+            raise HTTPException(404, "No block indexed")
+        return block_json(block)
+
+    @app.get("/blocks/{block_number}")
+    @cache()
+    def get_block(block_number: int):
+        block = block_by_number(block_number)
+        if block is None:
+            raise HTTPException(404, f"Block {block_number} not indexed")
+        return block_json(block)
+
+    @app.get("/holders")
+    @cache()
+    def get_holders():
+        _tip()
+        return [
+            {
+                "position": holder.position,
+                "stakechain_id": bytes(holder.stakechain_id).hex(),
+                "weight": holder.weight,
+            }
+            for holder in Holder.select().order_by(Holder.position)
+        ]
+
+    @app.get("/pools")
+    @cache()
+    def get_pools():
+        _tip()
+        return [pool_json(pool) for pool in Pool.select()]
+
+    @app.get("/pools/{stakechain_id}")
+    @cache()
+    def get_pool(stakechain_id: str):
+        pool = Pool.get_or_none(
+            Pool.stakechain_id == _from_hex(stakechain_id, "Stake chain id")
+        )
+        if pool is None:
+            raise HTTPException(404, f"Pool {stakechain_id} not found")
+        return pool_json(pool)
+
+    @app.get("/requests")
+    @cache()
+    def get_requests(lp_token: Optional[str] = None):
+        _tip()
+        query = Request.select()
+        if lp_token is not None:
+            policy_id, token_name = _parse_token(lp_token)
+            query = query.where(
+                (Request.lp_token_policy_id == policy_id)
+                & (Request.lp_token_name == token_name)
+            )
+        return [request_json(request) for request in query]
+
+    if history_path is not None:
+        beacon = History(history_path).blocks
+
+        def anchor_index(anchor_block: int, end: int) -> int:
+            records = beacon.records
+            i = anchor_block - int(records[0]["block_number"]) if len(records) else -1
+            if not 0 <= i < len(records):
+                raise HTTPException(404, f"Anchor block {anchor_block} not in history")
+            if i < end:
+                raise HTTPException(400, "The anchor block must follow the values")
+            return i
+
+        @app.get("/beacon/slot/{slot}")
+        @cache()
+        def get_beacon_value(slot: int, anchor_block: int):
+            """
+            The block valid at the slot, with the blocks linking it to the anchor block
+            """
+            i = beacon.index_at_slot(slot)
+            if i is None:
+                raise HTTPException(404, f"No beacon value at slot {slot}")
+            end = anchor_index(anchor_block, i)
+            if end - i >= MAX_BEACON_PROOF:
+                raise HTTPException(400, "The anchor block is too far from the value")
+            return beacon_json(beacon.records[i : end + 1], 1)
+
+        @app.get("/beacon/range")
+        @cache()
+        def get_beacon_range(from_slot: int, to_slot: int, anchor_block: int):
+            """
+            All blocks valid in the slot range, with the blocks linking them to the anchor block
+            """
+            start = beacon.index_at_slot(from_slot)
+            start = 0 if start is None else start
+            end = beacon.index_at_slot(to_slot)
+            if end is None or end < start:
+                raise HTTPException(404, "No beacon values in slot range")
+            if end - start >= MAX_BEACON_RANGE:
+                raise HTTPException(400, f"At most {MAX_BEACON_RANGE} values at once")
+            anchor = anchor_index(anchor_block, end)
+            if anchor - start >= MAX_BEACON_PROOF:
+                raise HTTPException(400, "The anchor block is too far from the values")
+            return beacon_json(beacon.records[start : anchor + 1], end - start + 1)
+
+    return app
+
+
+def main(
+    index_path: Optional[str] = None,
+    history_path: Optional[str] = None,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+):
+    """
+    Serve the state index at the given path (default: index/stakechain.db)
+    and the randomness beacon if a history directory is given
+    """
+    uvicorn.run(create_app(index_path, history_path), host=host, port=port)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -24,6 +24,9 @@ from steak_protocol.onchain.stakechain import (
     stakechain_v1,
     stakechain_auth_nft,
     stakechain_upgrade_v1,
+    stakechain_upgrade_v1a,
+    stakechain_v2,
+    stakechain_upgrade_v2,
 )
 from steak_protocol.onchain.stakepool import stakepool_request, stakepool
 from steak_protocol.utils import network, get_signing_info, get_address
@@ -116,6 +119,7 @@ def main(
     for script in (
         stakechain_v0,
         stakechain_v1,
+        stakechain_v2,
         stakeholder,
         stakepool_request,
     ):
@@ -132,6 +136,8 @@ def main(
         stakechain_upgrade_v0,
         stakechain_upgrade_v0a,
         stakechain_upgrade_v1,
+        stakechain_upgrade_v1a,
+        stakechain_upgrade_v2,
     ):
         build_compressed("rewarding", script.__file__)
 
@@ -0,0 +1,232 @@
+"""
+Spending many airdrop utxos at once.
+
+Airdrop utxos are packed into as few transactions as the size and execution unit limits allow.
+Every transaction pays fees and collateral from its own wallet utxo, so transactions do not conflict
+and are submitted concurrently while the next batches are being built and evaluated.
+Scripts can only be evaluated against confirmed utxos, so transactions are not chained on their change,
+instead the change becomes available as new fee utxo once the transaction is confirmed.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Iterator, List, Optional, Set, Tuple
+
+import pycardano
+from pycardano import (
+    Redeemer,
+    TransactionBuilder,
+    TransactionFailedException,
+    TransactionInput,
+    TransactionOutput,
+    UTxO,
+    UTxOSelectionException,
+)
+
+from steak_protocol.offchain.util import protocol_param, with_min_lovelace
+from steak_protocol.utils.clock import Clock, system_clock
+from steak_protocol.utils.to_script_context import to_tx_out_ref
+
+# upper bound on the number of airdrop utxos spent in one transaction
+MAX_BATCH_SIZE = 50
+
+# adds the redeemer and possibly outputs for the i-th airdrop utxo of a batch
+SpendAirdrop = Callable[[TransactionBuilder, int, UTxO], None]
+
+
+def redeem_spender(
+    airdrop_script: pycardano.PlutusV2Script,
+    minutxo_address: pycardano.Address,
+    context: pycardano.ChainContext,
+) -> SpendAirdrop:
+    """
+    Claim as recipient. Every claimed utxo requires an output to the min utxo address
+    that references the claimed utxo, the redeemer is the index of this output.
+    """
+
+    def spend(txbuilder: TransactionBuilder, i: int, airdrop_utxo: UTxO):
+        txbuilder.add_script_input(airdrop_utxo, airdrop_script, None, Redeemer(i))
+        txbuilder.add_output(
+            with_min_lovelace(
+                TransactionOutput(
+                    minutxo_address,
+                    amount=pycardano.Value(coin=2500000),
+                    datum=to_tx_out_ref(airdrop_utxo.input),
+                ),
+                context,
+            )
+        )
+
+    return spend
+
+
+def close_spender(airdrop_script: pycardano.PlutusV2Script) -> SpendAirdrop:
+    """
+    Reclaim as admin after the expiry date
+    """
+
+    def spend(txbuilder: TransactionBuilder, i: int, airdrop_utxo: UTxO):
+        txbuilder.add_script_input(airdrop_utxo, airdrop_script, None, Redeemer(-1))
+
+    return spend
+
+
+def within_limits(tx: pycardano.Transaction, context: pycardano.ChainContext) -> bool:
+    param = protocol_param(context)
+    redeemers = tx.transaction_witness_set.redeemer or []
+    return (
+        len(tx.to_cbor()) <= param.max_tx_size
+        and sum(r.ex_units.mem for r in redeemers) <= param.max_tx_ex_mem
+        and sum(r.ex_units.steps for r in redeemers) <= param.max_tx_ex_steps
+    )
+
+
+class FuelPool:
+    """
+    Hands out every utxo of the wallet at most once to pay fees and collateral.
+    If all are handed out, waits until new utxos (i.e. the change of submitted transactions) are confirmed.
+    """
+
+    def __init__(
+        self,
+        address: pycardano.Address,
+        context: pycardano.ChainContext,
+        clock: Clock = system_clock,
+        poll_interval: float = 20,
+        timeout: float = 600,
+    ):
+        self.address = address
+        self.context = context
+        self.clock = clock
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._available: Deque[UTxO] = deque()
+        self._used: Set[TransactionInput] = set()
+
+    def _refresh(self):
+        for u in sorted(
+            self.context.utxos(self.address), key=lambda u: -u.output.amount.coin
+        ):
+            if (
+                u.input not in self._used
+                and u.output.datum is None
+                and u.output.datum_hash is None
+                and u.output.script is None
+            ):
+                self._used.add(u.input)
+                self._available.append(u)
+
+    def take(self) -> UTxO:
+        waited = 0
+        while True:
+            if not self._available:
+                self._refresh()
+            if self._available:
+                return self._available.popleft()
+            assert waited < self.timeout, "No utxo to pay fees available"
+            self.clock.sleep(self.poll_interval)
+            waited += self.poll_interval
+
+
+def build_batch(
+    batch: List[UTxO],
+    spend: SpendAirdrop,
+    fuel_utxo: UTxO,
+    payment_vkey: pycardano.PaymentVerificationKey,
+    payment_skey: pycardano.PaymentSigningKey,
+    payment_address: pycardano.Address,
+    message: str,
+    context: pycardano.ChainContext,
+    validity_start: Optional[int] = None,
+) -> pycardano.Transaction:
+    txbuilder = TransactionBuilder(context)
+    txbuilder.add_input(fuel_utxo)
+    for i, u in enumerate(batch):
+        spend(txbuilder, i, u)
+    txbuilder.collaterals = [fuel_utxo]
+    txbuilder.required_signers = [payment_vkey.hash()]
+    if validity_start is not None:
+        txbuilder.validity_start = validity_start
+    txbuilder.auxiliary_data = pycardano.AuxiliaryData(
+        data=pycardano.AlonzoMetadata(
+            metadata=pycardano.Metadata(
+                {
+                    674: {"msg": [message]},
+                }
+            )
+        )
+    )
+    return txbuilder.build_and_sign(
+        signing_keys=[payment_skey],
+        change_address=payment_address,
+    )
+
+
+def build_batches(
+    airdrop_utxos: List[UTxO],
+    build: Callable[[List[UTxO], UTxO], pycardano.Transaction],
+    fuel: FuelPool,
+    context: pycardano.ChainContext,
+    max_batch_size: int = MAX_BATCH_SIZE,
+) -> Iterator[Tuple[int, pycardano.Transaction]]:
+    """
+    Spend the airdrop utxos in as few transactions as possible.
+    The batch size shrinks whenever a transaction exceeds the limits or the fuel utxo does not cover it
+    and is kept for the following batches.
+
+    Yields the number of spent airdrop utxos and the signed transaction.
+    """
+    batch_size = max_batch_size
+    remaining = list(airdrop_utxos)
+    while remaining:
+        fuel_utxo = fuel.take()
+        while True:
+            batch = remaining[:batch_size]
+            try:
+                tx = build(batch, fuel_utxo)
+                if within_limits(tx, context):
+                    break
+            except TransactionFailedException:
+                # the evaluation fails if the execution budget is exceeded
+                if batch_size == 1:
+                    raise
+            except UTxOSelectionException as e:
+                # the fuel utxo does not cover the fees, collateral and outputs of the batch
+                if batch_size == 1:
+                    raise UTxOSelectionException(
+                        f"Fuel utxo {fuel_utxo.input} with {fuel_utxo.output.amount.coin} lovelace "
+                        "does not cover the spending of a single airdrop utxo, add funds to the wallet"
+                    ) from e
+            assert batch_size > 1, "A single airdrop utxo exceeds the limits"
+            batch_size = max(1, batch_size * 3 // 4)
+        remaining = remaining[len(batch) :]
+        yield len(batch), tx
+
+
+def submit_batches(
+    batches: Iterator[Tuple[int, pycardano.Transaction]],
+    total: int,
+    context: pycardano.ChainContext,
+    workers: int = 4,
+    show_tx: Callable[[pycardano.Transaction], None] = lambda tx: None,
+) -> List[pycardano.Transaction]:
+    """
+    Submit the transactions concurrently while the next batches are built and report the progress
+    """
+    spent = 0
+    lock = threading.Lock()
+
+    def submit(n: int, tx: pycardano.Transaction):
+        nonlocal spent
+        context.submit_tx(tx)
+        with lock:
+            spent += n
+            progress = spent
+        show_tx(tx)
+        print(f"Spent {progress}/{total} airdrop utxos")
+        return tx
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [executor.submit(submit, n, tx) for n, tx in batches]
+        return [job.result() for job in jobs]
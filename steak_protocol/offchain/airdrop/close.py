@@ -15,6 +15,15 @@ from pycardano import (
     RawPlutusData,
 )
 
+from steak_protocol.offchain.airdrop.batch import (
+    MAX_BATCH_SIZE,
+    FuelPool,
+    build_batch,
+    build_batches,
+    close_spender,
+    submit_batches,
+)
+from steak_protocol.offchain.airdrop.lookup import airdrop_recipient, all_airdrop_utxos
 from steak_protocol.offchain.util import (
     sorted_utxos,
     with_min_lovelace,
@@ -47,27 +56,54 @@ from opshin.builder import apply_parameters
 
 def main(
     name: str = "airdrop",
+    batch: bool = False,
+    max_batch_size: int = MAX_BATCH_SIZE,
+    workers: int = 4,
     return_tx: bool = False,
 ):
     payment_vkey, payment_skey, payment_address = get_signing_info(
         name, network=network
     )
-    own_pkhash = payment_vkey.hash().payload
 
     airdrop_script, _, airdrop_address = get_contract("airdrop")
+    # the admin can close the airdrop of any recipient
+    airdrop_utxos = (
+        u
+        for u in all_airdrop_utxos(airdrop_address, context)
+        if airdrop_recipient(u) is not None
+    )
+
+    if batch:
+        airdrop_utxos = list(airdrop_utxos)
+        txs = submit_batches(
+            build_batches(
+                airdrop_utxos,
+                lambda utxos, fuel_utxo: build_batch(
+                    utxos,
+                    close_spender(airdrop_script),
+                    fuel_utxo,
+                    payment_vkey,
+                    payment_skey,
+                    payment_address,
+                    "Close Expired Airdrop",
+                    context,
+                    validity_start=context.last_block_slot,
+                ),
+                FuelPool(payment_address, context),
+                context,
+                max_batch_size=max_batch_size,
+            ),
+            len(airdrop_utxos),
+            context,
+            workers=workers,
+            show_tx=show_tx,
+        )
+        if return_tx:
+            return txs
+        return
 
-    airdrop_utxo = None
-    for u in context.utxos(airdrop_address):
-        try:
-            airdrop_receiver = RawPlutusData.from_cbor(u.output.datum.cbor).data
-        except Exception as e:
-            continue
-        if airdrop_receiver == own_pkhash:
-            airdrop_utxo = u
-            break
-        airdrop_utxo = u
-        break
-    assert airdrop_utxo is not None, "No stake chain state found"
+    airdrop_utxo = next(airdrop_utxos, None)
+    assert airdrop_utxo is not None, "No airdrop found"
 
     unlock_redeemer = Redeemer(-1)
 
@@ -1,47 +1,241 @@
-import secrets
-from hashlib import sha256
+import datetime
+import itertools
+import json
+from collections import deque
+from pathlib import Path
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple, Union
 
 import fire
 import pycardano
-from opshin.ledger.api_v2 import PubKeyCredential, NoOutputDatum
 from opshin.prelude import Token
 from pycardano import (
     TransactionBuilder,
-    script_hash,
+    TransactionInput,
     TransactionOutput,
-    Value,
-    Redeemer,
     DeserializeException,
+    UTxO,
 )
 
+from steak_protocol.offchain.airdrop.lookup import recipient_airdrop_address
 from steak_protocol.offchain.util import (
     sorted_utxos,
     with_min_lovelace,
-    asset_from_token,
+    protocol_param,
     STAKE_CHAIN_AUTH_NFT,
     amount_of_token_in_value,
     token_from_string,
     value_from_token,
-    commit_hash_secrets,
-    write_ahead_hash_secrets,
 )
-from steak_protocol.onchain.stakechain.stakechain_v0 import RegisterStake
-from steak_protocol.onchain.stakeholder.stakeholder_auth_nft import Mint
-from steak_protocol.onchain.types import (
-    StakeChainV0State,
-    StakeHolderRegistrations,
-    StakeHolderState,
-    StakePoolParams,
-)
-from steak_protocol.utils import get_signing_info, network, context, get_address
-from steak_protocol.utils.contracts import get_contract, get_ref_utxo
+from steak_protocol.onchain.types import StakeChainV0State
+from steak_protocol.utils import get_signing_info, network, context
+from steak_protocol.utils.contracts import get_contract
 from steak_protocol.utils.network import show_tx
-from steak_protocol.utils.to_script_context import (
-    to_address,
-    to_tx_out_ref,
-)
 
-from opshin.builder import apply_parameters
+# bytes reserved for inputs, change, witnesses and metadata when packing outputs into a transaction
+RESERVED_TX_SIZE = 2000
+
+
+def read_recipients(recipients_file: Union[str, Path]) -> Iterator[pycardano.Address]:
+    """
+    Lazily read the recipients, one address per line, in file order and without duplicates
+    """
+    seen = set()
+    with open(recipients_file) as f:
+        for line in f:
+            recipient = line.strip()
+            if not recipient or recipient in seen:
+                continue
+            seen.add(recipient)
+            yield pycardano.Address.from_primitive(recipient)
+
+
+def airdrop_output(
+    recipient: pycardano.Address,
+    airdrop_address: pycardano.Address,
+    stakecoin: Token,
+    airdrop_amount: int,
+    context: pycardano.ChainContext,
+) -> TransactionOutput:
+    """
+    The airdrop can be claimed by the payment key of the recipient and is staked with the recipients staking key
+    """
+    return with_min_lovelace(
+        TransactionOutput(
+            recipient_airdrop_address(airdrop_address, recipient),
+            amount=value_from_token(stakecoin, airdrop_amount),
+            datum=recipient.payment_part.payload,
+        ),
+        context,
+    )
+
+
+def load_checkpoint(checkpoint_file: Union[str, Path]) -> Tuple[int, List[UTxO]]:
+    """
+    Returns the number of processed recipients and the change outputs to continue from.
+    Starts from scratch if there is no checkpoint.
+    """
+    try:
+        with open(checkpoint_file) as f:
+            lines = [l for l in f.readlines() if l.strip()]
+    except FileNotFoundError:
+        return 0, []
+    if not lines:
+        return 0, []
+    d = json.loads(lines[-1])
+    return d["processed"], [UTxO.from_cbor(u) for u in d["change"]]
+
+
+def write_checkpoint(
+    checkpoint_file: Union[str, Path],
+    processed: int,
+    tx: pycardano.Transaction,
+    change: List[UTxO],
+):
+    with open(checkpoint_file, "a") as f:
+        f.write(
+            json.dumps(
+                {
+                    "processed": processed,
+                    "tx_id": tx.id.payload.hex(),
+                    "change": [u.to_cbor_hex() for u in change],
+                    "timestamp": datetime.datetime.now().timestamp(),
+                }
+            )
+            + "\n"
+        )
+
+
+def build_airdrop_transactions(
+    outputs: Iterable[TransactionOutput],
+    inputs: List[UTxO],
+    payment_address: pycardano.Address,
+    payment_skey: pycardano.PaymentSigningKey,
+    change_address: pycardano.Address,
+    context: pycardano.ChainContext,
+    max_tx_size: Optional[int] = None,
+    max_fee: Optional[int] = None,
+) -> Iterator[Tuple[int, pycardano.Transaction, List[UTxO]]]:
+    """
+    Greedily pack the outputs into transactions below the size and fee limit.
+    Every transaction spends the change of the previous one, so they can all be submitted at once.
+    Only the change of the last transaction goes to the change address.
+
+    Yields the number of packed outputs, the signed transaction and its change outputs.
+    """
+    if max_tx_size is None:
+        max_tx_size = protocol_param(context).max_tx_size
+    outputs = iter(outputs)
+    pending: Deque[TransactionOutput] = deque()
+    exhausted = False
+
+    def build(batch: List[TransactionOutput], last: bool):
+        txbuilder = TransactionBuilder(context)
+        for u in inputs:
+            txbuilder.add_input(u)
+        for output in batch:
+            txbuilder.add_output(output)
+        txbuilder.auxiliary_data = pycardano.AuxiliaryData(
+            data=pycardano.AlonzoMetadata(
+                metadata=pycardano.Metadata(
+                    {
+                        674: {"msg": ["Initialize Airdrop"]},
+                    }
+                )
+            )
+        )
+        return txbuilder.build_and_sign(
+            signing_keys=[payment_skey],
+            change_address=change_address if last else payment_address,
+        )
+
+    while True:
+        batch = []
+        batch_size = 0
+        while True:
+            if not pending:
+                output = next(outputs, None)
+                if output is None:
+                    exhausted = True
+                    break
+                pending.append(output)
+            output_size = len(pending[0].to_cbor())
+            if batch and batch_size + output_size > max_tx_size - RESERVED_TX_SIZE:
+                break
+            batch.append(pending.popleft())
+            batch_size += output_size
+        if not batch:
+            return
+        if not pending and not exhausted:
+            output = next(outputs, None)
+            if output is None:
+                exhausted = True
+            else:
+                pending.append(output)
+
+        while True:
+            tx = build(batch, last=exhausted and not pending)
+            if len(tx.to_cbor()) <= max_tx_size and (
+                max_fee is None or tx.transaction_body.fee <= max_fee
+            ):
+                break
+            assert len(batch) > 1, "A single airdrop output exceeds the limits"
+            # the size estimate was too optimistic, move some outputs to the next transaction
+            dropped = max(1, len(batch) // 10)
+            pending.extendleft(reversed(batch[-dropped:]))
+            batch = batch[:-dropped]
+
+        change = [
+            UTxO(TransactionInput(tx.id, i), output)
+            for i, output in enumerate(tx.transaction_body.outputs)
+            if i >= len(batch) and output.address == payment_address
+        ]
+        inputs = change
+        yield len(batch), tx, change
+
+
+def send_airdrop(
+    recipients_file: Union[str, Path],
+    checkpoint_file: Union[str, Path],
+    stakecoin: Token,
+    airdrop_amount: int,
+    airdrop_address: pycardano.Address,
+    payment_address: pycardano.Address,
+    payment_skey: pycardano.PaymentSigningKey,
+    change_address: pycardano.Address,
+    context: pycardano.ChainContext,
+    max_tx_size: Optional[int] = None,
+    max_fee: Optional[int] = None,
+) -> Iterator[pycardano.Transaction]:
+    """
+    Submit the airdrop transactions, resuming after the last checkpoint.
+    Yields every transaction once it was submitted and checkpointed.
+    """
+    processed, inputs = load_checkpoint(checkpoint_file)
+    if processed > 0:
+        print(f"Resuming after {processed} recipients")
+    else:
+        inputs = sorted_utxos(context.utxos(payment_address))
+    outputs = (
+        airdrop_output(recipient, airdrop_address, stakecoin, airdrop_amount, context)
+        for recipient in itertools.islice(
+            read_recipients(recipients_file), processed, None
+        )
+    )
+    for n, tx, change in build_airdrop_transactions(
+        outputs,
+        inputs,
+        payment_address,
+        payment_skey,
+        change_address,
+        context,
+        max_tx_size=max_tx_size,
+        max_fee=max_fee,
+    ):
+        context.submit_tx(tx)
+        # only checkpoint the progress if the transaction was successful
+        processed += n
+        write_checkpoint(checkpoint_file, processed, tx, change)
+        yield tx
 
 
 def main(
@@ -49,12 +243,22 @@ def main(
     stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
     airdrop_amount: int = 1200_000_000,
     recipients_file: str = "addresses.txt",
+    checkpoint_file: Optional[str] = None,
+    max_fee: Optional[int] = None,
     return_tx: bool = False,
     change_address: str = None,
 ):
+    """
+    Send the airdrop to all recipients, split over as many transactions as needed.
+    Progress is stored in the checkpoint file (default: next to the recipients file)
+    and a restart resumes after the last submitted transaction.
+    With return_tx, the last submitted transaction is returned.
+    """
     payment_vkey, payment_skey, payment_address = get_signing_info(
         name, network=network
     )
+    if checkpoint_file is None:
+        checkpoint_file = f"{recipients_file}.checkpoint"
 
     stakechain_script, _, stakechain_address = get_contract("stakechain")
     stakechain_auth_nft = token_from_string(stakechain_auth_nft)
@@ -75,48 +279,24 @@ def main(
 
     stakecoin = stakechain_state.params.stake_coin
 
-    txbuilder = TransactionBuilder(context)
-    txbuilder.add_input_address(payment_address)
-
-    with open(recipients_file) as f:
-        recipients = set(f.readlines())
-    for recipient_addr in recipients:
-        recipient = pycardano.Address.from_primitive(recipient_addr.strip())
-        recipient_airdrop_addr = pycardano.Address(
-            payment_part=airdrop_address.payment_part,
-            staking_part=recipient.staking_part,
-            network=network,
-        )
-        txbuilder.add_output(
-            with_min_lovelace(
-                TransactionOutput(
-                    recipient_airdrop_addr,
-                    amount=value_from_token(stakecoin, airdrop_amount),
-                    datum=recipient.payment_part.payload,
-                ),
-                context,
-            )
-        )
-    txbuilder.auxiliary_data = pycardano.AuxiliaryData(
-        data=pycardano.AlonzoMetadata(
-            metadata=pycardano.Metadata(
-                {
-                    674: {"msg": ["Initialize Airdrop"]},
-                }
-            )
-        )
-    )
-    tx = txbuilder.build_and_sign(
-        signing_keys=[payment_skey],
-        change_address=(
+    tx = None
+    for tx in send_airdrop(
+        recipients_file,
+        checkpoint_file,
+        stakecoin,
+        airdrop_amount,
+        airdrop_address,
+        payment_address,
+        payment_skey,
+        (
             payment_address
             if change_address is None
             else pycardano.Address.from_primitive(change_address)
         ),
-    )
-
-    context.submit_tx(tx)
-    show_tx(tx)
+        context,
+        max_fee=max_fee,
+    ):
+        show_tx(tx)
     if return_tx:
         return tx
 
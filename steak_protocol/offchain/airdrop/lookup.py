@@ -0,0 +1,64 @@
+"""
+Finding airdrop utxos.
+
+All airdrop utxos share the payment part of the airdrop address and carry the staking part of their recipient,
+so the utxos of one recipient can be queried directly instead of scanning and decoding the whole airdrop.
+"""
+
+from typing import List, Optional
+
+import pycardano
+from pycardano import RawPlutusData, UTxO
+
+from steak_protocol.utils.backends import address_pattern
+
+
+def recipient_airdrop_address(
+    airdrop_address: pycardano.Address, recipient: pycardano.Address
+) -> pycardano.Address:
+    """
+    The address holding the airdrop of the recipient, staked with the staking key of the recipient
+    """
+    return pycardano.Address(
+        payment_part=airdrop_address.payment_part,
+        staking_part=recipient.staking_part,
+        network=airdrop_address.network,
+    )
+
+
+def all_airdrop_utxos(
+    airdrop_address: pycardano.Address, context: pycardano.ChainContext
+) -> List[UTxO]:
+    """
+    Airdrop utxos of all recipients, which share the payment part of the airdrop address
+    """
+    if getattr(context, "supports_address_patterns", False):
+        return context.utxos_by_pattern(address_pattern(airdrop_address.payment_part))
+    return context.utxos(airdrop_address)
+
+
+def airdrop_recipient(airdrop_utxo: UTxO) -> Optional[bytes]:
+    """
+    The payment key hash of the recipient or None if the utxo is not a valid airdrop
+    """
+    try:
+        return RawPlutusData.from_cbor(airdrop_utxo.output.datum.cbor).data
+    except Exception:
+        return None
+
+
+def recipient_airdrop_utxos(
+    airdrop_address: pycardano.Address,
+    recipient: pycardano.Address,
+    context: pycardano.ChainContext,
+) -> List[UTxO]:
+    """
+    Airdrop utxos that can be claimed by the payment key of the recipient.
+    Only the utxos at the address of the recipient are queried and decoded.
+    """
+    recipient_pkh = recipient.payment_part.payload
+    return [
+        u
+        for u in context.utxos(recipient_airdrop_address(airdrop_address, recipient))
+        if airdrop_recipient(u) == recipient_pkh
+    ]
@@ -1,5 +1,6 @@
 import secrets
 from hashlib import sha256
+from typing import Optional
 
 import fire
 import pycardano
@@ -15,6 +16,15 @@ from pycardano import (
     RawPlutusData,
 )
 
+from steak_protocol.offchain.airdrop.batch import (
+    MAX_BATCH_SIZE,
+    FuelPool,
+    build_batch,
+    build_batches,
+    redeem_spender,
+    submit_batches,
+)
+from steak_protocol.offchain.airdrop.lookup import recipient_airdrop_utxos
 from steak_protocol.offchain.util import (
     sorted_utxos,
     with_min_lovelace,
@@ -48,28 +58,58 @@ from opshin.builder import apply_parameters
 def main(
     name: str = "creator",
     minutxo_address: str = "recipient",
+    recipient_address: Optional[str] = None,
+    batch: bool = False,
+    max_batch_size: int = MAX_BATCH_SIZE,
+    workers: int = 4,
     return_tx: bool = False,
 ):
     payment_vkey, payment_skey, payment_address = get_signing_info(
         name, network=network
     )
-    own_pkhash = payment_vkey.hash().payload
     minutxo_address = get_address(minutxo_address, network=network)
+    # the address that received the airdrop, its staking part determines the airdrop address
+    recipient_address = (
+        pycardano.Address.from_primitive(recipient_address)
+        if recipient_address is not None
+        else payment_address
+    )
+    assert (
+        recipient_address.payment_part == payment_vkey.hash()
+    ), "Recipient address does not belong to the signing key"
 
     airdrop_script, _, airdrop_address = get_contract("airdrop")
+    airdrop_utxos = recipient_airdrop_utxos(airdrop_address, recipient_address, context)
+    assert len(airdrop_utxos) > 0, "No airdrop found"
+
+    if batch:
+        txs = submit_batches(
+            build_batches(
+                airdrop_utxos,
+                lambda utxos, fuel_utxo: build_batch(
+                    utxos,
+                    redeem_spender(airdrop_script, minutxo_address, context),
+                    fuel_utxo,
+                    payment_vkey,
+                    payment_skey,
+                    payment_address,
+                    "Claim Airdrop",
+                    context,
+                ),
+                FuelPool(payment_address, context),
+                context,
+                max_batch_size=max_batch_size,
+            ),
+            len(airdrop_utxos),
+            context,
+            workers=workers,
+            show_tx=show_tx,
+        )
+        if return_tx:
+            return txs
+        return
 
-    airdrop_utxo = None
-    for u in context.utxos(airdrop_address):
-        try:
-            airdrop_receiver = RawPlutusData.from_cbor(u.output.datum.cbor).data
-        except Exception as e:
-            continue
-        if airdrop_receiver == own_pkhash:
-            airdrop_utxo = u
-            break
-        airdrop_utxo = u
-        break
-    assert airdrop_utxo is not None, "No airdrop found"
+    airdrop_utxo = airdrop_utxos[0]
 
     unlock_redeemer = Redeemer(0)
 
@@ -0,0 +1,516 @@
+"""
+Offline audit of the stake chain history.
+
+Every transition between two consecutive stake chain states is re-verified with the validator logic:
+for blocks, the elected slot leader (recovered from the block hash), the block linkage,
+the slot, the reward taken from the reserve and credited to the slot leader (for stake pools only the guaranteed
+share, if the spent holder state is known) and, if the revealed secret is known,
+the producer signature and the commitment of the producer to the secret
+(the secret is only part of the redeemer, not of the stored datums).
+Transitions are independent of each other, so they are verified in parallel.
+
+The history is read from a dump of all stake chain outputs (JSON lines, see `dump_from_kupo`)
+or, with fewer checks since intermediate holder updates are not stored, from the block index.
+"""
+
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import fire
+import requests
+from opshin.ledger.api_v2 import ScriptCredential
+from opshin.prelude import Token, TxId, TxOutRef
+from opshin.std.builtins import sha2_256
+from opshin.std.fractions import ceil_fraction, floor_fraction
+from opshin.std.math import bytes_big_from_unsigned_int
+from pycardano import DeserializeException
+
+from steak_protocol.offchain.util import STAKE_CHAIN_AUTH_NFT, token_from_string
+from steak_protocol.onchain.stakechain.stakechain_v1 import (
+    MineBlockUpdateStake,
+    compute_slot_leader,
+)
+from steak_protocol.onchain.stakepool.stakepool import PoolState
+from steak_protocol.onchain.types import StakeChainV1State, StakeHolderState
+from steak_protocol.onchain.util import scale_fraction
+from steak_protocol.utils import block_index
+from steak_protocol.utils.contracts import get_contract
+from steak_protocol.utils.datums import DatumResolver, kupo_datum_resolver
+from steak_protocol.utils.dump import StateRecord, records_from_dump
+from steak_protocol.utils.network import kupo_url as network_kupo_url
+
+# number of transitions verified by a worker at once
+CHUNK_SIZE = 256
+
+
+@dataclass
+class Anomaly:
+    block_number: int
+    transaction_id: bytes
+    output_index: int
+    message: str
+
+    def __str__(self):
+        return f"block {self.block_number} ({self.transaction_id.hex()}#{self.output_index}): {self.message}"
+
+
+@dataclass
+class AuditReport:
+    transitions: int = 0
+    blocks: int = 0
+    # transitions that could not be verified (i.e. not V1 states)
+    skipped: int = 0
+    anomalies: List[Anomaly] = field(default_factory=list)
+
+
+def records_from_index(
+    path: Union[str, Path, None] = None, batch_size: int = 1000
+) -> Iterator[StateRecord]:
+    """
+    Stream the first state of every block stored in the block index
+    """
+    block_index.open_index(path)
+    last_block_number = -1
+    while True:
+        blocks = list(
+            block_index.Block.select()
+            .where(block_index.Block.block_number > last_block_number)
+            .order_by(block_index.Block.block_number)
+            .limit(batch_size)
+        )
+        if not blocks:
+            return
+        for block in blocks:
+            yield StateRecord(
+                state=bytes(block.state),
+                transaction_id=bytes(block.transaction_id),
+                output_index=block.output_index,
+            )
+        last_block_number = blocks[-1].block_number
+
+
+def _spending_transaction(match: dict) -> Optional[str]:
+    spent_at = match.get("spent_at")
+    return spent_at.get("transaction_id") if spent_at else None
+
+
+def revealed_secrets(matches: List[dict]) -> Dict[str, bytes]:
+    """
+    The secrets revealed in the redeemers spending the stake chain outputs, by the transaction that revealed them.
+    Kupo only returns the redeemers of spent outputs if it is recent enough (>= 2.7).
+    """
+    secrets = {}
+    for match in matches:
+        tx_id = _spending_transaction(match)
+        redeemer = (match.get("spent_at") or {}).get("redeemer")
+        if tx_id is None or redeemer is None:
+            continue
+        try:
+            mine_redeemer = MineBlockUpdateStake.from_cbor(bytes.fromhex(redeemer))
+        except DeserializeException:
+            continue
+        secrets[tx_id] = mine_redeemer.slot_leader_secret
+    return secrets
+
+
+def spent_holder_states(
+    kupo_url: str, stakeholder_address: str, datum_resolver: DatumResolver
+) -> Dict[str, bytes]:
+    """
+    The cbor of every spent stake holder state, by the transaction that spent it
+    """
+    matches = [
+        match
+        for match in requests.get(
+            f"{kupo_url}/matches/{stakeholder_address}?spent&resolve_hashes"
+        ).json()
+        if match["datum_hash"] is not None and _spending_transaction(match)
+    ]
+    for match in matches:
+        if match.get("datum") is not None:
+            datum_resolver.prime(match["datum_hash"], match["datum"])
+    datums = datum_resolver.resolve_many(match["datum_hash"] for match in matches)
+    holder_states = {}
+    for match in matches:
+        datum_cbor = datums[match["datum_hash"]]
+        if datum_cbor is None:
+            continue
+        try:
+            StakeHolderState.from_cbor(datum_cbor.cbor)
+        except DeserializeException:
+            continue
+        holder_states[_spending_transaction(match)] = datum_cbor.cbor
+    return holder_states
+
+
+def dump_from_kupo(
+    kupo_url: str,
+    stakechain_address: str,
+    stakechain_auth_nft: Token,
+    path: Union[str, Path],
+    stakeholder_address: Optional[str] = None,
+) -> int:
+    """
+    Write all stake chain outputs observed by the kupo instance to a dump file.
+    Assumes that the kupo instance does not prune spent outputs.
+    The secret revealed by the producer of each block is taken from the redeemer spending the previous state
+    and, if the stake holder address is given, the spent stake holder state of the producer
+    (with the hash it committed to the secret).
+    Returns the number of written records.
+    """
+    auth_nft_asset = (
+        f"{stakechain_auth_nft.policy_id.hex()}.{stakechain_auth_nft.token_name.hex()}"
+    )
+    matches = requests.get(
+        f"{kupo_url}/matches/{stakechain_address}?order=oldest_first&resolve_hashes"
+    ).json()
+    datum_resolver = kupo_datum_resolver(kupo_url)
+    matches = [
+        match
+        for match in matches
+        if match["value"]["assets"].get(auth_nft_asset, 0) > 0
+        and match["datum_hash"] is not None
+    ]
+    for match in matches:
+        if match.get("datum") is not None:
+            datum_resolver.prime(match["datum_hash"], match["datum"])
+    datums = datum_resolver.resolve_many(match["datum_hash"] for match in matches)
+    secrets = revealed_secrets(matches)
+    holder_states = (
+        spent_holder_states(kupo_url, stakeholder_address, datum_resolver)
+        if stakeholder_address is not None
+        else {}
+    )
+    stake_coin_asset = None
+    written = 0
+    with open(path, "w") as f:
+        for match in matches:
+            datum_cbor = datums[match["datum_hash"]]
+            if datum_cbor is None:
+                continue
+            if stake_coin_asset is None:
+                try:
+                    stake_coin = block_index.stakechain_state_from_cbor(
+                        datum_cbor.cbor
+                    ).params.stake_coin
+                except DeserializeException:
+                    continue
+                stake_coin_asset = (
+                    f"{stake_coin.policy_id.hex()}.{stake_coin.token_name.hex()}"
+                )
+            secret = secrets.get(match["transaction_id"])
+            holder_state = holder_states.get(match["transaction_id"])
+            committed_hash = None
+            if holder_state is not None:
+                committed_hashes = StakeHolderState.from_cbor(
+                    holder_state
+                ).committed_hashes
+                committed_hash = committed_hashes[0] if committed_hashes else None
+            entry = {
+                "transaction_id": match["transaction_id"],
+                "output_index": match["output_index"],
+                "state": datum_cbor.cbor.hex(),
+                "reserve": match["value"]["assets"].get(stake_coin_asset, 0),
+                "slot_leader_secret": secret.hex() if secret is not None else None,
+                "committed_hash": (
+                    committed_hash.hex() if committed_hash is not None else None
+                ),
+                "holder_state": (
+                    holder_state.hex() if holder_state is not None else None
+                ),
+            }
+            f.write(json.dumps(entry) + "\n")
+            written += 1
+    return written
+
+
+def elected_slot_leader_number(
+    prev_state: StakeChainV1State, next_state: StakeChainV1State
+) -> Optional[int]:
+    """
+    The slot leader number that the producer claimed, recovered from the new block hash.
+    None if the block hash does not match any allowed slot leader number.
+    """
+    prev_chain_state = prev_state.chain_state.to_cbor()
+    prev_signature = prev_state.producer_state.producer_signature
+    for k in range(prev_state.params.num_slot_leaders + 1):
+        if (
+            sha2_256(bytes_big_from_unsigned_int(k) + prev_chain_state + prev_signature)
+            == next_state.chain_state.block_hash
+        ):
+            return k
+    return None
+
+
+def expected_stake_increase(taken: int, holder_state: Optional[bytes]) -> Optional[int]:
+    """
+    The stake credited to the slot leader for taking the given reward from the reserve.
+    Stake pools only credit the guaranteed share of the reward to the pool itself.
+    None if the holder state of the slot leader is unknown and it may have been a pool.
+    """
+    if holder_state is None:
+        return None
+    stakeholder_state = StakeHolderState.from_cbor(holder_state)
+    if not isinstance(stakeholder_state.params.owner, ScriptCredential):
+        return taken
+    pool_state = PoolState.from_cbor(stakeholder_state.aux.datum.to_cbor())
+    return ceil_fraction(
+        scale_fraction(taken, pool_state.params.guaranteed_reward_fraction)
+    )
+
+
+def check_block(
+    prev_record: StateRecord,
+    prev_state: StakeChainV1State,
+    next_record: StateRecord,
+    next_state: StakeChainV1State,
+    consecutive: bool,
+) -> List[str]:
+    """
+    Verify that the new block was correctly produced on top of the previous state.
+    If the states are not consecutive, only checks that do not depend on the holder list are performed.
+    """
+    errors = []
+    params = prev_state.params
+    prev_chain_state = prev_state.chain_state
+    next_chain_state = next_state.chain_state
+    if next_chain_state.block_number != prev_chain_state.block_number + 1:
+        errors.append("Block number not increased by one")
+    if next_chain_state.slot_number <= prev_chain_state.slot_number:
+        errors.append("Slot number not strictly increasing")
+    if next_chain_state.slot_number % params.slot_leader_interval != 0:
+        errors.append("Slot number not multiple of slot leader interval")
+    if next_state.producer_state.prev_producer_state_hash != sha2_256(
+        prev_state.producer_state.to_cbor()
+    ):
+        errors.append("Producer state does not link to the previous producer state")
+    if len(next_state.producer_state.auxiliary.to_cbor()) >= 100:
+        errors.append("Attached too long aux data")
+    if next_state.skip_holders != 0:
+        errors.append("Skip holders not reset")
+
+    k = elected_slot_leader_number(prev_state, next_state)
+    if k is None:
+        errors.append("Block hash does not match any allowed slot leader")
+    elif consecutive:
+        slot_leader = compute_slot_leader(prev_state, next_chain_state.slot_number, k)
+        prev_holders = prev_state.holder_state
+        next_holders = next_state.holder_state
+        if next_holders.stake_holder_ids != prev_holders.stake_holder_ids:
+            errors.append("Holder list changed in block")
+        else:
+            changed = [
+                i
+                for i, (prev_weight, next_weight) in enumerate(
+                    zip(
+                        prev_holders.stake_holder_weights,
+                        next_holders.stake_holder_weights,
+                    )
+                )
+                if prev_weight != next_weight
+            ]
+            if any(i != slot_leader for i in changed):
+                errors.append(
+                    f"Stake of holders {changed} changed but slot leader {k} is holder {slot_leader}"
+                )
+            elif prev_record.reserve is not None and next_record.reserve is not None:
+                increase = (
+                    next_holders.stake_holder_weights[slot_leader]
+                    - prev_holders.stake_holder_weights[slot_leader]
+                )
+                taken = prev_record.reserve - next_record.reserve
+                expected = expected_stake_increase(taken, next_record.holder_state)
+                # without the holder state, only check that no more than the reward was credited
+                if (expected is not None and increase != expected) or increase > taken:
+                    errors.append(
+                        f"Stake of the slot leader increased by {increase}, but {taken} were taken from the reserve"
+                    )
+
+    if next_record.slot_leader_secret is not None and (
+        sha2_256(next_chain_state.to_cbor() + next_record.slot_leader_secret)
+        != next_state.producer_state.producer_signature
+    ):
+        errors.append("Producer signature does not match the revealed secret")
+    if (
+        next_record.slot_leader_secret is not None
+        and next_record.committed_hash is not None
+        and sha2_256(next_record.slot_leader_secret) != next_record.committed_hash
+    ):
+        errors.append("Revealed secret does not match the committed hash")
+
+    if (
+        consecutive
+        and prev_record.reserve is not None
+        and next_record.reserve is not None
+    ):
+        reward = floor_fraction(
+            scale_fraction(prev_record.reserve, params.fraction_per_block)
+        )
+        if prev_record.reserve - next_record.reserve != reward:
+            errors.append(
+                f"Reserve decreased by {prev_record.reserve - next_record.reserve}, expected reward {reward}"
+            )
+    return errors
+
+
+def check_transition(
+    prev_record: StateRecord,
+    prev_state: StakeChainV1State,
+    next_record: StateRecord,
+    next_state: StakeChainV1State,
+    consecutive: bool,
+) -> List[str]:
+    errors = []
+    if next_state.params != prev_state.params:
+        errors.append("Parameters changed")
+    if consecutive and next_state.spent_for != TxOutRef(
+        TxId(prev_record.transaction_id), prev_record.output_index
+    ):
+        errors.append("State does not spend the previous state")
+    if next_state.chain_state != prev_state.chain_state:
+        errors += check_block(
+            prev_record, prev_state, next_record, next_state, consecutive
+        )
+    elif (
+        consecutive
+        and next_record.reserve is not None
+        and prev_record.reserve is not None
+    ):
+        # registrations and deregistrations pay the fee, updates keep the reserve
+        if next_record.reserve - prev_record.reserve not in (
+            0,
+            prev_state.params.register_fee,
+        ):
+            errors.append("Reserve changed outside of a block")
+    return errors
+
+
+def audit_transitions(
+    transitions: List[Tuple[StateRecord, StateRecord]], consecutive: bool = True
+) -> AuditReport:
+    """
+    Verify the given pairs of (previous, next) records
+    """
+    report = AuditReport()
+    for prev_record, next_record in transitions:
+        report.transitions += 1
+        try:
+            prev_state = StakeChainV1State.from_cbor(prev_record.state)
+            next_state = StakeChainV1State.from_cbor(next_record.state)
+        except DeserializeException:
+            report.skipped += 1
+            continue
+        if next_state.chain_state != prev_state.chain_state:
+            report.blocks += 1
+        for message in check_transition(
+            prev_record, prev_state, next_record, next_state, consecutive
+        ):
+            report.anomalies.append(
+                Anomaly(
+                    next_state.chain_state.block_number,
+                    next_record.transaction_id,
+                    next_record.output_index,
+                    message,
+                )
+            )
+    return report
+
+
+def _chunks(
+    records: Iterable[StateRecord], chunk_size: int
+) -> Iterator[List[Tuple[StateRecord, StateRecord]]]:
+    records = iter(records)
+    prev_record = next(records, None)
+    chunk = []
+    for record in records:
+        chunk.append((prev_record, record))
+        prev_record = record
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def audit(
+    records: Iterable[StateRecord],
+    consecutive: bool = True,
+    processes: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> AuditReport:
+    """
+    Verify all transitions between consecutive records.
+    Set `consecutive` to False if the records are not every state of the chain (i.e. only one state per block).
+    """
+    report = AuditReport()
+
+    def merge(partial: AuditReport):
+        report.transitions += partial.transitions
+        report.blocks += partial.blocks
+        report.skipped += partial.skipped
+        report.anomalies += partial.anomalies
+
+    chunks = _chunks(records, chunk_size)
+    if processes is None or processes <= 1:
+        for chunk in chunks:
+            merge(audit_transitions(chunk, consecutive))
+        return report
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # keep a bounded number of chunks in flight to stream arbitrarily long histories
+        pending = []
+        for chunk in chunks:
+            pending.append(executor.submit(audit_transitions, chunk, consecutive))
+            if len(pending) >= 4 * processes:
+                merge(pending.pop(0).result())
+        for job in pending:
+            merge(job.result())
+    return report
+
+
+def main(
+    dump: Optional[str] = None,
+    index: Optional[str] = None,
+    processes: Optional[int] = None,
+    # write the dump from the configured kupo instance before auditing it
+    from_kupo: bool = False,
+    stakechain_version: str = "v1",
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+):
+    """
+    Audit the stake chain history from a dump file or (with fewer checks) from the block index
+    """
+    if from_kupo:
+        assert dump is not None, "The dump path is required to dump from kupo"
+        assert network_kupo_url is not None, "No kupo instance configured"
+        _, _, stakechain_address = get_contract("stakechain_" + stakechain_version)
+        _, _, stakeholder_address = get_contract("stakeholder")
+        written = dump_from_kupo(
+            network_kupo_url,
+            str(stakechain_address),
+            token_from_string(stakechain_auth_nft),
+            dump,
+            str(stakeholder_address),
+        )
+        print(f"Dumped {written} stake chain states to {dump}")
+    if dump is not None:
+        report = audit(records_from_dump(dump), processes=processes)
+    else:
+        report = audit(
+            records_from_index(index), consecutive=False, processes=processes
+        )
+    for anomaly in report.anomalies:
+        print(anomaly)
+    print(
+        f"Verified {report.transitions} transitions ({report.blocks} blocks), "
+        f"skipped {report.skipped}, found {len(report.anomalies)} anomalies"
+    )
+    if report.anomalies:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -1,4 +1,3 @@
-import datetime
 import fractions
 from typing import Optional
 
@@ -34,6 +33,7 @@ from steak_protocol.onchain.types import (
     ProducerState,
 )
 from steak_protocol.utils import get_signing_info, network, context
+from steak_protocol.utils.clock import Clock, system_clock
 from steak_protocol.utils.contracts import get_contract
 from steak_protocol.utils.network import show_tx
 from steak_protocol.utils.to_script_context import (
@@ -91,6 +91,7 @@ def main(
     return_tx: bool = False,
     return_addr: Optional[str] = None,
     stakechain_version: ContractVersion = VERSION_0,
+    clock: Clock = system_clock,
 ):
     payment_vkey, payment_skey, payment_address = get_signing_info(
         name, network=network
@@ -154,7 +155,7 @@ def main(
             stake_coin=stake_coin,
             fraction_per_block=to_fraction(fractions.Fraction(fraction_per_block)),
             auth_nft=stakechain_auth_nft,
-            genesis_time=int(datetime.datetime.now().timestamp() * 1000),
+            genesis_time=clock.now(),
             register_fee=register_fee,
             upgrade_approval=ScriptCredential(stakechain_upgrade_script_hash.payload),
             num_slot_leaders=num_slot_leaders,
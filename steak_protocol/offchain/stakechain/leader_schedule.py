@@ -0,0 +1,178 @@
+"""
+Bulk computation of the slot leader schedule of the stake chain.
+
+The slot leader `k` of a slot is elected with the random number
+`sha2_256(bytes_big_from_unsigned_int(k) + block_hash + bytes_big_from_unsigned_int(slot))[:8]`
+(see `compute_slot_leader` and `random_number`).
+Analytics and audits need this number for every (k, slot) pair over long horizons,
+so the seeds are laid out in contiguous buffers and hashed in bulk, optionally across processes.
+"""
+
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Sequence, Union
+
+import fire
+import numpy as np
+
+from steak_protocol.onchain.types import StakeChainV1State
+
+# below this number of seeds, spawning processes is slower than hashing directly
+MIN_SEEDS_PER_PROCESS = 200_000
+
+
+def _byte_lengths(values: np.ndarray) -> np.ndarray:
+    """
+    Length of bytes_big_from_unsigned_int for each value (at least one byte)
+    """
+    lengths = np.ones(len(values), dtype=np.int64)
+    for i in range(1, 8):
+        lengths[values >= np.uint64(1) << np.uint64(8 * i)] = i + 1
+    return lengths
+
+
+def _hash_rows(buffer: bytes, width: int) -> bytes:
+    """
+    Hash every row of the given width and return the concatenated first 8 bytes of the digests
+    """
+    sha256 = hashlib.sha256
+    view = memoryview(buffer)
+    return b"".join(
+        [sha256(view[i : i + width]).digest()[:8] for i in range(0, len(buffer), width)]
+    )
+
+
+def _seed_buffer(
+    prefixes: np.ndarray, block_hashes: np.ndarray, slots: np.ndarray, slot_length: int
+) -> np.ndarray:
+    """
+    Contiguous buffer with one seed per row: prefix + block hash + big endian slot of the given length
+    """
+    prefix_length = prefixes.shape[1]
+    buffer = np.empty(
+        (len(slots), prefix_length + 32 + slot_length), dtype=np.uint8, order="C"
+    )
+    buffer[:, :prefix_length] = prefixes
+    buffer[:, prefix_length : prefix_length + 32] = block_hashes
+    for j in range(slot_length):
+        shift = np.uint64(8 * (slot_length - 1 - j))
+        buffer[:, prefix_length + 32 + j] = (slots >> shift) & np.uint64(0xFF)
+    return buffer
+
+
+def leader_random_numbers(
+    block_hashes: Union[bytes, Sequence[bytes]],
+    slots: Sequence[int],
+    slot_leader_number: int,
+    processes: Optional[int] = None,
+) -> np.ndarray:
+    """
+    The 64 bit random numbers that elect slot leader `slot_leader_number` in the given slots.
+    `block_hashes` is either the hash of the current block (shared by all slots) or one block hash per slot.
+
+    If `processes` is given, large batches are hashed across that many processes.
+    """
+    slots = np.asarray(slots, dtype=np.uint64)
+    n = len(slots)
+    if isinstance(block_hashes, bytes):
+        hash_rows = np.frombuffer(block_hashes, dtype=np.uint8)[None, :]
+    else:
+        assert len(block_hashes) == n, "Expected one block hash per slot"
+        hash_rows = np.frombuffer(b"".join(block_hashes), dtype=np.uint8).reshape(n, 32)
+    k = slot_leader_number
+    prefix = np.frombuffer(
+        k.to_bytes(max(1, (k.bit_length() + 7) // 8), "big"), dtype=np.uint8
+    )[None, :]
+
+    # seeds have the same width within a group of equally long slot numbers
+    lengths = _byte_lengths(slots)
+    groups = []
+    for slot_length in np.unique(lengths).tolist():
+        (indices,) = np.nonzero(lengths == slot_length)
+        buffer = _seed_buffer(
+            prefix,
+            hash_rows if hash_rows.shape[0] == 1 else hash_rows[indices],
+            slots[indices],
+            slot_length,
+        )
+        groups.append((indices, buffer))
+
+    if processes is not None and processes > 1 and n >= 2 * MIN_SEEDS_PER_PROCESS:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            jobs = []
+            for indices, buffer in groups:
+                width = buffer.shape[1]
+                chunk = max(MIN_SEEDS_PER_PROCESS, -(-len(indices) // processes))
+                for start in range(0, len(indices), chunk):
+                    jobs.append(
+                        (
+                            indices[start : start + chunk],
+                            executor.submit(
+                                _hash_rows,
+                                buffer[start : start + chunk].tobytes(),
+                                width,
+                            ),
+                        )
+                    )
+            results = [(indices, job.result()) for indices, job in jobs]
+    else:
+        results = [
+            (indices, _hash_rows(buffer.tobytes(), buffer.shape[1]))
+            for indices, buffer in groups
+        ]
+
+    random_numbers = np.empty(n, dtype=np.uint64)
+    for indices, digests in results:
+        random_numbers[indices] = np.frombuffer(digests, dtype=">u8")
+    return random_numbers
+
+
+def leader_schedule(
+    state: StakeChainV1State,
+    slots: Sequence[int],
+    processes: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Index of the elected slot leaders (in the holder list of the state) for the given slots,
+    assuming that no block is produced in between.
+    Returns an array of shape (num_slot_leaders + 1, len(slots)), row k holds slot leader k.
+    """
+    skip_holders = state.skip_holders
+    weights = np.asarray(
+        state.holder_state.stake_holder_weights[skip_holders:], dtype=np.int64
+    )
+    cumulative_weights = np.cumsum(weights)
+    total = np.uint64(cumulative_weights[-1])
+    schedule = np.empty((state.params.num_slot_leaders + 1, len(slots)), dtype=np.int64)
+    for k in range(state.params.num_slot_leaders + 1):
+        r = leader_random_numbers(
+            state.chain_state.block_hash, slots, k, processes=processes
+        )
+        schedule[k] = (
+            np.searchsorted(cumulative_weights, (r % total).astype(np.int64))
+            + skip_holders
+        )
+    return schedule
+
+
+def main(
+    state_cbor_hex: str,
+    holder_id: str,
+    n_slots: int = 1000,
+    processes: Optional[int] = None,
+):
+    """
+    Print the upcoming slots in which the given holder is elected, assuming no block is produced in between
+    """
+    state = StakeChainV1State.from_cbor(bytes.fromhex(state_cbor_hex))
+    holder_index = state.holder_state.stake_holder_ids.index(holder_id.encode())
+    interval = state.params.slot_leader_interval
+    first_slot = (state.chain_state.slot_number // interval + 1) * interval
+    slots = np.arange(first_slot, first_slot + n_slots * interval, interval)
+    schedule = leader_schedule(state, slots, processes=processes)
+    for k, slot_index in zip(*np.nonzero(schedule == holder_index)):
+        print(f"slot {slots[slot_index]}: slot leader {k}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
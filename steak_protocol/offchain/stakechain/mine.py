@@ -1,8 +1,8 @@
 import copy
-import datetime
+import math
 import secrets
 import time
-from typing import Optional
+from typing import List, Optional, Sequence, Tuple, Union
 
 import fire
 import pycardano
@@ -11,6 +11,7 @@ from opshin.ledger.api_v2 import (
     NoOutputDatum,
     SomeOutputDatumHash,
 )
+from opshin.prelude import Token
 from opshin.std.builtins import sha2_256
 from opshin.std.math import bytes_big_from_unsigned_int
 from opshin.std.fractions import floor_fraction, ceil_fraction
@@ -39,36 +40,145 @@ from steak_protocol.offchain.util import (
     commit_hash_secrets,
     write_ahead_hash_secrets,
     all_committed_hash_secrets,
+    next_hash_secret,
     ContractVersion,
     VERSION_0,
     VERSION_1,
+    VERSION_2,
+    find_stakechain_params,
+)
+from steak_protocol.offchain.wallet import select_collateral, select_inputs
+from steak_protocol.onchain.stakechain import (
+    stakechain_v0,
+    stakechain_v1,
+    stakechain_v2,
 )
-from steak_protocol.onchain.stakechain import stakechain_v0, stakechain_v1
 from steak_protocol.onchain.stakeholder.stakeholder import UpdateStake
 from steak_protocol.onchain.types import (
     StakeChainV0State,
+    StakeChainV1Params,
     StakeChainV1State,
+    StakeChainV2State,
     CoreChainState,
     StakeHolderState,
     ProducerState,
 )
 from steak_protocol.onchain.util import scale_fraction
-from steak_protocol.utils import get_signing_info, network, context
+from steak_protocol.utils import get_signing_info, context
+from steak_protocol.utils.clock import Clock, system_clock
 from steak_protocol.utils.contracts import get_contract, get_ref_utxo
+from steak_protocol.utils.metrics import registry, serve
 from steak_protocol.utils.network import show_tx
+from steak_protocol.utils.profiling import profiler, span
 from steak_protocol.utils.to_script_context import (
     to_tx_out_ref,
     to_address,
 )
 
+# how frequently to check whether the submitted block made it to the chain
+CONFIRMATION_POLL_INTERVAL = 10
+
+ATTEMPTS = registry.counter(
+    "steak_mine_attempts_total",
+    "Mining attempts by outcome (mined, not_leader, slot_passed, lost, error)",
+    ["outcome"],
+)
+CURRENT_SLOT = registry.gauge(
+    "steak_mine_current_slot", "Stake chain slot of the last mining attempt"
+)
+ELECTED = registry.gauge(
+    "steak_mine_elected", "1 if the pool is the slot leader of the current slot"
+)
+LEADER_SLOTS = registry.counter(
+    "steak_mine_leader_slots_total", "Slots in which the pool was the slot leader"
+)
+MISSED_SLOTS = registry.counter(
+    "steak_mine_missed_slots_total",
+    "Slots in which the pool was the slot leader but did not mine a block",
+)
+SUBMIT_SECONDS = registry.histogram(
+    "steak_mine_submit_seconds", "Latency of submitting the block transaction"
+)
+SLOT_OFFSET_SECONDS = registry.histogram(
+    "steak_mine_slot_offset_seconds",
+    "Time since the start of the stake chain slot when the block was submitted",
+    buckets=(1, 2, 5, 10, 15, 20, 30, 40, 50, 60, math.inf),
+)
+CONFIRMATION_SECONDS = registry.histogram(
+    "steak_mine_confirmation_seconds",
+    "Delay until the submitted block transaction was seen on chain",
+    buckets=(5, 10, 20, 30, 45, 60, 90, 120, 180, 300, math.inf),
+)
+
+
+class NotSlotLeader(Exception):
+    """
+    The pool is not the slot leader of the current slot
+    """
+
+
+class SlotPassed(Exception):
+    """
+    The slot passed before the block could be submitted
+    """
 
-def compute_current_slot(genesis_time: int, slot_length: int) -> int:
-    current_time = int(datetime.datetime.now().timestamp() * 1000)
+
+class BlockLost(Exception):
+    """
+    The block transaction was submitted but did not make it to the chain
+    """
+
+
+class LeaderSlotTracker:
+    """
+    Counts the slots in which the pool was elected and, once a slot has passed, whether it was missed
+    """
+
+    def __init__(self):
+        self.slot = None
+        self.elected = False
+        self.mined = False
+
+    def observe(self, slot: Optional[int], elected: bool, mined: bool):
+        if slot != self.slot:
+            if self.elected and not self.mined:
+                MISSED_SLOTS.inc()
+            self.slot, self.elected, self.mined = slot, elected, False
+            if elected:
+                LEADER_SLOTS.inc()
+        self.mined = self.mined or mined
+
+
+def report_attempt(error: Optional[Exception], leader_slots: LeaderSlotTracker):
+    """
+    Print and record the outcome of a mining attempt (error is None if a block was mined)
+    """
+    if error is None:
+        outcome = "mined"
+        print("Block mined! Trying again in 5 seconds...")
+    else:
+        outcome = {
+            NotSlotLeader: "not_leader",
+            SlotPassed: "slot_passed",
+            BlockLost: "lost",
+        }.get(type(error), "error")
+        print(error)
+        print("Press Ctrl+C to stop. Trying again in 5 seconds...")
+    ATTEMPTS.inc(outcome=outcome)
+    leader_slots.observe(CURRENT_SLOT.value(), bool(ELECTED.value()), error is None)
+
+
+def compute_current_slot(
+    genesis_time: int, slot_length: int, clock: Clock = system_clock
+) -> int:
+    current_time = clock.now()
     return (current_time - genesis_time) // slot_length
 
 
-def compute_validity_interval(genesis_time: int, slot_length: int) -> tuple[int, int]:
-    suggested_slot = compute_current_slot(genesis_time, slot_length)
+def compute_validity_interval(
+    genesis_time: int, slot_length: int, clock: Clock = system_clock
+) -> tuple[int, int]:
+    suggested_slot = compute_current_slot(genesis_time, slot_length, clock)
     min_acceptable_lower_bound = genesis_time + slot_length * suggested_slot
     max_acceptable_upper_bound = min_acceptable_lower_bound + slot_length
     return min_acceptable_lower_bound, max_acceptable_upper_bound
@@ -90,49 +200,63 @@ def main(
     # higher values may lead to more frequent missed blocks
     commit_interval: int = 120,
     stakechain_version=VERSION_1,
+    clock: Clock = system_clock,
+    # serve the metrics at http://127.0.0.1:<metrics_port>/metrics
+    metrics_port: Optional[int] = None,
 ):
+    if metrics_port is not None:
+        serve(metrics_port)
+    leader_slots = LeaderSlotTracker()
     while True:
         try:
-            mine(
-                name=name,
-                stakechain_auth_nft=stakechain_auth_nft,
-                pool_id=stakepool_id,
-                producer_message_hash_hex=producer_message_hash_hex,
-                tx_validity_width=tx_validity_width,
-                commit_interval=commit_interval,
-                stakechain_version=stakechain_version,
-            )
+            with profiler.operation("mine"):
+                mine(
+                    name=name,
+                    stakechain_auth_nft=stakechain_auth_nft,
+                    pool_id=stakepool_id,
+                    producer_message_hash_hex=producer_message_hash_hex,
+                    tx_validity_width=tx_validity_width,
+                    commit_interval=commit_interval,
+                    stakechain_version=stakechain_version,
+                    clock=clock,
+                )
         except KeyboardInterrupt:
             break
         except Exception as e:
-            print(e)
-            print("Press Ctrl+C to stop. Trying again in 5 seconds...")
+            report_attempt(e, leader_slots)
         else:
-            print("Block mined! Trying again in 5 seconds...")
-        time.sleep(retry_interval)
+            report_attempt(None, leader_slots)
+        clock.sleep(retry_interval)
 
 
-def mine(
-    name: str = "admin",
-    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
-    pool_id: str = "1番",
-    producer_message_hash_hex: Optional[str] = None,
-    tx_validity_width: int = 40,
-    commit_interval: int = 120,
-    stakechain_version: ContractVersion = VERSION_0,
-):
-    _, payment_skey, payment_address = get_signing_info(name, network=network)
+def wait_for_confirmation(
+    tx_id: str,
+    commit_interval: float,
+    clock: Clock = system_clock,
+    chain_context: pycardano.ChainContext = context,
+) -> Optional[float]:
+    """
+    Waits for the commit interval and returns the number of seconds
+    until the transaction was first seen on chain (None if it was not seen)
+    """
+    start = clock.now()
+    confirmed = None
+    while True:
+        elapsed = (clock.now() - start) / 1000
+        if confirmed is None and chain_context.utxo_by_tx_id(tx_id, 0) is not None:
+            confirmed = elapsed
+            CONFIRMATION_SECONDS.observe(confirmed)
+        if elapsed >= commit_interval:
+            return confirmed
+        clock.sleep(min(CONFIRMATION_POLL_INTERVAL, commit_interval - elapsed))
 
-    stakechain_script, _, stakechain_address = get_contract(
-        "stakechain_" + stakechain_version
-    )
-    stakeholder_script, _, stakeholder_address = get_contract("stakeholder")
-    stakechain_auth_nft = token_from_string(stakechain_auth_nft)
-    stakepool_script, stakepool_script_hash, _ = get_contract("stakepool")
 
-    stakechain_utxo = None
-    stakechain_state = None
-    for u in context.utxos(stakechain_address):
+def find_stakechain_state(
+    stakechain_utxos: List[UTxO],
+    stakechain_auth_nft: Token,
+    stakechain_version: ContractVersion,
+) -> Tuple[UTxO, Union[StakeChainV0State, StakeChainV1State, StakeChainV2State]]:
+    for u in stakechain_utxos:
         if amount_of_token_in_value(stakechain_auth_nft, u.output.amount) == 0:
             continue
         try:
@@ -140,29 +264,44 @@ def mine(
                 stakechain_state = StakeChainV0State.from_cbor(u.output.datum.cbor)
             elif stakechain_version == VERSION_1:
                 stakechain_state = StakeChainV1State.from_cbor(u.output.datum.cbor)
+            elif stakechain_version == VERSION_2:
+                stakechain_state = StakeChainV2State.from_cbor(u.output.datum.cbor)
             else:
                 continue
         except DeserializeException:
             continue
-        stakechain_utxo = u
-        break
-    assert stakechain_utxo is not None, "No stake chain state found"
+        return u, stakechain_state
+    raise AssertionError("No stake chain state found")
+
+
+def find_params(
+    stakechain_utxos: List[UTxO],
+    stakechain_state: Union[StakeChainV0State, StakeChainV1State, StakeChainV2State],
+    stakechain_version: ContractVersion,
+) -> Tuple[Optional[UTxO], StakeChainV1Params]:
+    """
+    Returns the params of the stake chain and, for V2, the output holding them
+    (stored next to the stake chain state)
+    """
+    if stakechain_version == VERSION_2:
+        return find_stakechain_params(stakechain_utxos, stakechain_state.params_hash)
+    return None, stakechain_state.params
 
-    stakecoin = stakechain_state.params.stake_coin
-    assert stakechain_state.params.stakeholder_address == to_address(
-        stakeholder_address
-    ), "Wrong stakeholder address"
 
-    stakeholder_secretss = all_committed_hash_secrets(pool_id)
+def find_stakeholder_state(
+    stakeholder_utxos: List[UTxO],
+    stakechain_auth_nft: Token,
+    pool_id: str,
+    stakeholder_secretss: List[List[bytes]],
+) -> Tuple[UTxO, StakeHolderState, List[bytes]]:
+    """
+    Find the stake holder utxo of the pool whose committed hashes match one of the stored secret lists
+    """
     all_stakeholder_secret_hashes = [
         [sha2_256(x) for x in stakeholder_secrets]
         for stakeholder_secrets in stakeholder_secretss
     ]
-    # prepare stake holder utxo
-    stakeholder_utxo = None
-    stakeholder_state = None
-    steakholder_secrets_match = None
-    for u in context.utxos(stakeholder_address):
+    for u in stakeholder_utxos:
         try:
             stakeholder_state = StakeHolderState.from_cbor(u.output.datum.cbor)
             if (
@@ -173,30 +312,126 @@ def mine(
                     all_stakeholder_secret_hashes
                 ):
                     if stakeholder_state.committed_hashes == stakeholder_secret_hashes:
-                        steakholder_secrets_match = stakeholder_secretss[i]
-                        break
-            if steakholder_secrets_match is not None:
-                stakeholder_utxo = u
-                break
+                        return u, stakeholder_state, stakeholder_secretss[i]
         except DeserializeException:
             continue
         except AttributeError:
             continue
-    assert (
-        stakeholder_utxo is not None
-    ), "No stake holder state found. Correct secrets and pool name?"
-    stakeholder_secrets = steakholder_secrets_match
-
-    own_index_in_stakeholder_list = (
-        stakechain_state.holder_state.stake_holder_ids.index(
-            stakeholder_state.params.stakechain_id
-        )
-    )
+    raise AssertionError("No stake holder state found. Correct secrets and pool name?")
+
 
+def elect_pool(
+    stakechain_state: Union[StakeChainV0State, StakeChainV1State, StakeChainV2State],
+    pool_ids: Sequence[str],
+    stakechain_version: ContractVersion,
+    clock: Clock = system_clock,
+    elected_slot_leader: int = 0,
+    stakechain_params: Optional[StakeChainV1Params] = None,
+) -> Tuple[int, str, int]:
+    """
+    Determines which of the pools may mine a block in the current slot.
+    The slot leader is computed once, independent of the number of pools.
+    Returns the current slot, the elected pool and its index in the holder list.
+    Raises NotSlotLeader if none of the pools may mine a block in the current slot.
+    The params are required for V2 states, which only carry their hash.
+    """
+    params = stakechain_state.params if stakechain_params is None else stakechain_params
+    stake_holder_ids = stakechain_state.holder_state.stake_holder_ids
+    assert any(
+        pool_id.encode() in stake_holder_ids for pool_id in pool_ids
+    ), "None of the pools is registered in the stake chain"
     current_slot_number = compute_current_slot(
-        stakechain_state.params.genesis_time, stakechain_state.params.slot_length
+        params.genesis_time,
+        params.slot_length,
+        clock,
     )
-    elected_slot_leader = 0  # just assume we are the leader and try to submit
+    compute_slot_leader = {
+        VERSION_0: stakechain_v0.compute_slot_leader,
+        VERSION_1: stakechain_v1.compute_slot_leader,
+        VERSION_2: stakechain_v2.compute_slot_leader,
+    }[stakechain_version]
+    elected_pool = None
+    if (
+        stakechain_version == VERSION_0
+        or current_slot_number % params.slot_leader_interval == 0
+    ):
+        leader_index = compute_slot_leader(
+            stakechain_state, current_slot_number, elected_slot_leader
+        )
+        leader_id = stake_holder_ids[leader_index]
+        elected_pool = next(
+            (pool_id for pool_id in pool_ids if pool_id.encode() == leader_id), None
+        )
+    CURRENT_SLOT.set(current_slot_number)
+    ELECTED.set(int(elected_pool is not None))
+    if elected_pool is None:
+        # the contract would reject the block, save the queries, evaluation and submission
+        raise NotSlotLeader(f"Not the slot leader of slot {current_slot_number}")
+    return current_slot_number, elected_pool, leader_index
+
+
+def check_slot_leader(
+    stakechain_state: Union[StakeChainV0State, StakeChainV1State, StakeChainV2State],
+    pool_id: str,
+    stakechain_version: ContractVersion,
+    clock: Clock = system_clock,
+    elected_slot_leader: int = 0,
+    stakechain_params: Optional[StakeChainV1Params] = None,
+) -> Tuple[int, int]:
+    """
+    Returns the current slot and the index of the pool in the holder list.
+    Raises NotSlotLeader if the pool may not mine a block in the current slot.
+    """
+    current_slot_number, _, own_index_in_stakeholder_list = elect_pool(
+        stakechain_state,
+        [pool_id],
+        stakechain_version,
+        clock,
+        elected_slot_leader,
+        stakechain_params,
+    )
+    return current_slot_number, own_index_in_stakeholder_list
+
+
+def build_block(
+    stakechain_utxo: UTxO,
+    stakechain_state: Union[StakeChainV0State, StakeChainV1State, StakeChainV2State],
+    stakeholder_utxo: UTxO,
+    stakeholder_state: StakeHolderState,
+    stakeholder_secrets: List[bytes],
+    payment_utxos: List[UTxO],
+    stakechain_script: Union[pycardano.PlutusV2Script, UTxO],
+    stakeholder_script: Union[pycardano.PlutusV2Script, UTxO],
+    stakepool_script: pycardano.PlutusV2Script,
+    stakepool_script_hash: pycardano.ScriptHash,
+    stakechain_address: Address,
+    stakeholder_address: Address,
+    payment_skey: pycardano.PaymentSigningKey,
+    payment_address: Address,
+    current_slot_number: int,
+    own_index_in_stakeholder_list: int,
+    last_block_slot: int,
+    producer_message_hash_hex: Optional[str] = None,
+    tx_validity_width: int = 40,
+    stakechain_version: ContractVersion = VERSION_0,
+    elected_slot_leader: int = 0,
+    stakechain_params_utxo: Optional[UTxO] = None,
+    stakechain_params: Optional[StakeChainV1Params] = None,
+    new_hash_secret: Optional[bytes] = None,
+    chain_context: pycardano.ChainContext = context,
+) -> Tuple[
+    pycardano.Transaction,
+    Union[StakeChainV0State, StakeChainV1State, StakeChainV2State],
+    List[bytes],
+]:
+    """
+    Build and sign the block transaction.
+    For V2, the output holding the params is added as reference input.
+    The newly committed secret is random unless given (i.e. derived from the seed of the holder).
+    Returns the transaction, the new stake chain state and the new stake holder secrets.
+    """
+    params = stakechain_state.params if stakechain_params is None else stakechain_params
+    stakecoin = params.stake_coin
     new_core_chain_state = CoreChainState(
         block_number=stakechain_state.chain_state.block_number + 1,
         block_hash=sha2_256(
@@ -215,76 +450,107 @@ def mine(
         if producer_message_hash_hex is None
         else SomeOutputDatumHash(datum_hash=bytes.fromhex(producer_message_hash_hex))
     )
-    new_stakechain_state_type = (
-        StakeChainV0State if stakechain_version == VERSION_0 else StakeChainV1State
+    new_producer_state = ProducerState(
+        producer_signature=slot_leader_sig,
+        auxiliary=producer_message,
+        prev_producer_state_hash=sha2_256(stakechain_state.producer_state.to_cbor()),
     )
-    new_stakechain_state = new_stakechain_state_type(
-        params=stakechain_state.params,
-        holder_state=stakechain_state.holder_state,
-        chain_state=new_core_chain_state,
-        producer_state=ProducerState(
-            producer_signature=slot_leader_sig,
-            auxiliary=producer_message,
-            prev_producer_state_hash=sha2_256(
-                stakechain_state.producer_state.to_cbor()
+    if stakechain_version == VERSION_2:
+        assert stakechain_params_utxo is not None, "V2 requires the params output"
+        new_stakechain_state = StakeChainV2State(
+            params_hash=stakechain_state.params_hash,
+            holder_state=stakechain_state.holder_state,
+            chain_state=new_core_chain_state,
+            producer_state=new_producer_state,
+            agreement=stakechain_v2.next_agreement(
+                stakechain_state.agreement, producer_message
             ),
-        ),
-        skip_holders=0,
-        spent_for=to_tx_out_ref(stakechain_utxo.input),
-    )
+            skip_holders=0,
+            spent_for=to_tx_out_ref(stakechain_utxo.input),
+        )
+    else:
+        new_stakechain_state_type = (
+            StakeChainV0State if stakechain_version == VERSION_0 else StakeChainV1State
+        )
+        new_stakechain_state = new_stakechain_state_type(
+            params=stakechain_state.params,
+            holder_state=stakechain_state.holder_state,
+            chain_state=new_core_chain_state,
+            producer_state=new_producer_state,
+            skip_holders=0,
+            spent_for=to_tx_out_ref(stakechain_utxo.input),
+        )
 
     stakeholder_is_pool = isinstance(stakeholder_state.params.owner, ScriptCredential)
     if stakeholder_is_pool:
         pool_state = PoolState.from_cbor(stakeholder_state.aux.datum.to_cbor())
         guarantee_reward_fraction = pool_state.params.guaranteed_reward_fraction
 
-    payment_utxos = context.utxos(payment_address)
+    collateral_utxos = select_collateral(payment_utxos)
+    payment_utxos = select_inputs(payment_utxos, exclude=collateral_utxos)
     all_input_utxos = sorted_utxos(payment_utxos + [stakechain_utxo, stakeholder_utxo])
     stakeholder_utxo_index = all_input_utxos.index(stakeholder_utxo)
     stakechain_utxo_index = all_input_utxos.index(stakechain_utxo)
 
-    stakechain_script = get_ref_utxo(stakechain_script, context)
-    stakeholder_script = get_ref_utxo(stakeholder_script, context)
     all_ref_input_utxos = sorted_utxos(
         [stakeholder_utxo]
         + [
             u
-            for u in [stakechain_script, stakeholder_script, stakepool_script]
+            for u in [
+                stakechain_script,
+                stakeholder_script,
+                # the pool script is only referenced if the producer is a pool
+                stakepool_script if stakeholder_is_pool else None,
+                stakechain_params_utxo,
+            ]
             if isinstance(u, UTxO)
         ]
     )
     stakeholder_ref_utxo_index = all_ref_input_utxos.index(stakeholder_utxo)
+    # negative if the params are part of the stake chain state
+    params_ref_index = (
+        all_ref_input_utxos.index(stakechain_params_utxo)
+        if stakechain_version == VERSION_2
+        else -1
+    )
 
-    mining_redeemer_type = (
-        stakechain_v0.MineBlockUpdateStake
-        if stakechain_version == VERSION_0
-        else stakechain_v1.MineBlockUpdateStake
+    mining_redeemer_fields = dict(
+        old_state_index=stakechain_utxo_index,
+        new_state_index=0,
+        producing_holder_ref_utxo_index=stakeholder_ref_utxo_index,
+        elected_slot_leader=elected_slot_leader,
+        aux=producer_message,
+        slot_leader_secret=stakeholder_secrets[0],
+        slot_leader_sig=slot_leader_sig,
+        old_stake_index=stakeholder_utxo_index,
+        new_stake_index=1,
+        stake_index_in_holder_list=own_index_in_stakeholder_list,
     )
-    mining_redeemer = Redeemer(
-        mining_redeemer_type(
-            old_state_index=stakechain_utxo_index,
-            new_state_index=0,
-            producing_holder_ref_utxo_index=stakeholder_ref_utxo_index,
-            elected_slot_leader=elected_slot_leader,
-            aux=producer_message,
-            slot_leader_secret=stakeholder_secrets[0],
-            slot_leader_sig=slot_leader_sig,
-            old_stake_index=stakeholder_utxo_index,
-            new_stake_index=1,
-            stake_index_in_holder_list=own_index_in_stakeholder_list,
+    if stakechain_version == VERSION_0:
+        mining_redeemer = stakechain_v0.MineBlockUpdateStake(**mining_redeemer_fields)
+    elif stakechain_version == VERSION_1:
+        mining_redeemer = stakechain_v1.MineBlockUpdateStake(**mining_redeemer_fields)
+    else:
+        mining_redeemer = stakechain_v2.MineBlockUpdateStake(
+            params_ref_index=params_ref_index,
+            **mining_redeemer_fields,
         )
-    )
+    mining_redeemer = Redeemer(mining_redeemer)
 
     new_stakeholder_state = copy.deepcopy(stakeholder_state)
-    new_stakeholder_secrets = stakeholder_secrets[1:] + [secrets.token_bytes(32)]
-    new_stakeholder_state.committed_hashes = stakeholder_secret_hashes[1:] + [
+    if new_hash_secret is None:
+        new_hash_secret = secrets.token_bytes(32)
+    new_stakeholder_secrets = stakeholder_secrets[1:] + [new_hash_secret]
+    new_stakeholder_state.committed_hashes = stakeholder_state.committed_hashes[1:] + [
         sha2_256(new_stakeholder_secrets[-1])
     ]
 
-    txbuilder = TransactionBuilder(context)
+    txbuilder = TransactionBuilder(chain_context)
     for u in payment_utxos:
         txbuilder.add_input(u)
     txbuilder.reference_inputs.add(stakeholder_utxo)
+    if stakechain_params_utxo is not None:
+        txbuilder.reference_inputs.add(stakechain_params_utxo)
     txbuilder.add_script_input(
         stakechain_utxo,
         stakechain_script,
@@ -310,7 +576,7 @@ def mine(
                 bytes(
                     Address(
                         staking_part=stakepool_script_hash,
-                        network=network,
+                        network=chain_context.network,
                     )
                 ): 0
             }
@@ -323,6 +589,7 @@ def mine(
                     own_output_index=1,
                     chain_input_index=stakechain_utxo_index,
                     chain_output_index=0,
+                    params_ref_index=params_ref_index,
                 )
             ),
         )
@@ -332,7 +599,7 @@ def mine(
         stakecoin, stakechain_utxo.output.amount
     )
     amount_to_be_distributed = floor_fraction(
-        scale_fraction(prev_reserve_amount, stakechain_state.params.fraction_per_block)
+        scale_fraction(prev_reserve_amount, params.fraction_per_block)
     )
     desired_new_value = stakechain_utxo.output.amount.multi_asset - asset_from_token(
         stakecoin, amount_to_be_distributed
@@ -368,10 +635,10 @@ def mine(
                 ),
                 datum=new_stakeholder_state,
             ),
-            context,
+            chain_context,
         )
     )
-    txbuilder.validity_start = context.last_block_slot + 1
+    txbuilder.validity_start = last_block_slot + 1
     txbuilder.ttl = txbuilder.validity_start + tx_validity_width
     txbuilder.auxiliary_data = pycardano.AuxiliaryData(
         data=pycardano.AlonzoMetadata(
@@ -382,25 +649,141 @@ def mine(
             )
         )
     )
-    txbuilder.collaterals = sorted(
-        payment_utxos, key=lambda x: x.output.amount.coin, reverse=True
-    )[:3]
-    tx = txbuilder.build_and_sign(
-        signing_keys=[payment_skey],
-        change_address=payment_address,
-    )
+    txbuilder.collaterals = collateral_utxos
+    with span("mine.build_and_sign"):
+        tx = txbuilder.build_and_sign(
+            signing_keys=[payment_skey],
+            change_address=payment_address,
+        )
 
+    return tx, new_stakechain_state, new_stakeholder_secrets
+
+
+def submit_block(
+    tx: pycardano.Transaction,
+    stakechain_state: Union[StakeChainV0State, StakeChainV1State, StakeChainV2State],
+    pool_id: str,
+    new_stakeholder_secrets: List[bytes],
+    commit_interval: int = 120,
+    clock: Clock = system_clock,
+    stakechain_params: Optional[StakeChainV1Params] = None,
+    chain_context: pycardano.ChainContext = context,
+):
+    params = stakechain_state.params if stakechain_params is None else stakechain_params
     # MODIFY THESE STEPS AT YOUR OWN RISK, may lead to need to recover the pool secrets
     write_ahead_hash_secrets(pool_id, new_stakeholder_secrets)
-    context.submit_tx(tx)
+    SLOT_OFFSET_SECONDS.observe(
+        (clock.now() - params.genesis_time) % params.slot_length / 1000
+    )
+    submit_start = time.perf_counter()
+    with span("mine.submit_tx"):
+        chain_context.submit_tx(tx)
+    SUBMIT_SECONDS.observe(time.perf_counter() - submit_start)
     show_tx(tx)
     print("Checking if tx made it to the chain... DO NOT ABORT")
-    time.sleep(commit_interval)
-    assert (
-        context.utxo_by_tx_id(tx.id.payload.hex(), 0) is not None
-    ), "Transaction not found, aborting"
+    wait_for_confirmation(tx.id.payload.hex(), commit_interval, clock, chain_context)
+    if chain_context.utxo_by_tx_id(tx.id.payload.hex(), 0) is None:
+        raise BlockLost("Transaction not found, aborting")
     # END OF DANGER ZONE
     commit_hash_secrets(pool_id, new_stakeholder_secrets)
+
+
+def mine(
+    name: str = "admin",
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+    pool_id: str = "1番",
+    producer_message_hash_hex: Optional[str] = None,
+    tx_validity_width: int = 40,
+    commit_interval: int = 120,
+    stakechain_version: ContractVersion = VERSION_0,
+    clock: Clock = system_clock,
+    chain_context: pycardano.ChainContext = context,
+):
+    _, payment_skey, payment_address = get_signing_info(
+        name, network=chain_context.network
+    )
+
+    stakechain_script, _, stakechain_address = get_contract(
+        "stakechain_" + stakechain_version
+    )
+    stakeholder_script, _, stakeholder_address = get_contract("stakeholder")
+    stakechain_auth_nft = token_from_string(stakechain_auth_nft)
+    stakepool_script, stakepool_script_hash, _ = get_contract("stakepool")
+
+    with span("mine.query_stakechain"):
+        stakechain_utxos = chain_context.utxos(stakechain_address)
+    with span("mine.decode_stakechain"):
+        stakechain_utxo, stakechain_state = find_stakechain_state(
+            stakechain_utxos, stakechain_auth_nft, stakechain_version
+        )
+        stakechain_params_utxo, stakechain_params = find_params(
+            stakechain_utxos, stakechain_state, stakechain_version
+        )
+    assert stakechain_params.stakeholder_address == to_address(
+        stakeholder_address
+    ), "Wrong stakeholder address"
+
+    current_slot_number, own_index_in_stakeholder_list = check_slot_leader(
+        stakechain_state,
+        pool_id,
+        stakechain_version,
+        clock,
+        stakechain_params=stakechain_params,
+    )
+
+    with span("mine.load_secrets"):
+        stakeholder_secretss = all_committed_hash_secrets(pool_id)
+    with span("mine.query_stakeholder"):
+        stakeholder_utxos = chain_context.utxos(stakeholder_address)
+    with span("mine.decode_stakeholder"):
+        stakeholder_utxo, stakeholder_state, stakeholder_secrets = (
+            find_stakeholder_state(
+                stakeholder_utxos, stakechain_auth_nft, pool_id, stakeholder_secretss
+            )
+        )
+
+    with span("mine.query_payment_utxos"):
+        payment_utxos = chain_context.utxos(payment_address)
+    with span("mine.get_ref_utxo"):
+        stakechain_script = get_ref_utxo(stakechain_script, chain_context)
+        stakeholder_script = get_ref_utxo(stakeholder_script, chain_context)
+
+    tx, new_stakechain_state, new_stakeholder_secrets = build_block(
+        stakechain_utxo,
+        stakechain_state,
+        stakeholder_utxo,
+        stakeholder_state,
+        stakeholder_secrets,
+        payment_utxos,
+        stakechain_script,
+        stakeholder_script,
+        stakepool_script,
+        stakepool_script_hash,
+        stakechain_address,
+        stakeholder_address,
+        payment_skey,
+        payment_address,
+        current_slot_number,
+        own_index_in_stakeholder_list,
+        chain_context.last_block_slot,
+        producer_message_hash_hex=producer_message_hash_hex,
+        tx_validity_width=tx_validity_width,
+        stakechain_version=stakechain_version,
+        stakechain_params_utxo=stakechain_params_utxo,
+        stakechain_params=stakechain_params,
+        new_hash_secret=next_hash_secret(pool_id, stakeholder_secrets),
+        chain_context=chain_context,
+    )
+    submit_block(
+        tx,
+        stakechain_state,
+        pool_id,
+        new_stakeholder_secrets,
+        commit_interval=commit_interval,
+        clock=clock,
+        stakechain_params=stakechain_params,
+        chain_context=chain_context,
+    )
     return tx, new_stakechain_state
 
 
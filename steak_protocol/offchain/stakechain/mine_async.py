@@ -0,0 +1,338 @@
+"""
+Asyncio runtime for the miner.
+
+The chain queries of a mining attempt (stake chain, stake holder and payment utxos, reference scripts
+and the chain tip) are independent of each other, so they are issued concurrently and the critical path
+is the slowest query instead of the sum of all queries. Decoding the states and building the transaction
+run in an executor to keep the event loop responsive.
+If the slot passes before the block is built, the in-flight work is cancelled.
+
+Several pools of the same operator can be mined from one process. All pools share the queries and the
+slot leader is computed once per slot, only the secrets of the elected pool are loaded.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Sequence, TypeVar, Union
+
+import fire
+import pycardano
+
+from steak_protocol.offchain.stakechain.mine import (
+    LeaderSlotTracker,
+    SlotPassed,
+    build_block,
+    elect_pool,
+    find_params,
+    find_stakechain_state,
+    find_stakeholder_state,
+    report_attempt,
+    submit_block,
+)
+from steak_protocol.offchain.util import (
+    STAKE_CHAIN_AUTH_NFT,
+    token_from_string,
+    all_committed_hash_secrets,
+    next_hash_secret,
+    ContractVersion,
+    VERSION_0,
+    VERSION_1,
+)
+from steak_protocol.onchain.types import (
+    StakeChainV0State,
+    StakeChainV1Params,
+    StakeChainV1State,
+    StakeChainV2State,
+)
+from steak_protocol.utils import get_signing_info, network, context
+from steak_protocol.utils.clock import Clock, system_clock
+from steak_protocol.utils.contracts import get_contract, get_ref_utxo
+from steak_protocol.utils.metrics import serve
+from steak_protocol.utils.profiling import profiler, span
+from steak_protocol.utils.to_script_context import to_address
+
+T = TypeVar("T")
+
+
+class ChainQueries:
+    """
+    Runs the blocking queries of a chain context in threads, so that they can be awaited concurrently
+    """
+
+    def __init__(self, context: pycardano.ChainContext):
+        self.context = context
+
+    @staticmethod
+    async def _run(name: str, f: Callable[..., T], *args) -> T:
+        def call():
+            with span(name):
+                return f(*args)
+
+        return await asyncio.to_thread(call)
+
+    def utxos(self, address: pycardano.Address, name: str = "mine.query_utxos"):
+        return self._run(name, self.context.utxos, address)
+
+    def ref_utxo(self, script: pycardano.PlutusV2Script):
+        return self._run("mine.get_ref_utxo", get_ref_utxo, script, self.context)
+
+    def last_block_slot(self):
+        return self._run(
+            "mine.query_last_block_slot", lambda: self.context.last_block_slot
+        )
+
+
+def slot_end(
+    stakechain_state: Union[StakeChainV0State, StakeChainV1State, StakeChainV2State],
+    slot: int,
+    stakechain_version: ContractVersion,
+    stakechain_params: Optional[StakeChainV1Params] = None,
+) -> int:
+    """
+    POSIX time in milliseconds at which a block for the given slot is no longer accepted
+    """
+    params = stakechain_state.params if stakechain_params is None else stakechain_params
+    slots = 1 if stakechain_version == VERSION_0 else params.slot_leader_interval
+    return params.genesis_time + (slot + slots) * params.slot_length
+
+
+async def before(
+    awaitable: Awaitable[T], deadline: int, clock: Clock = system_clock
+) -> T:
+    """
+    Await the result, cancelling it and raising SlotPassed if the deadline (POSIX time in ms) passes first
+    """
+    timeout = max(0, (deadline - clock.now()) / 1000)
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise SlotPassed("Slot passed before the block was built")
+
+
+def as_pool_ids(pool_id: Union[str, Sequence[str]]) -> List[str]:
+    return [pool_id] if isinstance(pool_id, str) else list(pool_id)
+
+
+async def mine_async(
+    name: str = "admin",
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+    pool_id: Union[str, Sequence[str]] = "1番",
+    producer_message_hash_hex: Optional[str] = None,
+    tx_validity_width: int = 40,
+    commit_interval: int = 120,
+    stakechain_version: ContractVersion = VERSION_0,
+    clock: Clock = system_clock,
+    executor: Optional[Executor] = None,
+    queries: Optional[ChainQueries] = None,
+):
+    """
+    Same as `mine.mine`, but with concurrent queries and for one or several pools
+    """
+    pool_ids = as_pool_ids(pool_id)
+    loop = asyncio.get_running_loop()
+    queries = ChainQueries(context) if queries is None else queries
+
+    def run(f, *args, **kwargs):
+        return loop.run_in_executor(executor, functools.partial(f, *args, **kwargs))
+
+    _, payment_skey, payment_address = get_signing_info(name, network=network)
+
+    stakechain_script, _, stakechain_address = get_contract(
+        "stakechain_" + stakechain_version
+    )
+    stakeholder_script, _, stakeholder_address = get_contract("stakeholder")
+    stakechain_auth_nft = token_from_string(stakechain_auth_nft)
+    stakepool_script, stakepool_script_hash, _ = get_contract("stakepool")
+
+    # issue all queries at once, only the election and the secrets depend on the stake chain state
+    stakechain_utxos = asyncio.ensure_future(
+        queries.utxos(stakechain_address, "mine.query_stakechain")
+    )
+    stakeholder_utxos = asyncio.ensure_future(
+        queries.utxos(stakeholder_address, "mine.query_stakeholder")
+    )
+    payment_utxos = asyncio.ensure_future(
+        queries.utxos(payment_address, "mine.query_payment_utxos")
+    )
+    stakechain_ref = asyncio.ensure_future(queries.ref_utxo(stakechain_script))
+    stakeholder_ref = asyncio.ensure_future(queries.ref_utxo(stakeholder_script))
+    last_block_slot = asyncio.ensure_future(queries.last_block_slot())
+    pending = [
+        stakechain_utxos,
+        stakeholder_utxos,
+        payment_utxos,
+        stakechain_ref,
+        stakeholder_ref,
+        last_block_slot,
+    ]
+
+    async def prepare_block():
+        stakeholder_secretss = asyncio.ensure_future(
+            asyncio.to_thread(all_committed_hash_secrets, elected_pool_id)
+        )
+        pending.append(stakeholder_secretss)
+        stakeholder_utxo, stakeholder_state, stakeholder_secrets = await run(
+            find_stakeholder_state,
+            await stakeholder_utxos,
+            stakechain_auth_nft,
+            elected_pool_id,
+            await stakeholder_secretss,
+        )
+        return await run(
+            build_block,
+            stakechain_utxo,
+            stakechain_state,
+            stakeholder_utxo,
+            stakeholder_state,
+            stakeholder_secrets,
+            await payment_utxos,
+            await stakechain_ref,
+            await stakeholder_ref,
+            stakepool_script,
+            stakepool_script_hash,
+            stakechain_address,
+            stakeholder_address,
+            payment_skey,
+            payment_address,
+            current_slot_number,
+            own_index_in_stakeholder_list,
+            await last_block_slot,
+            producer_message_hash_hex=producer_message_hash_hex,
+            tx_validity_width=tx_validity_width,
+            stakechain_version=stakechain_version,
+            stakechain_params_utxo=stakechain_params_utxo,
+            stakechain_params=stakechain_params,
+            new_hash_secret=await run(
+                next_hash_secret, elected_pool_id, stakeholder_secrets
+            ),
+        )
+
+    try:
+        stakechain_utxo, stakechain_state = await run(
+            find_stakechain_state,
+            await stakechain_utxos,
+            stakechain_auth_nft,
+            stakechain_version,
+        )
+        stakechain_params_utxo, stakechain_params = await run(
+            find_params, await stakechain_utxos, stakechain_state, stakechain_version
+        )
+        assert stakechain_params.stakeholder_address == to_address(
+            stakeholder_address
+        ), "Wrong stakeholder address"
+        current_slot_number, elected_pool_id, own_index_in_stakeholder_list = (
+            elect_pool(
+                stakechain_state,
+                pool_ids,
+                stakechain_version,
+                clock,
+                stakechain_params=stakechain_params,
+            )
+        )
+        tx, new_stakechain_state, new_stakeholder_secrets = await before(
+            prepare_block(),
+            slot_end(
+                stakechain_state,
+                current_slot_number,
+                stakechain_version,
+                stakechain_params,
+            ),
+            clock,
+        )
+    finally:
+        for f in pending:
+            if f.done() and not f.cancelled():
+                # retrieve the exception of failed queries that are no longer awaited
+                f.exception()
+            f.cancel()
+
+    # the submission is never cancelled, the secrets have to be committed
+    await run(
+        submit_block,
+        tx,
+        stakechain_state,
+        elected_pool_id,
+        new_stakeholder_secrets,
+        commit_interval=commit_interval,
+        clock=clock,
+        stakechain_params=stakechain_params,
+    )
+    return tx, new_stakechain_state
+
+
+async def run_miner(
+    name: str = "admin",
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+    stakepool_id: Union[str, Sequence[str]] = "3番",
+    producer_message_hash_hex: Optional[str] = None,
+    tx_validity_width: int = 40,
+    retry_interval: int = 5,
+    commit_interval: int = 120,
+    stakechain_version: ContractVersion = VERSION_1,
+    clock: Clock = system_clock,
+):
+    for pool_id in as_pool_ids(stakepool_id):
+        assert all_committed_hash_secrets(pool_id), f"No secrets for pool {pool_id}"
+    leader_slots = LeaderSlotTracker()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            try:
+                with profiler.operation("mine"):
+                    await mine_async(
+                        name=name,
+                        stakechain_auth_nft=stakechain_auth_nft,
+                        pool_id=stakepool_id,
+                        producer_message_hash_hex=producer_message_hash_hex,
+                        tx_validity_width=tx_validity_width,
+                        commit_interval=commit_interval,
+                        stakechain_version=stakechain_version,
+                        clock=clock,
+                        executor=executor,
+                    )
+            except Exception as e:
+                report_attempt(e, leader_slots)
+            else:
+                report_attempt(None, leader_slots)
+            await asyncio.to_thread(clock.sleep, retry_interval)
+
+
+def main(
+    name: str = "admin",
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+    # one pool id or a list of pool ids to mine for (i.e. --stakepool_id='["1番","2番"]')
+    stakepool_id: Union[str, List[str]] = "3番",
+    producer_message_hash_hex: Optional[str] = None,
+    tx_validity_width: int = 40,
+    retry_interval: int = 5,
+    commit_interval: int = 120,
+    stakechain_version=VERSION_1,
+    clock: Clock = system_clock,
+    # serve the metrics at http://127.0.0.1:<metrics_port>/metrics
+    metrics_port: Optional[int] = None,
+):
+    """
+    Drop-in replacement for `mine.main` with concurrent queries, see `mine.main` for the parameters
+    """
+    if metrics_port is not None:
+        serve(metrics_port)
+    try:
+        asyncio.run(
+            run_miner(
+                name=name,
+                stakechain_auth_nft=stakechain_auth_nft,
+                stakepool_id=stakepool_id,
+                producer_message_hash_hex=producer_message_hash_hex,
+                tx_validity_width=tx_validity_width,
+                retry_interval=retry_interval,
+                commit_interval=commit_interval,
+                stakechain_version=stakechain_version,
+                clock=clock,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
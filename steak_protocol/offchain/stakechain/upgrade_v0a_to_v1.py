@@ -1,5 +1,5 @@
 import datetime
-from typing import List
+from typing import List, Optional
 
 import fire
 import pycardano
@@ -38,10 +38,13 @@ from steak_protocol.onchain.types import (
     ProducerState,
 )
 from steak_protocol.onchain.util import scale_fraction
-from steak_protocol.utils import get_signing_info, network, context
+from steak_protocol.utils import get_signing_info, network, context, kupo_url
+from steak_protocol.utils import block_index
+from steak_protocol.utils.block_index import open_index
 from steak_protocol.utils.contracts import get_contract, get_ref_utxo
+from steak_protocol.utils.datums import kupo_datum_resolver
 from steak_protocol.utils.from_script_context import from_address
-from steak_protocol.utils.network import show_tx
+from steak_protocol.utils.network import show_tx, datum_resolver
 from steak_protocol.utils.to_script_context import (
     to_tx_out_ref,
 )
@@ -63,16 +66,16 @@ def previous_producer_states_from_kupo(
     """
     utxo_url = "{}/matches/{}?order=most_recent_first".format(kupo_url, stakechain_addr)
     matches = requests.get(utxo_url).json()
+    datums = kupo_datum_resolver(kupo_url).resolve_many(
+        match["datum_hash"] for match in matches if match["datum_hash"] is not None
+    )
     initial_producer_message_hash = None
     producer_states = []
     for match in matches:
         dtm_hash = match["datum_hash"]
         if dtm_hash is None:
             break
-        datum_cbor = requests.get("{}/datums/{}".format(kupo_url, dtm_hash)).json()[
-            "datum"
-        ]
-        chain_state = StakeChainV0State.from_cbor(datum_cbor)
+        chain_state = StakeChainV0State.from_cbor(datums[dtm_hash].cbor)
         producer_state = chain_state.producer_state
         if isinstance(producer_state.auxiliary, NoOutputDatum):
             break
@@ -97,6 +100,8 @@ def main(
     return_tx: bool = True,
     stakechain_version: ContractVersion = VERSION_0,
     stakechain_upgrade_version: ContractVersion = VERSION_0a,
+    agreement_length: int = 7,
+    index_path: Optional[str] = None,
 ):
     payment_vkey, payment_skey, payment_address = get_signing_info(
         name, network=network
@@ -108,28 +113,6 @@ def main(
     stakechain_script = get_ref_utxo(stakechain_script, context)
     stakechain_auth_nft = token_from_string(stakechain_auth_nft)
 
-    if previous_producer_states_cbor is None:
-        previous_producer_states = previous_producer_states_from_kupo(
-            kupo_url="http://localhost:1991",
-            stakechain_addr=stakechain_address,
-            context=context,
-        )[1:]
-    else:
-        previous_producer_states = [
-            ProducerState.from_cbor(cbor) for cbor in previous_producer_states_cbor
-        ]
-    assert len(previous_producer_states) + 1 == 7, "Want 7 previous producer states"
-
-    stakechain_upgrade_script_raw, _, _ = get_contract(
-        "stakechain_upgrade_" + stakechain_upgrade_version, compressed=True
-    )
-    stakechain_upgrade_script = apply_parameters(
-        stakechain_upgrade_script_raw,
-        len(previous_producer_states) + 1,
-        stakechain_auth_nft,
-    )
-    stakechain_upgrade_script_hash = plutus_script_hash(stakechain_upgrade_script)
-
     stakechain_utxo = None
     stakechain_state = None
     for u in context.utxos(stakechain_address):
@@ -155,6 +138,38 @@ def main(
         assert (
             datum_hash(upgrade_proposal).payload == producer_state.auxiliary.datum_hash
         )
+    if previous_producer_states_cbor is None:
+        open_index(index_path)
+        block_index.sync_from_kupo(
+            kupo_url=kupo_url or "http://localhost:1991",
+            stakechain_address=stakechain_address,
+            stakechain_auth_nft=stakechain_auth_nft,
+            datum_resolver=datum_resolver,
+        )
+        previous_producer_states = block_index.producer_states_agreeing_on(
+            datum_hash(upgrade_proposal).payload,
+            agreement_length,
+            up_to_block=stakechain_state.chain_state.block_number,
+            chain=block_index.chain_key(stakechain_auth_nft),
+        )[1:]
+    else:
+        previous_producer_states = [
+            ProducerState.from_cbor(cbor) for cbor in previous_producer_states_cbor
+        ]
+    assert (
+        len(previous_producer_states) + 1 == agreement_length
+    ), f"Want {agreement_length} previous producer states"
+
+    stakechain_upgrade_script_raw, _, _ = get_contract(
+        "stakechain_upgrade_" + stakechain_upgrade_version, compressed=True
+    )
+    stakechain_upgrade_script = apply_parameters(
+        stakechain_upgrade_script_raw,
+        len(previous_producer_states) + 1,
+        stakechain_auth_nft,
+    )
+    stakechain_upgrade_script_hash = plutus_script_hash(stakechain_upgrade_script)
+
     if isinstance(upgrade_proposal.upgrade_address, Nothing):
         new_address = stakechain_utxo.output.address
     else:
@@ -221,7 +236,9 @@ def main(
             context,
         )
     )
-    txbuilder.collaterals = sorted(payment_utxos, key=lambda u: u.output.amount.coin, reverse=True)[:3]
+    txbuilder.collaterals = sorted(
+        payment_utxos, key=lambda u: u.output.amount.coin, reverse=True
+    )[:3]
     txbuilder.validity_start = context.last_block_slot
     txbuilder.ttl = context.last_block_slot + 60
     txbuilder.auxiliary_data = pycardano.AuxiliaryData(
@@ -0,0 +1,269 @@
+from typing import List, Optional, Union
+
+import fire
+import pycardano
+from opshin.builder import apply_parameters
+from opshin.ledger.api_v2 import NoOutputDatum, SomeOutputDatum
+from opshin.prelude import Nothing
+from pycardano import (
+    TransactionBuilder,
+    TransactionOutput,
+    Redeemer,
+    DeserializeException,
+    Value,
+    UTxO,
+    plutus_script_hash,
+    datum_hash,
+)
+
+from steak_protocol.offchain.util import (
+    sorted_utxos,
+    with_min_lovelace,
+    STAKE_CHAIN_AUTH_NFT,
+    amount_of_token_in_value,
+    token_from_string,
+    stakechain_params_hash,
+    ContractVersion,
+    VERSION_1,
+    VERSION_1a,
+)
+from steak_protocol.onchain.stakechain.stakechain_v1 import UpgradeProtocol
+from steak_protocol.onchain.stakechain.stakechain_upgrade_v1a import (
+    ChainUpgradeProposal,
+    ChainUpgrade,
+)
+from steak_protocol.onchain.types import (
+    StakeChainV1State,
+    StakeChainV2State,
+    ProducerState,
+    UpgradeAgreement,
+)
+from steak_protocol.utils import get_signing_info, network, context, kupo_url
+from steak_protocol.utils import block_index
+from steak_protocol.utils.block_index import open_index
+from steak_protocol.utils.contracts import get_contract, get_ref_utxo
+from steak_protocol.utils.from_script_context import from_address
+from steak_protocol.utils.network import show_tx, datum_resolver
+from steak_protocol.utils.to_script_context import (
+    to_tx_out_ref,
+)
+
+
+def build_upgrade(
+    stakechain_utxo: UTxO,
+    stakechain_state: StakeChainV1State,
+    stakechain_script: Union[pycardano.PlutusV2Script, UTxO],
+    stakechain_upgrade_script: pycardano.PlutusV2Script,
+    upgrade_proposal: ChainUpgradeProposal,
+    previous_producer_states: List[ProducerState],
+    payment_utxos: List[UTxO],
+    payment_skey: pycardano.PaymentSigningKey,
+    payment_address: pycardano.Address,
+    chain_context: pycardano.ChainContext = context,
+) -> pycardano.Transaction:
+    """
+    Build and sign the upgrade transaction.
+    The upgrade script is already parameterized with the agreement length and the stake chain auth nft.
+    """
+    stakechain_upgrade_script_hash = plutus_script_hash(stakechain_upgrade_script)
+
+    if isinstance(upgrade_proposal.upgrade_address, Nothing):
+        new_address = stakechain_utxo.output.address
+    else:
+        new_address = from_address(
+            upgrade_proposal.upgrade_address, network=chain_context.network
+        )
+
+    if isinstance(upgrade_proposal.upgrade_params, Nothing):
+        new_params = stakechain_state.params
+    else:
+        new_params = upgrade_proposal.upgrade_params
+
+    new_stakechain_state = StakeChainV2State(
+        params_hash=stakechain_params_hash(new_params),
+        holder_state=stakechain_state.holder_state,
+        chain_state=stakechain_state.chain_state,
+        producer_state=stakechain_state.producer_state,
+        agreement=UpgradeAgreement(proposal_hash=b"", consecutive_blocks=0),
+        skip_holders=stakechain_state.skip_holders,
+        spent_for=to_tx_out_ref(stakechain_utxo.input),
+    )
+
+    all_input_utxos = sorted_utxos(payment_utxos + [stakechain_utxo])
+    stakechain_utxo_index = all_input_utxos.index(stakechain_utxo)
+
+    txbuilder = TransactionBuilder(chain_context)
+    for u in payment_utxos:
+        txbuilder.add_input(u)
+    txbuilder.add_script_input(
+        stakechain_utxo,
+        stakechain_script,
+        None,
+        Redeemer(UpgradeProtocol()),
+    )
+    txbuilder.add_withdrawal_script(
+        stakechain_upgrade_script,
+        Redeemer(
+            ChainUpgrade(
+                previous_states=previous_producer_states,
+                upgrade_proposal=upgrade_proposal,
+                prev_chain_state_index=stakechain_utxo_index,
+                next_chain_state_index=0,
+                payout_index=-1,
+            )
+        ),
+    )
+    txbuilder.withdrawals = pycardano.Withdrawals(
+        {
+            bytes(
+                pycardano.Address(
+                    staking_part=stakechain_upgrade_script_hash,
+                    network=chain_context.network,
+                )
+            ): 0
+        }
+    )
+
+    txbuilder.add_output(
+        with_min_lovelace(
+            TransactionOutput(
+                new_address,
+                amount=stakechain_utxo.output.amount,
+                datum=new_stakechain_state,
+            ),
+            chain_context,
+        )
+    )
+    # the params are referenced by all V2 transactions, they are stored next to the state
+    txbuilder.add_output(
+        with_min_lovelace(
+            TransactionOutput(new_address, amount=Value(0), datum=new_params),
+            chain_context,
+        )
+    )
+    txbuilder.collaterals = sorted(
+        payment_utxos, key=lambda u: u.output.amount.coin, reverse=True
+    )[:3]
+    txbuilder.validity_start = chain_context.last_block_slot
+    txbuilder.ttl = chain_context.last_block_slot + 60
+    txbuilder.auxiliary_data = pycardano.AuxiliaryData(
+        data=pycardano.AlonzoMetadata(
+            metadata=pycardano.Metadata(
+                {
+                    674: {"msg": ["Upgrade Protocol"]},
+                }
+            )
+        )
+    )
+    txbuilder.fee_buffer = 1000
+    tx = txbuilder.build_and_sign(
+        signing_keys=[payment_skey],
+        change_address=payment_address,
+    )
+
+    return tx
+
+
+def main(
+    name: str = "admin",
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+    previous_producer_states_cbor: List[str] = None,
+    proposal_cbor: Optional[str] = None,
+    return_tx: bool = True,
+    stakechain_version: ContractVersion = VERSION_1,
+    stakechain_upgrade_version: ContractVersion = VERSION_1a,
+    agreement_length: int = 7,
+    index_path: Optional[str] = None,
+):
+    """
+    Upgrade a V1 stake chain to V2.
+    The params move out of the state into an output next to the new stake chain state,
+    which V2 transactions use as reference input.
+    """
+    payment_vkey, payment_skey, payment_address = get_signing_info(
+        name, network=network
+    )
+
+    stakechain_script, _, stakechain_address = get_contract(
+        "stakechain_" + stakechain_version
+    )
+    stakechain_script = get_ref_utxo(stakechain_script, context)
+    stakechain_auth_nft = token_from_string(stakechain_auth_nft)
+
+    stakechain_utxo = None
+    stakechain_state = None
+    for u in context.utxos(stakechain_address):
+        if amount_of_token_in_value(stakechain_auth_nft, u.output.amount) == 0:
+            continue
+        try:
+            stakechain_state = StakeChainV1State.from_cbor(u.output.datum.cbor)
+        except DeserializeException:
+            continue
+        stakechain_utxo = u
+        break
+    assert stakechain_utxo is not None, "No stake chain state found"
+
+    producer_state = stakechain_state.producer_state
+    if isinstance(producer_state.auxiliary, NoOutputDatum):
+        raise ValueError("No proposal found")
+    elif isinstance(producer_state.auxiliary, SomeOutputDatum):
+        upgrade_proposal: ChainUpgradeProposal = producer_state.auxiliary.datum
+    else:
+        assert proposal_cbor is not None, "Proposal is only known by hash"
+        upgrade_proposal: ChainUpgradeProposal = ChainUpgradeProposal.from_cbor(
+            proposal_cbor
+        )
+        assert (
+            datum_hash(upgrade_proposal).payload == producer_state.auxiliary.datum_hash
+        )
+    if previous_producer_states_cbor is None:
+        open_index(index_path)
+        block_index.sync_from_kupo(
+            kupo_url=kupo_url or "http://localhost:1991",
+            stakechain_address=stakechain_address,
+            stakechain_auth_nft=stakechain_auth_nft,
+            datum_resolver=datum_resolver,
+        )
+        previous_producer_states = block_index.producer_states_agreeing_on(
+            datum_hash(upgrade_proposal).payload,
+            agreement_length,
+            up_to_block=stakechain_state.chain_state.block_number,
+            chain=block_index.chain_key(stakechain_auth_nft),
+        )[1:]
+    else:
+        previous_producer_states = [
+            ProducerState.from_cbor(cbor) for cbor in previous_producer_states_cbor
+        ]
+    assert (
+        len(previous_producer_states) + 1 == agreement_length
+    ), f"Want {agreement_length} previous producer states"
+
+    stakechain_upgrade_script_raw, _, _ = get_contract(
+        "stakechain_upgrade_" + stakechain_upgrade_version, compressed=True
+    )
+    stakechain_upgrade_script = apply_parameters(
+        stakechain_upgrade_script_raw,
+        len(previous_producer_states) + 1,
+        stakechain_auth_nft,
+    )
+
+    payment_utxos = context.utxos(payment_address)
+    tx = build_upgrade(
+        stakechain_utxo,
+        stakechain_state,
+        stakechain_script,
+        stakechain_upgrade_script,
+        upgrade_proposal,
+        previous_producer_states,
+        payment_utxos,
+        payment_skey,
+        payment_address,
+    )
+    context.submit_tx(tx)
+    show_tx(tx)
+    if return_tx:
+        return tx
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,259 @@
+from typing import List, Optional, Union
+
+import fire
+import pycardano
+from opshin.builder import apply_parameters
+from opshin.ledger.api_v2 import NoOutputDatum, SomeOutputDatum
+from opshin.prelude import Nothing
+from pycardano import (
+    TransactionBuilder,
+    TransactionOutput,
+    Redeemer,
+    DeserializeException,
+    Value,
+    UTxO,
+    plutus_script_hash,
+    datum_hash,
+)
+
+from steak_protocol.offchain.util import (
+    sorted_utxos,
+    with_min_lovelace,
+    STAKE_CHAIN_AUTH_NFT,
+    amount_of_token_in_value,
+    token_from_string,
+    stakechain_params_hash,
+    find_stakechain_params,
+    ContractVersion,
+    VERSION_2,
+)
+from steak_protocol.onchain.stakechain.stakechain_v2 import UpgradeProtocol
+from steak_protocol.onchain.stakechain.stakechain_upgrade_v2 import (
+    ChainUpgradeProposal,
+    ChainUpgrade,
+)
+from steak_protocol.onchain.types import (
+    StakeChainV2State,
+    UpgradeAgreement,
+)
+from steak_protocol.utils import get_signing_info, network, context
+from steak_protocol.utils.contracts import get_contract, get_ref_utxo
+from steak_protocol.utils.from_script_context import from_address
+from steak_protocol.utils.network import show_tx
+from steak_protocol.utils.to_script_context import (
+    to_tx_out_ref,
+)
+
+
+def build_upgrade(
+    stakechain_utxo: UTxO,
+    stakechain_state: StakeChainV2State,
+    params_utxo: UTxO,
+    stakechain_script: Union[pycardano.PlutusV2Script, UTxO],
+    stakechain_upgrade_script: pycardano.PlutusV2Script,
+    upgrade_proposal: ChainUpgradeProposal,
+    payment_utxos: List[UTxO],
+    payment_skey: pycardano.PaymentSigningKey,
+    payment_address: pycardano.Address,
+    chain_context: pycardano.ChainContext = context,
+) -> pycardano.Transaction:
+    """
+    Build and sign the upgrade transaction.
+    The upgrade script is already parameterized with the agreement length and the stake chain auth nft.
+    """
+    stakechain_upgrade_script_hash = plutus_script_hash(stakechain_upgrade_script)
+
+    if isinstance(upgrade_proposal.upgrade_address, Nothing):
+        new_address = stakechain_utxo.output.address
+    else:
+        new_address = from_address(
+            upgrade_proposal.upgrade_address, network=chain_context.network
+        )
+
+    if isinstance(upgrade_proposal.upgrade_params, Nothing):
+        new_params = None
+        new_params_hash = stakechain_state.params_hash
+    else:
+        new_params = upgrade_proposal.upgrade_params
+        new_params_hash = stakechain_params_hash(new_params)
+
+    new_stakechain_state = StakeChainV2State(
+        params_hash=new_params_hash,
+        holder_state=stakechain_state.holder_state,
+        chain_state=stakechain_state.chain_state,
+        producer_state=stakechain_state.producer_state,
+        agreement=UpgradeAgreement(proposal_hash=b"", consecutive_blocks=0),
+        skip_holders=stakechain_state.skip_holders,
+        spent_for=to_tx_out_ref(stakechain_utxo.input),
+    )
+
+    all_input_utxos = sorted_utxos(payment_utxos + [stakechain_utxo])
+    stakechain_utxo_index = all_input_utxos.index(stakechain_utxo)
+    all_ref_input_utxos = sorted_utxos(
+        [params_utxo] + [u for u in [stakechain_script] if isinstance(u, UTxO)]
+    )
+
+    txbuilder = TransactionBuilder(chain_context)
+    for u in payment_utxos:
+        txbuilder.add_input(u)
+    txbuilder.reference_inputs.add(params_utxo)
+    txbuilder.add_script_input(
+        stakechain_utxo,
+        stakechain_script,
+        None,
+        Redeemer(
+            UpgradeProtocol(params_ref_index=all_ref_input_utxos.index(params_utxo))
+        ),
+    )
+    txbuilder.add_withdrawal_script(
+        stakechain_upgrade_script,
+        Redeemer(
+            ChainUpgrade(
+                upgrade_proposal=upgrade_proposal,
+                prev_chain_state_index=stakechain_utxo_index,
+                next_chain_state_index=0,
+                payout_index=-1,
+            )
+        ),
+    )
+
+    txbuilder.withdrawals = pycardano.Withdrawals(
+        {
+            bytes(
+                pycardano.Address(
+                    staking_part=stakechain_upgrade_script_hash,
+                    network=chain_context.network,
+                )
+            ): 0
+        }
+    )
+
+    txbuilder.add_output(
+        with_min_lovelace(
+            TransactionOutput(
+                new_address,
+                amount=stakechain_utxo.output.amount,
+                datum=new_stakechain_state,
+            ),
+            chain_context,
+        )
+    )
+    if new_params is not None:
+        # the new params are referenced by all following transactions
+        txbuilder.add_output(
+            with_min_lovelace(
+                TransactionOutput(new_address, amount=Value(0), datum=new_params),
+                chain_context,
+            )
+        )
+    txbuilder.collaterals = sorted(
+        payment_utxos, key=lambda u: u.output.amount.coin, reverse=True
+    )[:3]
+    txbuilder.validity_start = chain_context.last_block_slot
+    txbuilder.ttl = chain_context.last_block_slot + 60
+    txbuilder.auxiliary_data = pycardano.AuxiliaryData(
+        data=pycardano.AlonzoMetadata(
+            metadata=pycardano.Metadata(
+                {
+                    674: {"msg": ["Upgrade Protocol"]},
+                }
+            )
+        )
+    )
+    txbuilder.fee_buffer = 1000
+    tx = txbuilder.build_and_sign(
+        signing_keys=[payment_skey],
+        change_address=payment_address,
+    )
+
+    return tx
+
+
+def main(
+    name: str = "admin",
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+    proposal_cbor: Optional[str] = None,
+    return_tx: bool = True,
+    stakechain_version: ContractVersion = VERSION_2,
+    stakechain_upgrade_version: ContractVersion = VERSION_2,
+    agreement_length: int = 7,
+):
+    """
+    Upgrade a V2 stake chain.
+    The state counts the blocks agreeing on the proposal,
+    so no previous producer states need to be fetched.
+    """
+    payment_vkey, payment_skey, payment_address = get_signing_info(
+        name, network=network
+    )
+
+    stakechain_script, _, stakechain_address = get_contract(
+        "stakechain_" + stakechain_version
+    )
+    stakechain_script = get_ref_utxo(stakechain_script, context)
+    stakechain_auth_nft = token_from_string(stakechain_auth_nft)
+
+    stakechain_utxos = context.utxos(stakechain_address)
+    stakechain_utxo = None
+    stakechain_state = None
+    for u in stakechain_utxos:
+        if amount_of_token_in_value(stakechain_auth_nft, u.output.amount) == 0:
+            continue
+        try:
+            stakechain_state = StakeChainV2State.from_cbor(u.output.datum.cbor)
+        except DeserializeException:
+            continue
+        stakechain_utxo = u
+        break
+    assert stakechain_utxo is not None, "No stake chain state found"
+    params_utxo, params = find_stakechain_params(
+        stakechain_utxos, stakechain_state.params_hash
+    )
+
+    producer_state = stakechain_state.producer_state
+    if isinstance(producer_state.auxiliary, NoOutputDatum):
+        raise ValueError("No proposal found")
+    elif isinstance(producer_state.auxiliary, SomeOutputDatum):
+        upgrade_proposal: ChainUpgradeProposal = producer_state.auxiliary.datum
+    else:
+        assert proposal_cbor is not None, "Proposal is only known by hash"
+        upgrade_proposal: ChainUpgradeProposal = ChainUpgradeProposal.from_cbor(
+            proposal_cbor
+        )
+    agreement = stakechain_state.agreement
+    assert (
+        datum_hash(upgrade_proposal).payload == agreement.proposal_hash
+    ), "Latest block did not agree to the proposal"
+    assert (
+        agreement.consecutive_blocks >= agreement_length
+    ), f"Only {agreement.consecutive_blocks} of {agreement_length} blocks agreed"
+
+    stakechain_upgrade_script_raw, _, _ = get_contract(
+        "stakechain_upgrade_" + stakechain_upgrade_version, compressed=True
+    )
+    stakechain_upgrade_script = apply_parameters(
+        stakechain_upgrade_script_raw,
+        agreement_length,
+        stakechain_auth_nft,
+    )
+
+    payment_utxos = context.utxos(payment_address)
+    tx = build_upgrade(
+        stakechain_utxo,
+        stakechain_state,
+        params_utxo,
+        stakechain_script,
+        stakechain_upgrade_script,
+        upgrade_proposal,
+        payment_utxos,
+        payment_skey,
+        payment_address,
+    )
+    context.submit_tx(tx)
+    show_tx(tx)
+    if return_tx:
+        return tx
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
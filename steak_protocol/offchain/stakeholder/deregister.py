@@ -1,5 +1,6 @@
 import datetime
 from hashlib import sha256
+from typing import List, Optional, Union
 
 import fire
 import pycardano
@@ -10,6 +11,7 @@ from pycardano import (
     TransactionOutput,
     Redeemer,
     DeserializeException,
+    UTxO,
 )
 
 from steak_protocol.onchain.stakeholder import stakeholder, stakeholder_auth_nft
@@ -23,12 +25,16 @@ from steak_protocol.offchain.util import (
     value_from_token,
     ContractVersion,
     VERSION_0,
+    VERSION_2,
 )
-from steak_protocol.onchain.stakechain.stakechain_v0 import (
-    DeregisterStake,
-)
+from steak_protocol.offchain.stakechain.mine import find_params, find_stakechain_state
+from steak_protocol.offchain.wallet import select_collateral
+from steak_protocol.onchain.stakechain import stakechain_v0, stakechain_v2
 from steak_protocol.onchain.types import (
     StakeChainV0State,
+    StakeChainV1Params,
+    StakeChainV1State,
+    StakeChainV2State,
     StakeHolderState,
     StakeHolderRegistrations,
 )
@@ -45,70 +51,30 @@ from steak_protocol.utils.to_script_context import (
 )
 
 
-def main(
-    name: str = "admin",
-    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
-    pool_id: str = "1番",
+def build_deregister(
+    stakechain_utxo: UTxO,
+    stakechain_state: Union[StakeChainV0State, StakeChainV1State, StakeChainV2State],
+    stakeholder_utxo: UTxO,
+    stakeholder_state: StakeHolderState,
+    stakechain_script: Union[pycardano.PlutusV2Script, UTxO],
+    stakeholder_script: Union[pycardano.PlutusV2Script, UTxO],
+    stakeholder_auth_nft_script: pycardano.PlutusV2Script,
+    stakechain_address: pycardano.Address,
+    payment_utxos: List[UTxO],
+    payment_vkey: pycardano.PaymentVerificationKey,
+    payment_skey: pycardano.PaymentSigningKey,
+    payment_address: pycardano.Address,
     stakechain_version: ContractVersion = VERSION_0,
-):
-    pool_id = pool_id.encode()
-    payment_vkey, payment_skey, payment_address = get_signing_info(
-        name, network=network
-    )
-
-    stakechain_script, _, stakechain_address = get_contract(
-        "stakechain_" + stakechain_version
-    )
-    stakeholder_script, _, stakeholder_address = get_contract("stakeholder")
-    stakechain_auth_nft = token_from_string(stakechain_auth_nft)
-    stakepool_script, _, _ = get_contract("stakepool")
-
-    stakeholder_auth_nft_script_raw, _, _ = get_contract(
-        "stakeholder_auth_nft", compressed=True
-    )
-    stakeholder_auth_nft_script = apply_parameters(
-        stakeholder_auth_nft_script_raw, stakechain_auth_nft
-    )
-
-    stakechain_utxo = None
-    stakechain_state = None
-    for u in context.utxos(stakechain_address):
-        if amount_of_token_in_value(stakechain_auth_nft, u.output.amount) == 0:
-            continue
-        try:
-            stakechain_state = StakeChainV0State.from_cbor(u.output.datum.cbor)
-        except DeserializeException as e:
-            continue
-        stakechain_utxo = u
-        break
-    assert stakechain_utxo is not None, "No stake chain state found"
-
-    stakecoin = stakechain_state.params.stake_coin
-    assert stakechain_state.params.stakeholder_address == to_address(
-        stakeholder_address
-    ), "Wrong stakeholder address"
-
-    # prepare stake holder utxo
-    stakeholder_utxo = None
-    stakeholder_state = None
-    for u in context.utxos(stakeholder_address):
-        try:
-            stakeholder_state = StakeHolderState.from_cbor(u.output.datum.cbor)
-            if stakeholder_state.params.stakechain_id != pool_id:
-                continue
-            if stakeholder_state.params.chain_auth_nft != stakechain_auth_nft:
-                continue
-            stakeholder_utxo = u
-            break
-        except DeserializeException:
-            continue
-        except AttributeError:
-            continue
-    assert stakeholder_utxo is not None, "No stake holder state found"
-    if stakeholder_state.params.owner.credential_hash != payment_vkey.hash().payload:
-        raise ValueError(
-            "Only the owner can deregister the stakeholder. Did you specify the correct owner / stake pool id?"
-        )
+    stakechain_params_utxo: Optional[UTxO] = None,
+    stakechain_params: Optional[StakeChainV1Params] = None,
+    chain_context: pycardano.ChainContext = context,
+) -> pycardano.Transaction:
+    """
+    Build and sign the transaction removing the stake holder from the stake chain and burning its auth NFT.
+    V2 stake chains require the output holding their params.
+    """
+    params = stakechain_state.params if stakechain_params is None else stakechain_params
+    stakecoin = params.stake_coin
 
     own_index_in_stakeholder_list = (
         stakechain_state.holder_state.stake_holder_ids.index(
@@ -126,40 +92,72 @@ def main(
             own_index_in_stakeholder_list,
         ),
     )
-
-    new_stakechain_state = StakeChainV0State(
-        params=stakechain_state.params,
-        holder_state=new_holder_registrations,
-        chain_state=stakechain_state.chain_state,
-        producer_state=stakechain_state.producer_state,
-        skip_holders=stakechain_state.skip_holders
-        - int(own_index_in_stakeholder_list < stakechain_state.skip_holders),
-        spent_for=to_tx_out_ref(stakechain_utxo.input),
+    new_skip_holders = stakechain_state.skip_holders - int(
+        own_index_in_stakeholder_list < stakechain_state.skip_holders
     )
 
-    payment_utxos = context.utxos(payment_address)
+    if stakechain_version == VERSION_2:
+        new_stakechain_state = StakeChainV2State(
+            params_hash=stakechain_state.params_hash,
+            holder_state=new_holder_registrations,
+            chain_state=stakechain_state.chain_state,
+            producer_state=stakechain_state.producer_state,
+            agreement=stakechain_state.agreement,
+            skip_holders=new_skip_holders,
+            spent_for=to_tx_out_ref(stakechain_utxo.input),
+        )
+    else:
+        new_stakechain_state_type = (
+            StakeChainV0State if stakechain_version == VERSION_0 else StakeChainV1State
+        )
+        new_stakechain_state = new_stakechain_state_type(
+            params=stakechain_state.params,
+            holder_state=new_holder_registrations,
+            chain_state=stakechain_state.chain_state,
+            producer_state=stakechain_state.producer_state,
+            skip_holders=new_skip_holders,
+            spent_for=to_tx_out_ref(stakechain_utxo.input),
+        )
+
     all_input_utxos = sorted_utxos(payment_utxos + [stakechain_utxo, stakeholder_utxo])
     stakeholder_utxo_index = all_input_utxos.index(stakeholder_utxo)
     stakechain_utxo_index = all_input_utxos.index(stakechain_utxo)
 
-    stakechain_script = get_ref_utxo(stakechain_script, context)
-    stakeholder_script = get_ref_utxo(stakeholder_script, context)
-
-    deregister_chain_redeemer = Redeemer(
-        DeregisterStake(
-            old_state_index=stakechain_utxo_index,
-            new_state_index=0,
-            old_stake_index=stakeholder_utxo_index,
-            stake_index_in_holder_list=own_index_in_stakeholder_list,
-        )
+    deregister_fields = dict(
+        old_state_index=stakechain_utxo_index,
+        new_state_index=0,
+        old_stake_index=stakeholder_utxo_index,
+        stake_index_in_holder_list=own_index_in_stakeholder_list,
     )
+    if stakechain_version == VERSION_2:
+        all_ref_input_utxos = sorted_utxos(
+            [stakeholder_utxo, stakechain_params_utxo]
+            + [
+                u
+                for u in [stakechain_script, stakeholder_script]
+                if isinstance(u, UTxO)
+            ]
+        )
+        deregister_chain_redeemer = Redeemer(
+            stakechain_v2.DeregisterStake(
+                params_ref_index=all_ref_input_utxos.index(stakechain_params_utxo),
+                **deregister_fields,
+            )
+        )
+    else:
+        deregister_chain_redeemer = Redeemer(
+            stakechain_v0.DeregisterStake(**deregister_fields)
+        )
 
-    deregister_fee = value_from_token(stakecoin, stakechain_state.params.register_fee)
+    deregister_fee = value_from_token(stakecoin, params.register_fee)
 
-    txbuilder = TransactionBuilder(context)
+    txbuilder = TransactionBuilder(chain_context)
     for u in payment_utxos:
         txbuilder.add_input(u)
+    txbuilder.collaterals = select_collateral(payment_utxos)
     txbuilder.reference_inputs.add(stakeholder_utxo)
+    if stakechain_params_utxo is not None:
+        txbuilder.reference_inputs.add(stakechain_params_utxo)
     txbuilder.add_script_input(
         stakechain_utxo,
         stakechain_script,
@@ -185,7 +183,7 @@ def main(
                 amount=stakechain_utxo.output.amount + deregister_fee,
                 datum=new_stakechain_state,
             ),
-            context,
+            chain_context,
         )
     )
     txbuilder.mint = asset_from_token(stakeholder_state.params.stakeholder_auth_nft, -1)
@@ -194,18 +192,94 @@ def main(
         Redeemer(stakeholder_auth_nft.Burn()),
     )
     txbuilder.required_signers = [payment_vkey.hash()]
-    txbuilder.validity_start = context.last_block_slot
-    txbuilder.ttl = context.last_block_slot + 100
+    txbuilder.validity_start = chain_context.last_block_slot
+    txbuilder.ttl = chain_context.last_block_slot + 100
     txbuilder.auxiliary_data = pycardano.AuxiliaryData(
         data=pycardano.AlonzoMetadata(
             metadata=pycardano.Metadata({674: {"msg": ["Deregister Stakeholder"]}})
         )
     )
-    tx = txbuilder.build_and_sign(
+    return txbuilder.build_and_sign(
         signing_keys=[payment_skey],
         change_address=payment_address,
     )
 
+
+def main(
+    name: str = "admin",
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+    pool_id: str = "1番",
+    stakechain_version: ContractVersion = VERSION_0,
+):
+    pool_id = pool_id.encode()
+    payment_vkey, payment_skey, payment_address = get_signing_info(
+        name, network=network
+    )
+
+    stakechain_script, _, stakechain_address = get_contract(
+        "stakechain_" + stakechain_version
+    )
+    stakeholder_script, _, stakeholder_address = get_contract("stakeholder")
+    stakechain_auth_nft = token_from_string(stakechain_auth_nft)
+
+    stakeholder_auth_nft_script_raw, _, _ = get_contract(
+        "stakeholder_auth_nft", compressed=True
+    )
+    stakeholder_auth_nft_script = apply_parameters(
+        stakeholder_auth_nft_script_raw, stakechain_auth_nft
+    )
+
+    stakechain_utxos = context.utxos(stakechain_address)
+    stakechain_utxo, stakechain_state = find_stakechain_state(
+        stakechain_utxos, stakechain_auth_nft, stakechain_version
+    )
+    stakechain_params_utxo, stakechain_params = find_params(
+        stakechain_utxos, stakechain_state, stakechain_version
+    )
+    assert stakechain_params.stakeholder_address == to_address(
+        stakeholder_address
+    ), "Wrong stakeholder address"
+
+    # prepare stake holder utxo
+    stakeholder_utxo = None
+    stakeholder_state = None
+    for u in context.utxos(stakeholder_address):
+        try:
+            stakeholder_state = StakeHolderState.from_cbor(u.output.datum.cbor)
+            if stakeholder_state.params.stakechain_id != pool_id:
+                continue
+            if stakeholder_state.params.chain_auth_nft != stakechain_auth_nft:
+                continue
+            stakeholder_utxo = u
+            break
+        except DeserializeException:
+            continue
+        except AttributeError:
+            continue
+    assert stakeholder_utxo is not None, "No stake holder state found"
+    if stakeholder_state.params.owner.credential_hash != payment_vkey.hash().payload:
+        raise ValueError(
+            "Only the owner can deregister the stakeholder. Did you specify the correct owner / stake pool id?"
+        )
+
+    tx = build_deregister(
+        stakechain_utxo=stakechain_utxo,
+        stakechain_state=stakechain_state,
+        stakeholder_utxo=stakeholder_utxo,
+        stakeholder_state=stakeholder_state,
+        stakechain_script=get_ref_utxo(stakechain_script, context),
+        stakeholder_script=get_ref_utxo(stakeholder_script, context),
+        stakeholder_auth_nft_script=stakeholder_auth_nft_script,
+        stakechain_address=stakechain_address,
+        payment_utxos=context.utxos(payment_address),
+        payment_vkey=payment_vkey,
+        payment_skey=payment_skey,
+        payment_address=payment_address,
+        stakechain_version=stakechain_version,
+        stakechain_params_utxo=stakechain_params_utxo,
+        stakechain_params=stakechain_params,
+    )
+
     context.submit_tx(tx)
     show_tx(tx)
 
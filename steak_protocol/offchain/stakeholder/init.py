@@ -1,5 +1,5 @@
-import secrets
 from hashlib import sha256
+from typing import List, Optional, Union
 
 import fire
 import pycardano
@@ -11,8 +11,9 @@ from pycardano import (
     TransactionOutput,
     Value,
     Redeemer,
-    DeserializeException,
+    UTxO,
 )
+from pycardano.serialization import IndefiniteList
 
 from steak_protocol.offchain.util import (
     sorted_utxos,
@@ -23,14 +24,22 @@ from steak_protocol.offchain.util import (
     token_from_string,
     value_from_token,
     commit_hash_secrets,
+    init_hash_seed,
+    new_hash_secrets,
     write_ahead_hash_secrets,
     ContractVersion,
     VERSION_0,
+    VERSION_2,
 )
-from steak_protocol.onchain.stakechain.stakechain_v0 import RegisterStake
-from steak_protocol.onchain.stakeholder.stakeholder_auth_nft import Mint
+from steak_protocol.offchain.stakechain.mine import find_params, find_stakechain_state
+from steak_protocol.offchain.wallet import select_collateral
+from steak_protocol.onchain.stakechain import stakechain_v0, stakechain_v2
+from steak_protocol.onchain.stakeholder.stakeholder_auth_nft import Mint, MintV2
 from steak_protocol.onchain.types import (
     StakeChainV0State,
+    StakeChainV1Params,
+    StakeChainV1State,
+    StakeChainV2State,
     StakeHolderRegistrations,
     StakeHolderState,
     StakePoolParams,
@@ -46,77 +55,69 @@ from steak_protocol.utils.to_script_context import (
 from opshin.builder import apply_parameters
 
 
-def main(
-    name: str = "admin",
-    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
-    stake_amount: int = 1_000_000,
-    stakeholder_id: str = "2番",
-    skip_warning: bool = False,
-    return_tx: bool = False,
+def build_register(
+    stakechain_utxo: UTxO,
+    stakechain_state: Union[StakeChainV0State, StakeChainV1State, StakeChainV2State],
+    stakechain_script: Union[pycardano.PlutusV2Script, UTxO],
+    stakechain_address: pycardano.Address,
+    stakeholder_address: pycardano.Address,
+    stakeholder_auth_nft_script: pycardano.PlutusV2Script,
+    stakechain_auth_nft: Token,
+    payment_utxos: List[UTxO],
+    payment_vkey: pycardano.PaymentVerificationKey,
+    payment_skey: pycardano.PaymentSigningKey,
+    payment_address: pycardano.Address,
+    stakeholder_id: str,
+    stake_amount: int,
+    committed_hashes: List[bytes],
     stakechain_version: ContractVersion = VERSION_0,
-):
-    print(
-        "Warning: if you previously ran this script with the same name, the secrets will be overwritten. Press enter to continue."
-    )
-    if not skip_warning:
-        input()
-    payment_vkey, payment_skey, payment_address = get_signing_info(
-        name, network=network
-    )
-
-    stakechain_script, _, stakechain_address = get_contract(
-        "stakechain_" + stakechain_version
-    )
-    stakeholder_script, _, stakeholder_address = get_contract("stakeholder")
-    stakechain_auth_nft = token_from_string(stakechain_auth_nft)
-
-    stakechain_utxo = None
-    stakechain_state = None
-    for u in context.utxos(stakechain_address):
-        if amount_of_token_in_value(stakechain_auth_nft, u.output.amount) == 0:
-            continue
-        try:
-            stakechain_state = StakeChainV0State.from_cbor(u.output.datum.cbor)
-        except DeserializeException as e:
-            continue
-        stakechain_utxo = u
-        break
-    assert stakechain_utxo is not None, "No stake chain state found"
-
-    stakecoin = stakechain_state.params.stake_coin
-    assert stakechain_state.params.stakeholder_address == to_address(
+    stakechain_params_utxo: Optional[UTxO] = None,
+    stakechain_params: Optional[StakeChainV1Params] = None,
+    chain_context: pycardano.ChainContext = context,
+) -> pycardano.Transaction:
+    """
+    Build and sign the transaction registering a new stake holder with the given committed hashes.
+    V2 stake chains require the output holding their params.
+    """
+    params = stakechain_state.params if stakechain_params is None else stakechain_params
+    stakecoin = params.stake_coin
+    assert params.stakeholder_address == to_address(
         stakeholder_address
     ), "Wrong stakeholder address"
 
-    new_stakechain_state = StakeChainV0State(
-        params=stakechain_state.params,
-        chain_state=stakechain_state.chain_state,
-        holder_state=StakeHolderRegistrations(
-            stake_holder_weights=[stake_amount]
-            + stakechain_state.holder_state.stake_holder_weights,
-            stake_holder_ids=[stakeholder_id.encode()]
-            + stakechain_state.holder_state.stake_holder_ids,
-        ),
-        producer_state=stakechain_state.producer_state,
-        skip_holders=stakechain_state.skip_holders + 1,
-        spent_for=to_tx_out_ref(stakechain_utxo.input),
+    new_holder_state = StakeHolderRegistrations(
+        stake_holder_weights=[stake_amount]
+        + stakechain_state.holder_state.stake_holder_weights,
+        stake_holder_ids=[stakeholder_id.encode()]
+        + stakechain_state.holder_state.stake_holder_ids,
     )
+    if stakechain_version == VERSION_2:
+        new_stakechain_state = StakeChainV2State(
+            params_hash=stakechain_state.params_hash,
+            holder_state=new_holder_state,
+            chain_state=stakechain_state.chain_state,
+            producer_state=stakechain_state.producer_state,
+            agreement=stakechain_state.agreement,
+            skip_holders=stakechain_state.skip_holders + 1,
+            spent_for=to_tx_out_ref(stakechain_utxo.input),
+        )
+    else:
+        new_stakechain_state_type = (
+            StakeChainV0State if stakechain_version == VERSION_0 else StakeChainV1State
+        )
+        new_stakechain_state = new_stakechain_state_type(
+            params=stakechain_state.params,
+            chain_state=stakechain_state.chain_state,
+            holder_state=new_holder_state,
+            producer_state=stakechain_state.producer_state,
+            skip_holders=stakechain_state.skip_holders + 1,
+            spent_for=to_tx_out_ref(stakechain_utxo.input),
+        )
 
-    payment_utxos = context.utxos(payment_address)
     all_input_utxos = sorted_utxos(payment_utxos + [stakechain_utxo])
     stakechain_utxo_index = all_input_utxos.index(stakechain_utxo)
 
-    stakeholder_auth_nft_script_raw, _, _ = get_contract(
-        "stakeholder_auth_nft", compressed=True
-    )
-    stakeholder_auth_nft_script = apply_parameters(
-        stakeholder_auth_nft_script_raw, stakechain_auth_nft
-    )
     stakeholder_auth_nft_policy_id = script_hash(stakeholder_auth_nft_script)
-
-    mint_redeemer = Mint(
-        chain_input_index=stakechain_utxo_index,
-    )
     stakeholder_auth_nft_token_name = stakechain_auth_nft.token_name
     stakeholder_auth_nft = Token(
         stakeholder_auth_nft_policy_id.payload,
@@ -124,7 +125,31 @@ def main(
     )
     minted_asset = asset_from_token(stakeholder_auth_nft, 1)
 
-    hash_secrets = [secrets.token_bytes(32) for _ in range(5)]
+    if stakechain_version == VERSION_2:
+        all_ref_input_utxos = sorted_utxos(
+            [stakechain_params_utxo]
+            + ([stakechain_script] if isinstance(stakechain_script, UTxO) else [])
+        )
+        params_ref_index = all_ref_input_utxos.index(stakechain_params_utxo)
+        mint_redeemer = MintV2(
+            chain_input_index=stakechain_utxo_index,
+            params_ref_index=params_ref_index,
+        )
+        register_redeemer = stakechain_v2.RegisterStake(
+            params_ref_index=params_ref_index,
+            old_state_index=stakechain_utxo_index,
+            new_state_index=0,
+            new_stake_index=1,
+        )
+    else:
+        mint_redeemer = Mint(
+            chain_input_index=stakechain_utxo_index,
+        )
+        register_redeemer = stakechain_v0.RegisterStake(
+            stakechain_utxo_index,
+            0,
+            1,
+        )
 
     new_stakeholder_state = StakeHolderState(
         StakePoolParams(
@@ -133,34 +158,33 @@ def main(
             chain_auth_nft=stakechain_auth_nft,
             stakeholder_auth_nft=stakeholder_auth_nft,
         ),
-        committed_hashes=[sha256(x).digest() for x in hash_secrets],
+        # encoded like the lists of decoded datums, the builder estimates the fee
+        # on the output before it copies (and thereby re-encodes) the datum
+        committed_hashes=IndefiniteList(committed_hashes),
         aux=NoOutputDatum(),
     )
 
-    txbuilder = TransactionBuilder(context)
+    txbuilder = TransactionBuilder(chain_context)
     for u in payment_utxos:
         txbuilder.add_input(u)
+    txbuilder.collaterals = select_collateral(payment_utxos)
+    if stakechain_params_utxo is not None:
+        txbuilder.reference_inputs.add(stakechain_params_utxo)
     txbuilder.add_script_input(
         stakechain_utxo,
-        get_ref_utxo(stakechain_script, context),
+        stakechain_script,
         None,
-        Redeemer(
-            RegisterStake(
-                stakechain_utxo_index,
-                0,
-                1,
-            )
-        ),
+        Redeemer(register_redeemer),
     )
     txbuilder.add_output(
         with_min_lovelace(
             TransactionOutput(
                 stakechain_address,
                 amount=stakechain_utxo.output.amount
-                + value_from_token(stakecoin, stakechain_state.params.register_fee),
+                + value_from_token(stakecoin, params.register_fee),
                 datum=new_stakechain_state,
             ),
-            context,
+            chain_context,
         )
     )
     txbuilder.mint = minted_asset
@@ -179,7 +203,7 @@ def main(
                 ),
                 datum=new_stakeholder_state,
             ),
-            context,
+            chain_context,
         )
     )
     txbuilder.auxiliary_data = pycardano.AuxiliaryData(
@@ -191,11 +215,77 @@ def main(
             )
         )
     )
-    tx = txbuilder.build_and_sign(
+    return txbuilder.build_and_sign(
         signing_keys=[payment_skey],
         change_address=payment_address,
     )
 
+
+def main(
+    name: str = "admin",
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+    stake_amount: int = 1_000_000,
+    stakeholder_id: str = "2番",
+    skip_warning: bool = False,
+    return_tx: bool = False,
+    stakechain_version: ContractVersion = VERSION_0,
+    # derive the secrets from a seed instead of storing every secret list
+    derive_secrets: bool = False,
+):
+    print(
+        "Warning: if you previously ran this script with the same name, the secrets will be overwritten. Press enter to continue."
+    )
+    if not skip_warning:
+        input()
+    payment_vkey, payment_skey, payment_address = get_signing_info(
+        name, network=network
+    )
+
+    stakechain_script, _, stakechain_address = get_contract(
+        "stakechain_" + stakechain_version
+    )
+    _, _, stakeholder_address = get_contract("stakeholder")
+    stakechain_auth_nft = token_from_string(stakechain_auth_nft)
+
+    stakechain_utxos = context.utxos(stakechain_address)
+    stakechain_utxo, stakechain_state = find_stakechain_state(
+        stakechain_utxos, stakechain_auth_nft, stakechain_version
+    )
+    stakechain_params_utxo, stakechain_params = find_params(
+        stakechain_utxos, stakechain_state, stakechain_version
+    )
+
+    stakeholder_auth_nft_script_raw, _, _ = get_contract(
+        "stakeholder_auth_nft", compressed=True
+    )
+    stakeholder_auth_nft_script = apply_parameters(
+        stakeholder_auth_nft_script_raw, stakechain_auth_nft
+    )
+
+    if derive_secrets:
+        init_hash_seed(stakeholder_id)
+    hash_secrets = new_hash_secrets(stakeholder_id)
+
+    tx = build_register(
+        stakechain_utxo=stakechain_utxo,
+        stakechain_state=stakechain_state,
+        stakechain_script=get_ref_utxo(stakechain_script, context),
+        stakechain_address=stakechain_address,
+        stakeholder_address=stakeholder_address,
+        stakeholder_auth_nft_script=stakeholder_auth_nft_script,
+        stakechain_auth_nft=stakechain_auth_nft,
+        payment_utxos=context.utxos(payment_address),
+        payment_vkey=payment_vkey,
+        payment_skey=payment_skey,
+        payment_address=payment_address,
+        stakeholder_id=stakeholder_id,
+        stake_amount=stake_amount,
+        committed_hashes=[sha256(x).digest() for x in hash_secrets],
+        stakechain_version=stakechain_version,
+        stakechain_params_utxo=stakechain_params_utxo,
+        stakechain_params=stakechain_params,
+    )
+
     write_ahead_hash_secrets(stakeholder_id, hash_secrets)
     context.submit_tx(tx)
     # only commit / overwrite the secrets if the transaction was successful
@@ -0,0 +1,108 @@
+"""
+Recover the secrets of a stake holder after a crash between submitting a block and committing its secrets.
+
+The secrets matching the hashes committed on chain are looked up in the journal
+and committed again, so that the journal head is consistent with the chain.
+"""
+
+import json
+import shutil
+from hashlib import sha256
+from typing import List
+
+import fire
+from pycardano import DeserializeException, UTxO
+
+from steak_protocol.offchain.util import (
+    STAKE_CHAIN_AUTH_NFT,
+    token_from_string,
+    commit_hash_secrets,
+    all_committed_hash_secrets,
+    load_hash_seed,
+)
+from steak_protocol.onchain.types import StakeHolderState
+from steak_protocol.utils import context
+from steak_protocol.utils.contracts import get_contract
+from steak_protocol.utils.keys import keys_dir
+
+
+def match_committed_hashes(
+    journal_lines: List[str], committed_hashes: List[bytes]
+) -> List[bytes]:
+    """
+    The secrets of the committed hashes.
+    The journal is searched from its end and the search stops as soon as all hashes are matched,
+    usually after the last few lines.
+    Consecutive lines share most of their secrets, every distinct secret is hashed once.
+    """
+    wanted = {h: i for i, h in enumerate(committed_hashes)}
+    found: List[bytes] = [None] * len(committed_hashes)
+    remaining = len(wanted)
+    seen = set()
+    for line in reversed(journal_lines):
+        for x in json.loads(line)["secrets"]:
+            if x in seen:
+                continue
+            seen.add(x)
+            secret = bytes.fromhex(x)
+            i = wanted.get(sha256(secret).digest())
+            if i is not None and found[i] is None:
+                found[i] = secret
+                remaining -= 1
+        if remaining == 0:
+            break
+    missing = [i for i, secret in enumerate(found) if secret is None]
+    assert not missing, f"No secrets found for committed hashes at positions {missing}"
+    return found
+
+
+def find_committed_hashes(
+    stakeholder_utxos: List[UTxO], stakechain_auth_nft, pool_id: str
+) -> List[bytes]:
+    for u in stakeholder_utxos:
+        try:
+            stakeholder_state = StakeHolderState.from_cbor(u.output.datum.cbor)
+        except (DeserializeException, AttributeError):
+            continue
+        if (
+            stakeholder_state.params.chain_auth_nft == stakechain_auth_nft
+            and stakeholder_state.params.stakechain_id == pool_id.encode()
+        ):
+            return stakeholder_state.committed_hashes
+    raise AssertionError("No stake holder state found. Correct pool name?")
+
+
+def main(
+    stakechain_auth_nft: str = STAKE_CHAIN_AUTH_NFT,
+    pool_id: str = "1番",
+    # replace the journal with the recovered secrets (a backup is kept)
+    compact: bool = False,
+):
+    stakechain_auth_nft = token_from_string(stakechain_auth_nft)
+    _, _, stakeholder_address = get_contract("stakeholder")
+    committed_hashes = find_committed_hashes(
+        context.utxos(stakeholder_address), stakechain_auth_nft, pool_id
+    )
+
+    if load_hash_seed(pool_id) is not None:
+        # derived secrets only need the counter to be committed
+        for hash_secrets in all_committed_hash_secrets(pool_id):
+            if [sha256(x).digest() for x in hash_secrets] == committed_hashes:
+                commit_hash_secrets(pool_id, hash_secrets)
+                print("Recovered secrets from seed")
+                return
+        raise AssertionError("Committed hashes were not derived from the seed")
+
+    journal_path = keys_dir / f"{pool_id}.hash_secret"
+    with open(journal_path) as f:
+        journal_lines = f.readlines()
+    hash_secrets = match_committed_hashes(journal_lines, committed_hashes)
+    if compact:
+        shutil.copy(journal_path, journal_path.with_suffix(".hash_secret_bak"))
+        journal_path.unlink()
+    commit_hash_secrets(pool_id, hash_secrets)
+    print(f"Recovered secrets from {len(journal_lines)} journal lines")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -1,7 +1,7 @@
 import functools
 import random
-import re
 from time import sleep
+from typing import Optional
 
 import fire
 import pycardano
@@ -37,7 +37,7 @@ from steak_protocol.offchain.util import (
     STAKE_CHAIN_AUTH_NFT,
     amount_of_token_in_value,
     token_from_string,
-    adjust_for_wrong_fee,
+    balance_tx,
 )
 from opshin.prelude import Token
 from steak_protocol.onchain.types import (
@@ -45,9 +45,13 @@ from steak_protocol.onchain.types import (
     StakeHolderRegistrations,
     StakeHolderState,
 )
+from steak_protocol.offchain.wallet import select_collateral, select_inputs
 from steak_protocol.utils import get_signing_info, network, context
+from steak_protocol.utils.backends import address_pattern
 from steak_protocol.utils.contracts import get_contract, get_ref_utxo
+from steak_protocol.utils.metrics import registry, serve
 from steak_protocol.utils.network import show_tx, ogmios_url, kupo_url
+from steak_protocol.utils.profiling import profiler, span
 from steak_protocol.utils.to_script_context import (
     to_address,
     to_tx_out_ref,
@@ -57,6 +61,20 @@ from pycardano.crypto.bech32 import encode
 
 from opshin.builder import apply_parameters
 
+ATTEMPTS = registry.counter(
+    "steak_fill_attempts_total",
+    "Iterations of the request filling loop by outcome (ok, error)",
+    ["outcome"],
+)
+QUEUE_DEPTH = registry.gauge(
+    "steak_fill_queue_depth", "Number of open stake requests at the last iteration"
+)
+REQUESTS = registry.counter(
+    "steak_fill_requests_total",
+    "Processed stake requests by outcome (filled, no_stakeholder, error)",
+    ["outcome"],
+)
+
 
 def main(
     name: str = "bob",
@@ -64,19 +82,27 @@ def main(
     stake_key: str = "*",
     no_stake_key: bool = False,
     retry_interval: int = 5,
+    # serve the metrics at http://127.0.0.1:<metrics_port>/metrics
+    metrics_port: Optional[int] = None,
 ):
+    if metrics_port is not None:
+        serve(metrics_port)
     while True:
         try:
-            fill_request(
-                name=name,
-                stakechain_auth_nft=stakechain_auth_nft,
-                stake_key=stake_key,
-                no_stake_key=no_stake_key,
-            )
+            with profiler.operation("fill_request"):
+                fill_request(
+                    name=name,
+                    stakechain_auth_nft=stakechain_auth_nft,
+                    stake_key=stake_key,
+                    no_stake_key=no_stake_key,
+                )
         except KeyboardInterrupt:
             break
         except Exception as e:
+            ATTEMPTS.inc(outcome="error")
             print(e)
+        else:
+            ATTEMPTS.inc(outcome="ok")
         print(
             f"Press Ctrl+C to stop. Trying again in {retry_interval} seconds...",
             flush=True,
@@ -105,7 +131,9 @@ def fill_request(
 
     stakechain_utxo = None
     stakechain_state = None
-    for u in context.utxos(stakechain_address):
+    with span("fill_request.query_stakechain"):
+        stakechain_utxos = context.utxos(stakechain_address)
+    for u in stakechain_utxos:
         if amount_of_token_in_value(stakechain_auth_nft, u.output.amount) == 0:
             continue
         try:
@@ -134,22 +162,27 @@ def fill_request(
     )
 
     # collect request (just one Add or Remove for now)
-    # NOTE: "*" only works with ogmios + kupo
-    if no_stake_key:
-        stakepool_request_address_adjusted = stakepool_request_address
-    elif stake_key == "*":
-        stakepool_request_address_adjusted = (
-            stakepool_request_address.payment_part.payload.hex() + "/*"
-        )
-    else:
-        assert stake_key, "No stake key provided"
-        stake_key = pycardano.Address.from_primitive(stake_key)
-        stakepool_request_address_adjusted = pycardano.Address(
-            payment_part=stakepool_request_address.payment_part,
-            staking_part=stake_key.staking_part,
-            network=stakepool_address.network,
-        )
-    request_utxos = context.utxos(stakepool_request_address_adjusted)
+    with span("fill_request.query_requests"):
+        if no_stake_key:
+            request_utxos = context.utxos(stakepool_request_address)
+        elif stake_key == "*":
+            assert (
+                context.supports_address_patterns
+            ), "Filling requests of any stake key requires a backend with address patterns (i.e. kupo)"
+            request_utxos = context.utxos_by_pattern(
+                address_pattern(stakepool_request_address.payment_part)
+            )
+        else:
+            assert stake_key, "No stake key provided"
+            stake_key = pycardano.Address.from_primitive(stake_key)
+            request_utxos = context.utxos(
+                pycardano.Address(
+                    payment_part=stakepool_request_address.payment_part,
+                    staking_part=stake_key.staking_part,
+                    network=stakepool_address.network,
+                )
+            )
+    QUEUE_DEPTH.set(len(request_utxos))
     request_state = None
     random.shuffle(request_utxos)
     for req_utxo in request_utxos:
@@ -167,7 +200,9 @@ def fill_request(
 
             stakeholder_utxo = None
             stakeholder_state = None
-            for u in context.utxos(stakeholder_address):
+            with span("fill_request.query_stakeholder"):
+                stakeholder_utxos = context.utxos(stakeholder_address)
+            for u in stakeholder_utxos:
                 if amount_of_token_in_value(stakeholder_auth_nft, u.output.amount) == 0:
                     continue
                 try:
@@ -197,6 +232,7 @@ def fill_request(
                 stakeholder_utxo = u
                 break
             if stakeholder_utxo is None:
+                REQUESTS.inc(outcome="no_stakeholder")
                 print(
                     f"No stake holder state found for {request_utxo.input.transaction_id.payload.hex()}"
                 )
@@ -251,12 +287,18 @@ def fill_request(
                 spent_for=to_tx_out_ref(stakechain_utxo.input),
             )
 
-            payment_utxos = context.utxos(payment_address)
+            with span("fill_request.query_payment_utxos"):
+                payment_utxos = context.utxos(payment_address)
+            collateral_utxos = select_collateral(payment_utxos)
+            payment_utxos = select_inputs(payment_utxos, exclude=collateral_utxos)
             all_input_utxos = sorted_utxos(
                 payment_utxos + [stakechain_utxo, stakeholder_utxo, request_utxo]
             )
             stakechain_utxo_index = all_input_utxos.index(stakechain_utxo)
             stakeholder_utxo_index = all_input_utxos.index(stakeholder_utxo)
+            stakechain_ref = get_ref_utxo(stakechain_script, context)
+            stakeholder_ref = get_ref_utxo(stakeholder_script, context)
+            stakepool_request_ref = get_ref_utxo(stakepool_request_script, context)
 
             minted_lp_asset = asset_from_token(
                 lp_token,
@@ -301,6 +343,7 @@ def fill_request(
                         own_output_index=1,
                         chain_input_index=stakechain_utxo_index,
                         chain_output_index=0,
+                        params_ref_index=-1,
                     )
                     if is_add_request
                     else RemoveStake(
@@ -308,6 +351,7 @@ def fill_request(
                         own_output_index=1,
                         chain_input_index=stakechain_utxo_index,
                         chain_output_index=0,
+                        params_ref_index=-1,
                     )
                 ),
             )
@@ -354,7 +398,7 @@ def fill_request(
             )
             txbuilder.add_script_input(
                 stakechain_utxo,
-                get_ref_utxo(stakechain_script, context),
+                stakechain_ref,
                 None,
                 Redeemer(
                     stakechain.UpdateStake(
@@ -368,7 +412,7 @@ def fill_request(
             )
             txbuilder.add_script_input(
                 stakeholder_utxo,
-                get_ref_utxo(stakeholder_script, context),
+                stakeholder_ref,
                 None,
                 Redeemer(
                     stakeholder.UpdateStake(
@@ -380,7 +424,7 @@ def fill_request(
             )
             txbuilder.add_script_input(
                 request_utxo,
-                get_ref_utxo(stakepool_request_script, context),
+                stakepool_request_ref,
                 None,
                 Redeemer(
                     FillRequest(
@@ -398,35 +442,28 @@ def fill_request(
                 )
             )
 
-            tx = txbuilder.build_and_sign(
-                signing_keys=[payment_skey],
-                change_address=payment_address,
-            )
+            txbuilder.collaterals = collateral_utxos
+            with span("fill_request.build_and_sign"):
+                tx = txbuilder.build_and_sign(
+                    signing_keys=[payment_skey],
+                    change_address=payment_address,
+                )
 
-            try:
-                context.submit_tx(tx)
-            except Exception as e:
-                coins = list(
-                    map(int, re.findall(r"'(?:lovelace|coins)': (\d+)", str(e)))
+            with span("fill_request.balance_tx"):
+                ref_utxos = [
+                    u
+                    for u in (stakechain_ref, stakeholder_ref, stakepool_request_ref)
+                    if isinstance(u, pycardano.UTxO)
+                ]
+                tx = balance_tx(
+                    tx, all_input_utxos + ref_utxos, [payment_skey], context
                 )
-                if (
-                    "valueNotConserved" in str(e)
-                    or "3123" in str(e)
-                    and len(coins) == 2
-                ):
-                    print(f"Coinsdiff: {coins[0]} vs {coins[1]}: {coins[1] - coins[0]}")
-                    print("Trying to adjust fee and output...")
-                    context.submit_tx(
-                        adjust_for_wrong_fee(
-                            tx,
-                            [payment_skey],
-                            output_offset=coins[1] - coins[0],
-                        )
-                    )
-                else:
-                    raise e
+            with span("fill_request.submit_tx"):
+                context.submit_tx(tx)
+            REQUESTS.inc(outcome="filled")
             show_tx(tx)
         except Exception as e:
+            REQUESTS.inc(outcome="error")
             print(
                 f"Error processing request {request_utxo.input.transaction_id.payload.hex()}"
             )
@@ -1,4 +1,3 @@
-import secrets
 from hashlib import sha256
 from typing import Optional
 
@@ -33,6 +32,8 @@ from steak_protocol.offchain.util import (
     token_from_string,
     value_from_token,
     commit_hash_secrets,
+    init_hash_seed,
+    new_hash_secrets,
     write_ahead_hash_secrets,
     ContractVersion,
     VERSION_0,
@@ -71,6 +72,8 @@ def main(
     return_tx: bool = False,
     return_address: Optional[str] = None,
     stakechain_version: ContractVersion = VERSION_0,
+    # derive the secrets from a seed instead of storing every secret list
+    derive_secrets: bool = False,
 ):
     print(
         "Warning: if you previously ran this script with the same name, the secrets will be overwritten. Press enter to continue."
@@ -153,7 +156,9 @@ def main(
     )
     minted_asset = asset_from_token(stakeholder_auth_nft, 1)
 
-    hash_secrets = [secrets.token_bytes(32) for _ in range(5)]
+    if derive_secrets:
+        init_hash_seed(stakeholder_id.decode())
+    hash_secrets = new_hash_secrets(stakeholder_id.decode())
     new_stakeholder_state = StakeHolderState(
         StakePoolParams(
             owner=ScriptCredential(
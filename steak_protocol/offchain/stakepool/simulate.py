@@ -0,0 +1,274 @@
+"""
+Monte Carlo simulation of block production and rewards on the stake chain.
+
+Slot leaders are drawn exactly like the stake chain contract does
+(see `compute_slot_leader` and `weighted_sample`): the seed
+`bytes_big_from_unsigned_int(k) + block_hash + bytes_big_from_unsigned_int(slot)` is hashed with SHA-256,
+truncated to 64 bits and reduced modulo the total stake, and the leader is the first holder
+whose cumulative stake reaches the result. Block hashes can not be predicted and are drawn at random.
+
+Rewards follow the reserve decay of the contract, `floor_fraction(scale_fraction(reserve, fraction_per_block))`
+per block, and pools keep `ceil_fraction(scale_fraction(reward, guaranteed_reward_fraction))`,
+the remainder going to the pool operator.
+
+Assumptions of the model:
+- only slots that are a multiple of `slot_leader_interval` can hold a block
+- holder i is online with probability `availability[i]` in every slot
+- of the `num_slot_leaders + 1` elected leaders of a slot, the online leader with the lowest number produces the block
+"""
+
+from dataclasses import dataclass
+from fractions import Fraction
+from typing import List, Optional, Sequence, Union
+
+import fire
+import numpy as np
+
+from steak_protocol.offchain.stakechain.leader_schedule import leader_random_numbers
+
+FractionLike = Union[Fraction, str, int, float]
+
+# number of slot windows whose leader random numbers are drawn at once in compounding simulations
+COMPOUND_CHUNK_SIZE = 4096
+
+
+def _fraction(f: FractionLike) -> Fraction:
+    return Fraction(f) if not isinstance(f, Fraction) else f
+
+
+def sample_leaders(cumulative_weights: np.ndarray, random_numbers: np.ndarray):
+    """
+    Vectorized `weighted_sample`.
+    `cumulative_weights` is the cumulative sum of the weights, either shared by all samples (1D)
+    or one row per sample (2D).
+    """
+    if cumulative_weights.ndim == 1:
+        r = random_numbers % np.uint64(cumulative_weights[-1])
+        return np.searchsorted(cumulative_weights, r.astype(np.int64), side="left")
+    r = random_numbers % cumulative_weights[:, -1].astype(np.uint64)
+    return np.argmax(cumulative_weights >= r.astype(np.int64)[:, None], axis=1)
+
+
+def reward_schedule(reserve: int, fraction_per_block: FractionLike, blocks: int):
+    """
+    The reward of each of the next blocks, given the current reserve of the stake chain
+    """
+    fraction_per_block = _fraction(fraction_per_block)
+    rewards = np.empty(blocks, dtype=np.int64)
+    for i in range(blocks):
+        reward = (
+            reserve * fraction_per_block.numerator
+        ) // fraction_per_block.denominator
+        rewards[i] = reward
+        reserve -= reward
+    return rewards
+
+
+@dataclass
+class SimulationResult:
+    # number of blocks produced per run and holder, shape (runs, holders)
+    blocks: np.ndarray
+    # rewards that stay staked with the holder (for pools: the guaranteed part), shape (runs, holders)
+    staked_rewards: np.ndarray
+    # rewards that pool operators may take out, shape (runs, holders)
+    operator_rewards: np.ndarray
+    # number of slots that could hold a block but no leader was online, shape (runs,)
+    missed_slots: np.ndarray
+
+    @property
+    def rewards(self) -> np.ndarray:
+        return self.staked_rewards + self.operator_rewards
+
+    def summary(self, percentiles: Sequence[float] = (5, 50, 95)) -> dict:
+        rewards = self.rewards
+        return {
+            "expected_blocks": self.blocks.mean(axis=0).tolist(),
+            "expected_rewards": rewards.mean(axis=0).tolist(),
+            "std_rewards": rewards.std(axis=0).tolist(),
+            "reward_percentiles": {
+                p: np.percentile(rewards, p, axis=0).tolist() for p in percentiles
+            },
+            "expected_missed_slots": float(self.missed_slots.mean()),
+        }
+
+
+def simulate(
+    weights: Sequence[int],
+    reserve: int,
+    fraction_per_block: FractionLike,
+    n_slots: int,
+    slot_leader_interval: int = 1,
+    num_slot_leaders: int = 0,
+    guaranteed_reward_fractions: Optional[Sequence[Optional[FractionLike]]] = None,
+    availability: Optional[Sequence[float]] = None,
+    runs: int = 100,
+    compound: bool = True,
+    start_slot: int = 0,
+    seed: Optional[int] = None,
+) -> SimulationResult:
+    """
+    Simulate `runs` independent histories of the next `n_slots` slots.
+
+    - weights: current stake of the registered holders
+    - reserve: amount of stake coins remaining in the stake chain
+    - guaranteed_reward_fractions: for each holder None (not a pool) or the guaranteed reward fraction of the pool
+    - availability: probability of each holder to be online in a slot (default: always online)
+    - compound: whether rewards increase the stake of the holder (as in the contract).
+      Without compounding the leader schedule is independent of the rewards and all slots are simulated at once,
+      this is the fast path and a good approximation as long as the rewards are small compared to the stake.
+      With compounding every block changes the leaders of the next slot, so the slots are elected one after another
+      (vectorized over the runs, the random numbers are precomputed), which is a few times slower.
+    """
+    rng = np.random.default_rng(seed)
+    weights = np.asarray(weights, dtype=np.int64)
+    n_holders = len(weights)
+    assert n_holders > 0 and weights.sum() > 0, "No stake registered"
+    fraction_per_block = _fraction(fraction_per_block)
+    if guaranteed_reward_fractions is None:
+        guaranteed_reward_fractions = [None] * n_holders
+    guaranteed = [
+        _fraction(g) if g is not None else Fraction(1)
+        for g in guaranteed_reward_fractions
+    ]
+    g_num = np.array([g.numerator for g in guaranteed], dtype=np.int64)
+    g_den = np.array([g.denominator for g in guaranteed], dtype=np.int64)
+    availability = (
+        np.ones(n_holders)
+        if availability is None
+        else np.asarray(availability, dtype=np.float64)
+    )
+    # slots that can hold a block
+    first_slot = -(-start_slot // slot_leader_interval) * slot_leader_interval
+    slots = np.arange(first_slot, start_slot + n_slots, slot_leader_interval)
+    n_windows = len(slots)
+    assert (
+        reserve * max(fraction_per_block.numerator, 1) < 2**63
+        and int(g_num.max()) * reserve < 2**63
+    ), "Amounts too large for exact 64 bit arithmetic"
+
+    blocks = np.zeros((runs, n_holders), dtype=np.int64)
+    staked = np.zeros((runs, n_holders), dtype=np.int64)
+    operator = np.zeros((runs, n_holders), dtype=np.int64)
+    missed = np.zeros(runs, dtype=np.int64)
+    run_index = np.arange(runs)
+
+    def draw(n_runs_windows: int, window_slots: List[int]):
+        """
+        The leader random numbers and the availability draws of each elected leader,
+        shape (num_slot_leaders + 1, n_runs_windows). Every window is drawn with a fresh block hash.
+        """
+        hash_buffer = rng.bytes(32 * n_runs_windows)
+        block_hashes = [hash_buffer[i : i + 32] for i in range(0, len(hash_buffer), 32)]
+        random_numbers = np.stack(
+            [
+                leader_random_numbers(block_hashes, window_slots, k)
+                for k in range(num_slot_leaders + 1)
+            ]
+        )
+        return random_numbers, rng.random(random_numbers.shape)
+
+    def elect(cumulative_weights, random_numbers, uniforms):
+        """
+        Returns the producing holder per sample and whether a block was produced
+        """
+        producer = np.zeros(random_numbers.shape[1], dtype=np.int64)
+        produced = np.zeros(random_numbers.shape[1], dtype=bool)
+        for k in range(num_slot_leaders + 1):
+            leaders = sample_leaders(cumulative_weights, random_numbers[k])
+            online = uniforms[k] < availability[leaders]
+            newly = online & ~produced
+            producer[newly] = leaders[newly]
+            produced |= online
+        return producer, produced
+
+    if not compound:
+        cumulative_weights = np.cumsum(weights)
+        producer, produced = elect(
+            cumulative_weights, *draw(runs * n_windows, np.tile(slots, runs).tolist())
+        )
+        producer = producer.reshape(runs, n_windows)
+        produced = produced.reshape(runs, n_windows)
+        schedule = reward_schedule(reserve, fraction_per_block, n_windows)
+        block_index = np.cumsum(produced, axis=1) - 1
+        reward = np.where(produced, schedule[np.maximum(block_index, 0)], 0)
+        to_stake = -((-reward * g_num[producer]) // g_den[producer])
+        rows = np.broadcast_to(run_index[:, None], producer.shape)
+        np.add.at(blocks, (rows, producer), produced)
+        np.add.at(staked, (rows, producer), to_stake)
+        np.add.at(operator, (rows, producer), reward - to_stake)
+        missed += n_windows - produced.sum(axis=1)
+        return SimulationResult(blocks, staked, operator, missed)
+
+    # every block changes the stake of its producer and thus the leaders of the next slot,
+    # so only the draws are precomputed (per chunk of windows) and the slots are elected one after another
+    current_weights = np.tile(weights, (runs, 1))
+    reserves = np.full(runs, reserve, dtype=np.int64)
+    for chunk_start in range(0, n_windows, COMPOUND_CHUNK_SIZE):
+        chunk_slots = slots[chunk_start : chunk_start + COMPOUND_CHUNK_SIZE]
+        n = len(chunk_slots)
+        random_numbers, uniforms = draw(runs * n, np.repeat(chunk_slots, runs).tolist())
+        random_numbers = random_numbers.reshape(-1, n, runs)
+        uniforms = uniforms.reshape(-1, n, runs)
+        producer = np.empty((n, runs), dtype=np.int64)
+        produced = np.empty((n, runs), dtype=bool)
+        reward = np.empty((n, runs), dtype=np.int64)
+        to_stake = np.empty((n, runs), dtype=np.int64)
+        for i in range(n):
+            producer[i], produced[i] = elect(
+                np.cumsum(current_weights, axis=1),
+                random_numbers[:, i],
+                uniforms[:, i],
+            )
+            reward[i] = produced[i] * (
+                (reserves * fraction_per_block.numerator)
+                // fraction_per_block.denominator
+            )
+            to_stake[i] = -((-reward[i] * g_num[producer[i]]) // g_den[producer[i]])
+            reserves -= reward[i]
+            current_weights[run_index, producer[i]] += to_stake[i]
+        rows = np.broadcast_to(run_index, producer.shape)
+        np.add.at(blocks, (rows, producer), produced)
+        np.add.at(staked, (rows, producer), to_stake)
+        np.add.at(operator, (rows, producer), reward - to_stake)
+        missed += n - produced.sum(axis=0)
+    return SimulationResult(blocks, staked, operator, missed)
+
+
+def main(
+    weights: List[int],
+    reserve: int,
+    fraction_per_block: str = "3/10000000",
+    n_slots: int = 100_000,
+    slot_leader_interval: int = 1,
+    num_slot_leaders: int = 0,
+    guaranteed_reward_fractions: Optional[List[Optional[str]]] = None,
+    availability: Optional[List[float]] = None,
+    runs: int = 100,
+    compound: bool = True,
+    seed: Optional[int] = None,
+):
+    result = simulate(
+        weights,
+        reserve,
+        fraction_per_block,
+        n_slots,
+        slot_leader_interval=slot_leader_interval,
+        num_slot_leaders=num_slot_leaders,
+        guaranteed_reward_fractions=guaranteed_reward_fractions,
+        availability=availability,
+        runs=runs,
+        compound=compound,
+        seed=seed,
+    )
+    summary = result.summary()
+    for i, weight in enumerate(weights):
+        print(
+            f"holder {i} (stake {weight}): "
+            f"{summary['expected_blocks'][i]:.1f} blocks, "
+            f"{summary['expected_rewards'][i]:.0f} ± {summary['std_rewards'][i]:.0f} rewards"
+        )
+    print(f"missed slots: {summary['expected_missed_slots']:.1f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -1,7 +1,12 @@
 import datetime
+import hmac
 import json
+import os
+import secrets
+import weakref
+from fractions import Fraction
 from hashlib import sha256
-from typing import List, Union, Literal
+from typing import List, Literal, Optional, Tuple, Union
 
 import pycardano
 
@@ -18,6 +23,8 @@ from pycardano import (
     ExtendedSigningKey,
 )
 
+from steak_protocol.onchain.types import StakeChainV1Params
+from steak_protocol.utils.clock import Clock, system_clock
 from steak_protocol.utils.keys import keys_dir
 
 STAKE_CHAIN_AUTH_NFT = "dfc450815c964e21bc9dd8e4ed1029c3407408c9fa95c48e1484f368.221c348f186c3e43ac9863a52d619d8183a274e7e15b40fa733b57fc76fd27f4"
@@ -46,10 +53,61 @@ def asset_from_token(token: Token, amount: int) -> MultiAsset:
     )
 
 
+# per chain context: the cached genesis parameters, epoch and protocol parameters of that epoch
+_param_cache = weakref.WeakKeyDictionary()
+
+
+def protocol_param(
+    context: pycardano.ChainContext, clock: Clock = system_clock
+) -> pycardano.ProtocolParameters:
+    """
+    The protocol parameters of the context, only queried again once the epoch changes.
+    The epoch is computed locally from the clock and the genesis parameters, which are queried once.
+    """
+    cached = _param_cache.get(context)
+    if cached is None:
+        genesis_param = context.genesis_param
+        epoch, param = None, None
+    else:
+        genesis_param, epoch, param = cached
+    current_epoch = (clock.now() // 1000 - genesis_param.system_start) // (
+        genesis_param.epoch_length * genesis_param.slot_length
+    )
+    if current_epoch != epoch:
+        param = context.protocol_param
+        _param_cache[context] = (genesis_param, current_epoch, param)
+    return param
+
+
+def min_lovelace(
+    output: pycardano.TransactionOutput,
+    context: pycardano.ChainContext,
+    clock: Clock = system_clock,
+) -> int:
+    """
+    The minimum amount of lovelace of the output (post alonzo) from the cached protocol parameters
+    """
+    # the size of the output depends on the amount of lovelace, just like the ledger we assume at least 1 ada
+    amount = Value(max(output.amount.coin, 1_000_000), output.amount.multi_asset)
+    sized_output = pycardano.TransactionOutput(
+        output.address,
+        amount,
+        output.datum_hash,
+        output.datum,
+        output.script,
+        True,
+    )
+    return (160 + len(sized_output.to_cbor())) * protocol_param(
+        context, clock
+    ).coins_per_utxo_byte
+
+
 def with_min_lovelace(
-    output: pycardano.TransactionOutput, context: pycardano.ChainContext
+    output: pycardano.TransactionOutput,
+    context: pycardano.ChainContext,
+    clock: Clock = system_clock,
 ):
-    min_lvl = pycardano.min_lovelace(context, output)
+    min_lvl = min_lovelace(output, context, clock)
     output.amount.coin = max(output.amount.coin, min_lvl + 500000)
     return output
 
@@ -97,7 +155,177 @@ def adjust_for_wrong_fee(
     )
 
 
+# fee for the scripts of spent and referenced outputs (Conway): the price per byte
+# is multiplied by 1.2 for every 25 KiB of script size, pycardano does not account for it
+REF_SCRIPT_FEE_PER_BYTE = 15
+REF_SCRIPT_FEE_TIER_SIZE = 25_600
+REF_SCRIPT_FEE_TIER_MULTIPLIER = Fraction(6, 5)
+
+
+def ref_script_fee(scripts_size: int) -> int:
+    """
+    The fee for the given total size of the scripts of the spent and referenced outputs
+    """
+    fee, price = Fraction(0), Fraction(REF_SCRIPT_FEE_PER_BYTE)
+    while scripts_size > 0:
+        tier_size = min(scripts_size, REF_SCRIPT_FEE_TIER_SIZE)
+        fee += tier_size * price
+        scripts_size -= tier_size
+        price *= REF_SCRIPT_FEE_TIER_MULTIPLIER
+    return int(fee)
+
+
+def script_size(script: Union[pycardano.NativeScript, bytes]) -> int:
+    if isinstance(script, pycardano.NativeScript):
+        return len(script.to_cbor())
+    return len(script)
+
+
+def balance_tx(
+    tx_signed: Transaction,
+    utxos: List[pycardano.UTxO],
+    signing_keys: List[Union[SigningKey, ExtendedSigningKey]],
+    context: pycardano.ChainContext,
+    clock: Clock = system_clock,
+) -> Transaction:
+    """
+    Check the fee and value conservation of a signed transaction locally and fix them before submission.
+    The minimum fee is computed from the size, the execution units of the redeemers
+    and the size of the scripts in the spent and referenced outputs,
+    the difference is taken from (or given to) the last output, the change output of the builder.
+    The given utxos have to contain all inputs and reference inputs of the transaction.
+    """
+    key_deposit = protocol_param(context, clock).key_deposit
+    for _ in range(3):
+        tx_body = tx_signed.transaction_body
+        inputs = {u.input: u for u in utxos}
+        consumed = Value(
+            sum((tx_body.withdraws or {}).values()), tx_body.mint or MultiAsset()
+        )
+        for tx_in in tx_body.inputs:
+            consumed += inputs[tx_in].output.amount
+        produced = Value(tx_body.fee)
+        for certificate in tx_body.certificates or []:
+            if isinstance(certificate, pycardano.StakeRegistration):
+                produced.coin += key_deposit
+            elif isinstance(certificate, pycardano.StakeDeregistration):
+                consumed.coin += key_deposit
+        for output in tx_body.outputs:
+            produced += output.amount
+        assert (produced - consumed).multi_asset.filter(
+            lambda p, n, a: a != 0
+        ) == MultiAsset(), "Tokens not conserved"
+
+        redeemers = tx_signed.transaction_witness_set.redeemer or []
+        scripts_size = sum(
+            script_size(inputs[tx_in].output.script)
+            for tx_in in list(tx_body.inputs) + list(tx_body.reference_inputs or [])
+            if inputs[tx_in].output.script is not None
+        )
+        min_fee = pycardano.fee(
+            context,
+            len(tx_signed.to_cbor()),
+            sum(r.ex_units.steps for r in redeemers),
+            sum(r.ex_units.mem for r in redeemers),
+        ) + ref_script_fee(scripts_size)
+        fee_offset = max(0, min_fee - tx_body.fee)
+        output_offset = produced.coin - consumed.coin
+        if fee_offset == 0 and output_offset == 0:
+            return tx_signed
+        tx_signed = adjust_for_wrong_fee(
+            tx_signed,
+            signing_keys,
+            output_offset=output_offset,
+            fee_offset=fee_offset,
+        )
+    raise AssertionError("Could not balance transaction")
+
+
+# number of hash secrets committed by a stake holder
+HASH_SECRETS = 5
+
+
+def derive_hash_secret(seed: bytes, counter: int) -> bytes:
+    return hmac.new(seed, counter.to_bytes(8, "big"), sha256).digest()
+
+
+def derive_hash_secrets(seed: bytes, counter: int) -> List[bytes]:
+    return [derive_hash_secret(seed, counter + i) for i in range(HASH_SECRETS)]
+
+
+def load_hash_seed(name: str) -> Optional[Tuple[bytes, int]]:
+    """
+    The seed and counter of the first committed secret, None if the secrets are not derived
+    """
+    try:
+        with open(keys_dir / f"{name}.hash_seed") as f:
+            d = json.load(f)
+    except FileNotFoundError:
+        return None
+    return bytes.fromhex(d["seed"]), d["counter"]
+
+
+def store_hash_seed(name: str, seed: bytes, counter: int):
+    path = keys_dir / f"{name}.hash_seed"
+    with open(path.with_suffix(".hash_seed_tmp"), "w") as f:
+        json.dump({"seed": seed.hex(), "counter": counter}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    # replace atomically, a crash leaves either the old or the new counter
+    os.replace(path.with_suffix(".hash_seed_tmp"), path)
+
+
+def init_hash_seed(name: str):
+    """
+    Derive all future hash secrets of the stake holder from a master seed.
+    The secret state is then only the seed and a counter instead of a journal of secret lists.
+    """
+    if load_hash_seed(name) is None:
+        store_hash_seed(name, secrets.token_bytes(32), 0)
+
+
+def hash_seed_counter(seed: bytes, counter: int, hash_secrets: List[bytes]) -> int:
+    """
+    The counter from which the secrets were derived.
+    Only the counters following the stored one are tried, the secrets advance by one per block.
+    """
+    for c in range(counter, counter + HASH_SECRETS + 1):
+        if derive_hash_secret(seed, c) == hash_secrets[0]:
+            return c
+    raise AssertionError("Secrets were not derived from the seed")
+
+
+def new_hash_secrets(name: str) -> List[bytes]:
+    """
+    Fresh secrets for registering a stake holder
+    """
+    hash_seed = load_hash_seed(name)
+    if hash_seed is None:
+        return [secrets.token_bytes(32) for _ in range(HASH_SECRETS)]
+    seed, counter = hash_seed
+    # skip the stored secrets, they may have been revealed already
+    # the counter is stored before registering so that the secrets are found after a crash
+    store_hash_seed(name, seed, counter + HASH_SECRETS)
+    return derive_hash_secrets(seed, counter + HASH_SECRETS)
+
+
+def next_hash_secret(name: str, hash_secrets: List[bytes]) -> bytes:
+    """
+    The secret to commit when the first of the given secrets is revealed
+    """
+    hash_seed = load_hash_seed(name)
+    if hash_seed is None:
+        return secrets.token_bytes(32)
+    seed, counter = hash_seed
+    return derive_hash_secret(
+        seed, hash_seed_counter(seed, counter, hash_secrets) + HASH_SECRETS
+    )
+
+
 def committed_hash_secrets(name: str):
+    hash_seed = load_hash_seed(name)
+    if hash_seed is not None:
+        return derive_hash_secrets(*hash_seed)
     with open(keys_dir / f"{name}.hash_secret") as f:
         d = None
         for l in reversed(f.readlines()):
@@ -109,6 +337,11 @@ def committed_hash_secrets(name: str):
 
 
 def all_committed_hash_secrets(name: str):
+    hash_seed = load_hash_seed(name)
+    if hash_seed is not None:
+        seed, counter = hash_seed
+        # the block may have been submitted without the counter being committed
+        return [derive_hash_secrets(seed, counter + i) for i in range(2)]
     with open(keys_dir / f"{name}.hash_secret") as f:
         l = [
             [bytes.fromhex(x) for x in json.loads(l)["secrets"]] for l in f.readlines()
@@ -117,6 +350,9 @@ def all_committed_hash_secrets(name: str):
 
 
 def write_ahead_hash_secrets(name: str, secrets: List[bytes]):
+    if load_hash_seed(name) is not None:
+        # derived secrets can always be recomputed
+        return
     with open(keys_dir / f"{name}.hash_secret", "a") as f:
         f.write(
             json.dumps(
@@ -131,6 +367,11 @@ def write_ahead_hash_secrets(name: str, secrets: List[bytes]):
 
 
 def commit_hash_secrets(name: str, secrets: List[bytes]):
+    hash_seed = load_hash_seed(name)
+    if hash_seed is not None:
+        seed, counter = hash_seed
+        store_hash_seed(name, seed, hash_seed_counter(seed, counter, secrets))
+        return
     with open(keys_dir / f"{name}.hash_secret", "a") as f:
         f.write(
             json.dumps(
@@ -147,7 +388,32 @@ def custom_sign_message(secret: bytes, message: bytes) -> bytes:
     return sha256(message + secret).digest()
 
 
-ContractVersion = Literal["v0", "v1"]
+ContractVersion = Literal["v0", "v1", "v2"]
 VERSION_0 = "v0"
 VERSION_0a = "v0a"
 VERSION_1 = "v1"
+VERSION_1a = "v1a"
+VERSION_2 = "v2"
+
+
+def stakechain_params_hash(params: StakeChainV1Params) -> bytes:
+    """
+    The hash by which V2 stake chain states refer to their params
+    """
+    return sha256(params.to_cbor()).digest()
+
+
+def find_stakechain_params(
+    utxos: List[pycardano.UTxO], params_hash: bytes
+) -> Tuple[pycardano.UTxO, StakeChainV1Params]:
+    """
+    Find the output holding the params of a V2 stake chain state in its inline datum
+    """
+    for u in utxos:
+        try:
+            params = StakeChainV1Params.from_cbor(u.output.datum.cbor)
+        except (pycardano.DeserializeException, AttributeError):
+            continue
+        if stakechain_params_hash(params) == params_hash:
+            return u, params
+    raise AssertionError("No stake chain params found")
@@ -0,0 +1,161 @@
+"""
+UTxO management of operator wallets.
+
+Transactions of the operators (mining, filling requests) only spend a few pure ada UTxOs as fuel
+and use a dedicated UTxO as collateral, so they stay small independent of how fragmented the wallet is.
+The consolidation job keeps the wallet split into one collateral UTxO and a few fuel UTxOs.
+It never spends the current collateral and fuel UTxOs, so it can run next to the miner and the filler.
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import fire
+import pycardano
+from pycardano import TransactionBuilder, TransactionOutput, UTxO, Address
+
+from steak_protocol.utils import get_signing_info, network, context
+from steak_protocol.utils.clock import Clock, system_clock
+from steak_protocol.utils.network import show_tx
+
+# amount of the collateral UTxO
+COLLATERAL_AMOUNT = 5_000_000
+# amount of a fuel UTxO, enough to pay fees and min ada of a block or fill transaction
+FUEL_AMOUNT = 10_000_000
+
+
+def is_pure_ada(utxo: UTxO) -> bool:
+    output = utxo.output
+    return (
+        not output.amount.multi_asset
+        and output.datum is None
+        and output.datum_hash is None
+        and output.script is None
+    )
+
+
+def select_collateral(utxos: List[UTxO], max_inputs: int = 3) -> List[UTxO]:
+    """
+    The smallest pure ada UTxO covering the collateral amount,
+    otherwise the largest UTxOs (like before the wallet was split)
+    """
+    covering = [
+        u for u in utxos if is_pure_ada(u) and u.output.amount.coin >= COLLATERAL_AMOUNT
+    ]
+    if covering:
+        return [min(covering, key=lambda u: u.output.amount.coin)]
+    return sorted(utxos, key=lambda u: u.output.amount.coin, reverse=True)[:max_inputs]
+
+
+def select_inputs(
+    utxos: List[UTxO], amount: int = FUEL_AMOUNT, exclude: Sequence[UTxO] = ()
+) -> List[UTxO]:
+    """
+    Few pure ada UTxOs that cover the amount, preferring a single one.
+    Falls back to all UTxOs that are not excluded if the pure ada UTxOs do not suffice,
+    and to the excluded ones if nothing else is left (e.g. a wallet with a single UTxO).
+    """
+    candidates = [u for u in utxos if is_pure_ada(u) and u not in exclude]
+    covering = [u for u in candidates if u.output.amount.coin >= amount]
+    if covering:
+        return [min(covering, key=lambda u: u.output.amount.coin)]
+    selected = []
+    for u in sorted(candidates, key=lambda u: u.output.amount.coin, reverse=True):
+        selected.append(u)
+        if sum(s.output.amount.coin for s in selected) >= amount:
+            return selected
+    remaining = [u for u in utxos if u not in exclude] or list(utxos)
+    assert remaining, "No UTxOs left to pay the fees, fund the wallet"
+    return remaining
+
+
+def current_split(
+    utxos: List[UTxO], num_fuel: int
+) -> Tuple[Optional[UTxO], List[UTxO]]:
+    """
+    The collateral UTxO and up to num_fuel fuel UTxOs of an earlier split of the wallet
+    """
+    pure_ada = [u for u in utxos if is_pure_ada(u)]
+    collateral = next(
+        (u for u in pure_ada if u.output.amount.coin == COLLATERAL_AMOUNT), None
+    )
+    fuel = [u for u in pure_ada if u.output.amount.coin == FUEL_AMOUNT][:num_fuel]
+    return collateral, fuel
+
+
+def needs_consolidation(utxos: List[UTxO], max_utxos: int) -> bool:
+    pure_ada = [u for u in utxos if is_pure_ada(u)]
+    collateral = [u for u in pure_ada if u.output.amount.coin == COLLATERAL_AMOUNT]
+    fuel = [u for u in pure_ada if u.output.amount.coin >= FUEL_AMOUNT]
+    return len(pure_ada) > max_utxos or not collateral or not fuel
+
+
+def build_consolidation(
+    utxos: List[UTxO],
+    address: Address,
+    payment_skey: pycardano.PaymentSigningKey,
+    num_fuel: int,
+    chain_context: pycardano.ChainContext = context,
+) -> Optional[pycardano.Transaction]:
+    """
+    Merge the pure ada UTxOs and split them into the missing collateral UTxO
+    and fuel UTxOs (up to num_fuel in total), the remainder is returned as change.
+    The current collateral and fuel UTxOs are left untouched, as they may be spent by the miner
+    or filler at the same time, and so are UTxOs holding tokens, datums or scripts.
+    Returns None if the wallet does not hold enough ada or there is nothing to merge.
+    """
+    collateral, fuel = current_split(utxos, num_fuel)
+    spendable = [
+        u for u in utxos if is_pure_ada(u) and u != collateral and u not in fuel
+    ]
+    total = sum(u.output.amount.coin for u in spendable)
+    new_collateral = COLLATERAL_AMOUNT if collateral is None else 0
+    # keep some ada for the fee and the change output
+    num_new_fuel = max(
+        0,
+        min(num_fuel - len(fuel), (total - new_collateral) // FUEL_AMOUNT - 1),
+    )
+    if new_collateral and total < new_collateral + FUEL_AMOUNT:
+        return None
+    if len(fuel) + num_new_fuel < 1:
+        return None
+    if not new_collateral and not num_new_fuel and len(spendable) < 2:
+        return None
+    txbuilder = TransactionBuilder(chain_context)
+    for u in spendable:
+        txbuilder.add_input(u)
+    if new_collateral:
+        txbuilder.add_output(TransactionOutput(address, COLLATERAL_AMOUNT))
+    for _ in range(num_new_fuel):
+        txbuilder.add_output(TransactionOutput(address, FUEL_AMOUNT))
+    return txbuilder.build_and_sign(
+        signing_keys=[payment_skey],
+        change_address=address,
+    )
+
+
+def main(
+    name: str = "admin",
+    num_fuel: int = 5,
+    # consolidate once the wallet holds more pure ada UTxOs than this
+    max_utxos: int = 10,
+    interval: int = 600,
+    once: bool = False,
+    clock: Clock = system_clock,
+):
+    _, payment_skey, payment_address = get_signing_info(name, network=network)
+    while True:
+        utxos = context.utxos(payment_address)
+        if needs_consolidation(utxos, max_utxos):
+            tx = build_consolidation(utxos, payment_address, payment_skey, num_fuel)
+            if tx is None:
+                print("Not enough ada to split the wallet")
+            else:
+                context.submit_tx(tx)
+                show_tx(tx)
+        if once:
+            break
+        clock.sleep(interval)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
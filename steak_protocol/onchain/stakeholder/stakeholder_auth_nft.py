@@ -1,6 +1,7 @@
 """
 Token to authenticate a stake holder position against the stake chain contract.
 The NFT is unique and can only be minted when the stake chain contract approves the transaction.
+V2 stake chains only store the hash of their params, which are resolved from a reference input.
 """
 
 from steak_protocol.onchain.util import *
@@ -17,7 +18,15 @@ class Burn(PlutusData):
     CONSTR_ID = 1
 
 
-AuthNFTRedeemer = Union[Mint, Burn]
+@dataclass
+class MintV2(PlutusData):
+    CONSTR_ID = 2
+    chain_input_index: int
+    # reference input holding the params of the V2 stake chain
+    params_ref_index: int
+
+
+AuthNFTRedeemer = Union[Mint, Burn, MintV2]
 
 
 def validator(
@@ -30,16 +39,28 @@ def validator(
     own_pid = purpose.policy_id
     own_auth_nft = Token(own_pid, stakechain_auth_nft.token_name)
 
-    if isinstance(redeemer, Mint):
+    if isinstance(redeemer, Burn):
+        assert all(
+            [x < 0 for x in tx_info.mint[own_pid].values()]
+        ), "Must burn all tokens"
+    else:
         chain_input_info = tx_info.inputs[redeemer.chain_input_index]
         chain_input = chain_input_info.resolved
         assert (
             amount_of_token_in_output(stakechain_auth_nft, chain_input) == 1
         ), "Chain must have exactly one auth NFT"
-        stake_chain_state: StakeChainV0State = resolve_datum_unsafe(
-            chain_input, tx_info
-        )
-        stakeholder_auth_nft = stake_chain_state.params.stakeholder_auth_nft
+        if isinstance(redeemer, MintV2):
+            stake_chain_state_v2: StakeChainV2State = resolve_datum_unsafe(
+                chain_input, tx_info
+            )
+            stakeholder_auth_nft = resolve_params(
+                stake_chain_state_v2.params_hash, redeemer.params_ref_index, tx_info
+            ).stakeholder_auth_nft
+        else:
+            stake_chain_state: StakeChainV0State = resolve_datum_unsafe(
+                chain_input, tx_info
+            )
+            stakeholder_auth_nft = stake_chain_state.params.stakeholder_auth_nft
         stakeholder_outputs = [
             o
             for o in tx_info.outputs
@@ -58,7 +79,3 @@ def validator(
         assert (
             stakeholder_datum.params.stakeholder_auth_nft == own_auth_nft
         ), "Auth NFT must match own auth NFT"
-    else:
-        assert all(
-            [x < 0 for x in tx_info.mint[own_pid].values()]
-        ), "Must burn all tokens"
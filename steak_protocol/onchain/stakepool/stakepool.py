@@ -1,5 +1,7 @@
 """
 A stake pool that pools liquidity from multiple users and stakes it in the chain.
+The redeemers point to the reference input holding the params of V2 stake chains,
+a negative index indicates a stake chain that carries the params in its state.
 """
 
 from steak_protocol.onchain.util import *
@@ -27,6 +29,7 @@ class AddStake(PlutusData):
     own_output_index: int
     chain_input_index: int
     chain_output_index: int
+    params_ref_index: int
 
 
 @dataclass
@@ -36,6 +39,7 @@ class RemoveStake(PlutusData):
     own_output_index: int
     chain_input_index: int
     chain_output_index: int
+    params_ref_index: int
 
 
 @dataclass
@@ -45,6 +49,7 @@ class InteractWithPool(PlutusData):
     own_output_index: int
     chain_input_index: int
     chain_output_index: int
+    params_ref_index: int
 
 
 @dataclass
@@ -58,6 +63,18 @@ class RegisterPool(PlutusData):
 StakePoolRedeemer = Union[AddStake, RemoveStake, InteractWithPool, RegisterPool]
 
 
+def resolve_stake_coin(
+    chain_input: TxOut, params_ref_index: int, tx_info: TxInfo
+) -> Token:
+    if params_ref_index < 0:
+        chain_state: StakeChainV0State = resolve_datum_unsafe(chain_input, tx_info)
+        return chain_state.params.stake_coin
+    chain_state_v2: StakeChainV2State = resolve_datum_unsafe(chain_input, tx_info)
+    return resolve_params(
+        chain_state_v2.params_hash, params_ref_index, tx_info
+    ).stake_coin
+
+
 def validator(
     redeemer: StakePoolRedeemer,
     context: ScriptContext,
@@ -120,7 +137,6 @@ def validator(
         own_input_state.params == own_output_state.params
     ), "Stake holder params must be preserved"
     chain_input = tx_info.inputs[redeemer.chain_input_index].resolved
-    chain_input_state: StakeChainV0State = resolve_datum_unsafe(chain_input, tx_info)
     chain_output = tx_info.outputs[redeemer.chain_output_index]
     # we just ensure that the chain logic is correct
     chain_auth_nft = own_pool_state_params.chain_auth_nft
@@ -140,7 +156,7 @@ def validator(
         admin = own_pool_state_params.admin
         check_owner_signed_tx(admin, tx_info)
         # we also check that no stakecoins go anywhere except to the pool or the chain
-        stake_coin = chain_input_state.params.stake_coin
+        stake_coin = resolve_stake_coin(chain_input, redeemer.params_ref_index, tx_info)
         coin_in_contract_before = amount_of_token_in_output(stake_coin, chain_input)
         coin_in_contract_after = amount_of_token_in_output(stake_coin, chain_output)
         coin_rewarded = coin_in_contract_before - coin_in_contract_after
@@ -156,6 +172,10 @@ def validator(
     else:
         pool_input_state_datum: SomeOutputDatum = own_input_state.aux
         pool_input_state: PoolState = pool_input_state_datum.datum
+        # the chain state has the same position in the states of all versions
+        chain_input_state: StakeChainV0State = resolve_datum_unsafe(
+            chain_input, tx_info
+        )
         chain_output_state: StakeChainV0State = resolve_datum_unsafe(
             chain_output, tx_info
         )
@@ -164,7 +184,7 @@ def validator(
             chain_output_state.chain_state == chain_input_state.chain_state
         ), "Chain state must be preserved"
 
-        stakecoin = chain_input_state.params.stake_coin
+        stakecoin = resolve_stake_coin(chain_input, redeemer.params_ref_index, tx_info)
 
         all_lp_tokens = pool_input_state.all_lp_tokens
 
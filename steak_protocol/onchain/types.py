@@ -150,6 +150,42 @@ class StakeChainV1State(PlutusData):
     spent_for: Union[Nothing, TxOutRef]
 
 
+@dataclass
+class UpgradeAgreement(PlutusData):
+    """
+    The upgrade proposal that the latest blocks agree on
+    """
+
+    CONSTR_ID = 0
+    # blake2b_256 of the proposal attached to the latest block, empty if none was attached
+    proposal_hash: bytes
+    # number of consecutive blocks up to the latest that attached the proposal
+    consecutive_blocks: int
+
+
+@dataclass
+class StakeChainV2State(PlutusData):
+    """
+    The params are not part of the state anymore but stored in the inline datum
+    of a reference input, identified by their hash.
+    The state keeps count of the blocks agreeing on an upgrade proposal,
+    so upgrades do not need to provide the preceding producer states.
+    """
+
+    CONSTR_ID = 0
+    # sha2_256 of the serialised StakeChainV1Params
+    params_hash: bytes
+    holder_state: StakeHolderRegistrations
+    chain_state: CoreChainState
+    producer_state: ProducerState
+    agreement: UpgradeAgreement
+    # holders registered during the last block, to be skipped in the next block
+    # just an int since new holders always jump to the start of the list
+    skip_holders: int
+    # reference to previous output
+    spent_for: Union[Nothing, TxOutRef]
+
+
 @dataclass
 class StakePoolParams(PlutusData):
     CONSTR_ID = 0
@@ -167,6 +167,20 @@ def check_owner_signed_tx(owner: Owner, tx_info: TxInfo) -> None:
     assert owner_signed_tx(owner, tx_info), "Owner of the stake pool did not sign tx"
 
 
+def resolve_params(
+    params_hash: bytes, params_ref_index: int, tx_info: TxInfo
+) -> StakeChainV1Params:
+    """
+    Resolve the params of a V2 stake chain from the reference input referenced by the redeemer
+    and check that they match the hash in the state.
+    Anyone may create such an output, but only the params with the correct hash are accepted.
+    """
+    params_input = tx_info.reference_inputs[params_ref_index].resolved
+    params: StakeChainV1Params = resolve_datum_unsafe(params_input, tx_info)
+    assert sha2_256(serialise_data(params)) == params_hash, "Params do not match hash"
+    return params
+
+
 def to_reduced_chain_state(chain_state: StakeChainV0State) -> ReducedChainState:
     return ReducedChainState(
         sha2_256(serialise_data(chain_state.params)),
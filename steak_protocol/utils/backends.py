@@ -0,0 +1,395 @@
+"""
+Chain backends for the off-chain code.
+
+Every backend is a pycardano ChainContext. Backends with an index (kupo, blockfrost, the local ledger)
+are additionally ChainBackends and describe which optimized queries they support:
+
+- `supports_address_patterns`: utxos can be queried by kupo style address patterns through `utxos_by_pattern`
+  (i.e. `<payment credential>/*` for all utxos with the given payment credential and any staking part)
+- `utxos_many`: utxos of several addresses are queried at once
+- `resolve_datums`: many datum hashes are resolved at once
+
+Ogmios without kupo has no index and only answers the plain ChainContext queries.
+Callers should check the capabilities instead of the type of the backend.
+"""
+
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import ogmios
+import requests
+from blockfrost import ApiError
+from pycardano import (
+    Address,
+    Asset,
+    AssetName,
+    BlockFrostChainContext,
+    ChainContext,
+    DatumHash,
+    GenesisParameters,
+    MultiAsset,
+    Network,
+    OgmiosChainContext,
+    PlutusV1Script,
+    PlutusV2Script,
+    ProtocolParameters,
+    RawCBOR,
+    ScriptHash,
+    TransactionInput,
+    TransactionOutput,
+    UTxO,
+    Value,
+    VerificationKeyHash,
+)
+from pycardano.backend.blockfrost import _try_fix_script
+
+from .datums import DatumResolver, kupo_datum_resolver
+
+
+def address_pattern(
+    payment_part: Union[VerificationKeyHash, ScriptHash],
+    staking_part: Union[VerificationKeyHash, ScriptHash, None] = None,
+) -> str:
+    """
+    Pattern matching all addresses with the given payment part and the given staking part (default: any)
+    """
+    return "{}/{}".format(
+        payment_part.payload.hex(),
+        staking_part.payload.hex() if staking_part is not None else "*",
+    )
+
+
+class ChainBackend(ABC):
+    """
+    Query capabilities shared by all backends with an index. Querying many addresses falls back to plain utxo queries.
+    Backends that support address patterns set `supports_address_patterns` and implement `utxos_by_pattern(pattern)`.
+    """
+
+    supports_address_patterns: bool = False
+
+    def utxos_many(
+        self, addresses: Iterable[Union[str, Address]]
+    ) -> Dict[str, List[UTxO]]:
+        return {str(address): self.utxos(address) for address in addresses}
+
+    @abstractmethod
+    def resolve_datums(
+        self, datum_hashes: Iterable[str]
+    ) -> Dict[str, Optional[RawCBOR]]:
+        """
+        The datums of the given datum hashes (hex), None for unknown datums
+        """
+
+
+class KupoQueries(ChainBackend):
+    """
+    Utxo and datum queries through kupo. Datums of all matches are resolved in bulk
+    and scripts are cached as they never change for a given hash.
+    """
+
+    supports_address_patterns = True
+
+    _kupo_url: str
+    _datum_resolver: DatumResolver
+    _script_cache: "OrderedDict[str, Union[PlutusV1Script, PlutusV2Script]]"
+
+    def _init_kupo(
+        self,
+        kupo_url: str,
+        datum_resolver: Optional[DatumResolver] = None,
+        script_cache_size: int = 1000,
+    ):
+        self._kupo_url = kupo_url
+        self._datum_resolver = (
+            datum_resolver
+            if datum_resolver is not None
+            else kupo_datum_resolver(kupo_url)
+        )
+        self._script_cache_size = script_cache_size
+        self._script_cache = OrderedDict()
+        self._sessions = threading.local()
+
+    def _kupo_get(self, path: str):
+        session = getattr(self._sessions, "session", None)
+        if session is None:
+            session = self._sessions.session = requests.Session()
+        return session.get(self._kupo_url + path).json()
+
+    def _get_script_from_kupo(
+        self, script_hash: str
+    ) -> Union[PlutusV1Script, PlutusV2Script]:
+        script = self._script_cache.get(script_hash)
+        if script is not None:
+            self._script_cache.move_to_end(script_hash)
+            return script
+        result = self._kupo_get("/scripts/" + script_hash)
+        if result["language"] == "plutus:v2":
+            script = PlutusV2Script(bytes.fromhex(result["script"]))
+        elif result["language"] == "plutus:v1":
+            script = PlutusV1Script(bytes.fromhex(result["script"]))
+        else:
+            raise ValueError("Unknown plutus script type")
+        script = _try_fix_script(script_hash, script)
+        self._script_cache[script_hash] = script
+        while len(self._script_cache) > self._script_cache_size:
+            self._script_cache.popitem(last=False)
+        return script
+
+    def _get_datum_from_kupo(self, datum_hash: str) -> Optional[RawCBOR]:
+        return self._datum_resolver.resolve(datum_hash)
+
+    def _extract_asset_info(self, asset_hash: str) -> Tuple[str, ScriptHash, AssetName]:
+        split_result = asset_hash.split(".")
+        if len(split_result) == 1:
+            policy_hex, asset_name_hex = split_result[0], ""
+        elif len(split_result) == 2:
+            policy_hex, asset_name_hex = split_result
+        else:
+            raise ValueError(f"Unable to parse asset hash: {asset_hash}")
+        policy = ScriptHash.from_primitive(policy_hex)
+        asset_name = AssetName.from_primitive(asset_name_hex)
+        return policy_hex, policy, asset_name
+
+    def _utxos_kupo(self, pattern: str) -> List[UTxO]:
+        matches = self._kupo_get("/matches/" + pattern + "?unspent&resolve_hashes")
+        for match in matches:
+            # kupo returns inline datums directly if it supports resolve_hashes
+            if match["datum_hash"] and match.get("datum") is not None:
+                self._datum_resolver.prime(match["datum_hash"], match["datum"])
+        datums = self._datum_resolver.resolve_many(
+            match["datum_hash"] for match in matches if match["datum_hash"]
+        )
+
+        utxos = []
+        for match in matches:
+            if match["spent_at"] is not None:
+                continue
+            tx_in = TransactionInput.from_primitive(
+                [match["transaction_id"], match["output_index"]]
+            )
+            script = (
+                self._get_script_from_kupo(match["script_hash"])
+                if match.get("script_hash")
+                else None
+            )
+            datum_hash = (
+                DatumHash.from_primitive(match["datum_hash"])
+                if match["datum_hash"]
+                else None
+            )
+            datum = datums.get(match["datum_hash"])
+
+            multi_assets = MultiAsset()
+            for asset, quantity in match["value"]["assets"].items():
+                _, policy, asset_name = self._extract_asset_info(asset)
+                multi_assets.setdefault(policy, Asset())[asset_name] = quantity
+            tx_out = TransactionOutput(
+                Address.from_primitive(match["address"]),
+                amount=Value(match["value"]["coins"], multi_assets),
+                datum_hash=datum_hash,
+                datum=datum,
+                script=script,
+            )
+            utxos.append(UTxO(tx_in, tx_out))
+        return utxos
+
+    def _utxos(self, address: str) -> List[UTxO]:
+        return self._utxos_kupo(address)
+
+    def utxos_by_pattern(self, pattern: str) -> List[UTxO]:
+        """
+        All utxos at addresses matching the kupo style address pattern
+        """
+        return self._utxos_kupo(pattern)
+
+    def resolve_datums(
+        self, datum_hashes: Iterable[str]
+    ) -> Dict[str, Optional[RawCBOR]]:
+        return self._datum_resolver.resolve_many(datum_hashes)
+
+
+class OgmiosV5Backend(OgmiosChainContext):
+    """
+    Ogmios (v5) without kupo
+    """
+
+
+class OgmiosV5KupoBackend(KupoQueries, OgmiosChainContext):
+    """
+    Ogmios (v5) for chain state and transaction submission, kupo for utxo queries
+    """
+
+    def __init__(
+        self,
+        ws_url: str,
+        network: Network,
+        kupo_url: str,
+        datum_resolver: Optional[DatumResolver] = None,
+        **kwargs,
+    ):
+        OgmiosChainContext.__init__(
+            self, ws_url, network=network, kupo_url=kupo_url, **kwargs
+        )
+        self._init_kupo(kupo_url, datum_resolver)
+
+
+class OgmiosV6Backend(ogmios.OgmiosChainContext):
+    """
+    Ogmios (v6) without kupo
+    """
+
+
+class OgmiosV6KupoBackend(KupoQueries, ogmios.OgmiosChainContext):
+    """
+    Ogmios (v6) for chain state and transaction submission, kupo for utxo queries
+    """
+
+    def __init__(
+        self,
+        kupo_url: str,
+        datum_resolver: Optional[DatumResolver] = None,
+        **kwargs,
+    ):
+        ogmios.OgmiosChainContext.__init__(self, **kwargs)
+        self._init_kupo(kupo_url, datum_resolver)
+
+
+class BlockFrostBackend(ChainBackend, BlockFrostChainContext):
+    """
+    Blockfrost without kupo. Address patterns are not supported,
+    datums are resolved through the datum endpoint of blockfrost.
+    """
+
+    def __init__(
+        self,
+        project_id: str,
+        datum_resolver: Optional[DatumResolver] = None,
+        **kwargs,
+    ):
+        BlockFrostChainContext.__init__(self, project_id, **kwargs)
+        self._datum_resolver = (
+            datum_resolver
+            if datum_resolver is not None
+            else DatumResolver(self._get_datum_from_blockfrost)
+        )
+
+    def _get_datum_from_blockfrost(self, datum_hash: str) -> Optional[bytes]:
+        try:
+            return bytes.fromhex(self.api.script_datum_cbor(datum_hash).cbor)
+        except ApiError as e:
+            if e.status_code == 404:
+                return None
+            raise
+
+    def resolve_datums(
+        self, datum_hashes: Iterable[str]
+    ) -> Dict[str, Optional[RawCBOR]]:
+        return self._datum_resolver.resolve_many(datum_hashes)
+
+
+class BlockFrostKupoBackend(KupoQueries, BlockFrostChainContext):
+    """
+    Blockfrost for chain state and transaction submission, kupo for utxo queries
+    """
+
+    def __init__(
+        self,
+        project_id: str,
+        kupo_url: str,
+        datum_resolver: Optional[DatumResolver] = None,
+        **kwargs,
+    ):
+        BlockFrostChainContext.__init__(self, project_id, **kwargs)
+        self._init_kupo(kupo_url, datum_resolver)
+
+
+class LedgerBackend(ChainBackend, ChainContext):
+    """
+    A local in-memory ledger. Utxos and datums are added and removed explicitly.
+    """
+
+    supports_address_patterns = True
+
+    def __init__(
+        self,
+        protocol_param: ProtocolParameters,
+        genesis_param: GenesisParameters,
+        network: Network = Network.TESTNET,
+    ):
+        self._protocol_param = protocol_param
+        self._genesis_param = genesis_param
+        self._network = network
+        self._last_block_slot = 0
+        self._utxos_by_input: Dict[TransactionInput, UTxO] = {}
+        self._utxos_by_address: Dict[str, Dict[TransactionInput, UTxO]] = {}
+        self._datums: Dict[str, RawCBOR] = {}
+
+    @property
+    def protocol_param(self) -> ProtocolParameters:
+        return self._protocol_param
+
+    @property
+    def genesis_param(self) -> GenesisParameters:
+        return self._genesis_param
+
+    @property
+    def network(self) -> Network:
+        return self._network
+
+    @property
+    def epoch(self) -> int:
+        return self._last_block_slot // self._genesis_param.epoch_length
+
+    @property
+    def last_block_slot(self) -> int:
+        return self._last_block_slot
+
+    def add_utxo(self, utxo: UTxO):
+        self._utxos_by_input[utxo.input] = utxo
+        self._utxos_by_address.setdefault(str(utxo.output.address), {})[
+            utxo.input
+        ] = utxo
+
+    def remove_utxo(self, tx_in: TransactionInput) -> UTxO:
+        utxo = self._utxos_by_input.pop(tx_in)
+        address = str(utxo.output.address)
+        del self._utxos_by_address[address][tx_in]
+        if not self._utxos_by_address[address]:
+            del self._utxos_by_address[address]
+        return utxo
+
+    def add_datum(self, datum_hash: str, datum: RawCBOR):
+        self._datums[datum_hash] = datum
+
+    def _utxos(self, address: str) -> List[UTxO]:
+        return list(self._utxos_by_address.get(address, {}).values())
+
+    def utxo_by_tx_id(self, tx_id: str, index: int) -> Optional[UTxO]:
+        return self._utxos_by_input.get(TransactionInput.from_primitive([tx_id, index]))
+
+    def utxos_by_pattern(self, pattern: str) -> List[UTxO]:
+        payment_part, staking_part = pattern.split("/")
+        utxos = []
+        for address_utxos in self._utxos_by_address.values():
+            address = next(iter(address_utxos.values())).output.address
+            if address.payment_part.payload.hex() != payment_part:
+                continue
+            if staking_part != "*" and (
+                address.staking_part is None
+                or address.staking_part.payload.hex() != staking_part
+            ):
+                continue
+            utxos.extend(address_utxos.values())
+        return utxos
+
+    def utxos_many(
+        self, addresses: Iterable[Union[str, Address]]
+    ) -> Dict[str, List[UTxO]]:
+        return {str(address): self._utxos(str(address)) for address in addresses}
+
+    def resolve_datums(
+        self, datum_hashes: Iterable[str]
+    ) -> Dict[str, Optional[RawCBOR]]:
+        return {datum_hash: self._datums.get(datum_hash) for datum_hash in datum_hashes}
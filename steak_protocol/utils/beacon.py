@@ -0,0 +1,142 @@
+"""
+The randomness beacon: the block hashes of the stake chain history.
+
+The beacon is served from the block records of a history directory (see `history`).
+They are memory mapped, so looking up the block hash valid at a slot is a binary search without parsing.
+
+A beacon value is verified backward from a trusted later block (i.e. the on-chain tip or a block observed on chain).
+Starting from the trusted block, each record is checked against its successor:
+- the producer state hashes to the recorded producer state hash
+- the producer state of the successor links to the recorded producer state hash
+- the block hash of the successor is derived from the core chain state and producer signature of the record
+The block hash and producer state hash of the successor are trusted at that point,
+so the recorded block hash, slot and producer state of the record can not be forged.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+from opshin.std.builtins import sha2_256
+from opshin.std.math import bytes_big_from_unsigned_int
+
+from steak_protocol.onchain.types import CoreChainState, ProducerState
+from steak_protocol.utils.block_index import StakeChainState
+from steak_protocol.utils.history import block_hash, block_record, core_chain_state
+
+# elected slot leader numbers tried when deriving the block hash
+MAX_SLOT_LEADERS = 16
+
+
+@dataclass(frozen=True)
+class TrustedBlock:
+    """
+    A block observed on chain that anchors the verification of preceding records
+    """
+
+    block_number: int
+    block_hash: bytes
+    producer_state_hash: bytes
+
+    @classmethod
+    def from_state(cls, state: StakeChainState) -> "TrustedBlock":
+        return cls(
+            state.chain_state.block_number,
+            state.chain_state.block_hash,
+            sha2_256(state.producer_state.to_cbor()),
+        )
+
+
+class BeaconVerificationError(Exception):
+    def __init__(self, block_number: int, reason: str):
+        super().__init__(f"Block {block_number}: {reason}")
+        self.block_number = block_number
+        self.reason = reason
+
+
+def record_to_json(record: np.void) -> dict:
+    return {
+        "block_number": int(record["block_number"]),
+        "slot_number": int(record["slot_number"]),
+        "block_hash": block_hash(record).hex(),
+        "producer_state_hash": bytes(record["producer_state_hash"]).hex(),
+    }
+
+
+def record_from_json(d: dict) -> np.ndarray:
+    return block_record(
+        CoreChainState(
+            d["block_number"], bytes.fromhex(d["block_hash"]), d["slot_number"]
+        ),
+        bytes.fromhex(d["producer_state_hash"]),
+    )
+
+
+def derive_block_hash(
+    prev_record: np.void,
+    prev_producer_state: ProducerState,
+    record_block_hash: bytes,
+    max_slot_leaders: int = MAX_SLOT_LEADERS,
+) -> Optional[int]:
+    """
+    Returns the elected slot leader number that yields the recorded block hash, None if there is none
+    """
+    suffix = (
+        core_chain_state(prev_record).to_cbor() + prev_producer_state.producer_signature
+    )
+    for k in range(max_slot_leaders):
+        if sha2_256(bytes_big_from_unsigned_int(k) + suffix) == record_block_hash:
+            return k
+    return None
+
+
+def verify_records(
+    records: np.ndarray,
+    producer_states: List[bytes],
+    trusted_block: TrustedBlock,
+    max_slot_leaders: int = MAX_SLOT_LEADERS,
+):
+    """
+    Verify a range of consecutive records in one pass given the CBOR of their producer states.
+    The last record has to be the trusted block, all preceding records are checked backward
+    against their successor.
+    Raises BeaconVerificationError for the first record (from the end) that does not verify.
+    """
+    assert len(records) == len(producer_states), "One producer state per record"
+    if len(records) == 0:
+        raise BeaconVerificationError(trusted_block.block_number, "anchor missing")
+    hashes = [sha2_256(p) for p in producer_states]
+    recorded_hashes = [bytes(h) for h in records["producer_state_hash"]]
+    last = records[-1]
+    if (
+        int(last["block_number"]) != trusted_block.block_number
+        or block_hash(last) != trusted_block.block_hash
+        or recorded_hashes[-1] != trusted_block.producer_state_hash
+    ):
+        raise BeaconVerificationError(
+            int(last["block_number"]), "anchor is not trusted"
+        )
+    decoded = [ProducerState.from_cbor(p) for p in producer_states]
+    for i in reversed(range(len(records))):
+        record = records[i]
+        block_number = int(record["block_number"])
+        if hashes[i] != recorded_hashes[i]:
+            raise BeaconVerificationError(block_number, "producer state hash mismatch")
+        if i == len(records) - 1:
+            continue
+        next_record = records[i + 1]
+        if int(next_record["block_number"]) != block_number + 1:
+            raise BeaconVerificationError(block_number, "blocks not consecutive")
+        if int(next_record["slot_number"]) <= int(record["slot_number"]):
+            raise BeaconVerificationError(block_number, "slot not increasing")
+        if decoded[i + 1].prev_producer_state_hash != recorded_hashes[i]:
+            raise BeaconVerificationError(block_number, "producer state not linked")
+        if (
+            derive_block_hash(
+                record, decoded[i], block_hash(next_record), max_slot_leaders
+            )
+            is None
+        ):
+            raise BeaconVerificationError(
+                block_number, "block hash of successor not derived"
+            )
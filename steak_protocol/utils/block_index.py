@@ -0,0 +1,329 @@
+"""
+A local index of the stake chain history.
+
+Every block is stored once per chain, keyed by the chain (its auth NFT) and block number,
+and indexed by the hash of the preceding producer state.
+If a different block is observed at a known block number (i.e. after a rollback), it replaces
+the stored block and the stored successors that no longer link to it are dropped.
+This allows answering questions about the history of the chain (i.e. which preceding blocks agreed
+on an upgrade proposal) with a single local query instead of walking the chain through the indexer.
+"""
+
+from pathlib import Path
+from typing import List, Optional, Union
+
+import peewee
+import pycardano
+import requests
+from opshin.ledger.api_v2 import NoOutputDatum, SomeOutputDatum
+from opshin.prelude import Token
+from opshin.std.builtins import sha2_256
+from pycardano import DeserializeException, datum_hash
+
+from steak_protocol.onchain.types import (
+    StakeChainV0State,
+    StakeChainV1State,
+    StakeChainV2State,
+    CoreChainState,
+    ProducerState,
+)
+from steak_protocol.utils.datums import DatumResolver, kupo_datum_resolver
+
+index_dir = Path(__file__).parent.parent.parent.joinpath("index")
+
+StakeChainState = Union[StakeChainV0State, StakeChainV1State, StakeChainV2State]
+
+db = peewee.SqliteDatabase(None)
+
+
+class BaseModel(peewee.Model):
+    class Meta:
+        database = db
+
+
+class Block(BaseModel):
+    # policy id and token name of the auth NFT of the chain, empty if not specified
+    chain = peewee.BlobField(default=b"")
+    block_number = peewee.IntegerField()
+    slot_number = peewee.IntegerField(index=True)
+    block_hash = peewee.BlobField()
+    # sha2_256 of the producer state of this block
+    producer_state_hash = peewee.BlobField(index=True)
+    prev_producer_state_hash = peewee.BlobField(index=True)
+    # hash of the message attached by the producer, None if no message was attached
+    producer_message_hash = peewee.BlobField(null=True, index=True)
+    chain_state = peewee.BlobField()
+    producer_state = peewee.BlobField()
+    # the full datum of the first output that carried this block
+    state = peewee.BlobField()
+    transaction_id = peewee.BlobField()
+    output_index = peewee.IntegerField()
+
+    class Meta:
+        primary_key = peewee.CompositeKey("chain", "block_number")
+
+    def core_chain_state(self) -> CoreChainState:
+        return CoreChainState.from_cbor(bytes(self.chain_state))
+
+    def decoded_producer_state(self) -> ProducerState:
+        return ProducerState.from_cbor(bytes(self.producer_state))
+
+
+class SyncState(BaseModel):
+    # identifies the indexer and chain that were synced
+    key = peewee.CharField(primary_key=True)
+    # last slot of the indexer that was processed
+    slot_number = peewee.IntegerField()
+
+
+def open_index(path: Union[str, Path, None] = None) -> peewee.SqliteDatabase:
+    """
+    Open (and create if necessary) the block index at the given path
+    """
+    path = Path(path) if path is not None else index_dir.joinpath("stakechain.db")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if not db.is_closed():
+        db.close()
+    db.init(str(path), pragmas={"journal_mode": "wal"})
+    db.connect()
+    db.create_tables([Block, SyncState])
+    return db
+
+
+def chain_key(stakechain_auth_nft: Token) -> bytes:
+    """
+    The key of the blocks of the chain with the given auth NFT
+    """
+    return stakechain_auth_nft.policy_id + stakechain_auth_nft.token_name
+
+
+def stakechain_state_from_cbor(cbor: Union[bytes, str]) -> StakeChainState:
+    """
+    Decode a stake chain datum of any supported version
+    """
+    for state_type in (StakeChainV2State, StakeChainV1State, StakeChainV0State):
+        try:
+            return state_type.from_cbor(cbor)
+        except DeserializeException:
+            continue
+    raise DeserializeException("Not a stake chain state")
+
+
+def producer_message_hash(producer_state: ProducerState) -> Optional[bytes]:
+    """
+    Returns the hash of the message attached to the block or None if no message was attached
+    """
+    if isinstance(producer_state.auxiliary, NoOutputDatum):
+        return None
+    if isinstance(producer_state.auxiliary, SomeOutputDatum):
+        return datum_hash(producer_state.auxiliary.datum).payload
+    return producer_state.auxiliary.datum_hash
+
+
+def add_state(
+    state: StakeChainState,
+    transaction_id: bytes,
+    output_index: int,
+    chain: bytes = b"",
+) -> bool:
+    """
+    Add the block contained in the given state to the index of the given chain (see `chain_key`).
+    Returns whether the block was not yet known.
+    Updates of the holder list keep the block unchanged and are not stored again.
+    A different block with the same block number replaces the stored one together with
+    the stored successors that do not link to it.
+    """
+    producer_state_cbor = state.producer_state.to_cbor()
+    producer_state_hash = sha2_256(producer_state_cbor)
+    block_number = state.chain_state.block_number
+    with db.atomic():
+        known = Block.get_or_none(
+            (Block.chain == chain) & (Block.block_number == block_number)
+        )
+        if known is not None:
+            if bytes(known.producer_state_hash) == producer_state_hash:
+                return False
+            drop_unlinked_successors(chain, block_number, producer_state_hash)
+        Block.insert(
+            chain=chain,
+            block_number=block_number,
+            slot_number=state.chain_state.slot_number,
+            block_hash=state.chain_state.block_hash,
+            producer_state_hash=producer_state_hash,
+            prev_producer_state_hash=state.producer_state.prev_producer_state_hash,
+            producer_message_hash=producer_message_hash(state.producer_state),
+            chain_state=state.chain_state.to_cbor(),
+            producer_state=producer_state_cbor,
+            state=state.to_cbor(),
+            transaction_id=transaction_id,
+            output_index=output_index,
+        ).on_conflict_replace().execute()
+    return True
+
+
+def drop_unlinked_successors(
+    chain: bytes, block_number: int, producer_state_hash: bytes
+):
+    """
+    Delete the stored successors of the given block from the first one that does not link to it
+    """
+    successors = (
+        Block.select(
+            Block.block_number,
+            Block.producer_state_hash,
+            Block.prev_producer_state_hash,
+        )
+        .where((Block.chain == chain) & (Block.block_number > block_number))
+        .order_by(Block.block_number)
+    )
+    expected_number, expected_hash = block_number + 1, producer_state_hash
+    for block in successors:
+        if (
+            block.block_number != expected_number
+            or bytes(block.prev_producer_state_hash) != expected_hash
+        ):
+            Block.delete().where(
+                (Block.chain == chain) & (Block.block_number >= block.block_number)
+            ).execute()
+            return
+        expected_number, expected_hash = (
+            block.block_number + 1,
+            bytes(block.producer_state_hash),
+        )
+
+
+def _of_chain(query, chain: Optional[bytes]):
+    return query if chain is None else query.where(Block.chain == chain)
+
+
+def latest_block(chain: Optional[bytes] = None) -> Optional[Block]:
+    """
+    The latest block of the given chain, or of all chains of the index if None
+    """
+    return _of_chain(Block.select(), chain).order_by(Block.block_number.desc()).first()
+
+
+def block_by_number(
+    block_number: int, chain: Optional[bytes] = None
+) -> Optional[Block]:
+    return _of_chain(
+        Block.select().where(Block.block_number == block_number), chain
+    ).first()
+
+
+def block_by_prev_producer_state_hash(
+    prev_producer_state_hash: bytes,
+    chain: Optional[bytes] = None,
+) -> Optional[Block]:
+    return _of_chain(
+        Block.select().where(
+            Block.prev_producer_state_hash == prev_producer_state_hash
+        ),
+        chain,
+    ).first()
+
+
+def producer_states_agreeing_on(
+    proposal_hash: bytes,
+    n: int,
+    up_to_block: Optional[int] = None,
+    chain: Optional[bytes] = None,
+) -> List[ProducerState]:
+    """
+    Returns the last n producer states (most recent first) up to the given block (default: latest block).
+    Stops at the first block that did not agree on the proposal or does not link to its successor,
+    so the result contains less than n states if there was no consecutive agreement of length n.
+    """
+    query = (
+        _of_chain(Block.select(), chain).order_by(Block.block_number.desc()).limit(n)
+    )
+    if up_to_block is not None:
+        query = query.where(Block.block_number <= up_to_block)
+    producer_states = []
+    successor = None
+    for block in query:
+        if (
+            block.producer_message_hash is None
+            or bytes(block.producer_message_hash) != proposal_hash
+        ):
+            break
+        if successor is not None and (
+            bytes(successor.prev_producer_state_hash)
+            != bytes(block.producer_state_hash)
+        ):
+            break
+        producer_states.append(block.decoded_producer_state())
+        successor = block
+    return producer_states
+
+
+def sync_from_kupo(
+    kupo_url: str,
+    stakechain_address: Union[str, pycardano.Address],
+    stakechain_auth_nft: Token,
+    datum_resolver: Optional[DatumResolver] = None,
+) -> int:
+    """
+    Add all blocks that the kupo instance observed at the stake chain address since the last sync.
+    Assumes that the kupo instance matches the stakechain address and does not prune spent outputs.
+    Datums are returned inline by kupo where supported and resolved in bulk otherwise.
+    The synced slot does not advance past an output whose datum could not be resolved (yet),
+    so it is fetched again by the next sync.
+
+    Returns the number of added blocks.
+    """
+    stakechain_address = str(stakechain_address)
+    auth_nft_asset = (
+        f"{stakechain_auth_nft.policy_id.hex()}.{stakechain_auth_nft.token_name.hex()}"
+    )
+    chain = chain_key(stakechain_auth_nft)
+    sync_key = f"{kupo_url}/{stakechain_address}/{auth_nft_asset}"
+    sync_state = SyncState.get_or_none(SyncState.key == sync_key)
+    utxo_url = "{}/matches/{}?order=oldest_first&resolve_hashes".format(
+        kupo_url, stakechain_address
+    )
+    if sync_state is not None:
+        utxo_url += "&created_after={}".format(sync_state.slot_number)
+    matches = requests.get(utxo_url).json()
+
+    if datum_resolver is None:
+        datum_resolver = kupo_datum_resolver(kupo_url)
+    matches = [
+        match
+        for match in matches
+        if match["value"]["assets"].get(auth_nft_asset, 0) > 0
+        and match["datum_hash"] is not None
+    ]
+    for match in matches:
+        if match.get("datum") is not None:
+            datum_resolver.prime(match["datum_hash"], match["datum"])
+    datums = datum_resolver.resolve_many(match["datum_hash"] for match in matches)
+
+    added = 0
+    last_slot = sync_state.slot_number if sync_state is not None else 0
+    unresolved = False
+    with db.atomic():
+        for match in matches:
+            slot = match["created_at"]["slot_no"]
+            datum_cbor = datums[match["datum_hash"]]
+            if datum_cbor is None:
+                # only outputs created after the synced slot are fetched again
+                last_slot = min(last_slot, slot - 1)
+                unresolved = True
+                continue
+            if not unresolved:
+                last_slot = max(last_slot, slot)
+            try:
+                state = stakechain_state_from_cbor(datum_cbor.cbor)
+            except DeserializeException:
+                continue
+            added += add_state(
+                state,
+                bytes.fromhex(match["transaction_id"]),
+                match["output_index"],
+                chain,
+            )
+        SyncState.insert(
+            key=sync_key, slot_number=last_slot
+        ).on_conflict_replace().execute()
+    return added
@@ -0,0 +1,60 @@
+"""
+Clocks for the off-chain code.
+
+Everything that depends on the current time (computing the current stake chain slot,
+waiting for transactions, waiting between retries) takes a clock.
+The system clock follows real time. The virtual clock only advances when asked to,
+so simulations and tests can skip thousands of slots instantly.
+"""
+
+import time
+from abc import ABC, abstractmethod
+
+
+class Clock(ABC):
+    @abstractmethod
+    def now(self) -> int:
+        """
+        Current POSIX time in milliseconds
+        """
+
+    @abstractmethod
+    def sleep(self, seconds: float):
+        """
+        Wait for the given number of seconds
+        """
+
+
+class SystemClock(Clock):
+    def now(self) -> int:
+        return int(time.time() * 1000)
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """
+    A clock that only advances explicitly. Sleeping advances the clock instantly.
+    """
+
+    def __init__(self, now: int = 0):
+        self._now = now
+
+    def now(self) -> int:
+        return self._now
+
+    def sleep(self, seconds: float):
+        self.advance(int(seconds * 1000))
+
+    def advance(self, milliseconds: int) -> int:
+        assert milliseconds >= 0, "Can not go back in time"
+        self._now += milliseconds
+        return self._now
+
+    def set(self, now: int):
+        assert now >= self._now, "Can not go back in time"
+        self._now = now
+
+
+system_clock = SystemClock()
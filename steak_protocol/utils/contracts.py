@@ -14,6 +14,7 @@ from pycardano import (
 
 from .keys import get_address
 from .network import network, context
+from .profiling import timed
 
 build_dir = Path(__file__).parent.parent.parent.joinpath("build")
 
@@ -22,6 +23,7 @@ def module_name(module):
     return Path(module.__file__).stem
 
 
+@timed("contracts.get_contract")
 def get_contract(name, compressed=True, context=context):
     with open(
         build_dir.joinpath(f"{name}{'_compressed' if compressed else ''}/script.cbor")
@@ -39,6 +41,7 @@ def get_contract(name, compressed=True, context=context):
     return contract_plutus_script, contract_script_hash, contract_script_address
 
 
+@timed("contracts.get_ref_utxo")
 def get_ref_utxo(contract: Union[PlutusV2Script, UTxO], context: ChainContext):
     if isinstance(contract, UTxO):
         return contract
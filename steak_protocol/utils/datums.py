@@ -0,0 +1,161 @@
+"""
+Resolution of datum hashes to datums.
+
+Long running processes (miners, fillers) resolve the same datums over and over again,
+so datums are cached with a bounded size and can optionally be persisted across restarts.
+"""
+
+import dbm
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+import requests
+from pycardano import RawCBOR
+
+DatumFetcher = Callable[[str], Optional[bytes]]
+BulkDatumFetcher = Callable[[List[str]], Dict[str, Optional[bytes]]]
+
+
+class DatumResolver:
+    """
+    Resolves datum hashes (hex) to the cbor of the datum.
+
+    - at most `maxsize` datums are kept in memory, the least recently used are evicted first
+    - if `persist_path` is given, resolved datums are additionally stored on disk
+    - concurrent requests for the same datum hash are only forwarded once to the backend
+    - many datums are resolved in one call to `fetch_many` if the backend supports it
+      and otherwise in parallel through `fetch`
+    """
+
+    def __init__(
+        self,
+        fetch: DatumFetcher,
+        fetch_many: Optional[BulkDatumFetcher] = None,
+        maxsize: int = 10_000,
+        persist_path: Union[str, Path, None] = None,
+        max_workers: int = 8,
+    ):
+        self._fetch = fetch
+        self._fetch_many = fetch_many
+        self.maxsize = maxsize
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._store = dbm.open(str(persist_path), "c") if persist_path else None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _get_cached(self, datum_hash: str) -> Optional[bytes]:
+        cbor = self._cache.get(datum_hash)
+        if cbor is not None:
+            self._cache.move_to_end(datum_hash)
+            return cbor
+        if self._store is not None:
+            cbor = self._store.get(datum_hash)
+            if cbor is not None:
+                self._put(datum_hash, cbor, persist=False)
+        return cbor
+
+    def _put(self, datum_hash: str, cbor: bytes, persist: bool = True):
+        self._cache[datum_hash] = cbor
+        self._cache.move_to_end(datum_hash)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        if persist and self._store is not None:
+            self._store[datum_hash] = cbor
+
+    def prime(self, datum_hash: str, cbor: Union[bytes, str]):
+        """
+        Add a datum that was obtained by other means (i.e. returned inline by the indexer)
+        """
+        if isinstance(cbor, str):
+            cbor = bytes.fromhex(cbor)
+        with self._lock:
+            self._put(datum_hash, cbor)
+
+    def _fetch_all(self, datum_hashes: List[str]) -> Dict[str, Optional[bytes]]:
+        if self._fetch_many is not None:
+            return self._fetch_many(datum_hashes)
+        if len(datum_hashes) == 1:
+            return {datum_hashes[0]: self._fetch(datum_hashes[0])}
+        return dict(zip(datum_hashes, self._executor.map(self._fetch, datum_hashes)))
+
+    def resolve_many(self, datum_hashes: Iterable[str]) -> Dict[str, Optional[RawCBOR]]:
+        """
+        Resolve all given datum hashes. Unknown datums resolve to None.
+        """
+        datums: Dict[str, Optional[bytes]] = {}
+        to_fetch = []
+        pending: Dict[str, Future] = {}
+        with self._lock:
+            for datum_hash in datum_hashes:
+                if datum_hash in datums or datum_hash in pending:
+                    continue
+                cbor = self._get_cached(datum_hash)
+                if cbor is not None:
+                    datums[datum_hash] = cbor
+                    continue
+                future = self._in_flight.get(datum_hash)
+                if future is None:
+                    future = Future()
+                    self._in_flight[datum_hash] = future
+                    to_fetch.append(datum_hash)
+                pending[datum_hash] = future
+
+        if to_fetch:
+            try:
+                fetched = self._fetch_all(to_fetch)
+            except Exception as e:
+                with self._lock:
+                    for datum_hash in to_fetch:
+                        self._in_flight.pop(datum_hash).set_exception(e)
+                raise
+            with self._lock:
+                for datum_hash in to_fetch:
+                    cbor = fetched.get(datum_hash)
+                    if cbor is not None:
+                        self._put(datum_hash, cbor)
+                    self._in_flight.pop(datum_hash).set_result(cbor)
+
+        for datum_hash, future in pending.items():
+            datums[datum_hash] = future.result()
+        return {
+            datum_hash: RawCBOR(cbor) if cbor is not None else None
+            for datum_hash, cbor in datums.items()
+        }
+
+    def resolve(self, datum_hash: str) -> Optional[RawCBOR]:
+        return self.resolve_many([datum_hash])[datum_hash]
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+
+def kupo_datum_fetcher(kupo_url: str) -> DatumFetcher:
+    """
+    Fetch single datums from kupo, reusing one connection per thread
+    """
+    sessions = threading.local()
+
+    def fetch(datum_hash: str) -> Optional[bytes]:
+        session = getattr(sessions, "session", None)
+        if session is None:
+            session = sessions.session = requests.Session()
+        result = session.get("{}/datums/{}".format(kupo_url, datum_hash)).json()
+        if not result:
+            return None
+        return bytes.fromhex(result["datum"])
+
+    return fetch
+
+
+def kupo_datum_resolver(kupo_url: str, **kwargs) -> DatumResolver:
+    return DatumResolver(kupo_datum_fetcher(kupo_url), **kwargs)
@@ -0,0 +1,59 @@
+"""
+Dump files of the stake chain history.
+
+A dump holds all stake chain outputs in chain order, one JSON object per line
+(written by `audit.dump_from_kupo`). It is read by the audit and the compact history.
+"""
+
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+
+@dataclass
+class StateRecord:
+    # cbor of the stake chain datum
+    state: bytes
+    transaction_id: bytes
+    output_index: int
+    # amount of stake coin held by the stake chain output, if known
+    reserve: Optional[int] = None
+    # secret revealed by the producer of this block (from the redeemer), if known
+    slot_leader_secret: Optional[bytes] = None
+    # hash the producer committed to for this block (from the spent holder state), if known
+    committed_hash: Optional[bytes] = None
+    # cbor of the holder state of the producer of this block (spent by the block), if known
+    holder_state: Optional[bytes] = None
+
+
+def records_from_dump(path: Union[str, Path]) -> Iterator[StateRecord]:
+    """
+    Stream the records of a dump file, one JSON object per line in chain order
+    """
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            yield StateRecord(
+                state=bytes.fromhex(entry["state"]),
+                transaction_id=bytes.fromhex(entry["transaction_id"]),
+                output_index=entry["output_index"],
+                reserve=entry.get("reserve"),
+                slot_leader_secret=(
+                    bytes.fromhex(entry["slot_leader_secret"])
+                    if entry.get("slot_leader_secret") is not None
+                    else None
+                ),
+                committed_hash=(
+                    bytes.fromhex(entry["committed_hash"])
+                    if entry.get("committed_hash") is not None
+                    else None
+                ),
+                holder_state=(
+                    bytes.fromhex(entry["holder_state"])
+                    if entry.get("holder_state") is not None
+                    else None
+                ),
+            )
@@ -0,0 +1,526 @@
+"""
+An in-memory emulator of the ledger.
+
+Transactions are validated and applied locally, Plutus scripts are evaluated through uplc
+and the slot only advances when asked to. This allows running the off-chain code
+(init, register, mine, upgrade, ...) without a node and without waiting for real time to pass.
+
+The emulator is not a full ledger implementation. In particular
+- uplc does not implement the cost model, execution units are a flat multiple of the number of machine steps.
+  The fees and execution units computed by the emulator are therefore not representative of the real chain,
+  use it to check the validity of transactions, not their cost or whether they fit the execution budget
+- native scripts, collateral and phase-2 failures (is_valid = False) are not modelled,
+  a transaction with a failing script is rejected on submission
+- only stake (de)registration and delegation certificates are supported
+"""
+
+import hashlib
+import io
+from fractions import Fraction
+from typing import Dict, List, Optional, Tuple, Union
+
+import cbor2
+import nacl.exceptions
+import nacl.signing
+import uplc.ast
+import uplc.tools
+from uplc.machine import Machine
+from opshin.prelude import ScriptContext
+from pycardano import (
+    Address,
+    Datum,
+    ExecutionUnits,
+    GenesisParameters,
+    MultiAsset,
+    Network,
+    PlutusV1Script,
+    PlutusV2Script,
+    ProtocolParameters,
+    RawCBOR,
+    Redeemer,
+    RedeemerTag,
+    ScriptHash,
+    StakeDelegation,
+    StakeRegistration,
+    Transaction,
+    TransactionFailedException,
+    TransactionId,
+    TransactionInput,
+    TransactionOutput,
+    UTxO,
+    Value,
+    VerificationKeyHash,
+    datum_hash,
+    fee,
+    plutus_script_hash,
+)
+from pycardano.certificate import StakeDeregistration
+from pycardano.serialization import default_encoder
+
+from .backends import LedgerBackend
+from .clock import VirtualClock
+from .to_script_context import sorted_inputs, to_script_purpose, to_tx_info
+
+# rough average cost of a single step of the CEK machine in the Plutus V2 cost model
+# (not the cost of the actual step, see the module docstring)
+STEP_CPU_COST = 23000
+STEP_MEM_COST = 100
+
+DEFAULT_PROTOCOL_PARAMETERS = ProtocolParameters(
+    min_fee_constant=155381,
+    min_fee_coefficient=44,
+    max_block_size=90112,
+    max_tx_size=16384,
+    max_block_header_size=1100,
+    key_deposit=2000000,
+    pool_deposit=500000000,
+    pool_influence=Fraction(3, 10),
+    monetary_expansion=Fraction(3, 1000),
+    treasury_expansion=Fraction(1, 5),
+    decentralization_param=Fraction(0),
+    extra_entropy="",
+    protocol_major_version=8,
+    protocol_minor_version=0,
+    min_utxo=1000000,
+    min_pool_cost=170000000,
+    price_mem=Fraction(577, 10000),
+    price_step=Fraction(721, 10000000),
+    max_tx_ex_mem=14000000,
+    max_tx_ex_steps=10000000000,
+    max_block_ex_mem=62000000,
+    max_block_ex_steps=20000000000,
+    max_val_size=5000,
+    collateral_percent=150,
+    max_collateral_inputs=3,
+    coins_per_utxo_word=34482,
+    coins_per_utxo_byte=4310,
+    cost_models={},
+)
+
+DEFAULT_GENESIS_PARAMETERS = GenesisParameters(
+    active_slots_coefficient=Fraction(1, 20),
+    update_quorum=5,
+    max_lovelace_supply=45000000000000000,
+    network_magic=2,
+    epoch_length=86400,
+    # 2022-10-25T00:00:00Z, the start of the preview testnet
+    system_start=1666656000,
+    slots_per_kes_period=129600,
+    slot_length=1,
+    max_kes_evolutions=62,
+    security_param=432,
+)
+
+PlutusScript = Union[PlutusV1Script, PlutusV2Script]
+
+
+def _data_cbor(data) -> bytes:
+    if isinstance(data, RawCBOR):
+        return data.cbor
+    return cbor2.dumps(data, default=default_encoder)
+
+
+def _normalized(value: Value) -> Value:
+    return Value(value.coin, value.multi_asset.filter(lambda p, n, a: a != 0))
+
+
+def _body_hash(cbor: bytes) -> bytes:
+    """
+    Hash of the transaction body as it was submitted.
+    pycardano does not always serialize a decoded body identically (i.e. certificate lists),
+    the ledger hashes the original bytes.
+    """
+    fp = io.BytesIO(cbor)
+    # skip the header of the transaction array
+    fp.read(1)
+    cbor2.CBORDecoder(fp).decode()
+    return hashlib.blake2b(cbor[1 : fp.tell()], digest_size=32).digest()
+
+
+def _staking_key(credential: Union[VerificationKeyHash, ScriptHash]) -> bytes:
+    return credential.payload
+
+
+class EmulatorBackend(LedgerBackend):
+    """
+    A chain context that validates and applies submitted transactions to a local ledger.
+
+    The current slot is derived from a virtual clock, which is advanced through `wait` and `set_slot`
+    (or directly on the clock, i.e. by off-chain code that sleeps on the same clock).
+    """
+
+    def __init__(
+        self,
+        protocol_param: ProtocolParameters = DEFAULT_PROTOCOL_PARAMETERS,
+        genesis_param: GenesisParameters = DEFAULT_GENESIS_PARAMETERS,
+        network: Network = Network.TESTNET,
+        slot: int = 0,
+        clock: Optional[VirtualClock] = None,
+    ):
+        super().__init__(protocol_param, genesis_param, network=network)
+        # the clock starts at the given slot unless a clock is passed explicitly
+        self.clock = (
+            clock if clock is not None else VirtualClock(self.slot_to_posix(slot))
+        )
+        self._reward_accounts: Dict[bytes, int] = {}
+        self._funding_nonce = 0
+        self.submitted: List[Transaction] = []
+
+    # clock
+
+    @property
+    def last_block_slot(self) -> int:
+        return self.posix_to_slot(self.clock.now())
+
+    @property
+    def epoch(self) -> int:
+        return self.last_block_slot // self._genesis_param.epoch_length
+
+    def wait(self, slots: int = 1) -> int:
+        """
+        Advance the current slot by the given number of slots
+        """
+        self.clock.advance(slots * self._genesis_param.slot_length * 1000)
+        return self.last_block_slot
+
+    def set_slot(self, slot: int):
+        self.clock.set(self.slot_to_posix(slot))
+
+    def slot_to_posix(self, slot: int) -> int:
+        """
+        POSIX time (in milliseconds) at the beginning of the given slot
+        """
+        return (
+            self._genesis_param.system_start + slot * self._genesis_param.slot_length
+        ) * 1000
+
+    def posix_to_slot(self, posix_time: int) -> int:
+        return (
+            posix_time // 1000 - self._genesis_param.system_start
+        ) // self._genesis_param.slot_length
+
+    # ledger state
+
+    def fund(
+        self,
+        address: Union[str, Address],
+        amount: Union[int, Value],
+        datum: Optional[Datum] = None,
+        script: Optional[PlutusScript] = None,
+    ) -> UTxO:
+        """
+        Create a new utxo with the given value (and inline datum and reference script) at the address,
+        out of thin air
+        """
+        self._funding_nonce += 1
+        tx_id = TransactionId(
+            hashlib.sha256(b"fund" + self._funding_nonce.to_bytes(8, "big")).digest()
+        )
+        if isinstance(address, str):
+            address = Address.from_primitive(address)
+        if datum is not None:
+            datum = RawCBOR(_data_cbor(datum))
+        utxo = UTxO(
+            TransactionInput(tx_id, 0),
+            TransactionOutput(address, amount, datum=datum, script=script),
+        )
+        self.add_utxo(utxo)
+        return utxo
+
+    def reward_balance(self, staking_part: Union[VerificationKeyHash, ScriptHash]):
+        """
+        Balance of the reward account or None if the staking credential is not registered
+        """
+        return self._reward_accounts.get(_staking_key(staking_part))
+
+    def _resolve(self, tx_ins: List[TransactionInput], kind: str) -> List[UTxO]:
+        utxos = []
+        for tx_in in tx_ins:
+            utxo = self._utxos_by_input.get(tx_in)
+            if utxo is None:
+                raise TransactionFailedException(f"Unknown {kind} {tx_in}")
+            utxos.append(utxo)
+        return utxos
+
+    # validation
+
+    def _check_validity_interval(self, tx: Transaction):
+        tx_body = tx.transaction_body
+        slot = self.last_block_slot
+        if tx_body.validity_start is not None and slot < tx_body.validity_start:
+            raise TransactionFailedException(
+                f"Transaction not yet valid (slot {slot} < {tx_body.validity_start})"
+            )
+        if tx_body.ttl is not None and slot >= tx_body.ttl:
+            raise TransactionFailedException(
+                f"Transaction expired (slot {slot} >= {tx_body.ttl})"
+            )
+
+    def _check_signatures(self, tx: Transaction, inputs: List[UTxO], body_hash: bytes):
+        tx_body = tx.transaction_body
+        signers = set()
+        for witness in tx.transaction_witness_set.vkey_witnesses or []:
+            try:
+                nacl.signing.VerifyKey(witness.vkey.payload[:32]).verify(
+                    body_hash, witness.signature
+                )
+            except nacl.exceptions.BadSignatureError:
+                raise TransactionFailedException(
+                    f"Invalid signature of {witness.vkey.hash()}"
+                )
+            signers.add(witness.vkey.hash())
+
+        required = set(tx_body.required_signers or [])
+        for utxo in inputs:
+            payment_part = utxo.output.address.payment_part
+            if isinstance(payment_part, VerificationKeyHash):
+                required.add(payment_part)
+        for reward_address in (tx_body.withdraws or {}).keys():
+            staking_part = Address.from_primitive(reward_address).staking_part
+            if isinstance(staking_part, VerificationKeyHash):
+                required.add(staking_part)
+        missing = required - signers
+        if missing:
+            raise TransactionFailedException(
+                f"Missing signatures of {', '.join(str(m) for m in missing)}"
+            )
+
+    def _apply_certificates_and_withdrawals(self, tx: Transaction) -> Tuple[int, int]:
+        """
+        Returns the deposits that are paid and refunded by the transaction
+        """
+        tx_body = tx.transaction_body
+        deposit, refund = 0, 0
+        for reward_address, amount in (tx_body.withdraws or {}).items():
+            key = _staking_key(Address.from_primitive(reward_address).staking_part)
+            if self._reward_accounts.get(key) != amount:
+                raise TransactionFailedException(
+                    f"Withdrawal of {amount} does not match the reward balance of {key.hex()}"
+                )
+        for certificate in tx_body.certificates or []:
+            key = _staking_key(certificate.stake_credential.credential)
+            if isinstance(certificate, StakeRegistration):
+                if key in self._reward_accounts:
+                    raise TransactionFailedException(f"{key.hex()} already registered")
+                deposit += self._protocol_param.key_deposit
+            elif isinstance(certificate, StakeDeregistration):
+                if key not in self._reward_accounts:
+                    raise TransactionFailedException(f"{key.hex()} not registered")
+                refund += self._protocol_param.key_deposit
+            elif isinstance(certificate, StakeDelegation):
+                if key not in self._reward_accounts:
+                    raise TransactionFailedException(f"{key.hex()} not registered")
+            else:
+                raise TransactionFailedException(
+                    f"Unsupported certificate {type(certificate).__name__}"
+                )
+        return deposit, refund
+
+    def _check_value_conservation(
+        self, tx: Transaction, inputs: List[UTxO], deposit: int, refund: int
+    ):
+        tx_body = tx.transaction_body
+        consumed = Value(
+            refund + sum((tx_body.withdraws or {}).values()),
+            tx_body.mint or MultiAsset(),
+        )
+        for utxo in inputs:
+            consumed += utxo.output.amount
+        produced = Value(tx_body.fee + deposit)
+        for output in tx_body.outputs:
+            produced += output.amount
+        if _normalized(consumed) != _normalized(produced):
+            raise TransactionFailedException(
+                f"Value not conserved: consumed {consumed}, produced {produced}"
+            )
+
+    # script evaluation
+
+    def _scripts(
+        self, tx: Transaction, utxos: List[UTxO]
+    ) -> Dict[ScriptHash, PlutusScript]:
+        witness_set = tx.transaction_witness_set
+        scripts = {}
+        for script in (witness_set.plutus_v1_script or []) + (
+            witness_set.plutus_v2_script or []
+        ):
+            scripts[plutus_script_hash(script)] = script
+        for utxo in utxos:
+            script = utxo.output.script
+            if isinstance(script, (PlutusV1Script, PlutusV2Script)):
+                scripts[plutus_script_hash(script)] = script
+        return scripts
+
+    def _redeemer_script_hash(
+        self, tx: Transaction, inputs: Dict[TransactionInput, UTxO], redeemer: Redeemer
+    ) -> ScriptHash:
+        tx_body = tx.transaction_body
+        if redeemer.tag == RedeemerTag.SPEND:
+            tx_in = sorted_inputs(tx_body.inputs)[redeemer.index]
+            return inputs[tx_in].output.address.payment_part
+        if redeemer.tag == RedeemerTag.MINT:
+            return sorted(tx_body.mint.keys(), key=lambda p: p.to_cbor())[
+                redeemer.index
+            ]
+        if redeemer.tag == RedeemerTag.WITHDRAWAL:
+            reward_address = sorted(tx_body.withdraws.keys())[redeemer.index]
+            return Address.from_primitive(reward_address).staking_part
+        raise TransactionFailedException(f"Unsupported redeemer {redeemer.tag}")
+
+    def _spent_datum(self, tx: Transaction, utxo: UTxO):
+        if utxo.output.datum is not None:
+            return utxo.output.datum
+        if utxo.output.datum_hash is None:
+            raise TransactionFailedException(f"No datum attached to {utxo.input}")
+        for datum in tx.transaction_witness_set.plutus_data or []:
+            if datum_hash(datum) == utxo.output.datum_hash:
+                return datum
+        datum = self._datums.get(utxo.output.datum_hash.payload.hex())
+        if datum is None:
+            raise TransactionFailedException(f"Missing datum of {utxo.input}")
+        return datum
+
+    def _evaluate(
+        self,
+        tx: Transaction,
+        inputs: List[UTxO],
+        reference_inputs: List[UTxO],
+        tx_id: bytes,
+    ) -> Dict[str, ExecutionUnits]:
+        """
+        Run all scripts of the transaction with the given id (the hash of the submitted body),
+        returns the approximate execution units per redeemer
+        """
+        tx_body = tx.transaction_body
+        redeemers = tx.transaction_witness_set.redeemer or []
+        if not redeemers:
+            return {}
+        inputs_by_ref = {u.input: u for u in inputs}
+        # spending redeemer indices refer to the inputs in the order of the ledger
+        ordered_inputs = sorted_inputs(tx_body.inputs)
+        tx_info = to_tx_info(
+            tx,
+            [u.output for u in inputs],
+            [u.output for u in reference_inputs],
+            slot_to_posix=self.slot_to_posix,
+            tx_id=tx_id,
+        )
+        scripts = self._scripts(tx, inputs + reference_inputs)
+        max_steps = self._protocol_param.max_tx_ex_steps // STEP_CPU_COST
+
+        ex_units = {}
+        for redeemer in redeemers:
+            key = f"{redeemer.tag.name.lower()}:{redeemer.index}"
+            script_hash = self._redeemer_script_hash(tx, inputs_by_ref, redeemer)
+            script = scripts.get(script_hash)
+            if script is None:
+                raise TransactionFailedException(
+                    f"Missing script {script_hash} ({key})"
+                )
+            args = []
+            if redeemer.tag == RedeemerTag.SPEND:
+                spent = inputs_by_ref[ordered_inputs[redeemer.index]]
+                args.append(_data_cbor(self._spent_datum(tx, spent)))
+            args.append(_data_cbor(redeemer.data))
+            args.append(
+                ScriptContext(tx_info, to_script_purpose(tx_body, redeemer)).to_cbor()
+            )
+
+            term = uplc.tools.unflatten(bytes(script)).term
+            for arg in args:
+                term = uplc.ast.Apply(term, uplc.ast.data_from_cbor(arg))
+            machine = Machine(term, max_steps=max_steps)
+            try:
+                machine.eval()
+            except RuntimeError as e:
+                raise TransactionFailedException(f"Script {key} failed: {e}")
+            steps = max_steps - machine.rem_steps
+            ex_units[key] = ExecutionUnits(
+                mem=steps * STEP_MEM_COST, steps=steps * STEP_CPU_COST
+            )
+        return ex_units
+
+    def evaluate_tx_cbor(self, cbor: Union[bytes, str]) -> Dict[str, ExecutionUnits]:
+        if isinstance(cbor, str):
+            cbor = bytes.fromhex(cbor)
+        tx = Transaction.from_cbor(cbor)
+        inputs = self._resolve(tx.transaction_body.inputs, "input")
+        reference_inputs = self._resolve(
+            tx.transaction_body.reference_inputs or [], "reference input"
+        )
+        return self._evaluate(tx, inputs, reference_inputs, _body_hash(cbor))
+
+    # submission
+
+    def submit_tx_cbor(self, cbor: Union[bytes, str]):
+        if isinstance(cbor, str):
+            cbor = bytes.fromhex(cbor)
+        if len(cbor) > self._protocol_param.max_tx_size:
+            raise TransactionFailedException(
+                f"Transaction too large ({len(cbor)} > {self._protocol_param.max_tx_size} bytes)"
+            )
+        tx = Transaction.from_cbor(cbor)
+        tx_body = tx.transaction_body
+
+        self._check_validity_interval(tx)
+        if len(set(tx_body.inputs)) != len(tx_body.inputs):
+            raise TransactionFailedException("Duplicate inputs")
+        inputs = self._resolve(tx_body.inputs, "input")
+        reference_inputs = self._resolve(
+            tx_body.reference_inputs or [], "reference input"
+        )
+        tx_id = TransactionId(_body_hash(cbor))
+        self._check_signatures(tx, inputs, tx_id.payload)
+        deposit, refund = self._apply_certificates_and_withdrawals(tx)
+        self._check_value_conservation(tx, inputs, deposit, refund)
+
+        ex_units = self._evaluate(tx, inputs, reference_inputs, tx_id.payload)
+        total_steps, total_mem = 0, 0
+        for redeemer in tx.transaction_witness_set.redeemer or []:
+            key = f"{redeemer.tag.name.lower()}:{redeemer.index}"
+            used = ex_units[key]
+            if (
+                redeemer.ex_units is None
+                or used.steps > redeemer.ex_units.steps
+                or used.mem > redeemer.ex_units.mem
+            ):
+                raise TransactionFailedException(
+                    f"Script {key} exceeds its execution budget ({used} > {redeemer.ex_units})"
+                )
+            total_steps += redeemer.ex_units.steps
+            total_mem += redeemer.ex_units.mem
+        if (
+            total_steps > self._protocol_param.max_tx_ex_steps
+            or total_mem > self._protocol_param.max_tx_ex_mem
+        ):
+            raise TransactionFailedException("Transaction exceeds the execution budget")
+        min_fee = fee(self, len(cbor), total_steps, total_mem)
+        if tx_body.fee < min_fee:
+            raise TransactionFailedException(
+                f"Fee too small ({tx_body.fee} < {min_fee})"
+            )
+
+        self._apply(tx, tx_id)
+        return tx_id
+
+    def _apply(self, tx: Transaction, tx_id: TransactionId):
+        tx_body = tx.transaction_body
+        for tx_in in tx_body.inputs:
+            self.remove_utxo(tx_in)
+        for reward_address in (tx_body.withdraws or {}).keys():
+            key = _staking_key(Address.from_primitive(reward_address).staking_part)
+            self._reward_accounts[key] = 0
+        for certificate in tx_body.certificates or []:
+            key = _staking_key(certificate.stake_credential.credential)
+            if isinstance(certificate, StakeRegistration):
+                self._reward_accounts[key] = 0
+            elif isinstance(certificate, StakeDeregistration):
+                del self._reward_accounts[key]
+        for datum in tx.transaction_witness_set.plutus_data or []:
+            self.add_datum(datum_hash(datum).payload.hex(), RawCBOR(_data_cbor(datum)))
+        for index, output in enumerate(tx_body.outputs):
+            if output.datum is not None and not isinstance(output.datum, RawCBOR):
+                # keep datums as raw cbor, just like the indexers return them
+                output.datum = RawCBOR(_data_cbor(output.datum))
+            self.add_utxo(UTxO(TransactionInput(tx_id, index), output))
+        self.submitted.append(tx)
@@ -49,7 +49,7 @@ def from_payment_credential(
     raise NotImplementedError(f"Unknown payment key type {type(c)}")
 
 
-def from_address(a: Address) -> pycardano.Address:
+def from_address(a: Address, network: pycardano.Network = network) -> pycardano.Address:
     return pycardano.Address(
         from_payment_credential(a.payment_credential),
         from_staking_credential(a.staking_credential),
@@ -0,0 +1,427 @@
+"""
+Compact binary history of the stake chain.
+
+The history is a directory with two append-only files of fixed-width records:
+- blocks.bin: one record per block with the core chain state and the hashes of the producer state
+- holders.bin: the changes of the holder list as delta records (set weight, insert, remove)
+
+Each block record points to the number of holder deltas that were applied up to that block,
+so the holder list of any block can be reconstructed without storing it per block.
+Both files are memory mapped as NumPy structured arrays, so scans over millions of blocks
+do not parse anything.
+"""
+
+import difflib
+import os
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+import fire
+import numpy as np
+from opshin.std.builtins import sha2_256
+
+from steak_protocol.onchain.types import CoreChainState, StakeHolderRegistrations
+from steak_protocol.utils.block_index import (
+    Block,
+    StakeChainState,
+    open_index,
+    producer_message_hash,
+    stakechain_state_from_cbor,
+)
+from steak_protocol.utils.dump import records_from_dump
+
+VERSION = 1
+HEADER_SIZE = 16
+
+BLOCK_MAGIC = b"STEAKBLK"
+BLOCK_DTYPE = np.dtype(
+    [
+        ("block_number", "<u8"),
+        ("slot_number", "<u8"),
+        ("block_hash", "u1", (32,)),
+        ("producer_state_hash", "u1", (32,)),
+        ("prev_producer_state_hash", "u1", (32,)),
+        # hash of the message attached by the producer (see has_message)
+        ("producer_message_hash", "u1", (32,)),
+        # number of holder deltas applied up to and including this block
+        ("holder_deltas", "<u8"),
+        # the genesis block hash is empty, all others are 32 bytes
+        ("block_hash_length", "u1"),
+        ("has_message", "u1"),
+        ("_padding", "u1", (6,)),
+    ]
+)
+
+HOLDER_MAGIC = b"STEAKHLD"
+HOLDER_DELTA_DTYPE = np.dtype(
+    [
+        # the last block before the change
+        ("block_number", "<u8"),
+        ("weight", "<u8"),
+        ("position", "<u4"),
+        ("op", "u1"),
+        ("stakechain_id_length", "u1"),
+        ("_padding", "u1", (2,)),
+        ("stakechain_id", "u1", (32,)),
+    ]
+)
+OP_SET_WEIGHT = 0
+OP_INSERT = 1
+OP_REMOVE = 2
+
+
+def _put_bytes(field: np.ndarray, value: bytes):
+    assert len(value) <= len(field), "Value too long for record field"
+    field[: len(value)] = np.frombuffer(value, dtype="u1")
+
+
+class RecordFile:
+    """
+    Append-only file of fixed-width records, mapped into memory for reading
+    """
+
+    def __init__(self, path: Union[str, Path], dtype: np.dtype, magic: bytes):
+        self.path = Path(path)
+        self.dtype = dtype
+        header = (
+            magic + VERSION.to_bytes(4, "little") + dtype.itemsize.to_bytes(4, "little")
+        )
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "wb") as f:
+                f.write(header)
+        with open(self.path, "rb") as f:
+            assert (
+                f.read(HEADER_SIZE) == header
+            ), f"Not a {magic.decode()} v{VERSION} file"
+        self._size = -1
+        self._records = np.zeros(0, dtype=dtype)
+
+    @property
+    def records(self) -> np.ndarray:
+        """
+        All records, re-mapped if the file grew since the last access
+        """
+        size = os.path.getsize(self.path)
+        if size != self._size:
+            count = (size - HEADER_SIZE) // self.dtype.itemsize
+            self._records = (
+                np.memmap(
+                    self.path,
+                    dtype=self.dtype,
+                    mode="r",
+                    offset=HEADER_SIZE,
+                    shape=(count,),
+                )
+                if count > 0
+                else np.zeros(0, dtype=self.dtype)
+            )
+            self._size = size
+        return self._records
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def append(self, records: Union[np.ndarray, Sequence[np.ndarray]]):
+        """
+        Append the records after the last complete record.
+        A partial record left by an interrupted write is dropped first.
+        """
+        records = np.asarray(records, dtype=self.dtype).reshape(-1)
+        if len(records) == 0:
+            return
+        with open(self.path, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            complete = (
+                HEADER_SIZE
+                + (size - HEADER_SIZE) // self.dtype.itemsize * self.dtype.itemsize
+            )
+            if complete != size:
+                f.truncate(complete)
+                f.seek(complete)
+            f.write(records.tobytes())
+        self._size = -1
+
+
+def block_record(
+    chain_state: CoreChainState,
+    producer_state_hash: bytes,
+    prev_producer_state_hash: bytes = b"",
+    producer_message_hash: Optional[bytes] = None,
+    holder_deltas: int = 0,
+) -> np.ndarray:
+    record = np.zeros((), dtype=BLOCK_DTYPE)
+    record["block_number"] = chain_state.block_number
+    record["slot_number"] = chain_state.slot_number
+    _put_bytes(record["block_hash"], chain_state.block_hash)
+    record["block_hash_length"] = len(chain_state.block_hash)
+    _put_bytes(record["producer_state_hash"], producer_state_hash)
+    _put_bytes(record["prev_producer_state_hash"], prev_producer_state_hash)
+    if producer_message_hash is not None:
+        _put_bytes(record["producer_message_hash"], producer_message_hash)
+        record["has_message"] = 1
+    record["holder_deltas"] = holder_deltas
+    return record
+
+
+def block_hash(record: np.void) -> bytes:
+    return bytes(record["block_hash"][: record["block_hash_length"]])
+
+
+def core_chain_state(record: np.void) -> CoreChainState:
+    return CoreChainState(
+        int(record["block_number"]), block_hash(record), int(record["slot_number"])
+    )
+
+
+class BlockFile(RecordFile):
+    """
+    The block records, ordered by block number and thus by slot
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        super().__init__(path, BLOCK_DTYPE, BLOCK_MAGIC)
+
+    def last_block_number(self) -> Optional[int]:
+        records = self.records
+        return int(records[-1]["block_number"]) if len(records) else None
+
+    def append(self, records: Union[np.ndarray, Sequence[np.ndarray]]):
+        """
+        Append records of consecutive blocks following the last record
+        """
+        records = np.asarray(records, dtype=BLOCK_DTYPE).reshape(-1)
+        if len(records) == 0:
+            return
+        last = self.last_block_number()
+        first = int(records[0]["block_number"]) if last is None else last + 1
+        assert np.array_equal(
+            records["block_number"], np.arange(first, first + len(records))
+        ), "Records must be consecutive blocks following the last record"
+        super().append(records)
+
+    def index_at_slot(self, slot: int) -> Optional[int]:
+        """
+        Index of the record valid at the given slot, i.e. the last block produced at or before the slot
+        """
+        i = int(np.searchsorted(self.records["slot_number"], slot, side="right")) - 1
+        return i if i >= 0 else None
+
+    def at_slot(self, slot: int) -> Optional[np.void]:
+        i = self.index_at_slot(slot)
+        return self.records[i] if i is not None else None
+
+    def between_slots(self, from_slot: int, to_slot: int) -> np.ndarray:
+        """
+        Records valid at any slot in the range (including the one valid at from_slot)
+        """
+        slots = self.records["slot_number"]
+        start = max(0, int(np.searchsorted(slots, from_slot, side="right")) - 1)
+        end = int(np.searchsorted(slots, to_slot, side="right"))
+        return self.records[start:end]
+
+
+def broken_links(blocks: np.ndarray) -> np.ndarray:
+    """
+    Indices of blocks that do not follow their predecessor
+    (block number not consecutive, slot not increasing or producer state not linked).
+    Vectorized over the whole array, the first block is never reported.
+    """
+    broken = (
+        (blocks["block_number"][1:] != blocks["block_number"][:-1] + 1)
+        | (blocks["slot_number"][1:] <= blocks["slot_number"][:-1])
+        | np.any(
+            blocks["prev_producer_state_hash"][1:]
+            != blocks["producer_state_hash"][:-1],
+            axis=1,
+        )
+    )
+    return np.flatnonzero(broken) + 1
+
+
+def holder_deltas(
+    prev: Tuple[List[bytes], List[int]],
+    new: Tuple[List[bytes], List[int]],
+    block_number: int,
+) -> List[np.ndarray]:
+    """
+    Delta records that turn the previous holder list into the new one
+    """
+    prev_ids, prev_weights = prev
+    new_ids, new_weights = new
+    records = []
+
+    def delta(op: int, position: int, stakechain_id: bytes = b"", weight: int = 0):
+        record = np.zeros((), dtype=HOLDER_DELTA_DTYPE)
+        record["block_number"] = block_number
+        record["op"] = op
+        record["position"] = position
+        record["weight"] = weight
+        _put_bytes(record["stakechain_id"], stakechain_id)
+        record["stakechain_id_length"] = len(stakechain_id)
+        records.append(record)
+
+    # positions refer to the list with all preceding deltas applied
+    matcher = difflib.SequenceMatcher(a=prev_ids, b=new_ids, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                if prev_weights[i] != new_weights[j]:
+                    delta(OP_SET_WEIGHT, j, weight=new_weights[j])
+            continue
+        for _ in range(i1, i2):
+            delta(OP_REMOVE, j1)
+        for j in range(j1, j2):
+            delta(OP_INSERT, j, new_ids[j], new_weights[j])
+    return records
+
+
+def apply_holder_deltas(
+    holders: Tuple[List[bytes], List[int]], deltas: np.ndarray
+) -> Tuple[List[bytes], List[int]]:
+    ids, weights = list(holders[0]), list(holders[1])
+    for d in deltas:
+        op, position = int(d["op"]), int(d["position"])
+        if op == OP_SET_WEIGHT:
+            weights[position] = int(d["weight"])
+        elif op == OP_INSERT:
+            ids.insert(position, bytes(d["stakechain_id"][: d["stakechain_id_length"]]))
+            weights.insert(position, int(d["weight"]))
+        elif op == OP_REMOVE:
+            del ids[position]
+            del weights[position]
+        else:
+            raise ValueError(f"Unknown holder delta op {op}")
+    return ids, weights
+
+
+class History:
+    """
+    Reader and writer of a history directory
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.blocks = BlockFile(self.directory.joinpath("blocks.bin"))
+        self.holder_deltas = RecordFile(
+            self.directory.joinpath("holders.bin"), HOLDER_DELTA_DTYPE, HOLDER_MAGIC
+        )
+        self._holders: Optional[Tuple[List[bytes], List[int]]] = None
+
+    def holders_at(self, index: int) -> Tuple[List[bytes], List[int]]:
+        """
+        Holder ids and weights at the block with the given index in the block file
+        """
+        end = int(self.blocks.records[index]["holder_deltas"])
+        return apply_holder_deltas(([], []), self.holder_deltas.records[:end])
+
+    def holders(self) -> Tuple[List[bytes], List[int]]:
+        """
+        The latest holder list (including changes after the last block)
+        """
+        if self._holders is None:
+            self._holders = apply_holder_deltas(([], []), self.holder_deltas.records)
+        return self._holders
+
+    def last_block_number(self) -> Optional[int]:
+        return self.blocks.last_block_number()
+
+    def add_state(self, state: StakeChainState) -> bool:
+        """
+        Append a state that follows the last appended state.
+        Holder list changes are stored as deltas, a new block as block record.
+        Returns whether the state contained a new block.
+        """
+        holder_state: StakeHolderRegistrations = state.holder_state
+        last_block_number = self.blocks.last_block_number()
+        block_number = state.chain_state.block_number
+        new_block = last_block_number is None or block_number > last_block_number
+        assert (
+            new_block or block_number == last_block_number
+        ), "States must be appended in order"
+        deltas = holder_deltas(
+            self.holders(),
+            (holder_state.stake_holder_ids, holder_state.stake_holder_weights),
+            block_number if new_block else last_block_number,
+        )
+        self.holder_deltas.append(deltas)
+        self._holders = (
+            list(holder_state.stake_holder_ids),
+            list(holder_state.stake_holder_weights),
+        )
+        if new_block:
+            self.blocks.append(
+                block_record(
+                    state.chain_state,
+                    sha2_256(state.producer_state.to_cbor()),
+                    state.producer_state.prev_producer_state_hash,
+                    producer_message_hash(state.producer_state),
+                    len(self.holder_deltas),
+                )
+            )
+        return new_block
+
+    def add_states(self, states: Iterable[StakeChainState]) -> int:
+        """
+        Append the states of the blocks after the last block, returns the number of new blocks.
+        States of already stored blocks are skipped, so a complete dump can be replayed to resume.
+        """
+        last = self.last_block_number()
+        return sum(
+            self.add_state(state)
+            for state in states
+            if last is None or state.chain_state.block_number > last
+        )
+
+
+def sync_from_index(history: History) -> int:
+    """
+    Append the blocks of the (open) block index that follow the last block record.
+    Only the holder list of the first state of each block is known there.
+    Stops at the first gap in the index. Returns the number of appended blocks.
+    """
+    last = history.last_block_number()
+    query = Block.select().order_by(Block.block_number)
+    if last is not None:
+        query = query.where(Block.block_number > last)
+    appended = 0
+    expected = None if last is None else last + 1
+    for block in query:
+        if expected is not None and block.block_number != expected:
+            break
+        appended += history.add_state(stakechain_state_from_cbor(bytes(block.state)))
+        expected = block.block_number + 1
+    return appended
+
+
+def main(
+    history: str,
+    dump: Optional[str] = None,
+    index: Optional[str] = None,
+):
+    """
+    Extend the history directory from a dump file (see `audit.dump_from_kupo`)
+    or from the block index and check the linkage of all blocks
+    """
+    if dump is not None:
+        h = History(history)
+        appended = h.add_states(
+            stakechain_state_from_cbor(record.state)
+            for record in records_from_dump(dump)
+        )
+    else:
+        open_index(index)
+        h = History(history)
+        appended = sync_from_index(h)
+    blocks = h.blocks.records
+    broken = broken_links(blocks)
+    for i in broken:
+        print(f"Block {int(blocks[i]['block_number'])} does not follow its predecessor")
+    print(
+        f"Appended {appended} blocks, {len(blocks)} blocks and "
+        f"{len(h.holder_deltas)} holder deltas in history"
+    )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,222 @@
+"""
+A lightweight metrics registry for the long running daemons (miner, request filler).
+
+Counters, gauges and histograms are kept in memory and exposed in the Prometheus text format
+over a local HTTP endpoint. The span histograms of `profiling` are exposed on the same endpoint.
+"""
+
+import math
+import threading
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from .profiling import DEFAULT_BUCKETS, Histogram as _Buckets, _format_bound, profiler
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = [
+        str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for v in values
+    ]
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Metric(ABC):
+    type: str
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        assert set(labels) == set(
+            self.labelnames
+        ), f"Expected labels {self.labelnames} for {self.name}"
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """
+        The sample lines of the metric in the Prometheus text format
+        """
+
+    def to_prometheus(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+        ] + self.samples()
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        assert amount >= 0, "Counters can only increase"
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [
+                f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(self._values.items())
+            ]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        if not math.isinf(self.buckets[-1]):
+            self.buckets += (math.inf,)
+        self._histograms: Dict[LabelValues, _Buckets] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Buckets(self.buckets)
+            histogram.observe(value)
+
+    def count(self, **labels) -> int:
+        histogram = self._histograms.get(self._key(labels))
+        return histogram.count if histogram is not None else 0
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, histogram in sorted(self._histograms.items()):
+                for upper_bound, count in histogram.cumulative_counts():
+                    labels = _format_labels(
+                        self.labelnames + ("le",), key + (_format_bound(upper_bound),)
+                    )
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {histogram.sum}")
+                lines.append(f"{self.name}_count{labels} {histogram.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], str]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # modules may be reloaded, metrics are shared by name
+                assert type(existing) is type(
+                    metric
+                ), f"Metric {metric.name} already registered with a different type"
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], str]):
+        """
+        Add a function that returns additional metrics in the Prometheus text format
+        """
+        self._collectors.append(collector)
+
+    def to_prometheus(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(
+            [m.to_prometheus() for m in metrics] + [c() for c in self._collectors]
+        )
+
+
+registry = Registry()
+registry.add_collector(lambda: profiler.to_prometheus() if profiler.enabled else "")
+
+
+def serve(
+    port: int, host: str = "127.0.0.1", registry: Registry = registry
+) -> ThreadingHTTPServer:
+    """
+    Serve the metrics of the registry at http://host:port/metrics in a background thread.
+    Also enables the profiling spans so that the stage histograms are collected.
+    """
+    profiler.enabled = True
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,12 +1,20 @@
-import functools
 import os
-from typing import List
+from typing import Optional
 
 import blockfrost
-import ogmios
 
 import pycardano
-from pycardano import Network, OgmiosChainContext, BlockFrostChainContext
+from pycardano import Network, ChainContext
+
+from .backends import (
+    BlockFrostBackend,
+    BlockFrostKupoBackend,
+    OgmiosV5Backend,
+    OgmiosV5KupoBackend,
+    OgmiosV6Backend,
+    OgmiosV6KupoBackend,
+)
+from .datums import kupo_datum_resolver
 
 ogmios_host = os.getenv("OGMIOS_API_HOST", "localhost")
 ogmios_port = os.getenv("OGMIOS_API_PORT", "1337")
@@ -22,10 +30,21 @@ blockfrost_project_id = os.getenv("BLOCKFROST_PROJECT_ID", None)
 
 network = Network.MAINNET
 
+datum_cache_size = int(os.getenv("DATUM_CACHE_SIZE", "10000"))
+datum_cache_path = os.getenv("DATUM_CACHE_PATH", None)
+
+datum_resolver = (
+    kupo_datum_resolver(
+        kupo_url, maxsize=datum_cache_size, persist_path=datum_cache_path
+    )
+    if kupo_url
+    else None
+)
+
 # Load chain context
+context: Optional[ChainContext]
 if blockfrost_project_id is not None:
-    context = BlockFrostChainContext(
-        blockfrost_project_id,
+    blockfrost_args = dict(
         base_url=(
             blockfrost.ApiUrls.mainnet.value
             if network == Network.MAINNET
@@ -33,39 +52,44 @@ if blockfrost_project_id is not None:
         ),
         network=network,
     )
+    if kupo_url:
+        context = BlockFrostKupoBackend(
+            blockfrost_project_id,
+            kupo_url=kupo_url,
+            datum_resolver=datum_resolver,
+            **blockfrost_args,
+        )
+    else:
+        context = BlockFrostBackend(blockfrost_project_id, **blockfrost_args)
 else:
     try:
-        context = OgmiosChainContext(ogmios_url, network=network, kupo_url=kupo_url)
+        if kupo_url:
+            context = OgmiosV5KupoBackend(
+                ogmios_url,
+                network=network,
+                kupo_url=kupo_url,
+                datum_resolver=datum_resolver,
+            )
+        else:
+            context = OgmiosV5Backend(ogmios_url, network=network)
     except Exception:
         try:
-            context = ogmios.OgmiosChainContext(
+            ogmios_args = dict(
                 host=ogmios_host,
                 port=int(ogmios_port),
                 secure=ogmios_protocol == "wss",
                 network=network,
             )
+            if kupo_url:
+                context = OgmiosV6KupoBackend(
+                    kupo_url=kupo_url, datum_resolver=datum_resolver, **ogmios_args
+                )
+            else:
+                context = OgmiosV6Backend(**ogmios_args)
         except Exception as e:
             print("No ogmios available")
             context = None
 
-_datum_cache = {}
-
-if kupo_url and (
-    isinstance(context, ogmios.OgmiosChainContext)
-    or isinstance(context, BlockFrostChainContext)
-):
-    # ugly hack
-    context._datum_cache = _datum_cache
-    context._kupo_url = kupo_url
-    context._get_datum_from_kupo = functools.partial(
-        OgmiosChainContext._get_datum_from_kupo, context
-    )
-    context._extract_asset_info = functools.partial(
-        OgmiosChainContext._extract_asset_info, context
-    )
-    context._utxos = functools.partial(OgmiosChainContext._utxos_kupo, context)
-    # end of ugly hack
-
 
 def show_tx(signed_tx: pycardano.Transaction):
     tx_hash = signed_tx.id.payload.hex()
@@ -0,0 +1,247 @@
+"""
+Timing instrumentation for the hot paths of the off-chain code.
+
+Code is instrumented with named spans:
+
+    with span("mine.submit_tx"):
+        context.submit_tx(tx)
+
+Spans are disabled by default and then cost a single attribute lookup.
+When enabled, the durations are collected in one histogram per span name
+and can be exported in the Prometheus text format or appended as JSON lines.
+Additionally, whole operations (i.e. one mining attempt) can be profiled with cProfile.
+
+Configuration through environment variables:
+- STEAK_PROFILE=1 enables the spans
+- STEAK_PROFILE_EXPORT=<path> exports the histograms after every operation,
+  in the Prometheus text format if the path ends with .prom, as JSON lines otherwise
+- STEAK_CPROFILE_DIR=<dir> dumps a cProfile of every operation into the directory
+"""
+
+import contextlib
+import cProfile
+import functools
+import json
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Union
+
+# upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    math.inf,
+)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def cumulative_counts(self):
+        total = 0
+        for upper_bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield upper_bound, total
+
+    def to_json(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "buckets": {
+                _format_bound(upper_bound): count
+                for upper_bound, count in self.cumulative_counts()
+            },
+        }
+
+
+def _format_bound(upper_bound: float) -> str:
+    return "+Inf" if math.isinf(upper_bound) else repr(float(upper_bound))
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    def __init__(
+        self,
+        enabled: bool = False,
+        export_path: Union[str, Path, None] = None,
+        cprofile_dir: Union[str, Path, None] = None,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.enabled = enabled
+        self.export_path = export_path
+        self.cprofile_dir = cprofile_dir
+        self.buckets = buckets
+        self.histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def span(self, name: str):
+        """
+        Context manager that records the duration of its body under the given name
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, name)
+
+    def timed(self, name: Optional[str] = None):
+        """
+        Decorator that records the duration of every call of the function
+        """
+
+        def decorator(f):
+            span_name = name if name is not None else f.__qualname__
+
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return f(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+
+    def to_prometheus(self, metric: str = "steak_span_seconds") -> str:
+        lines = [
+            f"# HELP {metric} Duration of instrumented spans in seconds",
+            f"# TYPE {metric} histogram",
+        ]
+        with self._lock:
+            for name, histogram in sorted(self.histograms.items()):
+                for upper_bound, count in histogram.cumulative_counts():
+                    lines.append(
+                        f'{metric}_bucket{{span="{name}",le="{_format_bound(upper_bound)}"}} {count}'
+                    )
+                lines.append(f'{metric}_sum{{span="{name}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{span="{name}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "spans": {
+                    name: histogram.to_json()
+                    for name, histogram in sorted(self.histograms.items())
+                },
+            }
+
+    def export(self, path: Union[str, Path, None] = None):
+        """
+        Write the histograms to the given path (default: the configured export path).
+        Prometheus files (.prom) are overwritten, other files get one JSON line appended.
+        """
+        path = path if path is not None else self.export_path
+        if path is None or not self.enabled:
+            return
+        path = Path(path)
+        if path.suffix == ".prom":
+            # write atomically so that scrapers never see a partial file
+            tmp_path = path.with_suffix(".prom.tmp")
+            tmp_path.write_text(self.to_prometheus())
+            tmp_path.replace(path)
+        else:
+            with open(path, "a") as f:
+                f.write(json.dumps(self.to_json()) + "\n")
+
+    @contextlib.contextmanager
+    def operation(self, name: str):
+        """
+        Instrument one complete operation (i.e. a mining attempt):
+        records it as span, dumps a cProfile if configured and exports the histograms afterwards
+        """
+        profile = None
+        if self.cprofile_dir is not None:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            with self.span(name):
+                yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                cprofile_dir = Path(self.cprofile_dir)
+                cprofile_dir.mkdir(parents=True, exist_ok=True)
+                profile.dump_stats(
+                    cprofile_dir.joinpath(f"{name}-{time.time_ns()}.prof")
+                )
+            self.export()
+
+
+profiler = Profiler(
+    enabled=os.getenv("STEAK_PROFILE", "0") not in ("", "0"),
+    export_path=os.getenv("STEAK_PROFILE_EXPORT", None),
+    cprofile_dir=os.getenv("STEAK_CPROFILE_DIR", None),
+)
+span = profiler.span
+timed = profiler.timed
@@ -1,5 +1,5 @@
 import fractions
-from typing import Optional
+from typing import Callable, Optional
 
 import pycardano
 from opshin.prelude import *
@@ -45,17 +45,34 @@ def to_wdrl(wdrl: Optional[pycardano.Withdrawals]) -> Dict[StakingCredential, in
     return {m(key): val for key, val in wdrl.to_primitive().items()}
 
 
-def to_valid_range(validity_start: Optional[int], ttl: Optional[int]):
+def to_valid_range(
+    validity_start: Optional[int],
+    ttl: Optional[int],
+    slot_to_posix: Optional[Callable[[int], int]] = None,
+):
+    """
+    Convert the validity interval of a transaction.
+    If `slot_to_posix` is given, slots are converted to POSIX times like the ledger does
+    (inclusive lower bound, exclusive upper bound). Otherwise the slots are used as is.
+    """
     if validity_start is None:
         lower_bound = LowerBoundPOSIXTime(NegInfPOSIXTime(), FalseData())
-    else:
+    elif slot_to_posix is None:
         # TODO converting slot number to POSIXTime
         lower_bound = LowerBoundPOSIXTime(FinitePOSIXTime(validity_start), TrueData())
+    else:
+        lower_bound = LowerBoundPOSIXTime(
+            FinitePOSIXTime(slot_to_posix(validity_start)), TrueData()
+        )
     if ttl is None:
         upper_bound = UpperBoundPOSIXTime(PosInfPOSIXTime(), FalseData())
-    else:
+    elif slot_to_posix is None:
         # TODO converting slot number to POSIXTime
         upper_bound = UpperBoundPOSIXTime(FinitePOSIXTime(ttl), TrueData())
+    else:
+        upper_bound = UpperBoundPOSIXTime(
+            FinitePOSIXTime(slot_to_posix(ttl)), FalseData()
+        )
     return POSIXTimeRange(lower_bound, upper_bound)
 
 
@@ -68,7 +85,16 @@ def to_tx_id(tx_id: pycardano.TransactionId):
 
 
 def to_dcert(c: pycardano.Certificate) -> DCert:
-    raise NotImplementedError("Can not convert certificates yet")
+    if isinstance(c, pycardano.StakeRegistration):
+        return DCertDelegRegKey(to_staking_hash(c.stake_credential.credential))
+    if isinstance(c, pycardano.certificate.StakeDeregistration):
+        return DCertDelegDeRegKey(to_staking_hash(c.stake_credential.credential))
+    if isinstance(c, pycardano.StakeDelegation):
+        return DCertDelegDelegate(
+            to_staking_hash(c.stake_credential.credential),
+            PubKeyHash(c.pool_keyhash.payload),
+        )
+    raise NotImplementedError(f"Can not convert certificate {type(c)} yet")
 
 
 def multiasset_to_value(ma: pycardano.MultiAsset) -> Value:
@@ -81,9 +107,7 @@ def multiasset_to_value(ma: pycardano.MultiAsset) -> Value:
 
 
 def value_to_value(v: pycardano.Value):
-    ma = multiasset_to_value(v.multi_asset)
-    ma[b""][b""] = v.coin
-    return ma
+    return {b"": {b"": v.coin}, **multiasset_to_value(v.multi_asset)}
 
 
 def to_payment_credential(
@@ -113,7 +137,7 @@ def to_tx_out(o: pycardano.TransactionOutput):
     if o.script is None:
         script = NoScriptHash()
     else:
-        script = SomeScriptHash(o.script.hash().to_primitive())
+        script = SomeScriptHash(pycardano.script_hash(o.script).to_primitive())
     return TxOut(
         to_address(o.address),
         value_to_value(o.amount),
@@ -136,36 +160,78 @@ def to_tx_in_info(i: pycardano.TransactionInput, o: pycardano.TransactionOutput)
     )
 
 
+def sorted_inputs(
+    inputs: List[pycardano.TransactionInput],
+) -> List[pycardano.TransactionInput]:
+    """
+    Inputs in the order of the ledger (which is also the order of spending redeemer indices)
+    """
+    return sorted(inputs, key=lambda i: (i.transaction_id.payload, i.index))
+
+
+def to_script_purpose(
+    tx_body: pycardano.TransactionBody, redeemer: pycardano.Redeemer
+) -> ScriptPurpose:
+    """
+    Determine the purpose of the script validated with the given redeemer
+    """
+    if redeemer.tag == pycardano.RedeemerTag.SPEND:
+        return Spending(to_tx_out_ref(sorted_inputs(tx_body.inputs)[redeemer.index]))
+    if redeemer.tag == pycardano.RedeemerTag.MINT:
+        policies = sorted(tx_body.mint.keys(), key=lambda p: p.to_cbor())
+        return Minting(PolicyId(policies[redeemer.index].payload))
+    if redeemer.tag == pycardano.RedeemerTag.WITHDRAWAL:
+        reward_address = sorted(tx_body.withdraws.keys())[redeemer.index]
+        return Rewarding(
+            to_staking_hash(
+                pycardano.Address.from_primitive(reward_address).staking_part
+            )
+        )
+    raise NotImplementedError(f"Can not convert script purpose {redeemer.tag}")
+
+
 def to_tx_info(
     tx: pycardano.Transaction,
     resolved_inputs: List[pycardano.TransactionOutput],
     resolved_reference_inputs: List[pycardano.TransactionOutput],
+    slot_to_posix: Optional[Callable[[int], int]] = None,
+    tx_id: Optional[bytes] = None,
 ):
+    """
+    The resolved (reference) inputs are given in the order of the transaction body,
+    the scripts see them in the order of the ledger.
+    The id defaults to the hash of the body as serialized by pycardano.
+    """
     tx_body = tx.transaction_body
+    witness_set = tx.transaction_witness_set
+    resolved = dict(zip(tx_body.inputs, resolved_inputs))
+    resolved_reference = dict(
+        zip(tx_body.reference_inputs or [], resolved_reference_inputs)
+    )
     return TxInfo(
-        [to_tx_in_info(i, o) for i, o in zip(tx_body.inputs, resolved_inputs)],
+        [to_tx_in_info(i, resolved[i]) for i in sorted_inputs(tx_body.inputs)],
         [
-            to_tx_in_info(i, o)
-            for i, o in zip(tx_body.reference_inputs, resolved_reference_inputs)
+            to_tx_in_info(i, resolved_reference[i])
+            for i in sorted_inputs(tx_body.reference_inputs or [])
         ],
         [to_tx_out(o) for o in tx_body.outputs],
         value_to_value(pycardano.Value(tx_body.fee)),
-        multiasset_to_value(tx_body.mint),
-        [to_dcert(c) for c in tx_body.certificates],
+        value_to_value(pycardano.Value(0, tx_body.mint or pycardano.MultiAsset())),
+        [to_dcert(c) for c in tx_body.certificates or []],
         to_wdrl(tx_body.withdraws),
-        to_valid_range(tx_body.validity_start, tx_body.ttl),
-        [to_pubkeyhash(s) for s in tx_body.required_signers],
+        to_valid_range(tx_body.validity_start, tx_body.ttl, slot_to_posix),
+        [to_pubkeyhash(s) for s in tx_body.required_signers or []],
+        {to_script_purpose(tx_body, r): r.data for r in witness_set.redeemer or []},
         {
-            pycardano.datum_hash(d): d
+            pycardano.datum_hash(d).payload: d
             for d in [
                 o.datum
                 for o in tx_body.outputs + resolved_inputs + resolved_reference_inputs
                 if o.datum is not None
             ]
-            + tx.transaction_witness_set.plutus_data
+            + (witness_set.plutus_data or [])
         },
-        {pycardano.datum_hash(r): r for r in tx.transaction_witness_set.redeemer},
-        to_tx_id(tx_body.id),
+        TxId(tx_id) if tx_id is not None else to_tx_id(tx_body.id),
     )
 
 
@@ -0,0 +1,176 @@
+import asyncio
+
+import httpx
+from opshin.ledger.api_v2 import (
+    Address,
+    NoStakingCredential,
+    PubKeyCredential,
+    SomeOutputDatum,
+)
+from opshin.prelude import Nothing, Token, TxId, TxOutRef
+from opshin.std.builtins import sha2_256
+from opshin.std.fractions import Fraction
+from pycardano import Value
+from pycardano import Address as CardanoAddress
+from pycardano import VerificationKeyHash
+
+from steak_protocol.api.follower import Deployment, follow_once
+from steak_protocol.api.server import create_app
+from steak_protocol.offchain.util import (
+    VERSION_1,
+    VERSION_2,
+    ContractVersion,
+    asset_from_token,
+    stakechain_params_hash,
+)
+from steak_protocol.onchain.stakepool.stakepool import PoolParams, PoolState
+from steak_protocol.onchain.stakepool.stakepool_request import (
+    AddStakeRequest,
+    RemoveStakeRequest,
+)
+from steak_protocol.onchain.types import (
+    CoreChainState,
+    ProducerState,
+    StakeChainV2State,
+    StakeHolderRegistrations,
+    StakeHolderState,
+    StakePoolParams,
+    UpgradeAgreement,
+)
+from steak_protocol.utils.emulator import EmulatorBackend
+from test.offchain.util import PARAMS, make_chain
+
+POLICY_ID = b"\x05" * 28
+
+
+def address(i: int) -> CardanoAddress:
+    return CardanoAddress(VerificationKeyHash(bytes([i]) * 28))
+
+
+def setup_chain(
+    context: EmulatorBackend, version: ContractVersion = VERSION_1
+) -> Deployment:
+    deployment = Deployment(
+        stakechain_address=address(10),
+        stakeholder_address=address(11),
+        request_address=address(12),
+        stakechain_auth_nft=PARAMS.auth_nft,
+        stakeholder_auth_nft=PARAMS.stakeholder_auth_nft,
+        stakepool_policy_id=POLICY_ID,
+    )
+    state = make_chain([None, None])[-1]
+    state.holder_state = StakeHolderRegistrations([5000, 300], [b"pool", b"solo"])
+    if version == VERSION_2:
+        state = StakeChainV2State(
+            stakechain_params_hash(state.params),
+            state.holder_state,
+            state.chain_state,
+            state.producer_state,
+            UpgradeAgreement(b"", 0),
+            state.skip_holders,
+            state.spent_for,
+        )
+        context.fund(deployment.stakechain_address, 2_000_000, datum=PARAMS)
+    context.fund(
+        deployment.stakechain_address,
+        Value(
+            2_000_000,
+            asset_from_token(PARAMS.auth_nft, 1)
+            + asset_from_token(PARAMS.stake_coin, 10**9),
+        ),
+        datum=state,
+    )
+    pool_state = PoolState(
+        PoolParams(
+            initial_utxo=TxOutRef(TxId(b"\x06" * 32), 0),
+            admin=PubKeyCredential(b"\x07" * 28),
+            guaranteed_reward_fraction=Fraction(1, 10),
+            stake_auth_nft=PARAMS.stakeholder_auth_nft,
+            chain_auth_nft=PARAMS.auth_nft,
+        ),
+        all_lp_tokens=4000,
+    )
+    context.fund(
+        deployment.stakeholder_address,
+        Value(
+            2_000_000,
+            asset_from_token(PARAMS.stakeholder_auth_nft, 1)
+            + asset_from_token(PARAMS.stake_coin, 5000),
+        ),
+        datum=StakeHolderState(
+            StakePoolParams(
+                PubKeyCredential(b"\x07" * 28),
+                b"pool",
+                PARAMS.auth_nft,
+                PARAMS.stakeholder_auth_nft,
+            ),
+            [],
+            SomeOutputDatum(pool_state),
+        ),
+    )
+    lp_token = Token(POLICY_ID, sha2_256(pool_state.params.initial_utxo.to_cbor()))
+    beneficiary = Address(PubKeyCredential(b"\x08" * 28), NoStakingCredential())
+    context.fund(
+        deployment.request_address,
+        Value(2_000_000, asset_from_token(PARAMS.stake_coin, 700)),
+        datum=AddStakeRequest(b"\x08" * 28, beneficiary, lp_token, 10),
+    )
+    context.fund(
+        deployment.request_address,
+        Value(2_000_000, asset_from_token(lp_token, 20)),
+        datum=RemoveStakeRequest(b"\x08" * 28, beneficiary, lp_token, 10),
+    )
+    return deployment
+
+
+async def follow_and_serve(index_path, version: ContractVersion = VERSION_1):
+    context = EmulatorBackend()
+    deployment = setup_chain(context, version)
+    app = create_app(index_path)
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app), httpx.AsyncClient(
+        transport=transport, base_url="http://test"
+    ) as client:
+        assert (await client.get("/tip")).status_code == 503
+        assert follow_once(context, deployment)
+        # nothing changes until the chain moves
+        assert not follow_once(context, deployment)
+
+        tip = (await client.get("/tip")).json()
+        assert (tip["block_number"], tip["reserve"]) == (1, 10**9)
+        assert (await client.get("/blocks/latest")).json()["block_number"] == 1
+        assert (await client.get("/holders")).json() == [
+            {"position": 0, "stakechain_id": b"pool".hex(), "weight": 5000},
+            {"position": 1, "stakechain_id": b"solo".hex(), "weight": 300},
+        ]
+        (pool,) = (await client.get("/pools")).json()
+        assert (pool["lp_supply"], pool["stake"]) == (4000, 5000)
+        assert (await client.get(f"/pools/{b'pool'.hex()}")).json() == pool
+        assert (await client.get(f"/pools/{b'solo'.hex()}")).status_code == 404
+        requests = await client.get("/requests", params={"lp_token": pool["lp_token"]})
+        assert sorted((r["kind"], r["amount"]) for r in requests.json()) == [
+            ("add", 700),
+            ("remove", 20),
+        ]
+        # malformed input is rejected instead of failing in the handler
+        assert (await client.get("/pools/xyz")).status_code == 400
+        for lp_token in ["00", "00.11.22", "zz.00"]:
+            response = await client.get("/requests", params={"lp_token": lp_token})
+            assert response.status_code == 400
+
+        # the cache is keyed by the tip, a new tip is served fresh
+        first_tip = await client.get("/tip")
+        assert first_tip.headers["X-FastAPI-Cache"] == "HIT"
+        context.wait(5)
+        assert follow_once(context, deployment)
+        second_tip = await client.get("/tip")
+        assert second_tip.headers["X-FastAPI-Cache"] == "MISS"
+        assert second_tip.json()["chain_slot"] == first_tip.json()["chain_slot"] + 5
+
+
+def test_follow_and_serve(tmp_path):
+    asyncio.run(follow_and_serve(str(tmp_path.joinpath("index.db"))))
+
+
+def test_follow_and_serve_v2(tmp_path):
+    asyncio.run(follow_and_serve(str(tmp_path.joinpath("index.db")), VERSION_2))
@@ -0,0 +1,158 @@
+from dataclasses import replace
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from opshin.builder import build
+from pycardano import (
+    Address,
+    InsufficientUTxOBalanceException,
+    PaymentSigningKey,
+    PaymentVerificationKey,
+    UTxOSelectionException,
+    plutus_script_hash,
+)
+
+from steak_protocol.offchain.airdrop import batch as batch_module
+from steak_protocol.offchain.airdrop.batch import (
+    FuelPool,
+    build_batch,
+    build_batches,
+    close_spender,
+    redeem_spender,
+    submit_batches,
+)
+from steak_protocol.offchain.airdrop.lookup import (
+    all_airdrop_utxos,
+    recipient_airdrop_utxos,
+)
+from steak_protocol.utils.emulator import DEFAULT_PROTOCOL_PARAMETERS, EmulatorBackend
+from steak_protocol.utils.to_script_context import to_address
+
+AIRDROP_CONTRACT = Path(__file__).parent.parent.parent.parent.joinpath(
+    "steak_protocol", "onchain", "airdrop.py"
+)
+EXPIRY_SLOT = 100
+
+
+def new_wallet(context: EmulatorBackend):
+    skey = PaymentSigningKey.generate()
+    vkey = PaymentVerificationKey.from_signing_key(skey)
+    return skey, vkey, Address(vkey.hash(), vkey.hash(), network=context.network)
+
+
+def spend_all(context, airdrop_utxos, spend, wallet, message, validity_start=None):
+    skey, vkey, address = wallet
+    return submit_batches(
+        build_batches(
+            airdrop_utxos,
+            lambda utxos, fuel_utxo: build_batch(
+                utxos,
+                spend,
+                fuel_utxo,
+                vkey,
+                skey,
+                address,
+                message,
+                context,
+                validity_start=validity_start,
+            ),
+            FuelPool(address, context, poll_interval=0.01),
+            context,
+        ),
+        len(airdrop_utxos),
+        context,
+        workers=2,
+    )
+
+
+def test_batch_redeem_and_close():
+    # force several transactions per batch run
+    context = EmulatorBackend(
+        replace(DEFAULT_PROTOCOL_PARAMETERS, max_tx_ex_mem=1_000_000)
+    )
+    admin = new_wallet(context)
+    recipient = new_wallet(context)
+    others = [new_wallet(context) for _ in range(3)]
+    for wallet in (admin, recipient):
+        for _ in range(2):
+            context.fund(wallet[2], 50_000_000)
+    airdrop_script = build(
+        str(AIRDROP_CONTRACT),
+        to_address(admin[2]),
+        admin[1].hash().payload,
+        context.slot_to_posix(EXPIRY_SLOT),
+    )
+    airdrop_address = Address(
+        plutus_script_hash(airdrop_script), network=context.network
+    )
+    for wallet in [recipient] * 4 + others * 2:
+        context.fund(
+            Address(
+                airdrop_address.payment_part,
+                wallet[2].staking_part,
+                network=context.network,
+            ),
+            3_000_000,
+            datum=wallet[1].hash().payload,
+        )
+    # a utxo at the address of the recipient that the recipient can not claim
+    context.fund(
+        Address(
+            airdrop_address.payment_part,
+            recipient[2].staking_part,
+            network=context.network,
+        ),
+        3_000_000,
+        datum=others[0][1].hash().payload,
+    )
+    assert len(all_airdrop_utxos(airdrop_address, context)) == 11
+
+    own_utxos = recipient_airdrop_utxos(airdrop_address, recipient[2], context)
+    assert len(own_utxos) == 4
+    txs = spend_all(
+        context,
+        own_utxos,
+        redeem_spender(airdrop_script, admin[2], context),
+        recipient,
+        "Claim Airdrop",
+    )
+    assert len(txs) > 1
+    assert len(all_airdrop_utxos(airdrop_address, context)) == 7
+    assert len(context.utxos(admin[2])) == 2 + 4
+
+    context.wait(EXPIRY_SLOT)
+    remaining = all_airdrop_utxos(airdrop_address, context)
+    txs = spend_all(
+        context,
+        remaining,
+        close_spender(airdrop_script),
+        admin,
+        "Close Expired Airdrop",
+        validity_start=context.last_block_slot,
+    )
+    assert len(txs) > 1
+    assert all_airdrop_utxos(airdrop_address, context) == []
+
+
+def test_batch_fuel_shortage(monkeypatch):
+    monkeypatch.setattr(batch_module, "within_limits", lambda tx, context: True)
+    context = EmulatorBackend()
+    _, _, address = new_wallet(context)
+    fuel_utxo = context.fund(address, 5_000_000)
+    fuel = SimpleNamespace(take=lambda: fuel_utxo)
+
+    def build_covered(batch, fuel_utxo):
+        # the fuel utxo only covers the outputs of two airdrop utxos
+        if len(batch) > 2:
+            raise InsufficientUTxOBalanceException("Not enough funds")
+        return batch
+
+    batches = build_batches(list(range(10)), build_covered, fuel, context, 4)
+    assert [n for n, _ in batches] == [2] * 5
+
+    def build_uncovered(batch, fuel_utxo):
+        raise InsufficientUTxOBalanceException("Not enough funds")
+
+    with pytest.raises(UTxOSelectionException, match="add funds to the wallet"):
+        list(build_batches(list(range(10)), build_uncovered, fuel, context, 4))
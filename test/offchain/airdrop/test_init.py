@@ -0,0 +1,98 @@
+import itertools
+
+from opshin.prelude import Token
+from pycardano import (
+    Address,
+    PaymentSigningKey,
+    PaymentVerificationKey,
+    Value,
+    plutus_script_hash,
+    PlutusV2Script,
+)
+
+from steak_protocol.offchain.airdrop.init import (
+    airdrop_output,
+    load_checkpoint,
+    read_recipients,
+    send_airdrop,
+)
+from steak_protocol.offchain.util import amount_of_token_in_value, value_from_token
+from steak_protocol.utils.emulator import EmulatorBackend
+
+STAKECOIN = Token(bytes(28), b"stakecoin")
+AIRDROP_AMOUNT = 1_000_000
+MAX_TX_SIZE = 6000
+
+
+def new_address(context: EmulatorBackend):
+    skey = PaymentSigningKey.generate()
+    vkey = PaymentVerificationKey.from_signing_key(skey)
+    return skey, Address(vkey.hash(), vkey.hash(), network=context.network)
+
+
+def setup(tmp_path, n_recipients: int):
+    context = EmulatorBackend()
+    skey, address = new_address(context)
+    context.fund(
+        address,
+        Value(10_000_000_000) + value_from_token(STAKECOIN, 10**12),
+    )
+    recipients = [str(new_address(context)[1]) for _ in range(n_recipients)]
+    recipients_file = tmp_path.joinpath("addresses.txt")
+    # duplicates are only sent once
+    recipients_file.write_text("\n".join(recipients + recipients[:10]) + "\n")
+    airdrop_address = Address(
+        plutus_script_hash(PlutusV2Script(b"airdrop")), network=context.network
+    )
+    return context, skey, address, recipients_file, airdrop_address
+
+
+def outputs(context, recipients_file, airdrop_address, skip=0):
+    return (
+        airdrop_output(r, airdrop_address, STAKECOIN, AIRDROP_AMOUNT, context)
+        for r in itertools.islice(read_recipients(recipients_file), skip, None)
+    )
+
+
+def airdropped(context, airdrop_address):
+    return sum(
+        amount_of_token_in_value(STAKECOIN, u.output.amount)
+        for u in context._utxos_by_input.values()
+        if u.output.address.payment_part == airdrop_address.payment_part
+    )
+
+
+def test_sharded_airdrop_with_resume(tmp_path):
+    n_recipients = 150
+    context, skey, address, recipients_file, airdrop_address = setup(
+        tmp_path, n_recipients
+    )
+    _, change_address = new_address(context)
+    checkpoint_file = tmp_path.joinpath("checkpoint")
+
+    def run():
+        for tx in send_airdrop(
+            recipients_file,
+            checkpoint_file,
+            STAKECOIN,
+            AIRDROP_AMOUNT,
+            airdrop_address,
+            address,
+            skey,
+            change_address,
+            context,
+            max_tx_size=MAX_TX_SIZE,
+        ):
+            assert len(tx.to_cbor()) <= MAX_TX_SIZE
+            yield tx
+
+    # interrupted after two transactions
+    assert len(list(itertools.islice(run(), 2))) == 2
+    assert 0 < load_checkpoint(checkpoint_file)[0] < n_recipients
+    txs = list(run())
+    assert len(txs) > 1
+    assert load_checkpoint(checkpoint_file) == (n_recipients, [])
+    assert airdropped(context, airdrop_address) == n_recipients * AIRDROP_AMOUNT
+    # only the last transaction pays out the change
+    assert context.utxos(address) == []
+    assert len(context.utxos(change_address)) == 1
@@ -0,0 +1,210 @@
+import json
+import secrets
+from types import SimpleNamespace
+
+from opshin.ledger.api_v2 import NoOutputDatum, ScriptCredential
+from opshin.std.builtins import blake2b_256
+
+import steak_protocol.offchain.stakechain.audit as audit_module
+from steak_protocol.offchain.stakechain.audit import (
+    audit,
+    dump_from_kupo,
+    records_from_dump,
+)
+from steak_protocol.onchain.stakechain.stakechain_v1 import (
+    MineBlockUpdateStake,
+    compute_slot_leader,
+)
+from steak_protocol.onchain.types import StakeChainV1State, StakeHolderState
+from test.offchain.util import honest_history
+
+
+def is_pool_block(record) -> bool:
+    return record.holder_state is not None and isinstance(
+        StakeHolderState.from_cbor(record.holder_state).params.owner, ScriptCredential
+    )
+
+
+def test_honest_history(tmp_path):
+    history = honest_history()
+    dump = tmp_path.joinpath("dump.jsonl")
+    with open(dump, "w") as f:
+        for record in history.records:
+            f.write(
+                json.dumps(
+                    {
+                        "transaction_id": record.transaction_id.hex(),
+                        "output_index": record.output_index,
+                        "state": record.state.hex(),
+                        "reserve": record.reserve,
+                        "slot_leader_secret": (
+                            record.slot_leader_secret.hex()
+                            if record.slot_leader_secret is not None
+                            else None
+                        ),
+                        "holder_state": (
+                            record.holder_state.hex()
+                            if record.holder_state is not None
+                            else None
+                        ),
+                    }
+                )
+                + "\n"
+            )
+    report = audit(records_from_dump(dump), chunk_size=7)
+    assert report.anomalies == []
+    assert (report.transitions, report.blocks) == (43, 39)
+    # the pool is only credited the guaranteed share of its rewards
+    assert any(is_pool_block(record) for record in history.records)
+    assert audit(history.records, processes=2, chunk_size=7) == report
+
+
+def test_wrong_producer():
+    history = honest_history()
+    slot = 3 * 40
+    leader = compute_slot_leader(history.state, slot, 0)
+    history.mine(slot, producer=(leader + 1) % 4)
+    report = audit(history.records)
+    assert [a.block_number for a in report.anomalies] == [40]
+
+
+def test_tampered_reward_and_signature():
+    history = honest_history()
+    history.records[10].reserve -= 1
+    history.records[20].slot_leader_secret = secrets.token_bytes(32)
+    report = audit(history.records)
+    # the reserve of record 10 does not match the rewards credited by blocks 10 and 11
+    assert len(report.anomalies) == 6
+    assert {a.transaction_id for a in report.anomalies} == {
+        history.records[i].transaction_id for i in (10, 11, 20)
+    }
+
+
+def test_pool_credits_full_reward():
+    history = honest_history()
+    i = next(i for i, r in enumerate(history.records) if is_pool_block(r))
+    prev_state = StakeChainV1State.from_cbor(history.records[i - 1].state)
+    state = StakeChainV1State.from_cbor(history.records[i].state)
+    weights = state.holder_state.stake_holder_weights
+    (leader,) = [
+        j
+        for j, (a, b) in enumerate(
+            zip(prev_state.holder_state.stake_holder_weights, weights)
+        )
+        if a != b
+    ]
+    weights[leader] = prev_state.holder_state.stake_holder_weights[leader] + (
+        history.records[i - 1].reserve - history.records[i].reserve
+    )
+    history.records[i].state = state.to_cbor()
+    assert [
+        a.message
+        for a in audit(history.records).anomalies
+        if a.transaction_id == history.records[i].transaction_id
+    ] == [
+        f"Stake of the slot leader increased by {weights[leader] - prev_state.holder_state.stake_holder_weights[leader]}, "
+        f"but {history.records[i - 1].reserve - history.records[i].reserve} were taken from the reserve"
+    ]
+
+
+def test_tampered_commitment_and_weight():
+    history = honest_history()
+    history.records[15].committed_hash = secrets.token_bytes(32)
+    # the slot leader credits itself more than the reward
+    prev_weights = StakeChainV1State.from_cbor(
+        history.records[24].state
+    ).holder_state.stake_holder_weights
+    state = StakeChainV1State.from_cbor(history.records[25].state)
+    weights = state.holder_state.stake_holder_weights
+    (leader,) = [i for i, (a, b) in enumerate(zip(prev_weights, weights)) if a != b]
+    weights[leader] += 1
+    history.records[25].state = state.to_cbor()
+    messages = {}
+    for a in audit(history.records).anomalies:
+        messages.setdefault(a.transaction_id, a.message)
+    assert messages[history.records[15].transaction_id] == (
+        "Revealed secret does not match the committed hash"
+    )
+    assert messages[history.records[25].transaction_id].startswith(
+        "Stake of the slot leader increased by"
+    )
+
+
+def kupo_matches(history):
+    """
+    The kupo matches of the stake chain and the stake holder outputs of the history
+    """
+    genesis = StakeChainV1State.from_cbor(history.records[0].state)
+    auth_nft = f"{genesis.params.auth_nft.policy_id.hex()}.{genesis.params.auth_nft.token_name.hex()}"
+    stake_coin = f"{genesis.params.stake_coin.policy_id.hex()}.{genesis.params.stake_coin.token_name.hex()}"
+    chain_matches, holder_matches = [], []
+    for record, next_record in zip(history.records, history.records[1:] + [None]):
+        spent_at = None
+        if next_record is not None:
+            spent_at = {"transaction_id": next_record.transaction_id.hex()}
+            if next_record.slot_leader_secret is not None:
+                spent_at["redeemer"] = (
+                    MineBlockUpdateStake(
+                        0,
+                        0,
+                        0,
+                        0,
+                        next_record.slot_leader_secret,
+                        b"",
+                        NoOutputDatum(),
+                        0,
+                        1,
+                        0,
+                    )
+                    .to_cbor()
+                    .hex()
+                )
+                holder_matches.append(
+                    {
+                        "datum_hash": blake2b_256(next_record.holder_state).hex(),
+                        "datum": next_record.holder_state.hex(),
+                        "spent_at": {
+                            "transaction_id": next_record.transaction_id.hex()
+                        },
+                    }
+                )
+        chain_matches.append(
+            {
+                "transaction_id": record.transaction_id.hex(),
+                "output_index": record.output_index,
+                "value": {
+                    "coins": 2_000_000,
+                    "assets": {auth_nft: 1, stake_coin: record.reserve},
+                },
+                "datum_hash": blake2b_256(record.state).hex(),
+                "datum": record.state.hex(),
+                "spent_at": spent_at,
+            }
+        )
+    return chain_matches, holder_matches
+
+
+def test_dump_from_kupo(tmp_path, monkeypatch):
+    history = honest_history()
+    chain_matches, holder_matches = kupo_matches(history)
+    responses = {"chain": chain_matches, "holder": holder_matches}
+
+    def get(url):
+        return SimpleNamespace(json=lambda: responses[url.split("/")[4].split("?")[0]])
+
+    monkeypatch.setattr(audit_module.requests, "get", get)
+    genesis = StakeChainV1State.from_cbor(history.records[0].state)
+    dump = tmp_path.joinpath("dump.jsonl")
+    written = dump_from_kupo(
+        "http://kupo", "chain", genesis.params.auth_nft, dump, "holder"
+    )
+    assert written == len(history.records)
+    records = list(records_from_dump(dump))
+    assert records == history.records
+    assert audit(records).anomalies == []
+
+    records[20].slot_leader_secret = secrets.token_bytes(32)
+    assert {a.message for a in audit(records).anomalies} == {
+        "Producer signature does not match the revealed secret",
+        "Revealed secret does not match the committed hash",
+    }
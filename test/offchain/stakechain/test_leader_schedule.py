@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+from hypothesis import given, settings, strategies as st
+from opshin.std.math import bytes_big_from_unsigned_int
+
+from steak_protocol.offchain.stakechain import leader_schedule as ls
+from steak_protocol.onchain.stakechain.stakechain_v1 import compute_slot_leader
+from steak_protocol.onchain.utils.random import random_number
+
+
+@given(
+    block_hashes=st.lists(st.binary(min_size=32, max_size=32), min_size=1),
+    slots=st.data(),
+    slot_leader_number=st.integers(min_value=0, max_value=2**20),
+)
+def test_random_numbers_match_onchain(block_hashes, slots, slot_leader_number):
+    slots = slots.draw(
+        st.lists(
+            st.integers(min_value=0, max_value=2**64 - 1),
+            min_size=len(block_hashes),
+            max_size=len(block_hashes),
+        )
+    )
+    expected = [
+        random_number(
+            bytes_big_from_unsigned_int(slot_leader_number)
+            + block_hash
+            + bytes_big_from_unsigned_int(slot)
+        )
+        for block_hash, slot in zip(block_hashes, slots)
+    ]
+    assert (
+        ls.leader_random_numbers(block_hashes, slots, slot_leader_number).tolist()
+        == expected
+    )
+    # a shared block hash
+    assert ls.leader_random_numbers(
+        block_hashes[0], slots, slot_leader_number
+    ).tolist() == [
+        random_number(
+            bytes_big_from_unsigned_int(slot_leader_number)
+            + block_hashes[0]
+            + bytes_big_from_unsigned_int(slot)
+        )
+        for slot in slots
+    ]
+
+
+def test_process_pool(monkeypatch):
+    monkeypatch.setattr(ls, "MIN_SEEDS_PER_PROCESS", 10)
+    block_hash = bytes(range(32))
+    slots = list(range(0, 100_000, 997))
+    assert (
+        ls.leader_random_numbers(block_hash, slots, 3, processes=2).tolist()
+        == ls.leader_random_numbers(block_hash, slots, 3).tolist()
+    )
+
+
+@settings(deadline=None, max_examples=20)
+@given(
+    weights=st.lists(st.integers(min_value=0, max_value=2**40), min_size=2),
+    block_hash=st.binary(min_size=32, max_size=32),
+    first_slot=st.integers(min_value=0, max_value=2**40),
+    data=st.data(),
+)
+def test_schedule_matches_onchain(weights, block_hash, first_slot, data):
+    skip_holders = data.draw(st.integers(min_value=0, max_value=len(weights) - 1))
+    if sum(weights[skip_holders:]) == 0:
+        weights[-1] = 1
+    # only the fields used for the leader election
+    state = SimpleNamespace(
+        params=SimpleNamespace(num_slot_leaders=2),
+        holder_state=SimpleNamespace(stake_holder_weights=weights),
+        chain_state=SimpleNamespace(block_hash=block_hash),
+        skip_holders=skip_holders,
+    )
+    slots = list(range(first_slot, first_slot + 10))
+    schedule = ls.leader_schedule(state, slots)
+    for k in range(3):
+        assert schedule[k].tolist() == [
+            compute_slot_leader(state, slot, k) for slot in slots
+        ]
@@ -1,12 +1,25 @@
+import copy
 from dataclasses import asdict
-from time import sleep
 
+import pytest
+from opshin.std.fractions import Fraction, ceil_fraction, floor_fraction
+from pycardano import TransactionFailedException
+
+from steak_protocol.offchain import util
 from steak_protocol.offchain.stakechain.init import main as init_stakechain
 from steak_protocol.offchain.stakeholder.init import main as init_stakeholder
 from steak_protocol.offchain.stakechain.mine import mine as mine_stakechain
+from steak_protocol.offchain.util import VERSION_2, amount_of_token_in_value
+from steak_protocol.onchain.util import scale_fraction
 from steak_protocol.submit_ref_script import main as submit_ref_script
 
-from test.offchain.util import DEFAULT_CONFIG, wait_for_tx
+from test.offchain.util import (
+    DEFAULT_CONFIG,
+    EMULATOR_POOL_ID,
+    EmulatorStakeChain,
+    wait_for_next_slot,
+    wait_for_tx,
+)
 
 
 def test_mine():
@@ -28,10 +41,94 @@ def test_mine():
             return_tx=True,
         )
     )
-    sleep(DEFAULT_CONFIG.slot_length / 1000 + 1)
+    wait_for_next_slot()
     wait_for_tx(
         mine_stakechain(
             name=DEFAULT_CONFIG.name,
             stakechain_auth_nft=stakechain_nft,
         )[0]
     )
+
+
+def test_mine_emulator(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, "keys_dir", tmp_path)
+    chain = EmulatorStakeChain()
+    stake_coin = chain.params.stake_coin
+    for block_number in range(1, 4):
+        prev_utxo, prev_state = chain.state()
+        prev_reserve = amount_of_token_in_value(stake_coin, prev_utxo.output.amount)
+        chain.mine()
+
+        utxo, state = chain.state()
+        reward = floor_fraction(
+            scale_fraction(prev_reserve, chain.params.fraction_per_block)
+        )
+        assert state.chain_state.block_number == block_number
+        assert state.chain_state.slot_number > prev_state.chain_state.slot_number
+        assert amount_of_token_in_value(stake_coin, utxo.output.amount) == (
+            prev_reserve - reward
+        )
+        assert state.holder_state.stake_holder_weights == [
+            prev_state.holder_state.stake_holder_weights[0] + reward
+        ]
+    # the secrets of the last block were committed
+    _, _, stakeholder_secrets = chain.stakeholder_state()
+    assert stakeholder_secrets == util.all_committed_hash_secrets(EMULATOR_POOL_ID)[-1]
+
+
+def test_mine_v2_emulator(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, "keys_dir", tmp_path)
+    chain = EmulatorStakeChain(VERSION_2, upgrade_version=VERSION_2)
+    for block_number in range(1, 3):
+        _, prev_state = chain.state(VERSION_2)
+        tx, _ = chain.mine(VERSION_2)
+
+        _, state = chain.state(VERSION_2)
+        assert state.chain_state.block_number == block_number
+        # the params are not part of the state but referenced
+        assert state.params_hash == prev_state.params_hash
+        params_utxo, params = chain.params_output()
+        assert params == chain.params
+        assert params_utxo.input in tx.transaction_body.reference_inputs
+
+
+def test_mine_pool_v2_emulator(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, "keys_dir", tmp_path)
+    chain = EmulatorStakeChain(VERSION_2, upgrade_version=VERSION_2, pool=True)
+    prev_utxo, prev_state = chain.state(VERSION_2)
+    prev_reserve = amount_of_token_in_value(
+        chain.params.stake_coin, prev_utxo.output.amount
+    )
+    chain.mine(VERSION_2)
+
+    _, state = chain.state(VERSION_2)
+    reward = floor_fraction(
+        scale_fraction(prev_reserve, chain.params.fraction_per_block)
+    )
+    # the pool is credited its guaranteed share of the reward
+    assert state.holder_state.stake_holder_weights == [
+        prev_state.holder_state.stake_holder_weights[0]
+        + ceil_fraction(scale_fraction(reward, Fraction(1, 3)))
+    ]
+
+
+def test_mine_v2_wrong_params_emulator(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(util, "keys_dir", tmp_path)
+    chain = EmulatorStakeChain(VERSION_2, upgrade_version=VERSION_2)
+    # params that pay out more stake per block than the committed ones
+    wrong_params = copy.deepcopy(chain.params)
+    wrong_params.fraction_per_block = Fraction(3, 10)
+    wrong_params_utxo = chain.context.fund(
+        chain.stakechain_addresses[VERSION_2], 2_000_000, datum=wrong_params
+    )
+    with pytest.raises(TransactionFailedException):
+        chain.build_block(
+            VERSION_2,
+            stakechain_params_utxo=wrong_params_utxo,
+            stakechain_params=wrong_params,
+        )
+    assert "Params do not match hash" in capsys.readouterr().out
+    # the committed params are still accepted
+    chain.mine(VERSION_2)
+    _, state = chain.state(VERSION_2)
+    assert state.chain_state.block_number == 1
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from steak_protocol.offchain.stakechain.mine import (
+    NotSlotLeader,
+    SlotPassed,
+    elect_pool,
+    find_params,
+)
+from steak_protocol.offchain.stakechain.mine_async import (
+    ChainQueries,
+    before,
+    slot_end,
+)
+from steak_protocol.offchain.util import (
+    VERSION_0,
+    VERSION_1,
+    VERSION_2,
+    stakechain_params_hash,
+)
+from steak_protocol.onchain.stakechain.stakechain_v1 import compute_slot_leader
+from steak_protocol.onchain.types import StakeChainV2State, UpgradeAgreement
+from steak_protocol.utils.clock import VirtualClock
+from test.offchain.util import honest_history
+
+
+class SlowContext:
+    last_block_slot = 42
+
+    def utxos(self, address):
+        time.sleep(0.2)
+        return [address]
+
+
+def test_queries_are_concurrent():
+    queries = ChainQueries(SlowContext())
+
+    async def query_all():
+        return await asyncio.gather(
+            *(queries.utxos(address) for address in ("a", "b", "c", "d")),
+            queries.last_block_slot(),
+        )
+
+    start = time.perf_counter()
+    results = asyncio.run(query_all())
+    assert time.perf_counter() - start < 0.6
+    assert results == [["a"], ["b"], ["c"], ["d"], 42]
+
+
+def test_slot_passed_cancels():
+    clock = VirtualClock(10_000)
+    cancelled = False
+
+    async def build():
+        nonlocal cancelled
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+
+    with pytest.raises(SlotPassed):
+        asyncio.run(before(build(), 10_100, clock))
+    assert cancelled
+    assert asyncio.run(before(asyncio.sleep(0, result=1), 10_100, clock)) == 1
+
+
+def test_slot_end():
+    state = SimpleNamespace(
+        params=SimpleNamespace(
+            genesis_time=1000, slot_length=60_000, slot_leader_interval=3
+        )
+    )
+    assert slot_end(state, 6, VERSION_0) == 1000 + 7 * 60_000
+    assert slot_end(state, 6, VERSION_1) == 1000 + 9 * 60_000
+
+
+def test_elect_pool():
+    history = honest_history()
+    state = history.state
+    params = state.params
+    pool_ids = [holder_id.decode() for holder_id in state.holder_state.stake_holder_ids]
+    for slot in range(30, 60, params.slot_leader_interval):
+        clock = VirtualClock(params.genesis_time + slot * params.slot_length)
+        leader = compute_slot_leader(state, slot, 0)
+        assert elect_pool(state, pool_ids, VERSION_1, clock) == (
+            slot,
+            pool_ids[leader],
+            leader,
+        )
+        for pool_id in pool_ids:
+            if pool_id != pool_ids[leader]:
+                with pytest.raises(NotSlotLeader):
+                    elect_pool(state, [pool_id], VERSION_1, clock)
+    # only the first slot of the slot leader interval can be mined
+    clock = VirtualClock(params.genesis_time + 31 * params.slot_length)
+    with pytest.raises(NotSlotLeader):
+        elect_pool(state, pool_ids, VERSION_1, clock)
+
+
+def test_elect_pool_v2():
+    state = honest_history().state
+    params = state.params
+    v2_state = StakeChainV2State(
+        stakechain_params_hash(params),
+        state.holder_state,
+        state.chain_state,
+        state.producer_state,
+        UpgradeAgreement(b"", 0),
+        state.skip_holders,
+        state.spent_for,
+    )
+    utxos = [
+        SimpleNamespace(output=SimpleNamespace(datum=SimpleNamespace(cbor=cbor)))
+        for cbor in (state.to_cbor(), params.to_cbor())
+    ]
+    params_utxo, found_params = find_params(utxos, v2_state, VERSION_2)
+    assert params_utxo is utxos[1] and found_params == params
+    assert find_params(utxos, state, VERSION_1) == (None, params)
+    pool_ids = [holder_id.decode() for holder_id in state.holder_state.stake_holder_ids]
+    for slot in range(30, 60, params.slot_leader_interval):
+        clock = VirtualClock(params.genesis_time + slot * params.slot_length)
+        assert elect_pool(
+            v2_state, pool_ids, VERSION_2, clock, stakechain_params=params
+        ) == elect_pool(state, pool_ids, VERSION_1, clock)
@@ -1,22 +1,39 @@
 from dataclasses import asdict
-from time import sleep
 
+import pytest
 from opshin.prelude import Nothing
-from pycardano import datum_hash
+from pycardano import TransactionFailedException, datum_hash
 
+from steak_protocol.offchain import util
+from steak_protocol.offchain.stakechain import upgrade_v2
 from steak_protocol.offchain.stakechain.init import main as init_stakechain
 from steak_protocol.offchain.stakeholder.init import main as init_stakeholder
 from steak_protocol.offchain.stakechain.mine import mine as mine_stakechain
+from steak_protocol.offchain.stakechain.mine import find_params
+from steak_protocol.offchain.util import VERSION_1, VERSION_2
+from steak_protocol.onchain.stakechain import (
+    stakechain_upgrade_v1a,
+    stakechain_upgrade_v2,
+)
 from steak_protocol.onchain.stakechain.stakechain_upgrade_v0 import ChainUpgradeProposal
+from steak_protocol.onchain.types import UpgradeAgreement
 from steak_protocol.submit_ref_script import main as submit_ref_script
-from steak_protocol.offchain.stakechain.upgrade import main as upgrade_stakechain
+from steak_protocol.offchain.stakechain.upgrade_v0_to_v0a import (
+    main as upgrade_stakechain,
+)
+from steak_protocol.offchain.stakechain.upgrade_v1_to_v2 import build_upgrade
 from steak_protocol.offchain.stakechain.register_upgrade_script import (
     main as register_upgrade,
 )
 from steak_protocol.utils import get_address
 from steak_protocol.utils.to_script_context import to_address
 
-from test.offchain.util import DEFAULT_CONFIG, wait_for_tx
+from test.offchain.util import (
+    DEFAULT_CONFIG,
+    EmulatorStakeChain,
+    wait_for_next_slot,
+    wait_for_tx,
+)
 
 
 def test_upgrade():
@@ -63,7 +80,7 @@ def test_upgrade():
         retries = 0
         while not successful:
             try:
-                sleep(DEFAULT_CONFIG.slot_length / 1000 + 1)
+                wait_for_next_slot()
                 tx, state = mine_stakechain(
                     name=DEFAULT_CONFIG.name,
                     stakechain_auth_nft=stakechain_nft,
@@ -94,3 +111,111 @@ def test_upgrade():
             return_tx=True,
         )
     )
+
+
+def test_upgrade_v1_to_v2_emulator(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, "keys_dir", tmp_path)
+    chain = EmulatorStakeChain(agreement_length=3, upgrade_version="v1a")
+    chain.deploy_stakechain(VERSION_2)
+    upgrade_proposal = stakechain_upgrade_v1a.ChainUpgradeProposal(
+        upgrade_address=to_address(chain.stakechain_addresses[VERSION_2]),
+        upgrade_params=Nothing(),
+        payout_txout=Nothing(),
+        take_treasury=Nothing(),
+    )
+    stakechain_states = [
+        chain.mine(
+            producer_message_hash_hex=datum_hash(upgrade_proposal).payload.hex()
+        )[1]
+        for _ in range(chain.agreement_length)
+    ]
+
+    stakechain_utxo, stakechain_state = chain.state(VERSION_1)
+    chain.context.submit_tx(
+        build_upgrade(
+            stakechain_utxo,
+            stakechain_state,
+            chain.stakechain_scripts[VERSION_1],
+            chain.upgrade_script,
+            upgrade_proposal,
+            [state.producer_state for state in reversed(stakechain_states[:-1])],
+            chain.context.utxos(chain.payment_address),
+            chain.payment_skey,
+            chain.payment_address,
+            chain_context=chain.context,
+        )
+    )
+
+    _, new_stakechain_state = chain.state(VERSION_2)
+    assert new_stakechain_state.chain_state == stakechain_state.chain_state
+    assert new_stakechain_state.holder_state == stakechain_state.holder_state
+    assert new_stakechain_state.agreement == UpgradeAgreement(b"", 0)
+    # the params moved into an output next to the state
+    _, params = find_params(
+        chain.context.utxos(chain.stakechain_addresses[VERSION_2]),
+        new_stakechain_state,
+        VERSION_2,
+    )
+    assert params == chain.params
+    # mining continues on V2, with the params as reference input
+    chain.mine(VERSION_2)
+    _, mined_stakechain_state = chain.state(VERSION_2)
+    assert mined_stakechain_state.chain_state.block_number == (
+        stakechain_state.chain_state.block_number + 1
+    )
+
+
+def agree_on_upgrade_v2(chain: EmulatorStakeChain, num_blocks: int):
+    """
+    Mine blocks agreeing on an upgrade that keeps address and params,
+    returns the upgrade transaction
+    """
+    upgrade_proposal = stakechain_upgrade_v2.ChainUpgradeProposal(
+        upgrade_address=Nothing(),
+        upgrade_params=Nothing(),
+        payout_txout=Nothing(),
+        take_treasury=Nothing(),
+    )
+    for _ in range(num_blocks):
+        chain.mine(
+            VERSION_2,
+            producer_message_hash_hex=datum_hash(upgrade_proposal).payload.hex(),
+        )
+    stakechain_utxo, stakechain_state = chain.state(VERSION_2)
+    assert stakechain_state.agreement == UpgradeAgreement(
+        datum_hash(upgrade_proposal).payload, num_blocks
+    )
+    params_utxo, _ = chain.params_output()
+    return upgrade_v2.build_upgrade(
+        stakechain_utxo,
+        stakechain_state,
+        params_utxo,
+        chain.stakechain_scripts[VERSION_2],
+        chain.upgrade_script,
+        upgrade_proposal,
+        chain.context.utxos(chain.payment_address),
+        chain.payment_skey,
+        chain.payment_address,
+        chain_context=chain.context,
+    )
+
+
+def test_upgrade_v2_emulator(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, "keys_dir", tmp_path)
+    chain = EmulatorStakeChain(VERSION_2, agreement_length=2, upgrade_version=VERSION_2)
+    _, genesis_state = chain.state(VERSION_2)
+    chain.context.submit_tx(agree_on_upgrade_v2(chain, chain.agreement_length))
+
+    _, stakechain_state = chain.state(VERSION_2)
+    # the agreement is consumed by the upgrade
+    assert stakechain_state.agreement == UpgradeAgreement(b"", 0)
+    assert stakechain_state.params_hash == genesis_state.params_hash
+    assert stakechain_state.chain_state.block_number == chain.agreement_length
+
+
+def test_upgrade_v2_not_enough_blocks_emulator(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(util, "keys_dir", tmp_path)
+    chain = EmulatorStakeChain(VERSION_2, agreement_length=2, upgrade_version=VERSION_2)
+    with pytest.raises(TransactionFailedException):
+        agree_on_upgrade_v2(chain, chain.agreement_length - 1)
+    assert "Not enough blocks agreed to upgrade" in capsys.readouterr().out
@@ -1,10 +1,23 @@
+import secrets
 from dataclasses import asdict
 
+import pycardano
+from opshin.std.builtins import sha2_256
+
+from steak_protocol.offchain import util
 from steak_protocol.offchain.stakechain.init import main as init_stakechain
+from steak_protocol.offchain.stakeholder.deregister import build_deregister
+from steak_protocol.offchain.stakeholder.init import build_register
 from steak_protocol.offchain.stakeholder.init import main as init_stakeholder
+from steak_protocol.offchain.util import (
+    VERSION_2,
+    amount_of_token_in_value,
+    asset_from_token,
+)
+from steak_protocol.onchain.types import StakeHolderState
 from steak_protocol.submit_ref_script import main as submit_ref_script
 
-from test.offchain.util import DEFAULT_CONFIG, wait_for_tx
+from test.offchain.util import DEFAULT_CONFIG, EmulatorStakeChain, wait_for_tx
 
 
 def test_init():
@@ -26,3 +39,73 @@ def test_init():
             return_tx=True,
         )
     )
+
+
+def test_register_deregister_v2_emulator(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, "keys_dir", tmp_path)
+    chain = EmulatorStakeChain(VERSION_2, upgrade_version=VERSION_2)
+    params_utxo, params = chain.params_output()
+    chain.context.fund(
+        chain.payment_address,
+        pycardano.Value(5_000_000, asset_from_token(params.stake_coin, 5_000)),
+    )
+    stakechain_utxo, stakechain_state = chain.state(VERSION_2)
+    chain.context.submit_tx(
+        build_register(
+            stakechain_utxo=stakechain_utxo,
+            stakechain_state=stakechain_state,
+            stakechain_script=chain.stakechain_scripts[VERSION_2],
+            stakechain_address=chain.stakechain_addresses[VERSION_2],
+            stakeholder_address=chain.stakeholder_address,
+            stakeholder_auth_nft_script=chain.stakeholder_auth_nft_script,
+            stakechain_auth_nft=chain.auth_nft,
+            payment_utxos=chain.context.utxos(chain.payment_address),
+            payment_vkey=chain.payment_vkey,
+            payment_skey=chain.payment_skey,
+            payment_address=chain.payment_address,
+            stakeholder_id="new",
+            stake_amount=5_000,
+            committed_hashes=[sha2_256(secrets.token_bytes(32)) for _ in range(5)],
+            stakechain_version=VERSION_2,
+            stakechain_params_utxo=params_utxo,
+            stakechain_params=params,
+            chain_context=chain.context,
+        )
+    )
+    _, registered_state = chain.state(VERSION_2)
+    assert registered_state.holder_state.stake_holder_ids == [b"new", b"pool"]
+    assert registered_state.skip_holders == stakechain_state.skip_holders + 1
+    assert registered_state.agreement == stakechain_state.agreement
+
+    (stakeholder_utxo,) = [
+        u
+        for u in chain.context.utxos(chain.stakeholder_address)
+        if amount_of_token_in_value(params.stakeholder_auth_nft, u.output.amount)
+        and StakeHolderState.from_cbor(u.output.datum.cbor).params.stakechain_id
+        == b"new"
+    ]
+    stakeholder_state = StakeHolderState.from_cbor(stakeholder_utxo.output.datum.cbor)
+    stakechain_utxo, stakechain_state = chain.state(VERSION_2)
+    chain.context.submit_tx(
+        build_deregister(
+            stakechain_utxo=stakechain_utxo,
+            stakechain_state=stakechain_state,
+            stakeholder_utxo=stakeholder_utxo,
+            stakeholder_state=stakeholder_state,
+            stakechain_script=chain.stakechain_scripts[VERSION_2],
+            stakeholder_script=chain.stakeholder_script,
+            stakeholder_auth_nft_script=chain.stakeholder_auth_nft_script,
+            stakechain_address=chain.stakechain_addresses[VERSION_2],
+            payment_utxos=chain.context.utxos(chain.payment_address),
+            payment_vkey=chain.payment_vkey,
+            payment_skey=chain.payment_skey,
+            payment_address=chain.payment_address,
+            stakechain_version=VERSION_2,
+            stakechain_params_utxo=params_utxo,
+            stakechain_params=params,
+            chain_context=chain.context,
+        )
+    )
+    _, deregistered_state = chain.state(VERSION_2)
+    assert deregistered_state.holder_state.stake_holder_ids == [b"pool"]
+    assert deregistered_state.skip_holders == stakechain_state.skip_holders - 1
@@ -0,0 +1,38 @@
+import json
+import secrets
+
+import pytest
+from hashlib import sha256
+
+from steak_protocol.offchain.stakeholder.recover import match_committed_hashes
+
+
+def journal(n: int):
+    hash_secrets = [secrets.token_bytes(32) for _ in range(5)]
+    lines, windows = [], []
+    for i in range(n):
+        hash_secrets = hash_secrets[1:] + [secrets.token_bytes(32)]
+        windows.append(hash_secrets)
+        for write_ahead in (True, False):
+            lines.append(
+                json.dumps(
+                    {
+                        "secrets": [x.hex() for x in hash_secrets],
+                        "timestamp": i,
+                        "write_ahead": write_ahead,
+                    }
+                )
+            )
+    return lines, windows
+
+
+def test_match_committed_hashes():
+    lines, windows = journal(1000)
+    for window in (windows[-1], windows[500], windows[0]):
+        committed_hashes = [sha256(x).digest() for x in window]
+        assert match_committed_hashes(lines, committed_hashes) == window
+    # the block made it to the chain but only its write ahead line was journaled
+    committed_hashes = [sha256(x).digest() for x in windows[-1]]
+    assert match_committed_hashes(lines[:-1], committed_hashes) == windows[-1]
+    with pytest.raises(AssertionError):
+        match_committed_hashes(lines, [secrets.token_bytes(32)])
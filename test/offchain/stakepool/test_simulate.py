@@ -0,0 +1,66 @@
+import numpy as np
+from hypothesis import given, settings, strategies as st
+from opshin.std.math import bytes_big_from_unsigned_int
+
+from steak_protocol.offchain.stakepool.simulate import (
+    leader_random_numbers,
+    reward_schedule,
+    sample_leaders,
+    simulate,
+)
+from steak_protocol.onchain.utils.random import weighted_sample
+
+
+@given(
+    weights=st.lists(st.integers(min_value=0, max_value=2**40), min_size=1),
+    block_hash=st.binary(min_size=32, max_size=32),
+    slot=st.integers(min_value=0, max_value=2**40),
+    slot_leader_number=st.integers(min_value=0, max_value=300),
+)
+def test_leader_matches_onchain(
+    weights: list, block_hash: bytes, slot: int, slot_leader_number: int
+):
+    if sum(weights) == 0:
+        weights[0] = 1
+    rng_seed = (
+        bytes_big_from_unsigned_int(slot_leader_number)
+        + block_hash
+        + bytes_big_from_unsigned_int(slot)
+    )
+    random_numbers = leader_random_numbers([block_hash], [slot], slot_leader_number)
+    cumulative_weights = np.cumsum(weights)
+    assert sample_leaders(cumulative_weights, random_numbers)[0] == weighted_sample(
+        weights, rng_seed
+    )
+    assert sample_leaders(cumulative_weights[None, :], random_numbers)[
+        0
+    ] == weighted_sample(weights, rng_seed)
+
+
+@settings(deadline=None, max_examples=10)
+@given(compound=st.booleans(), seed=st.integers(min_value=0, max_value=2**32))
+def test_rewards_conserved(compound: bool, seed: int):
+    reserve = 77_777_777_000_000
+    result = simulate(
+        [1_000_000, 3_000_000, 6_000_000],
+        reserve,
+        "3/10000000",
+        500,
+        slot_leader_interval=3,
+        num_slot_leaders=1,
+        guaranteed_reward_fractions=[None, "1/2", None],
+        availability=[1, 0.9, 0.5],
+        runs=4,
+        compound=compound,
+        seed=seed,
+    )
+    for run in range(4):
+        n_blocks = int(result.blocks[run].sum())
+        assert n_blocks + result.missed_slots[run] == 167
+        assert (
+            result.rewards[run].sum()
+            == reward_schedule(reserve, "3/10000000", n_blocks).sum()
+        )
+    # the pool keeps at least half of its rewards
+    assert (result.staked_rewards[:, 1] * 2 >= result.rewards[:, 1]).all()
+    assert (result.operator_rewards[:, [0, 2]] == 0).all()
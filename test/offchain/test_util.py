@@ -0,0 +1,129 @@
+import pycardano
+import pytest
+from pycardano import (
+    TransactionBuilder,
+    TransactionFailedException,
+    TransactionOutput,
+    Value,
+)
+
+from steak_protocol.offchain import util
+from steak_protocol.offchain.util import (
+    adjust_for_wrong_fee,
+    asset_from_token,
+    balance_tx,
+    min_lovelace,
+    ref_script_fee,
+    token_from_string,
+    all_committed_hash_secrets,
+    commit_hash_secrets,
+    committed_hash_secrets,
+    init_hash_seed,
+    new_hash_secrets,
+    next_hash_secret,
+    write_ahead_hash_secrets,
+)
+from steak_protocol.utils.emulator import EmulatorBackend
+from test.offchain.util import new_wallet
+
+
+def test_derived_hash_secrets(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, "keys_dir", tmp_path)
+    init_hash_seed("pool")
+    secrets = new_hash_secrets("pool")
+    commit_hash_secrets("pool", secrets)
+    assert committed_hash_secrets("pool") == secrets
+
+    for _ in range(3):
+        new_secrets = secrets[1:] + [next_hash_secret("pool", secrets)]
+        write_ahead_hash_secrets("pool", new_secrets)
+        commit_hash_secrets("pool", new_secrets)
+        secrets = new_secrets
+    assert committed_hash_secrets("pool") == secrets
+    assert secrets in all_committed_hash_secrets("pool")
+
+    # a block that made it to the chain without its secrets being committed
+    new_secrets = secrets[1:] + [next_hash_secret("pool", secrets)]
+    assert new_secrets in all_committed_hash_secrets("pool")
+    # the secret state is only the seed and counter
+    assert [p.name for p in tmp_path.iterdir()] == ["pool.hash_seed"]
+
+
+def test_random_hash_secrets(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, "keys_dir", tmp_path)
+    secrets = new_hash_secrets("pool")
+    write_ahead_hash_secrets("pool", secrets)
+    commit_hash_secrets("pool", secrets)
+    assert next_hash_secret("pool", secrets) != next_hash_secret("pool", secrets)
+    assert all_committed_hash_secrets("pool") == [secrets, secrets]
+
+
+def test_balance_tx():
+    context = EmulatorBackend()
+    skey, _, address = new_wallet(context)
+    _, _, receiver = new_wallet(context)
+    context.fund(address, 10_000_000)
+    utxos = context.utxos(address)
+
+    builder = TransactionBuilder(context)
+    builder.add_input_address(address)
+    builder.add_output(TransactionOutput(receiver, 3_000_000))
+    tx = builder.build_and_sign([skey], change_address=address)
+    assert balance_tx(tx, utxos, [skey], context) is tx
+
+    # too low a fee and too much change
+    tx = adjust_for_wrong_fee(tx, [skey], output_offset=-1000, fee_offset=-1000)
+    with pytest.raises(TransactionFailedException):
+        context.submit_tx(tx)
+    context.submit_tx(balance_tx(tx, utxos, [skey], context))
+
+
+def test_balance_tx_reference_script_fee():
+    context = EmulatorBackend()
+    skey, _, address = new_wallet(context)
+    context.fund(address, 10_000_000)
+    script = pycardano.PlutusV2Script(bytes(30_000))
+    ref_utxo = context.fund(address, 30_000_000, script=script)
+    utxos = [u for u in context.utxos(address) if u.output.script is None]
+
+    builder = TransactionBuilder(context)
+    for u in utxos:
+        builder.add_input(u)
+    builder.reference_inputs.add(ref_utxo)
+    tx = builder.build_and_sign([skey], change_address=address)
+    min_fee = pycardano.fee(context, len(tx.to_cbor()))
+    balanced = balance_tx(tx, utxos + [ref_utxo], [skey], context)
+    # 25600 bytes at 15 lovelace and the rest at 18 lovelace per byte
+    assert ref_script_fee(30_000) == 25_600 * 15 + 4_400 * 18
+    assert balanced.transaction_body.fee >= min_fee + ref_script_fee(30_000)
+    context.submit_tx(balanced)
+
+
+class CountingEmulator(EmulatorBackend):
+    queries = 0
+
+    @property
+    def protocol_param(self):
+        self.queries += 1
+        return super().protocol_param
+
+
+def test_min_lovelace():
+    context = CountingEmulator()
+    _, _, address = new_wallet(context)
+    token = token_from_string("00" * 28 + "." + b"steak".hex())
+    outputs = [
+        TransactionOutput(address, 0),
+        TransactionOutput(address, 5_000_000, datum=b"\x00" * 64),
+        TransactionOutput(address, Value(0, asset_from_token(token, 10**12))),
+    ]
+    for output in outputs:
+        computed = min_lovelace(output, context, context.clock)
+        assert computed == pycardano.min_lovelace(EmulatorBackend(), output)
+    assert context.queries == 1
+
+    # the parameters are queried again in the next epoch of the given clock
+    context.wait(context.genesis_param.epoch_length)
+    min_lovelace(outputs[0], context, context.clock)
+    min_lovelace(outputs[0], context, context.clock)
+    assert context.queries == 2
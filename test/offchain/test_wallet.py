@@ -0,0 +1,85 @@
+import pytest
+
+from steak_protocol.offchain.wallet import (
+    COLLATERAL_AMOUNT,
+    FUEL_AMOUNT,
+    build_consolidation,
+    needs_consolidation,
+    select_collateral,
+    select_inputs,
+)
+from steak_protocol.utils.emulator import EmulatorBackend
+from test.offchain.util import new_wallet
+
+
+def test_consolidation():
+    context = EmulatorBackend()
+    skey, _, address = new_wallet(context)
+    for _ in range(30):
+        context.fund(address, 3_000_000)
+    utxos = context.utxos(address)
+    assert needs_consolidation(utxos, max_utxos=10)
+    # many small inputs are needed before the wallet is split
+    assert len(select_inputs(utxos)) == 4
+
+    tx = build_consolidation(utxos, address, skey, num_fuel=5, chain_context=context)
+    context.submit_tx(tx)
+    utxos = context.utxos(address)
+    assert not needs_consolidation(utxos, max_utxos=10)
+    assert len(utxos) == 7
+
+    (collateral,) = select_collateral(utxos)
+    assert collateral.output.amount.coin == COLLATERAL_AMOUNT
+    (fuel,) = select_inputs(utxos, exclude=[collateral])
+    assert fuel.output.amount.coin == FUEL_AMOUNT
+
+
+def test_consolidation_without_funds():
+    context = EmulatorBackend()
+    skey, _, address = new_wallet(context)
+    context.fund(address, 12_000_000)
+    utxos = context.utxos(address)
+    assert build_consolidation(utxos, address, skey, 5, chain_context=context) is None
+    assert select_collateral(utxos) == utxos
+
+
+def test_consolidation_keeps_split():
+    context = EmulatorBackend()
+    skey, _, address = new_wallet(context)
+    context.fund(address, 100_000_000)
+    tx = build_consolidation(
+        context.utxos(address), address, skey, num_fuel=3, chain_context=context
+    )
+    context.submit_tx(tx)
+    (collateral,) = select_collateral(context.utxos(address))
+    fuel = [u for u in context.utxos(address) if u.output.amount.coin == FUEL_AMOUNT]
+    assert len(fuel) == 3
+
+    # the miner spent one fuel UTxO in the meantime and its change came back
+    for _ in range(12):
+        context.fund(address, 2_000_000)
+    utxos = [u for u in context.utxos(address) if u != fuel[0]]
+    assert needs_consolidation(utxos, max_utxos=10)
+    tx = build_consolidation(utxos, address, skey, num_fuel=3, chain_context=context)
+    inputs = set(tx.transaction_body.inputs)
+    assert collateral.input not in inputs
+    assert not inputs & {u.input for u in fuel}
+    # only the spent fuel UTxO is replaced
+    assert [o.amount.coin for o in tx.transaction_body.outputs[:-1]] == [FUEL_AMOUNT]
+
+
+def test_select_inputs_keeps_excluded():
+    context = EmulatorBackend()
+    _, _, address = new_wallet(context)
+    for amount in (6_000_000, 3_000_000, 3_000_000):
+        context.fund(address, amount)
+    utxos = context.utxos(address)
+    collateral = select_collateral(utxos)
+    assert len(collateral) == 1
+    assert select_inputs(utxos, exclude=collateral) == [
+        u for u in utxos if u not in collateral
+    ]
+    # a single UTxO pays the fees and serves as collateral
+    assert select_inputs(utxos[:1], exclude=utxos[:1]) == utxos[:1]
+    with pytest.raises(AssertionError):
+        select_inputs([], exclude=collateral)
@@ -1,10 +1,57 @@
 import dataclasses
-import time
-from typing import Union
+import functools
+import secrets
+import sys
+from copy import deepcopy
+from pathlib import Path
+from typing import Optional, Tuple, Union
 
 import pycardano
+from opshin.builder import apply_parameters, build
+from opshin.ledger.api_v2 import (
+    Address,
+    NoOutputDatum,
+    NoStakingCredential,
+    PubKeyCredential,
+    SomeOutputDatum,
+    SomeOutputDatumHash,
+)
+from opshin.prelude import Nothing, Token, TxId, TxOutRef
+from opshin.ledger.api_v2 import ScriptCredential
+from opshin.std.builtins import sha2_256
+from opshin.std.fractions import Fraction, ceil_fraction, floor_fraction
+from opshin.std.math import bytes_big_from_unsigned_int
 
+from steak_protocol.offchain.stakechain import mine
+from steak_protocol.offchain.stakechain.audit import StateRecord
+from steak_protocol.offchain.util import (
+    ContractVersion,
+    VERSION_1,
+    VERSION_2,
+    all_committed_hash_secrets,
+    asset_from_token,
+    commit_hash_secrets,
+    find_stakechain_params,
+    stakechain_params_hash,
+)
+from steak_protocol.onchain.stakechain.stakechain_v1 import compute_slot_leader
+from steak_protocol.onchain.stakepool.stakepool import PoolParams, PoolState
+from steak_protocol.onchain.types import (
+    CoreChainState,
+    ProducerState,
+    StakeChainV1Params,
+    StakeChainV1State,
+    StakeChainV2State,
+    StakeHolderRegistrations,
+    StakeHolderState,
+    StakePoolParams,
+    UpgradeAgreement,
+)
+from steak_protocol.onchain.util import scale_fraction
+from steak_protocol.utils.clock import Clock, system_clock
+from steak_protocol.utils.emulator import EmulatorBackend
 from steak_protocol.utils.network import context
+from steak_protocol.utils.to_script_context import to_address
 
 
 @dataclasses.dataclass()
@@ -35,9 +82,19 @@ class StakeChainConfig:
 DEFAULT_CONFIG = StakeChainConfig()
 
 
+def wait_for_next_slot(
+    config: StakeChainConfig = DEFAULT_CONFIG, clock: Clock = system_clock
+):
+    """
+    Wait until the stake chain advanced by at least one slot
+    """
+    clock.sleep(config.slot_length / 1000 + 1)
+
+
 def wait_for_tx(
     tx: Union[pycardano.Transaction, pycardano.TransactionInput],
-    context: pycardano.OgmiosChainContext = context,
+    context: pycardano.ChainContext = context,
+    clock: Clock = system_clock,
 ):
     while not context.utxo_by_tx_id(
         (
@@ -47,5 +104,502 @@ def wait_for_tx(
         ).hex(),
         0,
     ):
-        time.sleep(1)
+        clock.sleep(1)
         print("Waiting for transaction to be included in the blockchain")
+
+
+def new_wallet(context: EmulatorBackend):
+    skey = pycardano.PaymentSigningKey.generate()
+    vkey = pycardano.PaymentVerificationKey.from_signing_key(skey)
+    return skey, vkey, pycardano.Address(vkey.hash(), network=context.network)
+
+
+PARAMS = StakeChainV1Params(
+    stakeholder_address=Address(PubKeyCredential(b"\x00" * 28), NoStakingCredential()),
+    stakeholder_auth_nft=Token(b"\x01" * 28, b"holder"),
+    slot_length=60_000,
+    stake_coin=Token(b"\x02" * 28, b"stakecoin"),
+    fraction_per_block=Fraction(3, 10_000_000),
+    auth_nft=Token(b"\x03" * 28, b"chain"),
+    genesis_time=0,
+    register_fee=0,
+    upgrade_approval=PubKeyCredential(b"\x04" * 28),
+    num_slot_leaders=1,
+    max_holders=20,
+    slot_leader_interval=1,
+)
+
+
+def make_chain(messages):
+    states = []
+    producer_state = ProducerState(b"", NoOutputDatum(), b"")
+    for i, message in enumerate(messages):
+        producer_state = ProducerState(
+            producer_signature=sha2_256(bytes([i])),
+            auxiliary=(
+                NoOutputDatum() if message is None else SomeOutputDatumHash(message)
+            ),
+            prev_producer_state_hash=sha2_256(producer_state.to_cbor()),
+        )
+        states.append(
+            StakeChainV1State(
+                PARAMS,
+                StakeHolderRegistrations([1], [b"0"]),
+                CoreChainState(i, sha2_256(bytes([i, i])), i),
+                producer_state,
+                0,
+                Nothing(),
+            )
+        )
+    return states
+
+
+REGISTER_FEE = 7_000_000
+
+
+def genesis() -> StakeChainV1State:
+    return StakeChainV1State(
+        params=StakeChainV1Params(
+            stakeholder_address=Address(
+                PubKeyCredential(bytes(28)), NoStakingCredential()
+            ),
+            stakeholder_auth_nft=Token(bytes(28), b"holder"),
+            slot_length=60_000,
+            stake_coin=Token(bytes(28), b"stake"),
+            fraction_per_block=Fraction(3, 10_000_000),
+            auth_nft=Token(bytes(28), b"chain"),
+            genesis_time=0,
+            register_fee=REGISTER_FEE,
+            upgrade_approval=PubKeyCredential(bytes(28)),
+            num_slot_leaders=2,
+            max_holders=20,
+            slot_leader_interval=3,
+        ),
+        holder_state=StakeHolderRegistrations([], []),
+        chain_state=CoreChainState(0, b"", 0),
+        producer_state=ProducerState(b"", SomeOutputDatum(0), b""),
+        skip_holders=-1000,
+        spent_for=Nothing(),
+    )
+
+
+class History:
+    def __init__(self):
+        self.records = [
+            StateRecord(genesis().to_cbor(), secrets.token_bytes(32), 0, 10**12)
+        ]
+        # holder states by stake holder id
+        self.holder_states = {}
+
+    @property
+    def state(self) -> StakeChainV1State:
+        return StakeChainV1State.from_cbor(self.records[-1].state)
+
+    def append(
+        self,
+        state: StakeChainV1State,
+        reserve: int,
+        secret=None,
+        holder_state: Optional[StakeHolderState] = None,
+    ):
+        prev = self.records[-1]
+        state.spent_for = TxOutRef(TxId(prev.transaction_id), prev.output_index)
+        self.records.append(
+            StateRecord(
+                state.to_cbor(),
+                secrets.token_bytes(32),
+                0,
+                reserve,
+                secret,
+                sha2_256(secret) if secret is not None else None,
+                holder_state.to_cbor() if holder_state is not None else None,
+            )
+        )
+
+    def register(
+        self,
+        holder_id: bytes,
+        weight: int,
+        guaranteed_reward_fraction: Optional[Fraction] = None,
+    ):
+        """
+        Register a stake holder, a stake pool if the guaranteed reward fraction is given
+        """
+        state = self.state
+        owner, aux = PubKeyCredential(bytes(28)), NoOutputDatum()
+        if guaranteed_reward_fraction is not None:
+            owner = ScriptCredential(bytes(28))
+            aux = SomeOutputDatum(
+                PoolState(
+                    PoolParams(
+                        TxOutRef(TxId(bytes(32)), 0),
+                        PubKeyCredential(bytes(28)),
+                        guaranteed_reward_fraction,
+                        state.params.stakeholder_auth_nft,
+                        state.params.auth_nft,
+                    ),
+                    weight,
+                )
+            )
+        self.holder_states[holder_id] = StakeHolderState(
+            StakePoolParams(
+                owner,
+                holder_id,
+                state.params.auth_nft,
+                state.params.stakeholder_auth_nft,
+            ),
+            [],
+            aux,
+        )
+        state.holder_state.stake_holder_ids.insert(0, holder_id)
+        state.holder_state.stake_holder_weights.insert(0, weight)
+        state.skip_holders += 1
+        self.append(state, self.records[-1].reserve + REGISTER_FEE)
+
+    def mine(self, slot: int, k: int = 0, producer=None):
+        prev_state = self.state
+        state = deepcopy(prev_state)
+        leader = compute_slot_leader(prev_state, slot, k)
+        producer = leader if producer is None else producer
+        reserve = self.records[-1].reserve
+        reward = floor_fraction(
+            scale_fraction(reserve, prev_state.params.fraction_per_block)
+        )
+        holder_state = deepcopy(
+            self.holder_states[prev_state.holder_state.stake_holder_ids[producer]]
+        )
+        if isinstance(holder_state.aux, SomeOutputDatum):
+            # pools are only credited the guaranteed share of the reward
+            pool_state = PoolState.from_cbor(holder_state.aux.datum.to_cbor())
+            state.holder_state.stake_holder_weights[producer] += ceil_fraction(
+                scale_fraction(reward, pool_state.params.guaranteed_reward_fraction)
+            )
+        else:
+            state.holder_state.stake_holder_weights[producer] += reward
+        state.chain_state = CoreChainState(
+            prev_state.chain_state.block_number + 1,
+            sha2_256(
+                bytes_big_from_unsigned_int(k)
+                + prev_state.chain_state.to_cbor()
+                + prev_state.producer_state.producer_signature
+            ),
+            slot,
+        )
+        secret = secrets.token_bytes(32)
+        state.producer_state = ProducerState(
+            sha2_256(state.chain_state.to_cbor() + secret),
+            SomeOutputDatum(0),
+            sha2_256(prev_state.producer_state.to_cbor()),
+        )
+        state.skip_holders = 0
+        holder_state.committed_hashes = [sha2_256(secret)]
+        self.append(state, reserve - reward, secret, holder_state)
+
+
+def honest_history() -> History:
+    history = History()
+    history.register(b"a", 1000)
+    history.register(b"b", 3000)
+    history.register(b"c", 500)
+    for i in range(1, 40):
+        if i == 30:
+            # a stake pool that is elected for most of the remaining blocks
+            history.register(b"d", 10**9, Fraction(1, 3))
+        history.mine(3 * i, k=i % 3)
+    return history
+
+
+ONCHAIN_DIR = Path(__file__).parent.parent.parent.joinpath("steak_protocol", "onchain")
+
+
+@functools.lru_cache()
+def compile_contract(name: str) -> pycardano.PlutusV2Script:
+    """
+    Compile steak_protocol/onchain/<name>.py once per test session
+    """
+    # the stake chain contracts exceed the default recursion limit, also when evaluated by the emulator
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10_000))
+    return build(str(ONCHAIN_DIR.joinpath(f"{name}.py")))
+
+
+EMULATOR_POOL_ID = "pool"
+
+
+class EmulatorStakeChain:
+    """
+    A stake chain of the given version with a single stake holder on the emulated ledger.
+    Blocks are mined and submitted through the off-chain code, the secrets of the holder are
+    journaled in the keys dir (which tests point to a temporary directory).
+    The upgrade approval is the upgrade script of the given version.
+    If `pool` is set, the stake holder is a stake pool administered by the payment key.
+    """
+
+    def __init__(
+        self,
+        version: ContractVersion = VERSION_1,
+        agreement_length: int = 3,
+        upgrade_version: ContractVersion = "v1a",
+        reserve: int = 10**12,
+        stake: int = 10_000,
+        pool: bool = False,
+    ):
+        self.context = EmulatorBackend()
+        self.payment_skey, self.payment_vkey, self.payment_address = new_wallet(
+            self.context
+        )
+        for _ in range(3):
+            self.context.fund(self.payment_address, 100_000_000)
+        self.stakeholder_script, self.stakeholder_address = self.deploy(
+            "stakeholder/stakeholder"
+        )
+        self.stakepool_script, stakepool_address = self.deploy("stakepool/stakepool")
+        self.stakepool_script_hash = stakepool_address.payment_part
+        self.stakechain_scripts = {}
+        self.stakechain_addresses = {}
+        self.deploy_stakechain(version)
+
+        self.auth_nft = Token(b"\x03" * 28, b"chain")
+        self.stakeholder_auth_nft_script = apply_parameters(
+            compile_contract("stakeholder/stakeholder_auth_nft"), self.auth_nft
+        )
+        self.agreement_length = agreement_length
+        self.upgrade_script = self.upgrade_contract(upgrade_version)
+        self.params = StakeChainV1Params(
+            stakeholder_address=to_address(self.stakeholder_address),
+            stakeholder_auth_nft=Token(
+                pycardano.plutus_script_hash(self.stakeholder_auth_nft_script).payload,
+                self.auth_nft.token_name,
+            ),
+            slot_length=60_000,
+            stake_coin=Token(b"\x02" * 28, b"stakecoin"),
+            fraction_per_block=Fraction(3, 10_000_000),
+            auth_nft=self.auth_nft,
+            genesis_time=self.context.slot_to_posix(0),
+            register_fee=0,
+            upgrade_approval=ScriptCredential(
+                pycardano.plutus_script_hash(self.upgrade_script).payload
+            ),
+            num_slot_leaders=1,
+            max_holders=20,
+            slot_leader_interval=1,
+        )
+        genesis_fields = dict(
+            holder_state=StakeHolderRegistrations([stake], [EMULATOR_POOL_ID.encode()]),
+            chain_state=CoreChainState(0, b"", 0),
+            producer_state=ProducerState(b"", NoOutputDatum(), b""),
+            skip_holders=0,
+            spent_for=Nothing(),
+        )
+        if version == VERSION_2:
+            genesis_state = StakeChainV2State(
+                params_hash=stakechain_params_hash(self.params),
+                agreement=UpgradeAgreement(b"", 0),
+                **genesis_fields,
+            )
+            # the params are stored next to the state
+            self.context.fund(
+                self.stakechain_addresses[version], 2_000_000, datum=self.params
+            )
+        else:
+            genesis_state = StakeChainV1State(params=self.params, **genesis_fields)
+        self.context.fund(
+            self.stakechain_addresses[version],
+            pycardano.Value(
+                5_000_000,
+                asset_from_token(self.auth_nft, 1)
+                + asset_from_token(self.params.stake_coin, reserve),
+            ),
+            datum=genesis_state,
+        )
+        hash_secrets = [secrets.token_bytes(32) for _ in range(3)]
+        commit_hash_secrets(EMULATOR_POOL_ID, hash_secrets)
+        owner, aux = PubKeyCredential(self.payment_vkey.hash().payload), NoOutputDatum()
+        if pool:
+            owner = ScriptCredential(self.stakepool_script_hash.payload)
+            aux = SomeOutputDatum(
+                PoolState(
+                    PoolParams(
+                        initial_utxo=TxOutRef(TxId(bytes(32)), 0),
+                        admin=PubKeyCredential(self.payment_vkey.hash().payload),
+                        guaranteed_reward_fraction=Fraction(1, 3),
+                        stake_auth_nft=self.params.stakeholder_auth_nft,
+                        chain_auth_nft=self.auth_nft,
+                    ),
+                    all_lp_tokens=1000,
+                )
+            )
+        self.context.fund(
+            self.stakeholder_address,
+            pycardano.Value(
+                5_000_000,
+                asset_from_token(self.params.stakeholder_auth_nft, 1)
+                + asset_from_token(self.params.stake_coin, stake),
+            ),
+            datum=StakeHolderState(
+                params=StakePoolParams(
+                    owner=owner,
+                    stakechain_id=EMULATOR_POOL_ID.encode(),
+                    chain_auth_nft=self.auth_nft,
+                    stakeholder_auth_nft=self.params.stakeholder_auth_nft,
+                ),
+                committed_hashes=[sha2_256(x) for x in hash_secrets],
+                aux=aux,
+            ),
+        )
+        # register the upgrade and pool scripts so that they can be invoked by a withdrawal
+        builder = pycardano.TransactionBuilder(self.context)
+        builder.add_input_address(self.payment_address)
+        builder.certificates = [
+            pycardano.StakeRegistration(pycardano.StakeCredential(script_hash))
+            for script_hash in (
+                pycardano.plutus_script_hash(self.upgrade_script),
+                self.stakepool_script_hash,
+            )
+        ]
+        self.context.submit_tx(
+            builder.build_and_sign(
+                [self.payment_skey], change_address=self.payment_address
+            )
+        )
+
+    def deploy(self, name: str) -> Tuple[pycardano.UTxO, pycardano.Address]:
+        """
+        Create the reference script utxo of the contract at its own address (like submit_ref_script)
+        """
+        script = compile_contract(name)
+        address = pycardano.Address(
+            pycardano.plutus_script_hash(script), network=self.context.network
+        )
+        return self.context.fund(address, 30_000_000, script=script), address
+
+    def deploy_stakechain(self, version: ContractVersion):
+        (
+            self.stakechain_scripts[version],
+            self.stakechain_addresses[version],
+        ) = self.deploy(f"stakechain/stakechain_{version}")
+
+    def upgrade_contract(self, version: ContractVersion) -> pycardano.PlutusV2Script:
+        return apply_parameters(
+            compile_contract(f"stakechain/stakechain_upgrade_{version}"),
+            self.agreement_length,
+            self.auth_nft,
+        )
+
+    def state(self, version: ContractVersion = VERSION_1):
+        return mine.find_stakechain_state(
+            self.context.utxos(self.stakechain_addresses[version]),
+            self.auth_nft,
+            version,
+        )
+
+    def params_output(self):
+        """
+        The output holding the params of the V2 stake chain
+        """
+        _, state = self.state(VERSION_2)
+        return find_stakechain_params(
+            self.context.utxos(self.stakechain_addresses[VERSION_2]), state.params_hash
+        )
+
+    def stakeholder_state(self):
+        """
+        The stake holder state and the journaled secrets of its committed hashes
+        """
+        return mine.find_stakeholder_state(
+            self.context.utxos(self.stakeholder_address),
+            self.auth_nft,
+            EMULATOR_POOL_ID,
+            all_committed_hash_secrets(EMULATOR_POOL_ID),
+        )
+
+    def next_slot(self):
+        """
+        Advance the clock to the beginning of the next slot of the stake chain
+        """
+        current_slot = mine.compute_current_slot(
+            self.params.genesis_time, self.params.slot_length, self.context.clock
+        )
+        self.context.clock.set(
+            self.params.genesis_time
+            + (current_slot + 1) * self.params.slot_length
+            + 1000
+        )
+
+    def build_block(
+        self,
+        version: ContractVersion = VERSION_1,
+        producer_message_hash_hex: Optional[str] = None,
+        **kwargs,
+    ):
+        """
+        Build the block of the next slot, mirrors mine.mine
+        """
+        self.next_slot()
+        stakechain_utxos = self.context.utxos(self.stakechain_addresses[version])
+        stakechain_utxo, stakechain_state = mine.find_stakechain_state(
+            stakechain_utxos, self.auth_nft, version
+        )
+        stakechain_params_utxo, stakechain_params = mine.find_params(
+            stakechain_utxos, stakechain_state, version
+        )
+        current_slot_number, own_index_in_stakeholder_list = mine.check_slot_leader(
+            stakechain_state,
+            EMULATOR_POOL_ID,
+            version,
+            self.context.clock,
+            stakechain_params=stakechain_params,
+        )
+        stakeholder_utxo, stakeholder_state, stakeholder_secrets = (
+            self.stakeholder_state()
+        )
+        block = dict(
+            stakechain_utxo=stakechain_utxo,
+            stakechain_state=stakechain_state,
+            stakeholder_utxo=stakeholder_utxo,
+            stakeholder_state=stakeholder_state,
+            stakeholder_secrets=stakeholder_secrets,
+            payment_utxos=self.context.utxos(self.payment_address),
+            stakechain_script=self.stakechain_scripts[version],
+            stakeholder_script=self.stakeholder_script,
+            stakepool_script=self.stakepool_script,
+            stakepool_script_hash=self.stakepool_script_hash,
+            stakechain_address=self.stakechain_addresses[version],
+            stakeholder_address=self.stakeholder_address,
+            payment_skey=self.payment_skey,
+            payment_address=self.payment_address,
+            current_slot_number=current_slot_number,
+            own_index_in_stakeholder_list=own_index_in_stakeholder_list,
+            last_block_slot=self.context.last_block_slot,
+            producer_message_hash_hex=producer_message_hash_hex,
+            stakechain_version=version,
+            stakechain_params_utxo=stakechain_params_utxo,
+            stakechain_params=stakechain_params,
+            chain_context=self.context,
+        )
+        block.update(kwargs)
+        return mine.build_block(**block)
+
+    def mine(
+        self,
+        version: ContractVersion = VERSION_1,
+        producer_message_hash_hex: Optional[str] = None,
+    ):
+        """
+        Mine and submit the block of the next slot, returns the transaction and the new state
+        """
+        tx, new_stakechain_state, new_stakeholder_secrets = self.build_block(
+            version, producer_message_hash_hex
+        )
+        # the transaction is valid from the slot after the last block
+        self.context.wait(1)
+        mine.submit_block(
+            tx,
+            new_stakechain_state,
+            EMULATOR_POOL_ID,
+            new_stakeholder_secrets,
+            commit_interval=1,
+            clock=self.context.clock,
+            stakechain_params=self.params,
+            chain_context=self.context,
+        )
+        return tx, new_stakechain_state
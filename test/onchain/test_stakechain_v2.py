@@ -0,0 +1,46 @@
+from hypothesis import given
+from hypothesis import strategies as st
+from opshin.ledger.api_v2 import NoOutputDatum, SomeOutputDatum, SomeOutputDatumHash
+from pycardano import datum_hash
+
+from steak_protocol.onchain.stakechain.stakechain_upgrade_v2 import (
+    ChainUpgradeProposal,
+)
+from steak_protocol.onchain.stakechain.stakechain_v2 import next_agreement
+from steak_protocol.onchain.types import UpgradeAgreement
+from steak_protocol.onchain.util import Nothing
+
+
+@given(st.lists(st.sampled_from([None, b"\x01" * 32, b"\x02" * 32])))
+def test_next_agreement(proposals: list):
+    agreement = UpgradeAgreement(b"", 0)
+    for proposal in proposals:
+        aux = (
+            NoOutputDatum()
+            if proposal is None
+            else SomeOutputDatumHash(datum_hash=proposal)
+        )
+        agreement = next_agreement(agreement, aux)
+    # the number of consecutive latest blocks attaching the same proposal
+    latest = proposals[-1] if proposals else None
+    consecutive = 0
+    for proposal in reversed(proposals):
+        if proposal != latest:
+            break
+        consecutive += 1
+    if latest is None:
+        assert agreement == UpgradeAgreement(b"", 0)
+    else:
+        assert agreement == UpgradeAgreement(latest, consecutive)
+
+
+def test_next_agreement_inline_proposal():
+    proposal = ChainUpgradeProposal(Nothing(), Nothing(), Nothing(), Nothing())
+    proposal_hash = datum_hash(proposal).payload
+    agreement = next_agreement(
+        UpgradeAgreement(b"", 0), SomeOutputDatumHash(datum_hash=proposal_hash)
+    )
+    # attaching the proposal inline or by hash counts the same
+    assert next_agreement(agreement, SomeOutputDatum(proposal)) == UpgradeAgreement(
+        proposal_hash, 2
+    )
@@ -0,0 +1,124 @@
+from types import SimpleNamespace
+
+import pytest
+from blockfrost import ApiError, BlockFrostApi
+from pycardano import (
+    Address,
+    Network,
+    ScriptHash,
+    TransactionInput,
+    TransactionOutput,
+    UTxO,
+    VerificationKeyHash,
+)
+
+from steak_protocol.utils.backends import (
+    BlockFrostBackend,
+    ChainBackend,
+    KupoQueries,
+    LedgerBackend,
+    address_pattern,
+)
+from steak_protocol.utils.datums import DatumResolver
+
+SCRIPT = ScriptHash(b"\x01" * 28)
+STAKE_A = VerificationKeyHash(b"\x02" * 28)
+STAKE_B = VerificationKeyHash(b"\x03" * 28)
+
+
+def utxo(index: int, address: Address) -> UTxO:
+    return UTxO(
+        TransactionInput.from_primitive([bytes(32).hex(), index]),
+        TransactionOutput(address, 2_000_000),
+    )
+
+
+def test_ledger_pattern_query():
+    ledger = LedgerBackend(None, None, network=Network.TESTNET)
+    a = Address(SCRIPT, STAKE_A, network=Network.TESTNET)
+    b = Address(SCRIPT, STAKE_B, network=Network.TESTNET)
+    other = Address(VerificationKeyHash(b"\x04" * 28), network=Network.TESTNET)
+    for i, address in enumerate([a, b, b, other]):
+        ledger.add_utxo(utxo(i, address))
+
+    assert ledger.supports_address_patterns
+    assert len(ledger.utxos_by_pattern(address_pattern(SCRIPT))) == 3
+    assert len(ledger.utxos_by_pattern(address_pattern(SCRIPT, STAKE_B))) == 2
+    assert len(ledger.utxos(b)) == 2
+
+    ledger.remove_utxo(TransactionInput.from_primitive([bytes(32).hex(), 1]))
+    assert len(ledger.utxos_many([a, b])[str(b)]) == 1
+
+
+class FakeKupo(KupoQueries):
+    def __init__(self, matches):
+        self.matches = matches
+        self.requests = []
+        self._init_kupo(
+            "http://kupo",
+            DatumResolver(lambda h: bytes.fromhex("d87980")),
+        )
+
+    def _kupo_get(self, path: str):
+        self.requests.append(path)
+        return self.matches
+
+
+def test_kupo_matches_to_utxos():
+    address = Address(SCRIPT, STAKE_A, network=Network.TESTNET)
+    match = {
+        "transaction_id": bytes(32).hex(),
+        "output_index": 0,
+        "address": str(address),
+        "value": {"coins": 2_000_000, "assets": {f"{bytes(28).hex()}.01": 5}},
+        "datum_hash": bytes(32).hex(),
+        "datum_type": "inline",
+        "script_hash": None,
+        "spent_at": None,
+    }
+    kupo = FakeKupo([match, dict(match, output_index=1, datum="00")])
+    utxos = kupo.utxos_by_pattern(address_pattern(SCRIPT))
+    assert kupo.requests == [
+        f"/matches/{SCRIPT.payload.hex()}/*?unspent&resolve_hashes"
+    ]
+    assert [u.output.datum.cbor for u in utxos] == [b"\x00", b"\x00"]
+    assert utxos[0].output.amount.multi_asset.count(lambda p, n, a: a == 5) == 1
+
+
+def test_incomplete_backend_can_not_be_created():
+    class PatternsOnly(ChainBackend):
+        def utxos_by_pattern(self, pattern: str):
+            return []
+
+    with pytest.raises(TypeError):
+        PatternsOnly()
+
+
+def test_blockfrost_resolves_datums(monkeypatch):
+    datums = {"aa": "d87980"}
+    fetched = []
+
+    def script_datum_cbor(self, datum_hash, **kwargs):
+        fetched.append(datum_hash)
+        if datum_hash not in datums:
+            raise ApiError(
+                SimpleNamespace(
+                    json=lambda: {
+                        "status_code": 404,
+                        "error": "Not Found",
+                        "message": "The requested component has not been found.",
+                    }
+                )
+            )
+        return SimpleNamespace(cbor=datums[datum_hash])
+
+    monkeypatch.setattr(BlockFrostApi, "epoch_latest", lambda self, **kwargs: None)
+    monkeypatch.setattr(BlockFrostApi, "script_datum_cbor", script_datum_cbor)
+    backend = BlockFrostBackend("project")
+    assert not backend.supports_address_patterns
+    resolved = backend.resolve_datums(["aa", "bb"])
+    assert resolved["aa"].cbor == bytes.fromhex("d87980")
+    assert resolved["bb"] is None
+    # known datums are cached
+    backend.resolve_datums(["aa"])
+    assert sorted(fetched) == ["aa", "bb"]
@@ -0,0 +1,168 @@
+import asyncio
+from hashlib import sha256
+
+import httpx
+import numpy as np
+import pytest
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+
+from steak_protocol.api.beacon_client import BeaconClient
+from steak_protocol.api.index import open_state_index
+from steak_protocol.api.server import create_app, tip_key_builder
+from steak_protocol.onchain.types import StakeChainV1State
+from steak_protocol.utils import block_index
+from steak_protocol.onchain.types import ProducerState
+from steak_protocol.utils.beacon import (
+    BeaconVerificationError,
+    TrustedBlock,
+    verify_records,
+)
+from steak_protocol.utils.history import History, block_hash, sync_from_index
+from test.offchain.util import honest_history
+
+
+@pytest.fixture
+def indexed_history(tmp_path):
+    history = honest_history()
+    block_index.open_index(tmp_path.joinpath("index.db"))
+    for record in history.records:
+        block_index.add_state(
+            StakeChainV1State.from_cbor(record.state),
+            record.transaction_id,
+            record.output_index,
+        )
+    return history
+
+
+def test_beacon_file(tmp_path, indexed_history):
+    history = History(tmp_path.joinpath("history"))
+    assert sync_from_index(history) == 40
+    assert sync_from_index(history) == 0
+    # reopening maps the same records
+    beacon = History(tmp_path.joinpath("history")).blocks
+    assert len(beacon) == 40
+    # blocks are mined every 3 slots
+    assert int(beacon.at_slot(7)["block_number"]) == 2
+    assert int(beacon.at_slot(9)["block_number"]) == 3
+    assert int(beacon.at_slot(10**9)["block_number"]) == 39
+    assert [int(r["block_number"]) for r in beacon.between_slots(7, 12)] == [
+        2,
+        3,
+        4,
+    ]
+    with pytest.raises(AssertionError):
+        beacon.append(beacon.records[:1])
+
+    producer_states = [
+        bytes(block_index.block_by_number(i).producer_state) for i in range(40)
+    ]
+    records = np.array(beacon.records)
+    tip = TrustedBlock.from_state(
+        StakeChainV1State.from_cbor(indexed_history.records[-1].state)
+    )
+    verify_records(records, producer_states, tip)
+    # a prefix can be verified against any later block
+    verify_records(
+        records[:10],
+        producer_states[:10],
+        TrustedBlock.from_state(
+            StakeChainV1State.from_cbor(block_index.block_by_number(9).state)
+        ),
+    )
+    with pytest.raises(BeaconVerificationError) as e:
+        verify_records(records[:10], producer_states[:10], tip)
+    assert e.value.reason == "anchor is not trusted"
+
+    forged = np.array(records)
+    forged[20]["block_hash"][0] ^= 1
+    with pytest.raises(BeaconVerificationError) as e:
+        verify_records(forged, producer_states, tip)
+    assert e.value.block_number == 20
+
+    # a forged middle record with a consistent producer state and chosen slot
+    forged = np.array(records)
+    forged_producer_states = list(producer_states)
+    producer_state = ProducerState.from_cbor(producer_states[20])
+    producer_state.producer_signature = bytes(32)
+    forged_producer_states[20] = producer_state.to_cbor()
+    forged[20]["producer_state_hash"] = np.frombuffer(
+        sha256(forged_producer_states[20]).digest(), dtype=np.uint8
+    )
+    forged[20]["slot_number"] += 1
+    with pytest.raises(BeaconVerificationError) as e:
+        verify_records(forged, forged_producer_states, tip)
+    assert (e.value.block_number, e.value.reason) == (20, "producer state not linked")
+
+    # forged records following the trusted block are not accepted either
+    forged = np.concatenate([records, records[-1:]])
+    forged[-1]["block_number"] += 1
+    forged[-1]["slot_number"] = 999999
+    with pytest.raises(BeaconVerificationError) as e:
+        verify_records(forged, producer_states + producer_states[-1:], tip)
+    assert e.value.reason == "anchor is not trusted"
+
+
+def test_beacon_client(tmp_path, indexed_history):
+    history_path = tmp_path.joinpath("history")
+    sync_from_index(History(history_path))
+    app = create_app(history_path=str(history_path))
+    open_state_index(tmp_path.joinpath("index.db"))
+    FastAPICache.init(InMemoryBackend(), key_builder=tip_key_builder)
+
+    def get(path, params):
+        async def request():
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app), base_url="http://test"
+            ) as client:
+                response = await client.get(path, params=params)
+                response.raise_for_status()
+                return response.json()
+
+        return asyncio.run(request())
+
+    tip = TrustedBlock.from_state(
+        StakeChainV1State.from_cbor(indexed_history.records[-1].state)
+    )
+    client = BeaconClient(tip, get=get)
+    slot, block_number, value = client.value_at(10)
+    assert (slot, block_number) == (9, 3)
+    assert value == block_hash(History(history_path).blocks.records[3])
+    assert [v[1] for v in client.values_between(7, 30)] == list(range(2, 11))
+    assert client.value_at(0)[1] == 0
+
+    untrusted = BeaconClient(TrustedBlock(39, bytes(32), bytes(32)), get=get)
+    with pytest.raises(BeaconVerificationError):
+        untrusted.value_at(10)
+
+    # verified values for other slots than the requested ones are rejected
+    def get_later(path, params):
+        if path.startswith("/beacon/slot/"):
+            return get("/beacon/slot/30", params)
+        return get(path, dict(params, from_slot=params["from_slot"] + 3))
+
+    lying = BeaconClient(tip, get=get_later)
+    with pytest.raises(BeaconVerificationError) as e:
+        lying.value_at(10)
+    assert e.value.reason == "value not valid at slot 10"
+    with pytest.raises(BeaconVerificationError):
+        lying.values_between(7, 30)
+
+    def get_earlier(path, params):
+        if path.startswith("/beacon/slot/"):
+            return get("/beacon/slot/4", params)
+        return get(path, dict(params, to_slot=params["to_slot"] - 3))
+
+    lying = BeaconClient(tip, get=get_earlier)
+    with pytest.raises(BeaconVerificationError) as e:
+        lying.value_at(10)
+    assert e.value.reason == "values do not cover slot 10"
+    with pytest.raises(BeaconVerificationError) as e:
+        lying.values_between(7, 30)
+    assert e.value.reason == "values do not cover slot 30"
+
+    # producer states missing from the index are not served
+    block_index.Block.delete().where(block_index.Block.block_number == 20).execute()
+    with pytest.raises(httpx.HTTPStatusError) as e:
+        client.value_at(12)
+    assert e.value.response.status_code == 503
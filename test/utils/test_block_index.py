@@ -0,0 +1,97 @@
+from types import SimpleNamespace
+
+from opshin.prelude import Token
+from opshin.std.builtins import blake2b_256, sha2_256
+
+from steak_protocol.utils import block_index
+from steak_protocol.utils.datums import DatumResolver
+from test.offchain.util import make_chain
+
+
+def test_agreeing_producer_states(tmp_path):
+    block_index.open_index(tmp_path / "index.db")
+    proposal = b"\xaa" * 32
+    states = make_chain([None, proposal, b"\xbb" * 32] + [proposal] * 4)
+    for i, state in enumerate(states):
+        assert block_index.add_state(state, bytes([i]) * 32, 0)
+    # re-adding the same block (i.e. after a holder update) is a no-op
+    assert not block_index.add_state(states[-1], b"\xff" * 32, 1)
+
+    agreeing = block_index.producer_states_agreeing_on(proposal, 7)
+    assert agreeing == [s.producer_state for s in reversed(states[3:])]
+    assert len(block_index.producer_states_agreeing_on(proposal, 2)) == 2
+    assert block_index.producer_states_agreeing_on(proposal, 3, up_to_block=2) == []
+    assert block_index.producer_states_agreeing_on(proposal, 3, up_to_block=1) == [
+        states[1].producer_state
+    ]
+    assert (
+        block_index.block_by_prev_producer_state_hash(
+            sha2_256(states[3].producer_state.to_cbor())
+        ).block_number
+        == 4
+    )
+    assert block_index.latest_block().block_number == 6
+
+
+def test_rollback_and_chains(tmp_path):
+    block_index.open_index(tmp_path / "index.db")
+    states = make_chain([None] * 5)
+    for i, state in enumerate(states):
+        assert block_index.add_state(state, bytes([i]) * 32, 0)
+    # a fork from block 2 on replaces the stored block 2 and drops its successors
+    fork = make_chain([None, None, b"\xcc" * 32, None])
+    assert block_index.add_state(fork[2], b"\xfe" * 32, 0)
+    assert block_index.latest_block().block_number == 2
+    assert bytes(block_index.block_by_number(2).transaction_id) == b"\xfe" * 32
+    assert bytes(block_index.block_by_number(1).transaction_id) == bytes([1]) * 32
+    assert block_index.add_state(fork[3], b"\xfd" * 32, 0)
+    assert block_index.latest_block().block_number == 3
+
+    # the blocks of other chains are kept apart
+    other = block_index.chain_key(Token(bytes(28), b"other"))
+    for i, state in enumerate(states):
+        assert block_index.add_state(state, bytes([i]) * 32, 0, other)
+    assert block_index.latest_block(b"").block_number == 3
+    assert block_index.latest_block(other).block_number == 4
+    assert (
+        bytes(block_index.block_by_number(2, other).transaction_id) == bytes([2]) * 32
+    )
+    assert bytes(block_index.block_by_number(2, b"").transaction_id) == b"\xfe" * 32
+
+
+def test_sync_from_kupo_unresolved_datum(tmp_path, monkeypatch):
+    block_index.open_index(tmp_path / "index.db")
+    states = make_chain([None] * 4)
+    auth_nft = Token(bytes(28), b"chain")
+    asset = f"{auth_nft.policy_id.hex()}.{auth_nft.token_name.hex()}"
+    datums = {blake2b_256(s.to_cbor()).hex(): s.to_cbor() for s in states}
+    matches = [
+        {
+            "transaction_id": bytes([i]).hex() * 32,
+            "output_index": 0,
+            "value": {"coins": 2_000_000, "assets": {asset: 1}},
+            "datum_hash": blake2b_256(s.to_cbor()).hex(),
+            # the datum of the third block is not known to the indexer yet
+            "datum": None,
+            "created_at": {"slot_no": 10 * (i + 1)},
+        }
+        for i, s in enumerate(states)
+    ]
+    urls = []
+
+    def get(url):
+        urls.append(url)
+        slot = int(url.split("created_after=")[1]) if "created_after" in url else 0
+        return SimpleNamespace(
+            json=lambda: [m for m in matches if m["created_at"]["slot_no"] > slot]
+        )
+
+    monkeypatch.setattr(block_index.requests, "get", get)
+    unknown = {matches[2]["datum_hash"]}
+    resolver = DatumResolver(lambda h: None if h in unknown else datums[h])
+    assert block_index.sync_from_kupo("http://kupo", "chain", auth_nft, resolver) == 3
+    # the unresolved block is fetched again once its datum is known
+    unknown.clear()
+    assert block_index.sync_from_kupo("http://kupo", "chain", auth_nft, resolver) == 1
+    assert urls[-1].endswith("created_after=20")
+    assert block_index.latest_block().block_number == 3
@@ -0,0 +1,73 @@
+import threading
+import time
+
+from steak_protocol.utils.datums import DatumResolver
+
+
+def test_lru_eviction():
+    fetched = []
+
+    def fetch(datum_hash):
+        fetched.append(datum_hash)
+        return datum_hash.encode()
+
+    resolver = DatumResolver(fetch, maxsize=2)
+    assert resolver.resolve("a").cbor == b"a"
+    resolver.resolve("b")
+    # a is now the most recently used
+    resolver.resolve("a")
+    resolver.resolve("c")
+    assert len(resolver) == 2
+    resolver.resolve("a")
+    resolver.resolve("b")
+    assert fetched == ["a", "b", "c", "b"]
+
+
+def test_unknown_datum_not_cached():
+    fetched = []
+
+    def fetch(datum_hash):
+        fetched.append(datum_hash)
+        return None
+
+    resolver = DatumResolver(fetch)
+    assert resolver.resolve("a") is None
+    assert resolver.resolve("a") is None
+    assert fetched == ["a", "a"]
+
+
+def test_concurrent_requests_deduplicated():
+    calls = []
+
+    def fetch_many(datum_hashes):
+        calls.append(datum_hashes)
+        time.sleep(0.1)
+        return {h: h.encode() for h in datum_hashes}
+
+    resolver = DatumResolver(lambda h: None, fetch_many=fetch_many)
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(resolver.resolve_many(["a", "b"]))
+        )
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(len(c) for c in calls) == 2
+    assert all(r["a"].cbor == b"a" and r["b"].cbor == b"b" for r in results)
+
+
+def test_persisted_across_instances(tmp_path):
+    path = tmp_path / "datums"
+    resolver = DatumResolver(lambda h: h.encode(), persist_path=path)
+    resolver.resolve("a")
+    resolver.prime("b", "00")
+    resolver.close()
+
+    resolver = DatumResolver(lambda h: None, persist_path=path)
+    assert resolver.resolve("a").cbor == b"a"
+    assert resolver.resolve("b").cbor == b"\x00"
+    resolver.close()
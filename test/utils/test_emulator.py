@@ -0,0 +1,129 @@
+from pathlib import Path
+
+import pytest
+from opshin.builder import build
+from pycardano import (
+    Address,
+    Redeemer,
+    Transaction,
+    TransactionBody,
+    TransactionBuilder,
+    TransactionFailedException,
+    TransactionOutput,
+    TransactionWitnessSet,
+    plutus_script_hash,
+)
+
+from steak_protocol.offchain.stakechain.mine import (
+    compute_current_slot,
+    compute_validity_interval,
+)
+from steak_protocol.utils.clock import VirtualClock
+from steak_protocol.utils.emulator import DEFAULT_GENESIS_PARAMETERS, EmulatorBackend
+from steak_protocol.utils.to_script_context import (
+    sorted_inputs,
+    to_address,
+    to_tx_info,
+    to_tx_out_ref,
+)
+from test.offchain.util import new_wallet
+
+AIRDROP_CONTRACT = Path(__file__).parent.parent.parent.joinpath(
+    "steak_protocol", "onchain", "airdrop.py"
+)
+
+
+def test_transfer():
+    context = EmulatorBackend()
+    skey, _, address = new_wallet(context)
+    _, _, receiver = new_wallet(context)
+    context.fund(address, 10_000_000)
+
+    builder = TransactionBuilder(context)
+    builder.add_input_address(address)
+    builder.add_output(TransactionOutput(receiver, 3_000_000))
+    tx = builder.build_and_sign([skey], change_address=address)
+    context.submit_tx(tx)
+
+    assert [u.output.amount.coin for u in context.utxos(receiver)] == [3_000_000]
+    assert sum(u.output.amount.coin for u in context.utxos(address)) == (
+        7_000_000 - tx.transaction_body.fee
+    )
+    # the input is spent now
+    with pytest.raises(TransactionFailedException):
+        context.submit_tx(tx)
+
+
+def test_script_validity_range():
+    context = EmulatorBackend()
+    skey, vkey, address = new_wallet(context)
+    context.fund(address, 100_000_000)
+    expiry_slot = 100
+    airdrop_script = build(
+        str(AIRDROP_CONTRACT),
+        to_address(address),
+        vkey.hash().payload,
+        context.slot_to_posix(expiry_slot),
+    )
+    airdrop_address = Address(
+        plutus_script_hash(airdrop_script), network=context.network
+    )
+    context.fund(airdrop_address, 5_000_000, datum=vkey.hash().payload)
+
+    def close():
+        (airdrop_utxo,) = context.utxos(airdrop_address)
+        builder = TransactionBuilder(context)
+        builder.add_input_address(address)
+        builder.add_script_input(airdrop_utxo, airdrop_script, None, Redeemer(-1))
+        builder.required_signers = [vkey.hash()]
+        builder.validity_start = context.last_block_slot
+        builder.ttl = context.last_block_slot + 10
+        return builder.build_and_sign([skey], change_address=address)
+
+    # the contract has not yet expired, so already building fails in evaluation
+    with pytest.raises(TransactionFailedException):
+        close()
+    context.wait(expiry_slot)
+    context.submit_tx(close())
+    assert context.utxos(airdrop_address) == []
+
+
+def test_shared_virtual_clock():
+    clock = VirtualClock(DEFAULT_GENESIS_PARAMETERS.system_start * 1000)
+    context = EmulatorBackend(clock=clock)
+    genesis_time, slot_length = clock.now(), 60 * 1000
+
+    assert compute_current_slot(genesis_time, slot_length, clock) == 0
+    # an hour passes instantly
+    clock.sleep(3600)
+    assert context.last_block_slot == 3600
+    assert compute_current_slot(genesis_time, slot_length, clock) == 60
+    context.wait(60)
+    lower, upper = compute_validity_interval(genesis_time, slot_length, clock)
+    assert (lower, upper) == (
+        genesis_time + 61 * slot_length,
+        genesis_time + 62 * slot_length,
+    )
+
+
+def test_tx_info_of_unsorted_inputs():
+    context = EmulatorBackend()
+    skey, _, address = new_wallet(context)
+    utxos = [context.fund(address, 5_000_000) for _ in range(3)]
+    utxos.sort(key=lambda u: u.input.transaction_id.payload, reverse=True)
+    tx = Transaction(
+        TransactionBody(
+            inputs=[u.input for u in utxos],
+            outputs=[TransactionOutput(address, 14_000_000)],
+            fee=1_000_000,
+        ),
+        TransactionWitnessSet(),
+    )
+    tx_info = to_tx_info(tx, [u.output for u in utxos], [], tx_id=bytes(32))
+    # the scripts see the inputs in the order of the ledger and the id of the submitted body
+    assert [i.out_ref for i in tx_info.inputs] == [
+        to_tx_out_ref(i) for i in sorted_inputs(tx.transaction_body.inputs)
+    ]
+    assert tx_info.id.tx_id == bytes(32)
+    # the transaction itself is not touched
+    assert tx.transaction_body.inputs == [u.input for u in utxos]
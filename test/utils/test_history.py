@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from steak_protocol.onchain.types import StakeChainV1State
+from steak_protocol.utils.history import (
+    HEADER_SIZE,
+    OP_INSERT,
+    OP_REMOVE,
+    OP_SET_WEIGHT,
+    History,
+    apply_holder_deltas,
+    broken_links,
+    core_chain_state,
+    holder_deltas,
+)
+from test.offchain.util import honest_history
+
+
+def test_holder_deltas():
+    prev = ([b"a", b"b", b"c"], [1, 2, 3])
+    new = ([b"d", b"a", b"c"], [4, 1, 5])
+    deltas = holder_deltas(prev, new, 7)
+    assert sorted(int(d["op"]) for d in deltas) == [
+        OP_SET_WEIGHT,
+        OP_INSERT,
+        OP_REMOVE,
+    ]
+    assert all(int(d["block_number"]) == 7 for d in deltas)
+    assert apply_holder_deltas(prev, np.array(deltas)) == new
+    assert holder_deltas(new, new, 7) == []
+
+
+def test_history(tmp_path):
+    records = honest_history().records
+    states = [StakeChainV1State.from_cbor(r.state) for r in records]
+    # a holder leaves after block 21
+    states.insert(25, StakeChainV1State.from_cbor(records[24].state))
+    del states[25].holder_state.stake_holder_ids[1]
+    del states[25].holder_state.stake_holder_weights[1]
+    for state in states[26:]:
+        del state.holder_state.stake_holder_ids[1]
+        del state.holder_state.stake_holder_weights[1]
+
+    history = History(tmp_path)
+    assert history.add_states(states[:30]) == 26
+    # replaying all states resumes after the last stored block
+    history = History(tmp_path)
+    assert history.add_states(states) == 14
+
+    blocks = history.blocks.records
+    assert len(blocks) == 40
+    assert len(broken_links(blocks)) == 0
+    first_of_block = {}
+    for state in states:
+        first_of_block.setdefault(state.chain_state.block_number, state)
+    for i in (0, 10, 21, 22, 39):
+        state = first_of_block[i]
+        assert core_chain_state(blocks[i]) == state.chain_state
+        assert history.holders_at(i) == (
+            state.holder_state.stake_holder_ids,
+            state.holder_state.stake_holder_weights,
+        )
+    assert history.holders() == (
+        states[-1].holder_state.stake_holder_ids,
+        states[-1].holder_state.stake_holder_weights,
+    )
+
+    tampered = np.array(blocks)
+    tampered[12]["prev_producer_state_hash"][0] ^= 1
+    assert list(broken_links(tampered)) == [12]
+    with pytest.raises(AssertionError):
+        history.blocks.append(blocks[:1])
+
+
+def test_history_interrupted_write(tmp_path):
+    states = [StakeChainV1State.from_cbor(r.state) for r in honest_history().records]
+    history = History(tmp_path)
+    history.add_states(states[:10])
+    complete = history.blocks.records.copy()
+    # a write interrupted in the middle of a record
+    with open(history.blocks.path, "ab") as f:
+        f.write(complete[-1].tobytes()[:20])
+
+    history = History(tmp_path)
+    assert np.array_equal(history.blocks.records, complete)
+    assert history.add_states(states) > 0
+    blocks = history.blocks.records
+    assert np.array_equal(blocks[: len(complete)], complete)
+    assert len(broken_links(blocks)) == 0
+    assert history.blocks.path.stat().st_size == (
+        HEADER_SIZE + len(blocks) * blocks.dtype.itemsize
+    )
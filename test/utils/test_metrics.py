@@ -0,0 +1,71 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from steak_protocol.offchain.stakechain.mine import (
+    LEADER_SLOTS,
+    MISSED_SLOTS,
+    LeaderSlotTracker,
+)
+from steak_protocol.utils.metrics import Registry, serve
+
+
+def test_exposition():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ["outcome"])
+    depth = registry.gauge("queue_depth", "Queue depth")
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    requests.inc(outcome="ok")
+    requests.inc(2, outcome="ok")
+    requests.inc(outcome="error")
+    depth.set(7)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+    assert registry.counter("requests_total", "Requests", ["outcome"]) is requests
+    with pytest.raises(AssertionError):
+        requests.inc(outcome="ok", stage="submit")
+
+    text = registry.to_prometheus()
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{outcome="ok"} 3' in text
+    assert 'requests_total{outcome="error"} 1' in text
+    assert "queue_depth 7" in text
+    assert 'latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{le="1.0"} 2' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in text
+    assert "latency_seconds_count 3" in text
+
+
+def test_serve():
+    registry = Registry()
+    registry.counter("blocks_total", "Blocks").inc()
+    server = serve(0, registry=registry)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.status == 200
+            assert "blocks_total 1" in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_leader_slot_tracker():
+    leader_slots, missed_slots = LEADER_SLOTS.value(), MISSED_SLOTS.value()
+    tracker = LeaderSlotTracker()
+    # elected in slot 1, mined on the second try
+    tracker.observe(1, True, False)
+    tracker.observe(1, True, True)
+    # not elected in slot 2
+    tracker.observe(2, False, False)
+    # elected in slot 3 but never mined
+    tracker.observe(3, True, False)
+    tracker.observe(3, True, False)
+    assert MISSED_SLOTS.value() == missed_slots
+    tracker.observe(4, False, False)
+    assert LEADER_SLOTS.value() - leader_slots == 2
+    assert MISSED_SLOTS.value() - missed_slots == 1
@@ -0,0 +1,53 @@
+import json
+import time
+
+from steak_protocol.utils.profiling import Profiler
+
+
+def test_disabled_records_nothing():
+    profiler = Profiler(enabled=False)
+    with profiler.span("a"):
+        pass
+    assert profiler.histograms == {}
+
+
+def test_spans_and_export(tmp_path):
+    profiler = Profiler(enabled=True)
+
+    @profiler.timed("sleep")
+    def sleep():
+        time.sleep(0.002)
+
+    for _ in range(3):
+        sleep()
+    with profiler.span("fast"):
+        pass
+
+    histogram = profiler.histograms["sleep"]
+    assert histogram.count == 3
+    assert 0.006 <= histogram.sum < 1
+    assert dict(histogram.cumulative_counts())[0.001] == 0
+    assert dict(histogram.cumulative_counts())[float("inf")] == 3
+
+    prometheus = profiler.to_prometheus()
+    assert 'steak_span_seconds_bucket{span="sleep",le="+Inf"} 3' in prometheus
+    assert 'steak_span_seconds_count{span="fast"} 1' in prometheus
+
+    jsonl = tmp_path.joinpath("spans.jsonl")
+    profiler.export(jsonl)
+    profiler.export(jsonl)
+    lines = jsonl.read_text().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0])["spans"]["sleep"]["count"] == 3
+
+
+def test_operation_cprofile(tmp_path):
+    profiler = Profiler(
+        enabled=True,
+        export_path=tmp_path.joinpath("spans.prom"),
+        cprofile_dir=tmp_path.joinpath("profiles"),
+    )
+    with profiler.operation("mine"):
+        sum(range(1000))
+    assert len(list(tmp_path.joinpath("profiles").glob("mine-*.prof"))) == 1
+    assert 'span="mine"' in tmp_path.joinpath("spans.prom").read_text()